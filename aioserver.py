@@ -0,0 +1,892 @@
+"""
+Production HTTP/1.1 server for the MK Cloud WSGI app, built on asyncio.
+
+Connections live on one event loop, so an idle or slow client costs a socket and
+a little memory instead of a thread:
+
+- Small request bodies (up to body_memory_max bytes) are read asynchronously
+  into memory before the app is called, so a slow client sending a form never
+  holds a worker thread. Larger and chunked bodies are streamed: the app reads
+  them straight off the connection (StreamingBody), so uploads reach the disk
+  once, without a spool copy, at the cost of a worker thread while they last.
+- The WSGI app and each step of its response iterator run on a bounded app
+  executor; the event loop writes the chunks with backpressure, so slow
+  downloaders don't hold a thread either.
+- File bodies returned through wsgi.file_wrapper are sent with sendfile().
+- A response iterator may yield a `Suspend` (offered as environ['mkcloud.suspend'])
+  to park on the event loop until something happens, instead of sleeping in a
+  worker thread; the change feed uses this for its long-lived streams.
+- An optional BandwidthScheduler paces large response bodies: token buckets per
+  client and for the whole server, shared fairly (by weight) between the streams
+  in progress, while small responses skip the queue.
+
+serve_prefork() runs several such servers in forked worker processes that share
+the port through SO_REUSEPORT, to use more than one CPU core.
+"""
+import asyncio
+import contextvars
+import heapq
+import io
+import itertools
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_to_bytes
+from werkzeug.http import http_date
+
+log = logging.getLogger('aioserver')
+
+SERVER_SOFTWARE = 'mkcloud-aioserver'
+MAX_HEADER_BYTES = 64 * 1024
+READ_BUFSIZE = 256 * 1024
+BODY_READ_SIZE = 1024 * 1024  # Body bytes gathered per read() when the app reads to the end
+UNREAD_BODY_MAX = 1024 * 1024  # Body bytes the app left unread that are skipped to keep the connection
+KEEPALIVE_TIMEOUT = 75  # Idle seconds before a keep-alive connection is closed
+READ_TIMEOUT = 120  # Seconds a client may stall while sending headers or a body
+SHUTDOWN_GRACE = 10  # Seconds responses in progress get to finish when the server stops
+
+REASONS = {
+    400: 'Bad Request', 408: 'Request Timeout', 411: 'Length Required',
+    413: 'Content Too Large', 431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error', 501: 'Not Implemented', 505: 'HTTP Version Not Supported',
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class FileWrapper:
+    """
+    wsgi.file_wrapper: marks a body as "this file from its current position", so the
+    server can sendfile() Content-Length bytes instead of iterating over it.
+    """
+
+    def __init__(self, file, blocksize=READ_BUFSIZE):
+        self.file = file
+        self.blocksize = blocksize
+
+    def __iter__(self):
+        while True:
+            block = self.file.read(self.blocksize)
+            if not block:
+                break
+            yield block
+
+    def close(self):
+        self.file.close()
+
+
+class Suspend:
+    """
+    Yielded by a response iterator to wait on the event loop. `subscribe(callback)`
+    must arrange for callback() to be called (from any thread) when the iterator
+    should resume, and return a function that cancels the subscription. The
+    iterator is resumed after the callback fires or `timeout` seconds pass.
+    """
+
+    def __init__(self, subscribe, timeout):
+        self.subscribe = subscribe
+        self.timeout = timeout
+
+
+class StreamingBody:
+    """
+    wsgi.input for a body the app reads straight off the connection: read() runs
+    on an app thread and waits for the event loop to receive the bytes, so an
+    upload goes from the socket to wherever the app writes it in one pass.
+    Decodes chunked transfer coding (length=None) and enforces max_size.
+    """
+
+    def __init__(self, loop, reader, length, max_size=None):
+        self.loop = loop
+        self.reader = reader
+        self.chunked = length is None
+        self.remaining = 0 if self.chunked else length  # bytes left of the body, or of the current chunk
+        self.max_size = max_size
+        self.size = 0
+        self.done = length == 0
+        self.failed = False
+        self._buffer = b''  # read ahead by readline()
+
+    async def _next_chunk(self):
+        line = await asyncio.wait_for(self.reader.readuntil(b'\r\n'), READ_TIMEOUT)
+        try:
+            size = int(line.split(b';', 1)[0], 16)
+        except ValueError:
+            raise HTTPError(400)
+        if size == 0:
+            # Skip any trailer fields
+            while await asyncio.wait_for(self.reader.readuntil(b'\r\n'), READ_TIMEOUT) != b'\r\n':
+                pass
+            self.done = True
+        elif self.max_size is not None and self.size + size > self.max_size:
+            raise HTTPError(413)
+        self.remaining = size
+
+    async def receive(self, size):
+        """
+        Up to size bytes of the body (fewer only at its end); b'' once it is over.
+        """
+        parts = []
+        while size > 0 and not self.done:
+            if self.chunked and not self.remaining:
+                await self._next_chunk()
+                continue
+            data = await asyncio.wait_for(self.reader.read(min(size, self.remaining, READ_BUFSIZE)), READ_TIMEOUT)
+            if not data:
+                raise ConnectionResetError('Client disconnected in the middle of the request body')
+            parts.append(data)
+            size -= len(data)
+            self.size += len(data)
+            self.remaining -= len(data)
+            if not self.remaining:
+                if not self.chunked:
+                    self.done = True
+                elif await asyncio.wait_for(self.reader.readexactly(2), READ_TIMEOUT) != b'\r\n':
+                    raise HTTPError(400)
+        return b''.join(parts)
+
+    def _call(self, size):
+        if self.failed:
+            raise ConnectionResetError('Request body is unusable after an earlier error')
+        try:
+            return asyncio.run_coroutine_threadsafe(self.receive(size), self.loop).result()
+        except BaseException:
+            self.failed = True  # The connection is out of step with the body: it won't be reused
+            raise
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._buffer]
+            self._buffer = b''
+            while True:
+                data = self._call(BODY_READ_SIZE)
+                if not data:
+                    return b''.join(parts)
+                parts.append(data)
+        if self._buffer:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            return data
+        return self._call(size)
+
+    def readline(self, size=-1):
+        while True:
+            end = self._buffer.find(b'\n') + 1
+            if end or 0 <= size <= len(self._buffer):
+                end = min(end or len(self._buffer), size) if size >= 0 else end
+                line, self._buffer = self._buffer[:end], self._buffer[end:]
+                return line
+            data = self._call(READ_BUFSIZE)
+            if not data:
+                line, self._buffer = self._buffer, b''
+                return line
+            self._buffer += data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def close(self):
+        pass
+
+    async def discard_rest(self, limit):
+        """
+        Reads and drops what the app left unread, up to limit bytes. Returns
+        whether the connection is at the start of the next request.
+        """
+        if self.failed:
+            return False
+        try:
+            while not self.done and limit > 0:
+                limit -= len(await self.receive(min(limit, READ_BUFSIZE)))
+        except (HTTPError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return False
+        return self.done
+
+
+# --- Bandwidth Scheduling ---
+TRANSFER_BURST = 0.25  # seconds of tokens a bucket holds when idle
+TRANSFER_PRUNE_INTERVAL = 1.0  # seconds between sweeps of idle client buckets
+
+
+class TokenBucket:
+    """
+    Refills at `rate` bytes per second up to `burst`. reserve() may take more
+    tokens than there are; the caller then waits out the debt.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def reserve(self, nbytes):
+        """
+        Takes nbytes tokens; returns the seconds until they are paid for.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - nbytes
+        self.stamp = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def full(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class TransferStream:
+    """
+    One response body going through the scheduler.
+    """
+
+    def __init__(self, client, lane, weight, bucket):
+        self.client = client
+        self.lane = lane
+        self.weight = weight
+        self.bucket = bucket  # the client's TokenBucket, or None
+        self.finish = 0.0  # virtual time at which its last slice is due
+
+
+class BandwidthScheduler:
+    """
+    Paces response bodies on the event loop. Every write first waits for its
+    client's token bucket (`client_rate` bytes/s), whatever the lane. Responses
+    are sorted into lanes: 'interactive' ones (no length, or at most
+    `interactive_max` bytes, unless the app sets environ['mkcloud.transfer_lane'])
+    then go out at once, though their bytes still count against the server-wide
+    limit. Other bodies go out in slices of `slice_size` bytes, each taking its
+    turn at the server-wide bucket (`rate` bytes/s) in self-clocked fair queueing
+    order, which gives every active stream a share of `rate` proportional to its
+    lane's weight. A rate of 0 means no limit. Bodies of `bulk_min` bytes or more
+    are 'bulk', the rest 'normal'.
+
+    A client's bucket outlives its connections until it has refilled, so
+    reconnecting doesn't reset it. When several processes serve the same clients,
+    set_client_shares() gives each process's bucket its part of `client_rate`.
+    Scheduling runs on the event loop thread; the lock guards the stream and
+    client tables against stats() and the share updates, which come from other
+    threads.
+    """
+
+    LANES = ('interactive', 'normal', 'bulk')
+
+    def __init__(self, rate=0, client_rate=0, weights=None, interactive_max=256 * 1024,
+                 bulk_min=16 * 1024 * 1024, slice_size=256 * 1024):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.weights = dict({'normal': 4, 'bulk': 1}, **(weights or {}))
+        self.interactive_max = interactive_max
+        self.bulk_min = bulk_min
+        self.slice_size = slice_size
+        self.limited = bool(rate or client_rate)
+        self._global = TokenBucket(rate, max(slice_size, rate * TRANSFER_BURST)) if rate else None
+        self.lock = threading.Lock()
+        self._clients = {}  # client -> [TokenBucket or None, open streams]
+        self._shares = {}  # client -> fraction of client_rate this process may use
+        self._pruned = time.monotonic()
+        self._streams = set()
+        self._queue = []  # (finish, seq, nbytes, future) slices waiting for the global bucket
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self.virtual_time = 0.0
+        self.totals = {lane: {'bytes': 0, 'wait': 0.0} for lane in self.LANES}
+
+    def lane(self, environ, content_length):
+        lane = environ.get('mkcloud.transfer_lane')
+        if lane in self.LANES:
+            return lane
+        if content_length is None or content_length <= self.interactive_max:
+            return 'interactive'
+        return 'bulk' if content_length >= self.bulk_min else 'normal'
+
+    def open(self, environ, content_length):
+        """
+        Returns the stream for one response body.
+        """
+        lane = self.lane(environ, content_length)
+        address = environ.get('REMOTE_ADDR', '')
+        with self.lock:
+            now = time.monotonic()
+            if now - self._pruned >= TRANSFER_PRUNE_INTERVAL:
+                self._prune(now)
+            client = self._clients.get(address)
+            if client is None:
+                bucket = (TokenBucket(self.client_rate * self._shares.get(address, 1.0),
+                                      max(self.slice_size, self.client_rate * TRANSFER_BURST))
+                          if self.client_rate else None)
+                client = self._clients[address] = [bucket, 0]
+            client[1] += 1
+            stream = TransferStream(address, lane, self.weights.get(lane, 1), client[0])
+            self._streams.add(stream)
+        return stream
+
+    def close(self, stream):
+        with self.lock:
+            self._streams.discard(stream)
+            self._clients[stream.client][1] -= 1
+
+    def _prune(self, now):
+        """
+        Forgets clients without open streams whose bucket has refilled (caller holds the lock).
+        """
+        self._pruned = now
+        for address, (bucket, streams) in list(self._clients.items()):
+            if not streams and (bucket is None or bucket.full(now)):
+                del self._clients[address]
+
+    def client_streams(self):
+        """
+        Returns {client: open streams} for the clients with streams in progress.
+        """
+        with self.lock:
+            return {address: streams for address, (_, streams) in self._clients.items() if streams}
+
+    def set_client_shares(self, shares):
+        """
+        Limits each client in shares ({client: fraction}) to that fraction of
+        client_rate in this process; other clients get all of it.
+        """
+        with self.lock:
+            self._shares = dict(shares)
+            for address, (bucket, _) in self._clients.items():
+                if bucket is not None:
+                    bucket.rate = self.client_rate * self._shares.get(address, 1.0)
+
+    async def acquire(self, stream, nbytes):
+        """
+        Waits until stream may send nbytes more.
+        """
+        started = time.monotonic()
+        if stream.bucket is not None:
+            delay = stream.bucket.reserve(nbytes)
+            if delay:
+                await asyncio.sleep(delay)
+        if stream.lane == 'interactive':
+            if self._global is not None:
+                self._global.reserve(nbytes)  # Counted, but never queued
+        elif self._global is not None:
+            stream.finish = max(self.virtual_time, stream.finish) + nbytes / stream.weight
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queue, (stream.finish, next(self._seq), nbytes, future))
+            if self._dispatcher is None:
+                self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+            await future
+        totals = self.totals[stream.lane]
+        totals['bytes'] += nbytes
+        totals['wait'] += time.monotonic() - started
+
+    async def _dispatch(self):
+        """
+        Releases queued slices in order of their virtual finish time. A slice goes
+        out at once and the global bucket's debt is waited out afterwards, which
+        gives the stream just released time to queue its next slice before the
+        next one is picked.
+        """
+        try:
+            while self._queue:
+                finish, _, nbytes, future = heapq.heappop(self._queue)
+                if future.done():
+                    continue  # Its connection went away
+                self.virtual_time = finish
+                future.set_result(None)
+                delay = self._global.reserve(nbytes)
+                if delay:
+                    await asyncio.sleep(delay)
+        finally:
+            self._dispatcher = None
+
+    def stats(self):
+        """
+        Live view per lane: open streams, bytes sent, seconds spent waiting, and the
+        bytes/s currently allocated to the lane (0 when nothing limits it).
+        """
+        lanes = {lane: dict(totals, streams=0, allocated=0.0) for lane, totals in self.totals.items()}
+        with self.lock:
+            streams = [(stream.lane, stream.weight, stream.bucket, self._clients[stream.client][1])
+                       for stream in self._streams]
+            clients = sum(1 for _, open_streams in self._clients.values() if open_streams)
+        total_weight = sum(weight for lane, weight, _, _ in streams if lane != 'interactive')
+        for lane, weight, bucket, client_streams in streams:
+            shares = []
+            if self.rate and lane != 'interactive':
+                shares.append(self.rate * weight / total_weight)
+            if bucket is not None:
+                shares.append(bucket.rate / client_streams)
+            lanes[lane]['streams'] += 1
+            lanes[lane]['allocated'] += min(shares, default=0.0)
+        return {'lanes': lanes, 'clients': clients}
+
+
+class Server:
+    """
+    Serves one WSGI app on one listening socket.
+    """
+
+    def __init__(self, app, app_workers=64, disk_workers=8, body_memory_max=1024 * 1024, max_body_size=None,
+                 multiprocess=False, scheduler=None):
+        self.app = app
+        self.scheduler = scheduler
+        self.app_workers = app_workers
+        self.app_pool = ThreadPoolExecutor(max_workers=app_workers, thread_name_prefix='app')
+        self.disk_pool = ThreadPoolExecutor(max_workers=disk_workers, thread_name_prefix='disk')
+        self.body_memory_max = body_memory_max
+        self.max_body_size = max_body_size
+        self.multiprocess = multiprocess
+        self.connections = 0
+        self.connection_tasks = {}  # task -> whether it is waiting for a request
+        self.stopping = False
+
+    # --- Connection handling ---
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        task = asyncio.current_task()
+        peer = writer.get_extra_info('peername') or ('', 0)
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            keep_alive = True
+            first = True
+            while keep_alive and not self.stopping:
+                self.connection_tasks[task] = True
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                                  READ_TIMEOUT if first else KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break  # Client went away or stayed idle
+                except asyncio.LimitOverrunError:
+                    await self.send_error(writer, 431)
+                    break
+                self.connection_tasks[task] = False
+                first = False
+                try:
+                    keep_alive = await self.handle_request(head, reader, writer, peer)
+                except HTTPError as e:
+                    await self.send_error(writer, e.status)
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass  # Client disconnected mid-request
+        except asyncio.CancelledError:
+            pass  # Server shutting down; end quietly instead of logging every open stream
+        except Exception as e:
+            log.error('Connection from %s failed: %r', peer[0], e)
+        finally:
+            self.connection_tasks.pop(task, None)
+            self.connections -= 1
+            writer.close()
+
+    async def close_connections(self, grace=SHUTDOWN_GRACE):
+        """
+        Ends every connection once the listener is closed: idle ones at once, the
+        others when their response is sent or after `grace` seconds.
+        """
+        self.stopping = True
+        tasks = list(self.connection_tasks)
+        for task in tasks:
+            if self.connection_tasks.get(task):
+                task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=grace)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0)  # Let the closed transports release their sockets
+
+    async def send_error(self, writer, status):
+        body = f'{status} {REASONS.get(status, "Error")}\n'.encode()
+        writer.write(f'HTTP/1.1 {status} {REASONS.get(status, "Error")}\r\n'
+                     f'Date: {http_date()}\r\nServer: {SERVER_SOFTWARE}\r\n'
+                     f'Content-Type: text/plain\r\nContent-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    # --- Request parsing ---
+    @staticmethod
+    def parse_head(head):
+        """
+        Returns (method, target, version, {lower-case name: value}).
+        """
+        try:
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise HTTPError(400)
+        if not version.startswith('HTTP/1.'):
+            raise HTTPError(505)
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep or not name or name != name.strip():
+                raise HTTPError(400)
+            name = name.lower()
+            value = value.strip()
+            headers[name] = f'{headers[name]}, {value}' if name in headers else value
+        return method, target, version, headers
+
+    async def read_body(self, reader, writer, version, headers):
+        """
+        Returns (wsgi.input, length or None): the body read into memory if it is
+        small, else a StreamingBody the app reads from the connection.
+        """
+        chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        if not chunked and 'content-length' not in headers:
+            return io.BytesIO(), 0
+        length = None
+        if not chunked:
+            try:
+                length = int(headers['content-length'])
+            except ValueError:
+                raise HTTPError(400)
+            if length < 0:
+                raise HTTPError(400)
+            if self.max_body_size is not None and length > self.max_body_size:
+                raise HTTPError(413)
+            if length == 0:
+                return io.BytesIO(), 0
+        if headers.get('expect', '').lower() == '100-continue' and version == 'HTTP/1.1':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            await writer.drain()
+
+        body = StreamingBody(asyncio.get_running_loop(), reader, length, self.max_body_size)
+        if length is not None and length <= self.body_memory_max:
+            return io.BytesIO(await body.receive(length)), length
+        return body, length
+
+    def build_environ(self, method, target, version, headers, body, length, writer, peer):
+        if '://' in target:
+            target = '/' + target.split('://', 1)[1].partition('/')[2]  # absolute-form
+        path, _, query = target.partition('?')
+        sockname = writer.get_extra_info('sockname') or ('', 0)
+        host = headers.get('host', '')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+            'QUERY_STRING': query,
+            'REQUEST_URI': target,
+            'RAW_URI': target,
+            'SERVER_NAME': host.rpartition(':')[0] if ':' in host else (host or str(sockname[0])),
+            'SERVER_PORT': str(sockname[1]),
+            'SERVER_PROTOCOL': version,
+            'SERVER_SOFTWARE': SERVER_SOFTWARE,
+            'REMOTE_ADDR': str(peer[0]),
+            'REMOTE_PORT': str(peer[1]),
+            'CONTENT_LENGTH': str(length) if length is not None else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': body,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': self.multiprocess,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+            'mkcloud.suspend': Suspend,
+        }
+        for name, value in headers.items():
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name not in ('content-length', 'transfer-encoding'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+        return environ
+
+    # --- Request handling ---
+    async def handle_request(self, head, reader, writer, peer):
+        """
+        Runs one request/response exchange; returns whether to keep the connection.
+        """
+        loop = asyncio.get_running_loop()
+        method, target, version, headers = self.parse_head(head)
+        connection = headers.get('connection', '').lower()
+        keep_alive = 'close' not in connection if version == 'HTTP/1.1' else 'keep-alive' in connection
+        keep_alive = keep_alive and not self.stopping
+
+        body, length = await self.read_body(reader, writer, version, headers)
+        environ = self.build_environ(method, target, version, headers, body, length, writer, peer)
+        # Every step of the app runs in this request's context, whichever worker thread runs it
+        context = contextvars.copy_context()
+        state = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info and state.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            state['status'] = status
+            state['headers'] = response_headers
+            return state.setdefault('legacy', []).append  # write() callable
+
+        def call_app():
+            result = self.app(environ, start_response)
+            if isinstance(result, FileWrapper):
+                return result, None, None  # Sent with sendfile(), never iterated
+            # Pull the first chunk too, since generators only call start_response then
+            iterator = iter(result)
+            return result, iterator, next(iterator, None)
+
+        try:
+            result, iterator, first = await loop.run_in_executor(self.app_pool, context.run, call_app)
+        except Exception as e:
+            body.close()
+            log.exception('%s %s raised %r', method, target, e)
+            raise HTTPError(500)
+
+        try:
+            keep_alive = await self.send_response(loop, context, environ, writer, state, result, iterator, first,
+                                                  keep_alive)
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.app_pool, context.run, close)
+            body.close()
+        if isinstance(body, StreamingBody):
+            # The next request starts after this body: skip what the app didn't read
+            keep_alive = keep_alive and await body.discard_rest(UNREAD_BODY_MAX)
+        return keep_alive
+
+    async def send_response(self, loop, context, environ, writer, state, result, iterator, first, keep_alive):
+        status = state['status']
+        code = int(status.split(' ', 1)[0])
+        response_headers = list(state['headers'])
+        names = {name.lower() for name, _ in response_headers}
+        no_body = environ['REQUEST_METHOD'] == 'HEAD' or code in (204, 304) or code < 200
+        content_length = next((int(value) for name, value in response_headers
+                               if name.lower() == 'content-length'), None)
+
+        chunked = False
+        if content_length is None and not no_body:
+            if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                chunked = True
+                response_headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                keep_alive = False  # HTTP/1.0: the body ends when the connection closes
+        if 'date' not in names:
+            response_headers.append(('Date', http_date()))
+        if 'server' not in names:
+            response_headers.append(('Server', SERVER_SOFTWARE))
+        response_headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+        head = f"{environ['SERVER_PROTOCOL']} {status}\r\n" + ''.join(
+            f'{name}: {value}\r\n' for name, value in response_headers) + '\r\n'
+        writer.write(head.encode('latin-1'))
+        state['sent'] = True
+
+        if no_body:
+            await writer.drain()
+            return keep_alive
+
+        stream = self.scheduler.open(environ, content_length) if self.scheduler is not None else None
+        try:
+            return await self.send_body(loop, context, environ, writer, state, result, iterator, first,
+                                        keep_alive, content_length, chunked, stream)
+        finally:
+            if stream is not None:
+                self.scheduler.close(stream)
+
+    async def send_body(self, loop, context, environ, writer, state, result, iterator, first,
+                        keep_alive, content_length, chunked, stream):
+        if isinstance(result, FileWrapper):
+            await writer.drain()
+            if content_length == 0:
+                return keep_alive  # loop.sendfile() rejects a count of 0
+            if content_length is not None and hasattr(result.file, 'fileno'):
+                offset = await loop.run_in_executor(self.disk_pool, result.file.tell)
+                if stream is None or not self.scheduler.limited:
+                    await self._pace(stream, content_length)
+                    await loop.sendfile(writer.transport, result.file, offset, content_length)
+                    return keep_alive
+                sent = 0
+                while sent < content_length:
+                    count = min(self.scheduler.slice_size, content_length - sent)
+                    await self.scheduler.acquire(stream, count)
+                    await loop.sendfile(writer.transport, result.file, offset + sent, count)
+                    sent += count
+                return keep_alive
+            iterator = iter(result)
+            first = await loop.run_in_executor(self.disk_pool, next, iterator, None)
+
+        for data in state.get('legacy', []):
+            await self._write(writer, data, chunked, stream)
+        chunk = first
+        while True:
+            if isinstance(chunk, Suspend):
+                await self._suspend(loop, chunk)
+            elif chunk:
+                await self._write(writer, chunk.encode('latin-1') if isinstance(chunk, str) else chunk,
+                                  chunked, stream)
+            try:
+                chunk = await loop.run_in_executor(self.app_pool, context.run, next, iterator, StopIteration)
+            except Exception as e:
+                # Too late for an error response: cut the body short so the client notices
+                log.exception('%s %s failed while streaming: %r', environ['REQUEST_METHOD'], environ['REQUEST_URI'], e)
+                return False
+            if chunk is StopIteration:
+                break
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return keep_alive
+
+    async def _pace(self, stream, nbytes):
+        """
+        Waits for the scheduler's go-ahead to send nbytes of a body.
+        """
+        if stream is not None:
+            await self.scheduler.acquire(stream, nbytes)
+
+    async def _write(self, writer, data, chunked, stream=None):
+        await self._pace(stream, len(data))
+        if chunked:
+            writer.write(b'%x\r\n%b\r\n' % (len(data), data))
+        else:
+            writer.write(data)
+        await writer.drain()
+
+    @staticmethod
+    async def _suspend(loop, suspend):
+        event = asyncio.Event()
+        unsubscribe = suspend.subscribe(lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            await asyncio.wait_for(event.wait(), suspend.timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            unsubscribe()
+
+    def shutdown(self):
+        self.app_pool.shutdown(wait=False, cancel_futures=True)
+        self.disk_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def bind_socket(host, port, reuse_port=False, backlog=2048):
+    """
+    Creates the listening socket (dual-stack when host is '::').
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if family == socket.AF_INET6:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+async def _serve(server, sock):
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    listener = await asyncio.start_server(server.handle_connection, sock=sock, limit=MAX_HEADER_BYTES, backlog=2048)
+    try:
+        await stopping.wait()
+    finally:
+        listener.close()  # Accept no new connections
+        log.info('Server stopping (%d open connections)', server.connections)
+        await server.close_connections()
+        await listener.wait_closed()
+
+
+def serve(app, host='0.0.0.0', port=5000, sock=None, **options):
+    """
+    Runs the server until SIGINT/SIGTERM. Options are passed to Server.
+    """
+    server = Server(app, **options)
+    sock = sock or bind_socket(host, port)
+    started = time.time()
+    log.info('Serving on http://%s:%d (asyncio, %d app workers, pid %d)', host, port, server.app_workers, os.getpid())
+    try:
+        asyncio.run(_serve(server, sock))
+    finally:
+        server.shutdown()
+        sock.close()
+        log.info('Server stopped after %.0fs', time.time() - started)
+
+
+# --- Prefork ---
+WORKER_RESTART_DELAY = 1  # seconds to wait before replacing a worker that died right after starting
+
+
+def serve_prefork(app, host='0.0.0.0', port=5000, workers=2, on_start=None, on_stop=None, on_worker_exit=None,
+                  **options):
+    """
+    Forks `workers` processes that each run serve() on their own SO_REUSEPORT
+    socket, so the kernel spreads new connections across them. The parent only
+    supervises: it replaces workers that die and passes SIGINT/SIGTERM on.
+    on_start/on_stop run in the parent only, e.g. to advertise the service once;
+    on_worker_exit runs in each worker as it exits (which skips atexit handlers).
+    """
+    # Fail here rather than in every worker if the port is taken. The probe doesn't set
+    # SO_REUSEPORT, so it also fails if another prefork server is already listening.
+    bind_socket(host, port).close()
+    children = {}  # pid -> time.monotonic() at start
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                serve(app, host, port, sock=bind_socket(host, port, reuse_port=True), multiprocess=True, **options)
+                code = 0
+            except BaseException:
+                log.exception('Prefork: worker %d failed', os.getpid())
+            finally:
+                if on_worker_exit is not None:
+                    try:
+                        on_worker_exit()
+                    except Exception:
+                        log.exception('Prefork: worker %d failed to clean up', os.getpid())
+                logging.shutdown()  # os._exit() skips atexit, which would write out queued records
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    log.info('Prefork: starting %d workers on port %d (parent pid %d)', workers, port, os.getpid())
+    for _ in range(workers):
+        spawn()
+    if on_start is not None:
+        on_start()
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = children.pop(pid, None)
+            if started is None or stopping:
+                continue
+            log.warning('Prefork: worker %d exited with status %d; replacing it', pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)
+            spawn()
+    finally:
+        if on_stop is not None:
+            on_stop()
+        log.info('Prefork: all workers stopped')
@@ -0,0 +1,130 @@
+"""
+Lookup and listing cost of the flat and sharded UPLOAD_FOLDER layouts as the
+number of files grows.
+
+For every file count and layout, fills a scratch folder with empty files through
+main.py's StorageLayout (so the paths are exactly the server's), then measures:
+
+- create:  files created per second while filling the folder
+- lookup:  microseconds per StorageLayout.locate() + stat of a random existing name
+- miss:    microseconds per locate() + stat of a name that doesn't exist (a 404)
+- scan:    seconds for one full StorageLayout.scan() with a stat per file, which is
+           what the file index does at startup and on every reconciliation (and
+           roughly what a backup tool's walk costs)
+
+    python benchmarks/layout_scaling.py --files 10000 1000000 5000000
+
+The page cache stays warm unless --drop-caches is given (needs root); 5 million
+files take a few GB of disk for inodes and several minutes per layout.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYOUTS = ('flat', 'sharded')
+
+
+def load_main(folder):
+    """
+    Imports main.py with UPLOAD_FOLDER pointing into the scratch area.
+    """
+    os.environ['UPLOAD_FOLDER'] = folder
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, ROOT)
+    import main
+    return main
+
+
+def use_folder(main, folder, layout):
+    main.app.config['UPLOAD_FOLDER'] = folder
+    main.app.config['STATE_FOLDER'] = os.path.join(folder, '.mkcloud')
+    main.app.config['STORAGE_LAYOUT'] = layout
+    return main.StorageLayout()
+
+
+def drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+
+def populate(storage, names):
+    started = time.perf_counter()
+    for name in names:
+        fd = os.open(storage.target(name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        os.close(fd)
+    return len(names) / (time.perf_counter() - started)
+
+
+def time_lookups(storage, names, cache_drop):
+    if cache_drop:
+        drop_caches()
+    started = time.perf_counter()
+    for name in names:
+        try:
+            os.stat(storage.locate(name))
+        except FileNotFoundError:
+            pass
+    return (time.perf_counter() - started) / len(names) * 1e6
+
+
+def time_scan(storage, cache_drop):
+    if cache_drop:
+        drop_caches()
+    started = time.perf_counter()
+    count = 0
+    for entry in storage.scan():
+        entry.stat()
+        count += 1
+    return time.perf_counter() - started, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, nargs='+', default=[10000, 1000000, 5000000])
+    parser.add_argument('--layouts', nargs='+', choices=LAYOUTS, default=list(LAYOUTS))
+    parser.add_argument('--lookups', type=int, default=20000, help='random lookups per measurement')
+    parser.add_argument('--drop-caches', action='store_true', help='measure with a cold page cache (root only)')
+    parser.add_argument('--scratch', help='parent folder for the scratch folders (default: system temp)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='mkcloud-layout-', dir=args.scratch)
+    rows = []
+    try:
+        app_main = load_main(os.path.join(scratch, 'import'))
+        for count in args.files:
+            names = [f'file-{i:08d}.dat' for i in range(count)]
+            for layout in args.layouts:
+                folder = os.path.join(scratch, f'{layout}-{count}')
+                os.makedirs(folder)
+                storage = use_folder(app_main, folder, layout)
+                create_rate = populate(storage, names)
+                hits = random.sample(names, min(args.lookups, count))
+                misses = [f'missing-{i:08d}.dat' for i in range(len(hits))]
+                lookup_us = time_lookups(storage, hits, args.drop_caches)
+                miss_us = time_lookups(storage, misses, args.drop_caches)
+                scan_s, scanned = time_scan(storage, args.drop_caches)
+                rows.append({'files': count, 'layout': layout, 'create_per_s': round(create_rate),
+                             'lookup_us': round(lookup_us, 2), 'miss_us': round(miss_us, 2),
+                             'scan_s': round(scan_s, 3), 'scanned': scanned})
+                print(f"files={count:<9} {layout:<8} create={create_rate:9.0f}/s  lookup={lookup_us:7.2f}us  "
+                      f"miss={miss_us:7.2f}us  scan={scan_s:8.3f}s", flush=True)
+                shutil.rmtree(folder)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'cpu_count': os.cpu_count(), 'drop_caches': args.drop_caches,
+                       'lookups': args.lookups, 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+"""
+Load-test suite: throughput, latency, CPU and memory of the server under the
+workloads it sees in practice, written as JSON so runs can be compared across
+commits.
+
+Each workload gets a fresh `python main.py` (scratch UPLOAD_FOLDER, WORKERS=
+--server-workers) driven by keep-alive clients in separate processes:
+
+    small_uploads       many small files, one multipart POST / each (like the page)
+    huge_uploads        a few clients each streaming --huge-count large files (PUT /stream_upload)
+    downloads           parallel whole-file downloads of one large file
+    ranged_downloads    parallel random 1 MB Range requests on the same file
+    listing_<N>         --tabs simulated tabs polling the page's /files_json query
+                        against a folder of N files (--listing-sizes)
+
+For every workload the report has requests, errors, requests/s, MB/s, p50/p90/p99
+latency, the server's CPU time (all its processes) and the peak RSS of the
+server processes.
+
+    python benchmarks/load_suite.py --json before.json
+    git checkout my-branch
+    python benchmarks/load_suite.py --json after.json --compare before.json
+
+Numbers are only comparable between runs on the same machine with the same
+options. The load generator shares the machine, so give it cores (--clients) of
+its own; the 1M-file listing takes a few minutes to set up (use --listing-sizes
+to skip it).
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOWNLOAD_NAME = 'download.bin'
+RANGE_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+LISTING_QUERIES = (  # what the page asks for, per sort order the user can pick
+    '/files_json?sort=name&order=asc&limit=200',
+    '/files_json?sort=mtime&order=desc&limit=200',
+    '/files_json?sort=size&order=desc&limit=200',
+)
+
+
+class BenchError(Exception):
+    pass
+
+
+def _read_response(conn, expected_status):
+    response = conn.getresponse()
+    received = 0
+    while True:
+        block = response.read(READ_SIZE)
+        if not block:
+            break
+        received += len(block)
+    if response.status not in expected_status:
+        raise BenchError(f'HTTP {response.status}')
+    return received
+
+
+# --- Requests (one call = one timed request; returns the bytes of file data moved) ---
+
+def small_upload(conn, args, rng, tag):
+    boundary = 'bench' + tag.replace('-', '')
+    data = rng.randbytes(args.small_size)
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="small-{tag}.bin"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    conn.request('POST', '/', body=body, headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    _read_response(conn, (200,))
+    return len(data)
+
+
+def huge_upload(conn, args, rng, tag):
+    block = rng.randbytes(READ_SIZE)
+    size = args.huge_size
+
+    def body():
+        yield tag.encode().ljust(64)  # Unique content, so deduplication doesn't skip the work
+        remaining = size - 64
+        while remaining > 0:
+            yield block[:remaining]
+            remaining -= len(block)
+
+    conn.request('PUT', f'/stream_upload/huge-{tag}.bin', body=body(), headers={'Content-Length': str(size)})
+    _read_response(conn, (200,))
+    return size
+
+
+def download(conn, args, rng, tag):
+    conn.request('GET', f'/download/{DOWNLOAD_NAME}')
+    return _read_response(conn, (200,))
+
+
+def ranged_download(conn, args, rng, tag):
+    start = rng.randrange(0, max(1, args.download_size - RANGE_SIZE))
+    conn.request('GET', f'/download/{DOWNLOAD_NAME}', headers={'Range': f'bytes={start}-{start + RANGE_SIZE - 1}'})
+    return _read_response(conn, (206,))
+
+
+def listing_poll(conn, args, rng, tag):
+    conn.request('GET', rng.choice(LISTING_QUERIES))
+    _read_response(conn, (200,))
+    return 0
+
+
+# --- Setup of the scratch folder ---
+
+def write_random_file(path, size, seed):
+    rng = random.Random(seed)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            block = rng.randbytes(min(READ_SIZE, remaining))
+            f.write(block)
+            remaining -= len(block)
+
+
+def populate(folder, count):
+    """
+    Brings the folder to `count` empty files (listing cost doesn't depend on sizes).
+    """
+    existing = sum(1 for name in os.listdir(folder) if name.startswith('file-'))
+    for i in range(existing, count):
+        os.close(os.open(os.path.join(folder, f'file-{i:07d}.dat'), os.O_CREAT | os.O_WRONLY, 0o644))
+
+
+class Workload:
+    def __init__(self, name, request, connections, interval=0.0, requests_per_connection=None, setup=None):
+        self.name = name
+        self.request = request
+        self.connections = connections  # keep-alive connections per client process
+        self.interval = interval  # seconds between requests on one connection (0: back to back)
+        self.requests_per_connection = requests_per_connection  # None: run for --duration
+        self.setup = setup
+
+
+def workloads(args):
+    per_client = lambda total: max(1, -(-total // args.clients))  # ceil
+    download_setup = lambda folder: write_random_file(os.path.join(folder, DOWNLOAD_NAME), args.download_size, args.seed)
+    found = [
+        Workload('small_uploads', small_upload, args.connections),
+        Workload('huge_uploads', huge_upload, 1, requests_per_connection=args.huge_count),
+        Workload('downloads', download, args.connections, setup=download_setup),
+        Workload('ranged_downloads', ranged_download, args.connections, setup=download_setup),
+    ]
+    for size in sorted(args.listing_sizes):
+        found.append(Workload(f'listing_{size}', listing_poll, per_client(args.tabs), interval=args.poll_interval,
+                              setup=lambda folder, size=size: populate(folder, size)))
+    return found
+
+
+# --- Load generator ---
+
+def client(url, name, args, client_id, deadline, results):
+    """
+    One load-generator process: runs the workload's request on its keep-alive
+    connections until deadline (or their request quota) and reports the
+    latency of every request.
+    """
+    workload = next(w for w in workloads(args) if w.name == name)
+    parts = urlsplit(url)
+    rng = random.Random(args.seed * 1000 + client_id)
+    count = workload.connections
+    pool = [http.client.HTTPConnection(parts.hostname, parts.port, timeout=300) for _ in range(count)]
+    due = [time.monotonic() + (workload.interval * i / count) for i in range(count)]  # Spread the tabs out
+    remaining = [workload.requests_per_connection or float('inf')] * count
+    latencies = []
+    moved = errors = 0
+    i = 0
+    while time.time() < deadline:
+        active = [k for k in range(count) if remaining[k] > 0]
+        if not active:
+            break
+        k = min(active, key=due.__getitem__)
+        wait = due[k] - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, max(0, deadline - time.time())))
+            continue
+        started = time.perf_counter()
+        try:
+            moved += workload.request(pool[k], args, rng, f'{client_id}-{i}')
+            latencies.append(time.perf_counter() - started)
+        except (OSError, http.client.HTTPException, BenchError):
+            errors += 1
+            pool[k].close()
+        remaining[k] -= 1
+        due[k] = time.monotonic() + workload.interval
+        i += 1
+    results.put((latencies, moved, errors))
+
+
+# --- Server process accounting (Linux /proc; None elsewhere) ---
+
+def process_tree(pid):
+    try:
+        stats = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        stats[int(entry)] = f.read().rsplit(')', 1)[1].split()
+                except OSError:
+                    pass
+    except OSError:
+        return None
+    tree = {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, fields in stats.items():
+            if child not in tree and int(fields[1]) in tree:
+                tree.add(child)
+                changed = True
+    return {p: stats[p] for p in tree if p in stats}
+
+
+def cpu_seconds(pid):
+    tree = process_tree(pid)
+    if tree is None:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    # utime + stime of each live process (fields 14 and 15 of /proc/<pid>/stat)
+    return sum(int(fields[11]) + int(fields[12]) for fields in tree.values()) / ticks
+
+
+def peak_rss_mb(pid):
+    tree = process_tree(pid)
+    if tree is None:
+        return None
+    total = 0
+    for p in tree:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return round(total / 1024, 1)
+
+
+# --- Driver ---
+
+def start_server(folder, args):
+    env = dict(os.environ, UPLOAD_FOLDER=folder, PORT=str(args.port), WORKERS=str(args.server_workers),
+               MDNS_NAME='', LOG_LEVEL='WARNING')
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_up(url, timeout):
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+            # Also loads the file index and builds its sort orders, which timed requests shouldn't pay for
+            for path in LISTING_QUERIES:
+                conn.request('GET', path)
+                conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server at {url} did not come up')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_workload(workload, folder, args):
+    url = f'http://127.0.0.1:{args.port}'
+    if workload.setup is not None:
+        workload.setup(folder)
+    server = start_server(folder, args)
+    try:
+        wait_until_up(url, timeout=600)
+        results = multiprocessing.Queue()
+        deadline = time.time() + (args.duration if workload.requests_per_connection is None else 24 * 3600)
+        procs = [multiprocessing.Process(target=client, args=(url, workload.name, args, i, deadline, results))
+                 for i in range(args.clients)]
+        cpu_before = cpu_seconds(server.pid)
+        started = time.perf_counter()
+        for proc in procs:
+            proc.start()
+        latencies = []
+        moved = errors = 0
+        for _ in procs:
+            lat, m, e = results.get()
+            latencies.extend(lat)
+            moved += m
+            errors += e
+        seconds = time.perf_counter() - started
+        for proc in procs:
+            proc.join()
+        cpu_after = cpu_seconds(server.pid)
+        rss = peak_rss_mb(server.pid)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+
+    latencies.sort()
+    cpu = round(cpu_after - cpu_before, 2) if cpu_before is not None and cpu_after is not None else None
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'workload': workload.name,
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 2),
+        'rps': round(len(latencies) / seconds, 1),
+        'mb_per_s': round(moved / (1024 * 1024) / seconds, 1),
+        'latency_ms': {'p50': ms(percentile(latencies, 0.5)), 'p90': ms(percentile(latencies, 0.9)),
+                       'p99': ms(percentile(latencies, 0.99)), 'max': ms(latencies[-1] if latencies else None)},
+        'server_cpu_seconds': cpu,
+        'server_cpu_percent': round(100 * cpu / seconds, 1) if cpu is not None else None,
+        'server_peak_rss_mb': rss,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_row(row, baseline=None):
+    line = (f"{row['workload']:<18} {row['rps']:>9.1f} req/s {row['mb_per_s']:>8.1f} MB/s  "
+            f"p50 {row['latency_ms']['p50']}ms  p99 {row['latency_ms']['p99']}ms  "
+            f"cpu {row['server_cpu_percent']}%  rss {row['server_peak_rss_mb']} MB  errors {row['errors']}")
+    if baseline is not None and baseline['rps'] and baseline['latency_ms']['p99']:
+        line += (f"  [rps x{row['rps'] / baseline['rps']:.2f}, "
+                 f"p99 x{(row['latency_ms']['p99'] or 0) / baseline['latency_ms']['p99']:.2f} vs baseline]")
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', help='workload names to run (default: all)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per time-bound workload')
+    parser.add_argument('--clients', type=int, default=4, help='load generator processes')
+    parser.add_argument('--connections', type=int, default=4, help='keep-alive connections per client process')
+    parser.add_argument('--server-workers', type=int, default=1, help='WORKERS for the server')
+    parser.add_argument('--small-size', type=int, default=16 * 1024, help='bytes per small upload')
+    parser.add_argument('--huge-size', type=int, default=256 * 1024 * 1024, help='bytes per huge upload')
+    parser.add_argument('--huge-count', type=int, default=2, help='huge uploads per client process')
+    parser.add_argument('--download-size', type=int, default=64 * 1024 * 1024, help='bytes of the downloaded file')
+    parser.add_argument('--listing-sizes', type=int, nargs='*', default=[1000, 100000, 1000000])
+    parser.add_argument('--tabs', type=int, default=64, help='simulated browser tabs polling /files_json')
+    parser.add_argument('--poll-interval', type=float, default=0,
+                        help='seconds between polls of one tab (0: as fast as possible)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=5098)
+    parser.add_argument('--scratch', help='parent directory for the scratch folders (default: system temp)')
+    parser.add_argument('--json', default='load-suite.json', help='where to write the results')
+    parser.add_argument('--compare', help='results JSON of an earlier run to compare against')
+    args = parser.parse_args()
+
+    selected = [w for w in workloads(args) if not args.only or w.name in args.only]
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {row['workload']: row for row in json.load(f)['results']}
+
+    rows = []
+    listing_folder = None
+    try:
+        for workload in selected:
+            if workload.name.startswith('listing_'):
+                # Listings grow one folder from size to size instead of refilling it
+                listing_folder = listing_folder or tempfile.mkdtemp(prefix='mkcloud-bench-', dir=args.scratch)
+                rows.append(run_workload(workload, listing_folder, args))
+            else:
+                folder = tempfile.mkdtemp(prefix='mkcloud-bench-', dir=args.scratch)
+                try:
+                    rows.append(run_workload(workload, folder, args))
+                finally:
+                    shutil.rmtree(folder, ignore_errors=True)
+            print_row(rows[-1], baseline.get(workload.name))
+    finally:
+        if listing_folder:
+            shutil.rmtree(listing_folder, ignore_errors=True)
+
+    with open(args.json, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'options': {k: v for k, v in vars(args).items() if k not in ('json', 'compare', 'scratch')},
+            'results': rows,
+        }, f, indent=2)
+    print(f'Results written to {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Requests per second of the prefork server as the number of worker processes grows.
+
+Starts `python main.py` with WORKERS=1, 2, 4, ... against a scratch UPLOAD_FOLDER
+holding a few thousand files, drives it with keep-alive clients in separate
+processes for a fixed time, and prints one line per worker count plus the
+scaling efficiency (RPS / (workers * RPS with one worker)). The request is a
+page of /files_json, which is CPU-bound (sorting, JSON encoding), so it is
+limited by cores rather than by the disk.
+
+    python benchmarks/prefork_scaling.py --workers 1 2 4 8 --duration 10
+
+The load generator runs on the same machine, so it needs cores of its own
+(--clients): on a machine with fewer cores than workers plus clients the
+numbers only show contention.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REQUEST_PATH = '/files_json?limit=200&sort=mtime&order=desc'
+
+
+def client(url, path, deadline, connections, results):
+    """
+    One load-generator process: keeps `connections` keep-alive connections busy
+    round-robin until deadline and reports how many requests completed.
+    """
+    parts = urlsplit(url)
+    pool = [http.client.HTTPConnection(parts.hostname, parts.port, timeout=30) for _ in range(connections)]
+    done = errors = 0
+    i = 0
+    while time.time() < deadline:
+        conn = pool[i % connections]
+        i += 1
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                done += 1
+            else:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+    results.put((done, errors))
+
+
+def wait_until_up(url, timeout=20):
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request('GET', '/files_json')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server at {url} did not come up')
+
+
+def measure(url, clients, connections, duration):
+    # Warm every worker up (lazy index load, first-request setup) before timing
+    warmup = time.time() + 2
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=client, args=(url, REQUEST_PATH, warmup, connections, results))
+             for _ in range(clients)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        results.get()
+        proc.join()
+
+    deadline = time.time() + duration
+    procs = [multiprocessing.Process(target=client, args=(url, REQUEST_PATH, deadline, connections, results))
+             for _ in range(clients)]
+    started = time.time()
+    for proc in procs:
+        proc.start()
+    done = errors = 0
+    for _ in procs:
+        d, e = results.get()
+        done += d
+        errors += e
+    for proc in procs:
+        proc.join()
+    return done / (time.time() - started), errors
+
+
+def populate(folder, count):
+    for i in range(count):
+        with open(os.path.join(folder, f'file-{i:06d}.dat'), 'wb') as f:
+            f.write(b'x' * (i % 4096))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    cores = os.cpu_count() or 1
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[n for n in (1, 2, 4, 8, 16) if n <= max(1, cores // 2)] or [1])
+    parser.add_argument('--clients', type=int, default=max(2, cores // 2), help='load generator processes')
+    parser.add_argument('--connections', type=int, default=8, help='keep-alive connections per client process')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per measurement')
+    parser.add_argument('--files', type=int, default=5000, help='files in the scratch UPLOAD_FOLDER')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='mkcloud-bench-')
+    populate(folder, args.files)
+    url = f'http://127.0.0.1:{args.port}'
+    rows = []
+    try:
+        for workers in args.workers:
+            env = dict(os.environ, UPLOAD_FOLDER=folder, PORT=str(args.port), WORKERS=str(workers), MDNS_NAME='')
+            server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_until_up(url)
+                rps, errors = measure(url, args.clients, args.connections, args.duration)
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=30)
+            baseline = rows[0]['rps'] / rows[0]['workers'] if rows else rps / workers
+            rows.append({'workers': workers, 'rps': round(rps, 1), 'errors': errors,
+                         'efficiency': round(rps / (workers * baseline), 3)})
+            print(f"workers={workers:<3} {rps:10.1f} req/s  efficiency={rows[-1]['efficiency']:.2f}  errors={errors}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'cpu_count': cores, 'files': args.files, 'path': REQUEST_PATH,
+                       'clients': args.clients, 'connections': args.connections,
+                       'duration': args.duration, 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Latency of the filename search behind GET /search and the /files_json filter as
+the number of files grows.
+
+For every file count, builds main.py's NameSearch over synthetic filenames
+(words, dates, counters and extensions, like a shared folder collects), then
+measures:
+
+- build:   seconds to index all names (what a startup or journal snapshot costs)
+- add/rm:  microseconds per incremental add and remove (an upload or delete)
+- search:  p50/p99 milliseconds of a type-ahead query for the best 10 matches,
+           over a mix of prefixes, whole words, inner substrings and misses
+- filter:  p50/p99 milliseconds to collect every name containing the query
+           (the /files_json?q= filter), before sorting them for the page
+
+    python benchmarks/search_latency.py --files 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORDS = ['report', 'invoice', 'photo', 'scan', 'backup', 'draft', 'final', 'notes', 'meeting', 'budget',
+         'holiday', 'project', 'design', 'contract', 'export', 'video', 'screenshot', 'dump', 'release', 'vm']
+EXTENSIONS = ['.pdf', '.jpg', '.png', '.txt', '.docx', '.xlsx', '.zip', '.tar.gz', '.mp4', '.sql', '.qcow2']
+QUERIES = ['rep', 'report', 'invoice_2021', 'budget_final', 'hol', 'day_', '2019-0', '_v1', 'creensh', '.qcow',
+           'screenshot_2020-03', 'xyz', 'zzzz', 'ject_des', 'meeting_notes_2022-11-0']
+
+
+def load_main():
+    """
+    Imports main.py with UPLOAD_FOLDER pointing into a scratch folder.
+    """
+    os.environ['UPLOAD_FOLDER'] = tempfile.mkdtemp(prefix='mkcloud-search-')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, ROOT)
+    import main
+    return main
+
+
+def filenames(count, rng):
+    names = set()
+    while len(names) < count:
+        words = '_'.join(rng.sample(WORDS, rng.randint(1, 3)))
+        date = f'{rng.randint(2015, 2024)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+        names.add(f'{words}_{date}_v{rng.randint(1, 999)}{rng.choice(EXTENSIONS)}')
+    return sorted(names)
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--rounds', type=int, default=20, help='times each query is timed')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    app_main = load_main()
+    scan_limit = app_main.app.config['SEARCH_SCAN_LIMIT']
+    rng = random.Random(0)
+    rows = []
+    for count in args.files:
+        names = filenames(count, rng)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        search = app_main.NameSearch(names)
+        build_s = time.perf_counter() - started
+        rss_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+
+        churn = filenames(1000, random.Random(count))
+        started = time.perf_counter()
+        for name in churn:
+            search.add(name)
+        add_us = (time.perf_counter() - started) / len(churn) * 1e6
+        started = time.perf_counter()
+        for name in churn:
+            search.remove(name)
+        remove_us = (time.perf_counter() - started) / len(churn) * 1e6
+
+        search_ms, filter_ms = [], []
+        for _ in range(args.rounds):
+            for query in QUERIES:
+                started = time.perf_counter()
+                search.search(query, 10, scan_limit)
+                search_ms.append((time.perf_counter() - started) * 1000)
+                started = time.perf_counter()
+                if search.matching(query) is not None:
+                    filter_ms.append((time.perf_counter() - started) * 1000)
+        search_p50, search_p99 = percentiles(search_ms)
+        filter_p50, filter_p99 = percentiles(filter_ms)
+        rows.append({'files': count, 'build_s': round(build_s, 2), 'rss_growth_mb': round(rss_mb),
+                     'add_us': round(add_us, 1), 'remove_us': round(remove_us, 1),
+                     'search_p50_ms': round(search_p50, 3), 'search_p99_ms': round(search_p99, 3),
+                     'filter_p50_ms': round(filter_p50, 3), 'filter_p99_ms': round(filter_p99, 3)})
+        print(f"files={count:<8} build={build_s:6.2f}s (+{rss_mb:.0f} MB)  add={add_us:6.1f}us  "
+              f"rm={remove_us:6.1f}us  search p50={search_p50:6.3f}ms p99={search_p99:6.3f}ms  "
+              f"filter p50={filter_p50:6.3f}ms p99={filter_p99:6.3f}ms", flush=True)
+        del search
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'queries': QUERIES, 'rounds': args.rounds, 'scan_limit': scan_limit, 'results': rows},
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
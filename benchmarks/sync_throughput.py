@@ -0,0 +1,284 @@
+"""
+Throughput of the sync client (sync.py) on a folder of thousands of small files,
+against what the link carries for one large file.
+
+The client reaches the server through an emulated link: a proxy in this script
+that delays data by half the round-trip time (--rtt-ms) in each direction and
+caps each direction at --link-mbps, shared by all connections like one access
+link. Over a real link, one file per round trip leaves most of the bandwidth
+unused; the sync client keeps --connections requests in flight to fill it.
+
+For every --connections count, starts a fresh `python main.py` (scratch
+UPLOAD_FOLDER, WORKERS=--server-workers), pushes the generated folder to it,
+pulls it back into an empty folder and re-runs the push (nothing to send: the
+cost of the manifest diff). The link is measured first, on its own server: one
+large file PUT to /stream_upload and GET from /download over a single
+connection, which is what the sync of many small files should get close to.
+
+    python benchmarks/sync_throughput.py --files 2000 --size 65536 --link-mbps 8 --rtt-ms 20
+
+The server and the proxy share the machine with the client: keep --link-mbps
+below what the server handles for the file size on this machine (run with
+--rtt-ms 0 and a high --link-mbps to find out), or the server, not the link, is
+the bottleneck.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import sync  # noqa: E402
+
+READ_SIZE = 1024 * 1024
+PROXY_READ_SIZE = 64 * 1024
+
+
+class LinkEmulator:
+    """
+    TCP proxy from a local port to the server that adds rtt/2 seconds of delay
+    in each direction and lets each direction carry `rate` bytes/s in total.
+    """
+
+    def __init__(self, target_port, rate, rtt):
+        self.target_port = target_port
+        self.rate = rate
+        self.delay = rtt / 2
+        self.lock = threading.Lock()
+        self.free_at = {'up': 0.0, 'down': 0.0}  # when each direction's bandwidth is next free
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return  # Closed
+            try:
+                server = socket.create_connection(('127.0.0.1', self.target_port))
+            except OSError:
+                client.close()
+                continue
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._pipe(client, server, 'up')
+            self._pipe(server, client, 'down')
+
+    def _pipe(self, src, dst, direction):
+        # A reader schedules each chunk's delivery, a writer delivers it when due
+        pending = deque()
+        ready = threading.Condition()
+
+        def read():
+            while True:
+                try:
+                    data = src.recv(PROXY_READ_SIZE)
+                except OSError:
+                    data = b''
+                now = time.monotonic()
+                with self.lock:
+                    if data and self.rate:
+                        self.free_at[direction] = max(now, self.free_at[direction]) + len(data) / self.rate
+                        due = self.free_at[direction] + self.delay
+                    else:
+                        due = now + self.delay
+                with ready:
+                    pending.append((due, data))
+                    ready.notify()
+                if not data:
+                    return
+
+        def write():
+            while True:
+                with ready:
+                    ready.wait_for(lambda: pending)
+                    due, data = pending.popleft()
+                time.sleep(max(0.0, due - time.monotonic()))
+                try:
+                    if not data:
+                        dst.shutdown(socket.SHUT_WR)
+                        return
+                    dst.sendall(data)
+                except OSError:
+                    src.close()
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+
+def start_server(folder, args):
+    env = dict(os.environ, UPLOAD_FOLDER=folder, PORT=str(args.port), WORKERS=str(args.server_workers),
+               MDNS_NAME='', LOG_LEVEL='WARNING')
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+            conn.request('GET', '/manifest')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not come up')
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def make_tree(folder, count, size, seed=0):
+    """
+    count files of about `size` bytes (0.5x to 1.5x), spread over 10 subfolders.
+    """
+    rng = random.Random(seed)
+    total = 0
+    for i in range(count):
+        sub = os.path.join(folder, f'dir{i % 10}')
+        os.makedirs(sub, exist_ok=True)
+        data = rng.randbytes(rng.randint(size // 2, size * 3 // 2))
+        with open(os.path.join(sub, f'file-{i:06d}.bin'), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+
+def measure_link(port, size):
+    """
+    MB/s of one large upload and one large download over a single connection.
+    """
+    block = random.Random(1).randbytes(READ_SIZE)
+
+    def body():
+        for offset in range(0, size, READ_SIZE):
+            yield block[:size - offset]
+
+    conn = http.client.HTTPConnection('127.0.0.1', port, blocksize=READ_SIZE)
+    started = time.perf_counter()
+    conn.request('PUT', '/stream_upload/link.bin', body=body(), headers={'Content-Length': str(size)})
+    response = conn.getresponse()
+    response.read()
+    if response.status != 200:
+        raise RuntimeError(f'link upload failed: HTTP {response.status}')
+    up = size / (1024 * 1024) / (time.perf_counter() - started)
+    started = time.perf_counter()
+    conn.request('GET', '/download/link.bin')
+    response = conn.getresponse()
+    while response.read(READ_SIZE):
+        pass
+    down = size / (1024 * 1024) / (time.perf_counter() - started)
+    conn.close()
+    return up, down
+
+
+def run_sync(direction, folder, port, connections):
+    client = sync.SyncClient(f'http://127.0.0.1:{port}', folder, connections=connections)
+    try:
+        stats = client.push() if direction == 'push' else client.pull()
+    finally:
+        client.close()
+    if stats['errors']:
+        raise RuntimeError(f"{direction}: {stats['errors']} files failed")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=64 * 1024, help='average file size (bytes)')
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--server-workers', type=int, default=4)
+    parser.add_argument('--link-mbps', type=float, default=8, help='link bandwidth per direction (MB/s, 0: unlimited)')
+    parser.add_argument('--rtt-ms', type=float, default=20, help='link round-trip time (ms)')
+    parser.add_argument('--link-size', type=int, default=64 * 1024 * 1024,
+                        help='bytes of the single-file link measurement')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='mkcloud-sync-bench-')
+    link = LinkEmulator(args.port, args.link_mbps * 1024 * 1024, args.rtt_ms / 1000)
+    try:
+        source = os.path.join(scratch, 'source')
+        total = make_tree(source, args.files, args.size)
+        print(f'{args.files} files, {total / (1024 * 1024):.1f} MB', flush=True)
+
+        folder = os.path.join(scratch, 'link')
+        os.makedirs(folder)
+        server = start_server(folder, args)
+        try:
+            wait_until_up(args.port)
+            link_up, link_down = measure_link(link.port, args.link_size)
+        finally:
+            stop_server(server)
+        shutil.rmtree(folder)
+        print(f'link ({args.link_mbps} MB/s, {args.rtt_ms} ms RTT) carries one {args.link_size // (1024 * 1024)} MB '
+              f'file at: up {link_up:.1f} MB/s, down {link_down:.1f} MB/s', flush=True)
+
+        rows = []
+        for connections in args.connections:
+            folder = os.path.join(scratch, f'server-{connections}')
+            target = os.path.join(scratch, f'pull-{connections}')
+            os.makedirs(folder)
+            os.makedirs(target)
+            server = start_server(folder, args)
+            try:
+                wait_until_up(args.port)
+                push = run_sync('push', source, link.port, connections)
+                pull = run_sync('pull', target, link.port, connections)
+                noop = run_sync('push', source, link.port, connections)
+            finally:
+                stop_server(server)
+            shutil.rmtree(folder)
+            shutil.rmtree(target)
+            os.remove(os.path.join(source, sync.STATE_NAME))  # The next round starts from scratch
+            row = {'connections': connections,
+                   'push_files_per_s': push['files_per_s'], 'push_mb_per_s': push['mb_per_s'],
+                   'push_link_pct': round(100 * push['mb_per_s'] / link_up),
+                   'pull_files_per_s': pull['files_per_s'], 'pull_mb_per_s': pull['mb_per_s'],
+                   'pull_link_pct': round(100 * pull['mb_per_s'] / link_down),
+                   'noop_push_s': noop['seconds']}
+            rows.append(row)
+            print(f"connections={connections:<3} push {push['files_per_s']:7.1f} files/s {push['mb_per_s']:7.1f} MB/s "
+                  f"({row['push_link_pct']}% of link)  pull {pull['files_per_s']:7.1f} files/s "
+                  f"{pull['mb_per_s']:7.1f} MB/s ({row['pull_link_pct']}% of link)  "
+                  f"no-op push {noop['seconds']:.2f}s", flush=True)
+    finally:
+        link.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'files': args.files, 'size': args.size, 'bytes': total,
+                       'link_mbps': args.link_mbps, 'rtt_ms': args.rtt_ms,
+                       'link_up_mb_per_s': round(link_up, 1), 'link_down_mb_per_s': round(link_down, 1),
+                       'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
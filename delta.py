@@ -0,0 +1,299 @@
+"""
+rsync-style delta transfer of a new version of a file.
+
+The side that has the old version (the base) publishes its block signatures: a
+rolling checksum and a strong hash for every fixed-size block. The side with the
+new version finds those blocks in it at any byte offset, so content that moved
+still matches, and sends only block references plus the bytes in between. The
+receiver rebuilds the new version from the base and the delta. main.py serves
+signatures and applies deltas (GET /signatures, POST /delta); clients encode them.
+
+Wire formats (integers are big-endian):
+
+    signatures  one 20-byte record per block: Adler-32 (4 bytes), BLAKE2b-128 (16 bytes)
+    delta       any number of ops, then the end op:
+                b'C' + first block (8 bytes) + block count (4 bytes)   copy blocks of the base
+                b'L' + length (4 bytes) + that many bytes                literal data
+                b'E' + SHA-256 of the new version (32 bytes)             end
+
+The rolling checksum is Adler-32, so whole blocks are summed by zlib in C and
+only the byte-by-byte search for moved blocks runs in Python: unchanged data
+encodes at disk speed, changed regions at a few MB/s.
+"""
+import hashlib
+import struct
+import zlib
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+MAX_LITERAL = 1024 * 1024  # literal data goes out in ops of at most this many bytes
+SIGNATURE = struct.Struct('>I16s')
+COPY = struct.Struct('>QI')
+LITERAL = struct.Struct('>I')
+ADLER_MOD = 65521
+READ_SIZE = 4 * 1024 * 1024
+SEARCH_CHUNK = 1024 * 1024  # offsets searched for a moved block before literal data is sent
+
+
+class DeltaError(ValueError):
+    """
+    A malformed delta, or one that doesn't fit the base it is applied to.
+    """
+
+
+def block_size_for(size):
+    """
+    rsync's rule of thumb: blocks of about sqrt(size) bytes (here the next power
+    of two), so a file has about as many blocks as each block has bytes.
+    """
+    block_size = MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def signature(block):
+    return SIGNATURE.pack(zlib.adler32(block), strong_hash(block))
+
+
+def signatures(f, block_size):
+    """
+    Yields the packed signature record of each block of the binary file f, from
+    its current position to the end.
+    """
+    read_size = max(block_size, READ_SIZE // block_size * block_size)
+    while True:
+        chunk = f.read(read_size)
+        if not chunk:
+            return
+        view = memoryview(chunk)
+        for offset in range(0, len(chunk), block_size):
+            yield signature(view[offset:offset + block_size])
+
+
+class SignatureWriter:
+    """
+    Signatures of data that is written sequentially, e.g. a new version while
+    a delta is applied, so they needn't be computed again by reading it back.
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.records = []
+        self._pending = bytearray()
+
+    def update(self, data):
+        self._pending += data
+        if len(self._pending) < self.block_size:
+            return
+        end = len(self._pending) // self.block_size * self.block_size
+        with memoryview(self._pending) as view:
+            for offset in range(0, end, self.block_size):
+                self.records.append(signature(view[offset:offset + self.block_size]))
+        del self._pending[:end]
+
+    def finish(self):
+        """
+        Returns all signature records, including the one of a short last block.
+        """
+        if self._pending:
+            self.records.append(signature(self._pending))
+            self._pending.clear()
+        return b''.join(self.records)
+
+
+class _BaseBlocks:
+    """
+    Lookup of the base's blocks by signature, for the encoder.
+    """
+
+    def __init__(self, signature_data, block_size, base_size):
+        if len(signature_data) % SIGNATURE.size:
+            raise DeltaError('Truncated signatures')
+        self.block_size = block_size
+        self.count = len(signature_data) // SIGNATURE.size
+        if self.count != -(-base_size // block_size):
+            raise DeltaError('Signatures do not match the size of the base')
+        self.strong = []
+        self.by_weak = {}  # Adler-32 -> [block index, ...] of full-size blocks
+        self.tail = None  # (Adler-32, strong hash, length) of a short last block
+        for i, (weak, strong) in enumerate(SIGNATURE.iter_unpack(signature_data)):
+            self.strong.append(strong)
+            if i == self.count - 1 and base_size % block_size:
+                self.tail = (weak, strong, base_size % block_size)
+            else:
+                self.by_weak.setdefault(weak, []).append(i)
+
+    def find(self, weak, block, after):
+        """
+        Index of a base block with this checksum and content, preferring the
+        block after `after` so that copies of consecutive blocks merge; or None.
+        """
+        candidates = self.by_weak.get(weak)
+        if candidates is None:
+            return None
+        strong = strong_hash(block)
+        if after + 1 < self.count and self.strong[after + 1] == strong and (after + 1) in candidates:
+            return after + 1
+        for i in candidates:
+            if self.strong[i] == strong:
+                return i
+        return None
+
+
+def encode(f, signature_data, block_size, base_size):
+    """
+    Yields the delta (as chunks of bytes) that turns the base, described by its
+    signatures, into the content of the binary file f read from its current
+    position. Usable as a streamed request body.
+    """
+    base = _BaseBlocks(signature_data, block_size, base_size)
+    n = block_size
+    digest = hashlib.sha256()
+    buf = bytearray()  # Data read but not yet encoded starts at buf[start]
+    start = pos = 0  # pos: offset in buf of the window being checked
+    eof = False
+    copy_first = copy_count = 0
+    out = []
+
+    def fill(needed):
+        # Reads until buf holds `needed` bytes past pos (or the file ends)
+        nonlocal eof
+        while not eof and len(buf) - pos < needed:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                eof = True
+            else:
+                digest.update(chunk)
+                buf.extend(chunk)
+
+    def flush_copy():
+        nonlocal copy_count
+        if copy_count:
+            out.append(b'C' + COPY.pack(copy_first, copy_count))
+            copy_count = 0
+
+    def flush_literal(end):
+        nonlocal start
+        while start < end:
+            length = min(end - start, MAX_LITERAL)
+            out.append(b'L' + LITERAL.pack(length) + buf[start:start + length])
+            start += length
+
+    def copy(index):
+        nonlocal copy_first, copy_count
+        if copy_count and index == copy_first + copy_count:
+            copy_count += 1
+        else:
+            flush_copy()
+            copy_first, copy_count = index, 1
+
+    while True:
+        fill(n + SEARCH_CHUNK)
+        if len(buf) - pos < n:
+            break
+        with memoryview(buf)[pos:pos + n] as window:
+            index = base.find(zlib.adler32(window), window, copy_first + copy_count - 1)
+        if index is not None:
+            flush_literal(pos)
+            copy(index)
+            pos = start = pos + n
+        else:
+            # No block starts here: search the following offsets for one
+            last = min(len(buf) - n, pos + SEARCH_CHUNK)
+            found = _search(base, buf, pos, last, n)
+            pos = last + 1 if found is None else found
+            flush_copy()
+            flush_literal(pos)
+        if out:
+            yield b''.join(out)
+            out.clear()
+        if start >= READ_SIZE:
+            del buf[:start]  # Drop what has been encoded
+            pos -= start
+            start = 0
+
+    # Less than a block left: the base's short last block may still match it
+    with memoryview(buf)[pos:] as rest:
+        tail_matches = base.tail == (zlib.adler32(rest), strong_hash(rest), len(rest))
+    if tail_matches:
+        flush_literal(pos)
+        copy(base.count - 1)
+        start = len(buf)
+    flush_copy()
+    flush_literal(len(buf))
+    out.append(b'E' + digest.digest())
+    yield b''.join(out)
+
+
+def _search(base, buf, pos, last, n):
+    """
+    Rolls the checksum from the window at pos one byte at a time up to the one
+    at `last`; returns the offset of the first window matching a base block, or
+    None.
+    """
+    weak = zlib.adler32(memoryview(buf)[pos:pos + n])
+    a, b = weak & 0xffff, weak >> 16
+    by_weak = base.by_weak
+    for i in range(pos, last):
+        out = buf[i]
+        a = (a - out + buf[i + n]) % ADLER_MOD
+        b = (b - n * out + a - 1) % ADLER_MOD
+        if (b << 16 | a) in by_weak:
+            with memoryview(buf)[i + 1:i + 1 + n] as window:
+                if base.find(b << 16 | a, window, -1) is not None:
+                    return i + 1
+    return None
+
+
+def _read_exact(read, size):
+    data = read(size)
+    while len(data) < size:
+        more = read(size - len(data))
+        if not more:
+            raise DeltaError('Delta ends unexpectedly')
+        data += more
+    return data
+
+
+def apply(read, base, block_size, base_size, write):
+    """
+    Rebuilds the new version: reads the delta with read(n), copies blocks from
+    the binary file base (base_size bytes) and passes the output to write().
+    Returns (bytes copied, literal bytes, SHA-256 hex the sender announced).
+    Raises DeltaError for a malformed delta or one that doesn't fit the base.
+    """
+    block_count = -(-base_size // block_size)
+    copied = literal = 0
+    while True:
+        op = _read_exact(read, 1)
+        if op == b'C':
+            first, count = COPY.unpack(_read_exact(read, COPY.size))
+            if count == 0 or first + count > block_count:
+                raise DeltaError(f'Copy of blocks {first}-{first + count - 1} outside the base')
+            base.seek(first * block_size)
+            remaining = min(count * block_size, base_size - first * block_size)
+            while remaining:
+                chunk = base.read(min(remaining, READ_SIZE))
+                if not chunk:
+                    raise DeltaError('Base file shrank while applying the delta')
+                write(chunk)
+                remaining -= len(chunk)
+                copied += len(chunk)
+        elif op == b'L':
+            (length,) = LITERAL.unpack(_read_exact(read, LITERAL.size))
+            if length > MAX_LITERAL:
+                raise DeltaError(f'Literal of {length} bytes exceeds {MAX_LITERAL}')
+            write(_read_exact(read, length))
+            literal += length
+        elif op == b'E':
+            digest = _read_exact(read, 32).hex()
+            if read(1):
+                raise DeltaError('Data after the end of the delta')
+            return copied, literal, digest
+        else:
+            raise DeltaError(f'Unknown delta op {op!r}')
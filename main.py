@@ -1,8 +1,51 @@
 import os
-from flask import Flask, request, redirect, url_for, send_from_directory, render_template_string, jsonify
+import base64
+import bisect
+import contextvars
+import ctypes
+import errno
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import logging
+import mimetypes
+import multiprocessing
+import queue
+import random
+import re
+import secrets
+import shutil
+import signal
+import sqlite3
+import stat
+import struct
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import (CancelledError, ProcessPoolExecutor, ThreadPoolExecutor,
+                                TimeoutError as FuturesTimeoutError)
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from flask import Flask, Response, has_request_context, request, redirect, url_for, jsonify
 import socket # Used to get the local IP address for display
+from werkzeug.datastructures import Headers
+from werkzeug.http import http_date, parse_date, parse_etags, parse_options_header, parse_range_header, unquote_etag
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator
 from zeroconf import ServiceInfo, Zeroconf
+try:
+    import fcntl
+except ImportError:  # Windows: no flock(), and no prefork server either
+    fcntl = None
+
+import delta
 
 
 # --- Configuration ---
@@ -11,7 +54,7 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # Define the folder where uploaded files will be stored
 # Using os.path.join with BASE_DIR makes the path absolute and robust
-UPLOAD_FOLDER = os.path.join(BASE_DIR, r'D:\uploads')
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(BASE_DIR, r'D:\uploads')
 
 # ALLOWED_EXTENSIONS is removed to allow all file types as requested.
 # Server will accept any file, but browser might still warn about unknown types.
@@ -21,23 +64,1857 @@ app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 5000 * 1024 * 1024  # Max upload size: 50 MB
 
+# Server-side bookkeeping (partial uploads, caches, ...) lives in a hidden folder
+# inside UPLOAD_FOLDER, so moving finished files into place is a same-disk rename.
+# secure_filename() strips leading dots, so no uploaded file can collide with it.
+app.config['STATE_FOLDER'] = os.path.join(UPLOAD_FOLDER, '.mkcloud')
+
+# Resumable chunked uploads: default chunk size handed out to clients and how long
+# an unfinished upload session is kept before its partial data is discarded.
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024  # 8 MB
+app.config['UPLOAD_SESSION_TTL'] = 24 * 60 * 60  # 24 hours
+
+# Number of files from one multi-file upload that are written to disk concurrently
+app.config['UPLOAD_WORKERS'] = 4
+
+# --- Logging ---
+# Everything is logged through the logging module, one JSON object per line on
+# stdout. Records are handed to a writer thread, so request threads never wait on
+# stdout, and messages are only formatted there; a disabled level (e.g. debug with
+# LOG_LEVEL=INFO) costs a cached level check. If stdout falls behind by more than
+# LOG_QUEUE_MAX records, new ones are dropped and counted instead of piling up in
+# memory. Each request gets an id (taken from X-Request-ID or generated, and echoed
+# back) that is attached to everything it logs, plus one access-log record, sampled
+# per route through LOG_SAMPLE_RATES and written once the response body is sent.
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+app.config['LOG_QUEUE_MAX'] = 10000
+app.config['LOG_SAMPLE_RATES'] = {  # URL rule -> fraction of requests written to the access log
+    '/files_json': 0.1,  # polled by every open page
+    '/metrics': 0,
+}
+
+log = logging.getLogger('mkcloud')
+
+# Attributes copied from a record (set through `extra=` or per request) into its JSON
+LOG_FIELDS = ('request_id', 'client_ip', 'method', 'path', 'route', 'status', 'bytes', 'duration_ms', 'file')
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Queues up to `maxsize` records for a writer thread that passes them on to
+    `target`; records that don't fit are counted in `dropped`. Each process
+    starts its own writer on first use, so forked workers log too.
+    """
+
+    def __init__(self, target, maxsize=10000):
+        super().__init__()
+        self.target = target
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._writer = None
+        self._start_lock = threading.Lock()
+
+    def handle(self, record):
+        # No handler lock: Queue.put is thread-safe
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1  # Racy without a lock, but only ever a little low
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.maxsize)  # Not the parent's: its records were written there
+            self.dropped = 0
+            self._writer = threading.Thread(target=self._write, args=(self._queue,), name='log-writer', daemon=True)
+            self._writer.start()
+            self._pid = os.getpid()
+
+    def _write(self, records):
+        reported = 0
+        while True:
+            record = records.get()
+            if record is None:
+                return
+            try:
+                if self.dropped != reported:
+                    # Leave a mark where records went missing
+                    self.target.handle(logging.LogRecord(
+                        'mkcloud', logging.WARNING, __file__, 0, '%d log records dropped: the log writer fell behind',
+                        (self.dropped - reported,), None))
+                    reported = self.dropped
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+
+    def close(self):
+        """
+        Writes out what is still queued (logging.shutdown() calls this at exit).
+        """
+        if self._pid == os.getpid():
+            self._queue.put(None, timeout=5)
+            self._writer.join(timeout=5)
+            self._pid = None
+        super().close()
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Tags records logged while handling a request with its id and client IP.
+    Runs in the thread that logs, where the request context is available.
+    """
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = request.environ.get('mkcloud.request_id')
+            record.client_ip = request.remote_addr
+        return True
+
+
+def configure_logging():
+    root = logging.getLogger()
+    root.setLevel(app.config['LOG_LEVEL'])
+    if any(isinstance(handler, AsyncLogHandler) for handler in root.handlers):
+        return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonLogFormatter())
+    handler = AsyncLogHandler(stream, app.config['LOG_QUEUE_MAX'])
+    handler.addFilter(RequestContextFilter())
+    root.addHandler(handler)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # The access log below replaces its request lines
+
+
+configure_logging()
+
+
+def log_records_dropped():
+    return sum(handler.dropped for handler in logging.getLogger().handlers if isinstance(handler, AsyncLogHandler))
+
+
+@app.before_request
+def start_request():
+    request.environ['mkcloud.started'] = time.perf_counter()
+    request.environ['mkcloud.request_id'] = request.headers.get('X-Request-ID', '')[:64] or secrets.token_hex(8)
+
+
+@app.after_request
+def log_request(response):
+    response.headers['X-Request-ID'] = request.environ['mkcloud.request_id']
+    route = request.url_rule.rule if request.url_rule is not None else None
+    # Server errors are always logged, everything else at the route's sample rate
+    if response.status_code < 500 and random.random() >= app.config['LOG_SAMPLE_RATES'].get(route, 1):
+        return response
+    if log.isEnabledFor(logging.INFO):
+        # Written by log_when_sent(), after the body: there is no request context by then
+        request.environ['mkcloud.access_log'] = (
+            (request.method, request.full_path.rstrip('?'), response.status_code), {
+                'request_id': request.environ['mkcloud.request_id'],
+                'client_ip': request.remote_addr,
+                'method': request.method,
+                'path': request.path,
+                'route': route,
+                'status': response.status_code,
+                'bytes': response.content_length,  # None for streamed bodies
+            })
+    return response
+
+
+def log_when_sent(wsgi_app):
+    """
+    Wraps the WSGI app so the access-log record prepared by log_request() is
+    written when the server closes the response body, with duration_ms
+    covering the time spent sending it.
+    """
+    def app_with_access_log(environ, start_response):
+        result = wsgi_app(environ, start_response)
+        entry = environ.pop('mkcloud.access_log', None)
+        if entry is None:
+            return result
+        args, extra = entry
+
+        def write():
+            extra['duration_ms'] = round((time.perf_counter() - environ['mkcloud.started']) * 1000, 2)
+            log.info('%s %s %s', *args, extra=extra)
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(result, file_wrapper):
+            # The server sends its own file wrapper with sendfile(): keep it, and chain its close()
+            close = result.close
+
+            def close_and_write():
+                try:
+                    close()
+                finally:
+                    write()
+
+            result.close = close_and_write
+            return result
+        return ClosingIterator(result, write)
+
+    return app_with_access_log
+
+
+app.wsgi_app = log_when_sent(app.wsgi_app)
+
+# --- Storage Layout ---
+# A flat UPLOAD_FOLDER gets slow past a few hundred thousand entries: every lookup
+# searches one huge directory and every rescan or backup reads it in one piece.
+# The 'sharded' layout keeps the same flat namespace of names but stores each file
+# as UPLOAD_FOLDER/<shard>/<name>, the shard being the first STORAGE_SHARD_WIDTH hex
+# digits of a hash of the name (3 digits: 4096 folders, about 1200 files each at 5
+# million files).
+#
+# The layout in use is recorded in STATE_FOLDER/layout.json, so a folder keeps its
+# layout whatever STORAGE_LAYOUT says (that only picks the layout of a folder that
+# has no record yet). The migration is online: `python main.py migrate-layout`
+# records the sharded layout as pending (running servers pick it up within
+# LAYOUT_CHECK_INTERVAL), moves the existing files into their shards while the
+# server keeps serving them, and then records it as complete. While it is pending,
+# names not found in their shard are also looked up at the top level.
+
+app.config['STORAGE_LAYOUT'] = os.environ.get('STORAGE_LAYOUT', 'flat')  # flat | sharded
+app.config['STORAGE_SHARD_WIDTH'] = 3
+LAYOUT_CHECK_INTERVAL = 1  # seconds between checks of layout.json for a change
+
+
+class StorageLayout:
+    """
+    Maps file names to paths in UPLOAD_FOLDER for the layout recorded in
+    STATE_FOLDER/layout.json (or configured, for a folder without a record).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._state = None  # (layout, shard width, migration pending)
+        self._stamp = None  # mtime_ns of layout.json when it was read
+        self._checked = 0
+
+    @staticmethod
+    def record_path():
+        return os.path.join(app.config['STATE_FOLDER'], 'layout.json')
+
+    def current(self):
+        """
+        Returns (layout, shard width, migration pending), re-reading layout.json
+        when it changed.
+        """
+        now = time.monotonic()
+        if self._state is not None and now - self._checked < LAYOUT_CHECK_INTERVAL:
+            return self._state
+        with self.lock:
+            self._checked = now
+            try:
+                stamp = os.stat(self.record_path()).st_mtime_ns
+            except FileNotFoundError:
+                stamp = None
+            if self._state is None or stamp != self._stamp:
+                self._stamp = stamp
+                self._state = self._read()
+            return self._state
+
+    def _read(self):
+        try:
+            with open(self.record_path()) as f:
+                record = json.load(f)
+            return (record['layout'], int(record.get('width', app.config['STORAGE_SHARD_WIDTH'])),
+                    bool(record.get('pending')))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            log.error('Ignoring unreadable %s: %s', self.record_path(), e)
+        layout = app.config['STORAGE_LAYOUT']
+        if layout not in ('flat', 'sharded'):
+            log.warning("Unknown STORAGE_LAYOUT '%s'; using 'flat'", layout)
+            layout = 'flat'
+        pending = False
+        if layout == 'sharded':
+            # Remembered, so changing STORAGE_LAYOUT later can't hide the sharded files
+            pending = next(self.top_level_files(), None) is not None
+            if pending:
+                log.warning('UPLOAD_FOLDER has unsharded files; run `python main.py migrate-layout`')
+            self._write(layout, app.config['STORAGE_SHARD_WIDTH'], pending)
+            self._stamp = os.stat(self.record_path()).st_mtime_ns
+        return layout, app.config['STORAGE_SHARD_WIDTH'], pending
+
+    def _write(self, layout, width, pending):
+        os.makedirs(app.config['STATE_FOLDER'], exist_ok=True)
+        tmp_path = f'{self.record_path()}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"layout": layout, "width": width, "pending": pending}, f)
+        os.replace(tmp_path, self.record_path())
+
+    def record(self, layout, width, pending=False):
+        """
+        Makes layout the one this folder uses, for every server process.
+        """
+        self._write(layout, width, pending)
+        with self.lock:
+            self._state = None  # Read it back on next use
+
+    @staticmethod
+    def shard(name, width):
+        return hashlib.blake2b(name.encode('utf-8', 'surrogateescape'), digest_size=8).hexdigest()[:width]
+
+    def path(self, name):
+        """
+        Where name is stored in the current layout (whether or not it exists).
+        """
+        layout, width, _ = self.current()
+        if layout == 'sharded':
+            return os.path.join(app.config['UPLOAD_FOLDER'], self.shard(name, width), name)
+        return os.path.join(app.config['UPLOAD_FOLDER'], name)
+
+    def locate(self, name):
+        """
+        The path of the existing file called name: in its shard, or at the top
+        level while a migration is pending. Falls back to path(name).
+        """
+        _, _, pending = self.current()
+        path = self.path(name)
+        if not pending:
+            return path
+        flat_path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        # Shard first: a migration moving the file in between leaves it there
+        if path == flat_path or os.path.lexists(path) or not os.path.lexists(flat_path):
+            return path
+        return flat_path
+
+    def target(self, name):
+        """
+        The path a new version of name is written to; creates its shard folder.
+        """
+        path = self.path(name)
+        folder = os.path.dirname(path)
+        if folder != app.config['UPLOAD_FOLDER'] and not os.path.isdir(folder):
+            occupant = os.path.basename(folder)
+            if os.path.isfile(folder) and folder != os.path.dirname(self.path(occupant)):
+                self.migrate(occupant)  # An unmigrated file has the shard's name
+            os.makedirs(folder, exist_ok=True)
+        return path
+
+    def settle(self, name):
+        """
+        Removes the top-level copy of name once its shard holds the current
+        version (e.g. a file replaced before the migration reached it).
+        """
+        path = self.path(name)
+        flat_path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        if path == flat_path or not os.path.lexists(path):
+            return
+        digest = blob_store.digest_of(flat_path)
+        try:
+            os.remove(flat_path)
+        except FileNotFoundError:
+            return
+        blob_store.release(digest)
+
+    def migrate(self, name):
+        """
+        Moves one top-level file into its shard. Never overwrites: if the shard
+        already has a (newer) version, the top-level copy is dropped. Returns True
+        if the file was moved.
+        """
+        flat_path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        path = self.target(name)
+        if path == flat_path:
+            return False
+        try:
+            os.link(flat_path, path)  # Fails if the shard already has name
+        except FileExistsError:
+            self.settle(name)
+            return False
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # No hard links (FAT/exFAT): check, then rename
+            if os.path.lexists(path):
+                self.settle(name)
+                return False
+            os.rename(flat_path, path)
+            return True
+        os.remove(flat_path)
+        return True
+
+    def shard_folders(self):
+        """
+        The shard folders that exist in the current layout.
+        """
+        layout, width, _ = self.current()
+        if layout != 'sharded':
+            return []
+        with os.scandir(app.config['UPLOAD_FOLDER']) as it:
+            return [entry.path for entry in it if self.is_shard_name(entry.name, width) and entry.is_dir()]
+
+    @staticmethod
+    def is_shard_name(name, width):
+        return len(name) == width and all(c in '0123456789abcdef' for c in name)
+
+    def scan(self):
+        """
+        Yields a DirEntry for every visible regular file that can be found by
+        its name: in its own shard, or at the top level unless the folder is
+        completely sharded.
+        """
+        layout, width, pending = self.current()
+        if layout != 'sharded' or pending:
+            yield from self.top_level_files()
+        for folder in self.shard_folders():
+            shard = os.path.basename(folder)
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if self.shard(entry.name, width) != shard:
+                            continue  # Put there by hand; lookups by name would never find it
+                        if self._regular_file(entry):
+                            yield entry
+            except FileNotFoundError:
+                pass  # A shard folder that was removed
+
+    def top_level_files(self):
+        """
+        Yields a DirEntry for every visible regular file outside the shards.
+        """
+        with os.scandir(app.config['UPLOAD_FOLDER']) as it:
+            for entry in it:
+                # Dot-names are server state (.mkcloud) or OS litter
+                if not entry.name.startswith('.') and self._regular_file(entry):
+                    yield entry
+
+    @staticmethod
+    def _regular_file(entry):
+        try:
+            return entry.is_file(follow_symlinks=True)
+        except OSError:
+            return False  # Removed between readdir and stat
+
+
+storage = StorageLayout()
+
+
+def migrate_layout(width=None, pause=0.0, batch=1000):
+    """
+    Online migration of a flat UPLOAD_FOLDER to the sharded layout (see above).
+    Safe to interrupt and re-run; returns the number of files moved.
+    """
+    layout, current_width, pending = storage.current()
+    width = width or app.config['STORAGE_SHARD_WIDTH']
+    if layout == 'sharded' and width != current_width:
+        raise ValueError(f'UPLOAD_FOLDER is already sharded with width {current_width}')
+    if layout != 'sharded' or not pending:
+        storage.record('sharded', width, pending=True)
+        log.info('Layout: recorded sharded layout (width %d); waiting for servers to pick it up', width)
+        time.sleep(LAYOUT_CHECK_INTERVAL * 2)
+    moved = seen = 0
+    started = time.perf_counter()
+    # Servers that hadn't seen the new record yet may have added top-level files meanwhile
+    while True:
+        names = [entry.name for entry in storage.top_level_files()]
+        if not names:
+            break
+        log.info('Layout: %d files to move', len(names))
+        for name in names:
+            if storage.migrate(name):
+                moved += 1
+            seen += 1
+            if seen % batch == 0:
+                log.info('Layout: %d files (%.0f files/s)', seen, seen / (time.perf_counter() - started))
+                if pause:
+                    time.sleep(pause)  # Leave the disk to the server now and then
+    storage.record('sharded', width)
+    log.info('Layout: moved %d files into shards in %.1fs; migration complete', moved, time.perf_counter() - started)
+    return moved
+
 # --- Initialize UPLOAD_FOLDER and Example File ---
 # Ensure the uploads directory exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-print(f"Server configured to use UPLOAD_FOLDER: {UPLOAD_FOLDER}")
+log.info('Server configured to use UPLOAD_FOLDER: %s', UPLOAD_FOLDER)
 
 # Create an example file if it doesn't exist, for initial testing
-example_file_path = os.path.join(UPLOAD_FOLDER, 'example.txt')
+example_file_path = storage.locate('example.txt')
 if not os.path.exists(example_file_path):
     try:
-        with open(example_file_path, 'w') as f:
+        with open(storage.target('example.txt'), 'w') as f:
             f.write('This is an example file.\n')
             f.write('You can upload, download, or delete files here.')
-        print(f"Created example file: {example_file_path}")
+        log.info('Created example file: %s', example_file_path)
     except IOError as e:
-        print(f"Error creating example file {example_file_path}: {e}")
+        log.error('Error creating example file %s: %s', example_file_path, e)
+
+# --- Page Assets (Embedded Tailwind CSS and page script) ---
+# Served as versioned, long-cached files from /assets; see "Compiled Page and Static Assets".
+PAGE_CSS = '''
+/* Compiled and Minified Tailwind CSS for the dark theme and responsive design */
+/*! tailwindcss v3.4.3 | MIT License | https://tailwindcss.com */
+/*
+This is a compiled version of the Tailwind CSS used in the previous design.
+It's embedded directly here to ensure the styling works without an internet connection.
+*/
+*, ::before, ::after {
+    box-sizing: border-box;
+    border-width: 0;
+    border-style: solid;
+    border-color: #e5e7eb
+}
+::before, ::after {
+    --tw-content: ""
+}
+html {
+    line-height: 1.5;
+    -webkit-text-size-adjust: 100%;
+    font-family: ui-sans-serif, system-ui, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", "Segoe UI Symbol", "Noto Color Emoji";
+    font-feature-settings: normal;
+    font-variation-settings: normal
+}
+body {
+    margin: 0;
+    line-height: inherit
+}
+hr {
+    height: 0;
+    color: inherit;
+    border-top-width: 1px
+}
+abbr:where([title]) {
+    text-decoration: underline dotted
+}
+h1, h2, h3, h4, h5, h6 {
+    font-size: inherit;
+    font-weight: inherit
+}
+a {
+    color: inherit;
+    text-decoration: inherit
+}
+b, strong {
+    font-weight: bolder
+}
+code, kbd, samp, pre {
+    font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace;
+    font-size: 1em
+}
+small {
+    font-size: 80%
+}
+sub, sup {
+    font-size: 75%;
+    line-height: 0;
+    position: relative;
+    vertical-align: baseline
+}
+sub {
+    bottom: -0.25em
+}
+sup {
+    top: -0.5em
+}
+table {
+    text-indent: 0;
+    border-color: inherit;
+    border-collapse: collapse
+}
+button, input, optgroup, select, textarea {
+    font-family: inherit;
+    font-feature-settings: inherit;
+    font-variation-settings: inherit;
+    font-size: 100%;
+    font-weight: inherit;
+    line-height: inherit;
+    color: inherit;
+    margin: 0;
+    padding: 0
+}
+button, select {
+    text-transform: none
+}
+[type="button"], [type="reset"], [type="submit"] {
+    -webkit-appearance: button;
+    background-color: transparent;
+    background-image: none
+}
+:-moz-focusring {
+    outline: auto
+}
+:-moz-ui-invalid {
+    box-shadow: none
+}
+progress {
+    vertical-align: baseline
+}
+::-webkit-inner-spin-button, ::-webkit-outer-spin-button {
+    height: auto
+}
+[type="search"] {
+    -webkit-appearance: textfield;
+    outline-offset: -2px
+}
+::-webkit-search-decoration {
+    -webkit-appearance: none
+}
+::-webkit-file-upload-button {
+    -webkit-appearance: button;
+    font: inherit
+}
+summary {
+    display: list-item
+}
+blockquote, dl, dd, h1, h2, h3, h4, h5, h6, hr, figure, p, pre {
+    margin: 0
+}
+fieldset {
+    margin: 0;
+    padding: 0
+}
+legend {
+    padding: 0
+}
+ol, ul, menu {
+    list-style: none;
+    margin: 0;
+    padding: 0
+}
+textarea {
+    resize: vertical
+}
+input::placeholder, textarea::placeholder {
+    opacity: 1;
+    color: #9ca3af
+}
+button, [role="button"] {
+    cursor: pointer
+}
+:disabled {
+    cursor: default
+}
+img, svg, video, canvas, audio, iframe, embed, object {
+    display: block;
+    vertical-align: middle
+}
+img, video {
+    max-width: 100%;
+    height: auto
+}
+[hidden] {
+    display: none
+}
+*, ::before, ::after {
+    --tw-border-spacing-x: 0;
+    --tw-border-spacing-y: 0;
+    --tw-translate-x: 0;
+    --tw-translate-y: 0;
+    --tw-rotate: 0;
+    --tw-skew-x: 0;
+    --tw-skew-y: 0;
+    --tw-scale-x: 1;
+    --tw-scale-y: 1;
+    --tw-pan-x: ;
+    --tw-pan-y: ;
+    --tw-pinch-zoom: ;
+    --tw-scroll-snap-strictness: proximity;
+    --tw-ordinal: ;
+    --tw-slashed-zero: ;
+    --tw-numeric-figure: ;
+    --tw-numeric-spacing: ;
+    --tw-numeric-fraction: ;
+    --tw-ring-inset: ;
+    --tw-ring-offset-width: 0px;
+    --tw-ring-offset-color: #fff;
+    --tw-ring-color: rgb(59 130 246 / .5);
+    --tw-ring-offset-shadow: 0 0 #0000;
+    --tw-ring-shadow: 0 0 #0000;
+    --tw-shadow: 0 0 #0000;
+    --tw-shadow-rgb: 0 0 0;
+    --tw-filters: blur(0) saturate(1) brightness(1) contrast(1) grayscale(0) hue-rotate(0deg) invert(0) sepia(0) drop-shadow(0 0 #0000);
+    --tw-backdrop-filters: blur(0) saturate(1) brightness(1) contrast(1) grayscale(0) hue-rotate(0deg) invert(0) sepia(0);
+    --tw-contain-size: ;
+    --tw-contain-layout: ;
+    --tw-contain-paint: ;
+    --tw-contain-style:
+}
+::backdrop {
+    --tw-border-spacing-x: 0;
+    --tw-border-spacing-y: 0;
+    --tw-translate-x: 0;
+    --tw-translate-y: 0;
+    --tw-rotate: 0;
+    --tw-skew-x: 0;
+    --tw-skew-y: 0;
+    --tw-scale-x: 1;
+    --tw-scale-y: 1;
+    --tw-pan-x: ;
+    --tw-pan-y: ;
+    --tw-pinch-zoom: ;
+    --tw-scroll-snap-strictness: proximity;
+    --tw-ordinal: ;
+    --tw-slashed-zero: ;
+    --tw-numeric-figure: ;
+    --tw-numeric-spacing: ;
+    --tw-numeric-fraction: ;
+    --tw-ring-inset: ;
+    --tw-ring-offset-width: 0px;
+    --tw-ring-offset-color: #fff;
+    --tw-ring-color: rgb(59 130 246 / .5);
+    --tw-ring-offset-shadow: 0 0 #0000;
+    --tw-ring-shadow: 0 0 #0000;
+    --tw-shadow: 0 0 #0000;
+    --tw-shadow-rgb: 0 0 0;
+    --tw-filters: blur(0) saturate(1) brightness(1) contrast(1) grayscale(0) hue-rotate(0deg) invert(0) sepia(0) drop-shadow(0 0 #0000);
+    --tw-backdrop-filters: blur(0) saturate(1) brightness(1) contrast(1) grayscale(0) hue-rotate(0deg) invert(0) sepia(0);
+    --tw-contain-size: ;
+    --tw-contain-layout: ;
+    --tw-contain-paint: ;
+    --tw-contain-style:
+}
+.absolute {
+    position: absolute
+}
+.relative {
+    position: relative
+}
+.hidden {
+    display: none
+}
+.flex {
+    display: flex
+}
+.block {
+    display: block
+}
+.w-full {
+    width: 100%
+}
+.flex-grow {
+    flex-grow: 1
+}
+.flex-col {
+    flex-direction: column
+}
+.items-center {
+    align-items: center
+}
+.items-start {
+    align-items: flex-start
+}
+.justify-center {
+    justify-content: center
+}
+.justify-between {
+    justify-content: space-between
+}
+.justify-start {
+    justify-content: flex-start
+}
+.space-x-2>:not([hidden])~:not([hidden]) {
+    --tw-space-x: 0.5rem;
+    margin-left: var(--tw-space-x);
+    margin-right: 0
+}
+.space-y-3>:not([hidden])~:not([hidden]) {
+    --tw-space-y: 0.75rem;
+    margin-top: var(--tw-space-y);
+    margin-bottom: 0
+}
+.space-y-4>:not([hidden])~:not([hidden]) {
+    --tw-space-y: 1rem;
+    margin-top: var(--tw-space-y);
+    margin-bottom: 0
+}
+.space-y-8>:not([hidden])~:not([hidden]) {
+    --tw-space-y: 2rem;
+    margin-top: var(--tw-space-y);
+    margin-bottom: 0
+}
+.rounded-full {
+    border-radius: 9999px
+}
+.rounded-lg {
+    border-radius: 0.5rem
+}
+.rounded-xl {
+    border-radius: 0.75rem
+}
+.border {
+    border-width: 1px
+}
+.border-2 {
+    border-width: 2px
+}
+.border-dashed {
+    border-style: dashed
+}
+.border-transparent {
+    border-color: transparent
+}
+.border-gray-100 {
+    border-color: #f3f4f6
+}
+.border-gray-200 {
+    border-color: #e5e7eb
+}
+.border-gray-300 {
+    border-color: #d1d5db
+}
+.border-red-400 {
+    border-color: #f87171
+}
+.bg-white {
+    background-color: #fff
+}
+.bg-gray-50 {
+    background-color: #f9fafb
+}
+.bg-red-100 {
+    background-color: #fee2e2
+}
+.bg-indigo-50 {
+    background-color: #eef2ff
+}
+.bg-indigo-600 {
+    background-color: #4f46e5
+}
+.bg-green-500 {
+    background-color: #22c55e
+}
+.bg-red-500 {
+    background-color: #ef4444
+}
+.p-2 {
+    padding: 0.5rem
+}
+.p-4 {
+    padding: 1rem
+}
+.p-6 {
+    padding: 1.5rem
+}
+.p-8 {
+    padding: 2rem
+}
+.px-4 {
+    padding-left: 1rem;
+    padding-right: 1rem
+}
+.py-2 {
+    padding-top: 0.5rem;
+    padding-bottom: 0.5rem
+}
+.py-3 {
+    padding-top: 0.75rem;
+    padding-bottom: 0.75rem
+}
+.py-4 {
+    padding-top: 1rem;
+    padding-bottom: 1rem
+}
+.py-12 {
+    padding-top: 3rem;
+    padding-bottom: 3rem
+}
+.px-6 {
+    padding-left: 1.5rem;
+    padding-right: 1.5rem
+}
+.mb-2 {
+    margin-bottom: 0.5rem
+}
+.mb-4 {
+    margin-bottom: 1rem
+}
+.mt-1 {
+    margin-top: 0.25rem
+}
+.mt-4 {
+    margin-top: 1rem
+}
+.mt-8 {
+    margin-top: 2rem
+}
+.mr-4 {
+    margin-right: 1rem
+}
+.text-center {
+    text-align: center
+}
+.text-lg {
+    font-size: 1.125rem;
+    line-height: 1.75rem
+}
+.text-sm {
+    font-size: 0.875rem;
+    line-height: 1.25rem
+}
+.text-base {
+    font-size: 1rem;
+    line-height: 1.5rem
+}
+.text-2xl {
+    font-size: 1.5rem;
+    line-height: 2rem
+}
+.text-4xl {
+    font-size: 2.25rem;
+    line-height: 2.5rem
+}
+.font-semibold {
+    font-weight: 600
+}
+.font-bold {
+    font-weight: 700
+}
+.font-extrabold {
+    font-weight: 800
+}
+.font-medium {
+    font-weight: 500
+}
+.text-white {
+    color: #fff
+}
+.text-gray-900 {
+    color: #111827
+}
+.text-gray-600 {
+    color: #4b5563
+}
+.text-gray-700 {
+    color: #374151
+}
+.text-gray-500 {
+    color: #6b7280
+}
+.text-red-700 {
+    color: #b91c1c
+}
+.text-indigo-700 {
+    color: #4338ca
+}
+.truncate {
+    overflow: hidden;
+    text-overflow: ellipsis;
+    white-space: nowrap
+}
+.shadow-sm {
+    --tw-shadow: 0 1px 2px 0 rgb(0 0 0 / .05);
+    --tw-shadow-rgb: 0 0 0;
+    box-shadow: var(--tw-ring-offset-shadow, 0 0 #0000), var(--tw-ring-shadow, 0 0 #0000), var(--tw-shadow)
+}
+.shadow-lg {
+    --tw-shadow: 0 10px 15px -3px rgb(0 0 0 / .1), 0 4px 6px -4px rgb(0 0 0 / .1);
+    --tw-shadow-rgb: 0 0 0;
+    box-shadow: var(--tw-ring-offset-shadow, 0 0 #0000), var(--tw-ring-shadow, 0 0 #0000), var(--tw-shadow)
+}
+.shadow-2xl {
+    --tw-shadow: 0 25px 50px -12px rgb(0 0 0 / .25);
+    --tw-shadow-rgb: 0 0 0;
+    box-shadow: var(--tw-ring-offset-shadow, 0 0 #0000), var(--tw-ring-shadow, 0 0 #0000), var(--tw-shadow)
+}
+.shadow-inner {
+    --tw-shadow: inset 0 2px 4px 0 rgb(0 0 0 / .05);
+    --tw-shadow-rgb: 0 0 0;
+    box-shadow: var(--tw-ring-offset-shadow, 0 0 #0000), var(--tw-ring-shadow, 0 0 #0000), var(--tw-shadow)
+}
+.focus\:outline-none:focus {
+    outline: 2px solid transparent;
+    outline-offset: 2px
+}
+.focus\:ring-2:focus {
+    --tw-ring-offset-shadow: var(--tw-ring-inset) 0 0 0 var(--tw-ring-offset-width) var(--tw-ring-offset-color);
+    --tw-ring-shadow: var(--tw-ring-inset) 0 0 0 calc(2px + var(--tw-ring-offset-width)) var(--tw-ring-color);
+    box-shadow: var(--tw-ring-offset-shadow), var(--tw-ring-shadow), var(--tw-shadow, 0 0 #0000)
+}
+.focus\:ring-offset-2:focus {
+    --tw-ring-offset-width: 2px
+}
+.focus\:ring-indigo-500:focus {
+    --tw-ring-color: #6366f1
+}
+.hover\:border-indigo-500:hover {
+    border-color: #6366f1
+}
+.hover\:bg-indigo-100:hover {
+    background-color: #e0e7ff
+}
+.hover\:bg-indigo-700:hover {
+    background-color: #4338ca
+}
+.hover\:bg-green-600:hover {
+    background-color: #16a34a
+}
+.hover\:bg-red-600:hover {
+    background-color: #dc2626
+}
+.transition {
+    transition-property: color, background-color, border-color, text-decoration-color, fill, stroke, opacity, box-shadow, transform, filter, -webkit-backdrop-filter;
+    transition-property: color, background-color, border-color, text-decoration-color, fill, stroke, opacity, box-shadow, transform, filter, backdrop-filter;
+    transition-property: color, background-color, border-color, text-decoration-color, fill, stroke, opacity, box-shadow, transform, filter, backdrop-filter, -webkit-backdrop-filter;
+    transition-timing-function: cubic-bezier(0.4, 0, 0.2, 1);
+    transition-duration: 0.15s
+}
+.ease-in-out {
+    transition-timing-function: cubic-bezier(0.4, 0, 0.2, 1)
+}
+.duration-150 {
+    transition-duration: 0.15s
+}
+.duration-200 {
+    transition-duration: 0.2s
+}
+.duration-300 {
+    transition-duration: 0.3s
+}
+.min-h-screen {
+    min-height: 100vh
+}
+.relative {
+    position: relative
+}
+.absolute {
+    position: absolute
+}
+.top-4 {
+    top: 1rem
+}
+.right-4 {
+    right: 1rem
+}
+.cursor-pointer {
+    cursor: pointer
+}
+.bg-gradient-to-br {
+    background-image: linear-gradient(to bottom right, var(--tw-gradient-stops))
+}
+.from-indigo-50 {
+    --tw-gradient-from: #eef2ff;
+    --tw-gradient-to: rgb(238 242 255 / 0)
+}
+.to-purple-100 {
+    --tw-gradient-to: #ede9fe
+}
+.file\:mr-4::-webkit-file-upload-button {
+    margin-right: 1rem
+}
+.file\:mr-4::file-selector-button {
+    margin-right: 1rem
+}
+.file\:py-2::-webkit-file-upload-button {
+    padding-top: 0.5rem;
+    padding-bottom: 0.5rem
+}
+.file\:py-2::file-selector-button {
+    padding-top: 0.5rem;
+    padding-bottom: 0.5rem
+}
+.file\:px-4::-webkit-file-upload-button {
+    padding-left: 1rem;
+    padding-right: 1rem
+}
+.file\:px-4::file-selector-button {
+    padding-left: 1rem;
+    padding-right: 1rem
+}
+.file\:rounded-full::-webkit-file-upload-button {
+    border-radius: 9999px
+}
+.file\:rounded-full::file-selector-button {
+    border-radius: 9999px
+}
+.file\:border-0::-webkit-file-upload-button {
+    border-width: 0
+}
+.file\:border-0::file-selector-button {
+    border-width: 0
+}
+.file\:text-sm::-webkit-file-upload-button {
+    font-size: 0.875rem;
+    line-height: 1.25rem
+}
+.file\:text-sm::file-selector-button {
+    font-size: 0.875rem;
+    line-height: 1.25rem
+}
+.file\:font-semibold::-webkit-file-upload-button {
+    font-weight: 600
+}
+.file\:font-semibold::file-selector-button {
+    font-weight: 600
+}
+.file\:bg-indigo-50::-webkit-file-upload-button {
+    background-color: #eef2ff
+}
+.file\:bg-indigo-50::file-selector-button {
+    background-color: #eef2ff
+}
+.file\:text-indigo-700::-webkit-file-upload-button {
+    color: #4338ca
+}
+.file\:text-indigo-700::file-selector-button {
+    color: #4338ca
+}
+.hover\:file\:bg-indigo-100:hover::-webkit-file-upload-button {
+    background-color: #e0e7ff
+}
+.hover\:file\:bg-indigo-100:hover::file-selector-button {
+    background-color: #e0e7ff
+}
+@media (min-width: 640px) {
+    .sm\:px-6 {
+        padding-left: 1.5rem;
+        padding-right: 1.5rem
+    }
+    .sm\:items-center {
+        align-items: center
+    }
+    .sm\:mb-0 {
+        margin-bottom: 0
+    }
+    .sm\:w-auto {
+        width: auto
+    }
+}
+@media (min-width: 1024px) {
+    .lg\:px-8 {
+        padding-left: 2rem;
+        padding-right: 2rem
+    }
+}
+
+/* Custom CSS from previous iterations, adjusted for dark mode defaults */
+body {
+    font-family: 'Inter', sans-serif;
+    transition: background-color 0.3s ease, color 0.3s ease;
+    background-image: linear-gradient(to bottom right, #1a202c, #2d3748); /* Dark mode background */
+}
+.file-item, .drop-zone {
+    transition: transform 0.2s ease-in-out, box-shadow 0.2s ease-in-out, background-color 0.3s ease;
+}
+.file-item:hover {
+    transform: translateY(-2px);
+    box-shadow: 0 8px 16px rgba(0, 0, 0, 0.1);
+}
+.btn-primary, .btn-delete {
+    transition: transform 0.15s ease-in-out, box-shadow 0.15s ease-in-out, background-color 0.3s ease;
+}
+.btn-primary:hover {
+    transform: translateY(-1px);
+    box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
+}
+.btn-delete:hover {
+    background-color: #dc2626; /* Red-600 */
+}
+/* Dark mode specific styles - now applied by default */
+.bg-white { background-color: #2d3748; }
+.text-gray-900 { color: #e2e8f0; }
+.text-gray-600 { color: #a0aec0; }
+.bg-gray-50 { background-color: #4a5568; }
+.text-gray-800 { color: #e2e8f0; }
+.text-gray-700 { color: #cbd5e0; }
+.file-item { background-color: #4a5568; border-color: #2d3748; }
+.border-gray-200, .border-gray-100 { border-color: #4a5568; }
+.text-gray-500 { color: #a0aec0; }
+.file\:bg-indigo-50 { background-color: #4338ca; } /* Indigo-700 for dark mode */
+.file\:text-indigo-700 { color: #e0e7ff; } /* Indigo-100 for dark mode */
+.hover\:file\:bg-indigo-100:hover { background-color: #3730a3; } /* Indigo-800 for dark mode */
+.focus\:ring-indigo-500:focus { --tw-ring-color: #6366f1; } /* Indigo-500 for dark mode */
+.bg-indigo-600 { background-color: #4f46e5; }
+.hover\:bg-indigo-700:hover { background-color: #4338ca; }
+.bg-green-500 { background-color: #22c55e; }
+.hover\:bg-green-600:hover { background-color: #16a34a; }
+.bg-red-500 { background-color: #ef4444; }
+.hover\:bg-red-600:hover { background-color: #dc2626; }
+.drop-zone.highlight { border-color: #818cf8; background-color: rgba(129, 140, 248, 0.1); }
+.file-control {
+    background-color: #4a5568;
+    color: #e2e8f0;
+    border: 1px solid #2d3748;
+    border-radius: 0.5rem;
+    padding: 0.5rem 0.75rem;
+    font-size: 0.875rem;
+}
+.file-meta { font-size: 0.875rem; color: #a0aec0; margin-bottom: 0.5rem; }
+.file-thumb {
+    width: 4rem;
+    height: 4rem;
+    object-fit: cover;
+    border-radius: 0.375rem;
+    margin-right: 0.75rem;
+    flex-shrink: 0;
+    background-color: #2d3748;
+}
+.text-preview {
+    width: 100%;
+    max-height: 12rem;
+    overflow: auto;
+    white-space: pre-wrap;
+    word-break: break-word;
+    font-size: 0.75rem;
+    background-color: #2d3748;
+    color: #e2e8f0;
+    border-radius: 0.375rem;
+    padding: 0.5rem;
+    margin-bottom: 0.5rem;
+}
+.suggestions {
+    position: absolute;
+    left: 0;
+    right: 0;
+    top: 100%;
+    z-index: 10;
+    margin-top: 0.25rem;
+    background-color: #4a5568;
+    border: 1px solid #2d3748;
+    border-radius: 0.5rem;
+    box-shadow: 0 8px 16px rgba(0, 0, 0, 0.3);
+    overflow: hidden;
+}
+.suggestions li {
+    display: flex;
+    justify-content: space-between;
+    padding: 0.375rem 0.75rem;
+    font-size: 0.875rem;
+    color: #e2e8f0;
+    cursor: pointer;
+}
+.suggestions li.active { background-color: #4338ca; }
+.suggestions li span:first-child { overflow: hidden; text-overflow: ellipsis; white-space: nowrap; }
+.suggestions li span:last-child { color: #a0aec0; margin-left: 0.75rem; flex-shrink: 0; }
+.suggestions mark { background: none; color: #a5b4fc; font-weight: 600; }
+
+/* Mobile-friendly adjustments (apply to all screen sizes for mobile-first) */
+.max-w-4xl {
+    max-width: 100%;
+    padding: 1rem;
+}
+@media (min-width: 640px) {
+    .max-w-4xl {
+        max-width: 56rem;
+        padding: 2rem;
+    }
+}
+.file-item {
+    flex-direction: column;
+    align-items: flex-start;
+}
+.file-item .flex.space-x-2 {
+    width: 100%;
+    justify-content: flex-start;
+    margin-top: 0.5rem;
+}
+'''
+
+PAGE_JS = '''
+const dropZone = document.getElementById('drop-zone');
+const hiddenFileInput = document.getElementById('hidden-file-input');
+const errorMessageDiv = document.getElementById('error-message');
+const errorTextSpan = document.getElementById('error-text');
+const fileListUl = document.getElementById('file-list');
+const fileFilterInput = document.getElementById('file-filter');
+const suggestionsUl = document.getElementById('search-suggestions');
+const fileSortSelect = document.getElementById('file-sort');
+const fileCountP = document.getElementById('file-count');
+const loadMoreButton = document.getElementById('load-more');
+const bulkFormatSelect = document.getElementById('bulk-format');
+const downloadSelectedButton = document.getElementById('download-selected');
+const deleteSelectedButton = document.getElementById('delete-selected');
+
+function showErrorMessage(message) {
+    errorTextSpan.textContent = message;
+    errorMessageDiv.classList.remove('hidden');
+    setTimeout(() => {
+        errorMessageDiv.classList.add('hidden');
+    }, 5000); // Hide after 5 seconds
+}
+
+dropZone.addEventListener('click', () => {
+    hiddenFileInput.click(); // Trigger hidden file input click
+});
+
+hiddenFileInput.addEventListener('change', (event) => {
+    const files = event.target.files;
+    handleFiles(files);
+});
+
+dropZone.addEventListener('dragover', (event) => {
+    event.preventDefault();
+    dropZone.classList.add('highlight');
+});
+
+dropZone.addEventListener('dragleave', (event) => {
+    dropZone.classList.remove('highlight');
+});
+
+dropZone.addEventListener('drop', (event) => {
+    event.preventDefault();
+    dropZone.classList.remove('highlight');
+    const files = event.dataTransfer.files;
+    handleFiles(files);
+});
+
+// Files above this size use the resumable chunked upload API, so a dropped
+// connection only costs the chunks that were in flight.
+const RESUMABLE_THRESHOLD = 64 * 1024 * 1024;
+const PARALLEL_CHUNKS = 3;
+const CHUNK_RETRIES = 5;
+
+function resumeKey(file) {
+    return `upload:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+async function getUploadSession(file) {
+    // Reuse a session left over from an interrupted attempt, if the server still has it
+    const savedId = localStorage.getItem(resumeKey(file));
+    if (savedId) {
+        const response = await fetch(`/uploads/${savedId}`);
+        if (response.ok) {
+            return response.json();
+        }
+        localStorage.removeItem(resumeKey(file));
+    }
+    const response = await fetch('/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    });
+    if (!response.ok) {
+        throw new Error((await response.json()).error || 'Could not start upload.');
+    }
+    const session = await response.json();
+    localStorage.setItem(resumeKey(file), session.upload_id);
+    return session;
+}
+
+async function putChunk(session, file, index) {
+    const start = index * session.chunk_size;
+    const chunk = file.slice(start, Math.min(start + session.chunk_size, file.size));
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const response = await fetch(`/uploads/${session.upload_id}/chunks/${index}`, {
+                method: 'PUT',
+                body: chunk
+            });
+            if (response.ok) {
+                return;
+            }
+            if (response.status < 500 || attempt >= CHUNK_RETRIES) {
+                throw new Error((await response.json()).error || 'Chunk upload failed.');
+            }
+        } catch (error) {
+            if (attempt >= CHUNK_RETRIES) {
+                throw error;
+            }
+        }
+        // Back off before retrying the same chunk
+        await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+    }
+}
+
+async function uploadResumable(file) {
+    const session = await getUploadSession(file);
+    const pending = session.missing_chunks.slice();
+    const workers = [];
+    for (let i = 0; i < PARALLEL_CHUNKS; i++) {
+        workers.push((async () => {
+            while (pending.length > 0) {
+                await putChunk(session, file, pending.shift());
+            }
+        })());
+    }
+    await Promise.all(workers);
+
+    const response = await fetch(`/uploads/${session.upload_id}/complete`, { method: 'POST' });
+    if (!response.ok) {
+        throw new Error((await response.json()).error || 'Could not finish upload.');
+    }
+    localStorage.removeItem(resumeKey(file));
+}
+
+function handleFiles(files) {
+    if (files.length === 0) {
+        return;
+    }
+
+    const formData = new FormData();
+    const largeFiles = [];
+    for (let i = 0; i < files.length; i++) {
+        const file = files[i];
+        if (file.size > RESUMABLE_THRESHOLD) {
+            largeFiles.push(file);
+        } else {
+            formData.append('file', file); // Append all small files directly
+        }
+    }
+
+    largeFiles.forEach(file => {
+        uploadResumable(file)
+            .catch(error => {
+                console.error('Resumable upload failed:', error);
+                showErrorMessage(`Upload of ${file.name} failed: ${error.message} Drop it again to resume.`);
+            });
+    });
+    if (!formData.has('file')) {
+        return;
+    }
+
+    // Submit the form data; the server answers with a per-file summary
+    fetch('/', {
+        method: 'POST',
+        body: formData
+    })
+    .then(response => response.json())
+    .then(summary => {
+        const failed = (summary.files || []).filter(result => result.error);
+        if (summary.error && failed.length === 0) {
+            showErrorMessage('Upload failed: ' + summary.error);
+        } else if (failed.length > 0) {
+            showErrorMessage('Upload failed for ' + failed.map(result => `${result.filename}: ${result.error}`).join('; '));
+        }
+        // The change feed delivers the new files to the list
+    })
+    .catch(error => {
+        console.error('Upload failed:', error);
+        showErrorMessage('Network error during upload.');
+    });
+}
+
+// Builds the <li> for one file. Names are escaped, since files copied into
+// UPLOAD_FOLDER by other means can contain any characters.
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+function formatSize(bytes) {
+    const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+    let i = 0;
+    while (bytes >= 1024 && i < units.length - 1) {
+        bytes /= 1024;
+        i++;
+    }
+    return `${i === 0 ? bytes : bytes.toFixed(1)} ${units[i]}`;
+}
+
+function createFileItem(file) {
+    const template = document.createElement('template');
+    const name = escapeHtml(file.name);
+    const url = encodeURIComponent(file.name);
+    const modified = new Date(file.mtime * 1000).toLocaleString();
+    // Thumbnail URLs carry the mtime, so the browser may cache them for good
+    const thumb = file.preview === 'image'
+        ? `<img class="file-thumb" loading="lazy" alt="" src="/preview/${url}?v=${file.mtime}">`
+        : '';
+    const previewButton = file.preview === 'text'
+        ? `<button type="button" class="btn-preview inline-flex items-center px-4 py-2 border border-transparent text-sm font-medium rounded-full shadow-sm text-white bg-indigo-600 hover:bg-indigo-700 focus:outline-none focus:ring-2 focus:ring-offset-2 focus:ring-indigo-500 transition ease-in-out duration-150">
+                        Preview
+                    </button>`
+        : '';
+    template.innerHTML = `
+            <li class="file-item flex flex-col items-start justify-between p-4 bg-gray-50 rounded-lg shadow-sm transition ease-in-out duration-200 border border-gray-100">
+                <label class="flex items-center w-full mb-2">
+                    <input type="checkbox" class="file-select mr-3">
+                    ${thumb}
+                    <span class="text-lg text-gray-800 font-medium truncate flex-grow mr-4">${name}</span>
+                </label>
+                <span class="file-meta">${formatSize(file.size)} &middot; ${escapeHtml(modified)}</span>
+                <div class="flex space-x-2 w-full justify-start">
+                    <a href="/download/${url}" class="inline-flex items-center px-4 py-2 border border-transparent text-sm font-medium rounded-full shadow-sm text-white bg-green-500 hover:bg-green-600 focus:outline-none focus:ring-2 focus:ring-offset-2 focus:ring-green-500 transition ease-in-out duration-150">
+                        Download
+                    </a>
+                    ${previewButton}
+                    <form action="/delete/${url}" method="post" class="delete-form">
+                        <button type="submit" class="btn-delete inline-flex items-center px-4 py-2 border border-transparent text-sm font-medium rounded-full shadow-sm text-white bg-red-500 hover:bg-red-600 focus:outline-none focus:ring-2 focus:ring-offset-2 focus:ring-red-500 transition ease-in-out duration-150">
+                            Delete
+                        </button>
+                    </form>
+                </div>
+            </li>`;
+    const li = template.content.firstElementChild;
+    li.dataset.name = file.name;
+    const thumbImg = li.querySelector('.file-thumb');
+    if (thumbImg) {
+        thumbImg.onerror = () => thumbImg.remove();
+    }
+    const previewBtn = li.querySelector('.btn-preview');
+    if (previewBtn) {
+        previewBtn.onclick = () => toggleTextPreview(li, file, previewBtn);
+    }
+    li.querySelector('.delete-form').onsubmit = event => {
+        event.preventDefault();
+        if (confirm(`Are you sure you want to delete ${file.name}?`)) {
+            deleteFiles([file.name]);
+        }
+    };
+    const checkbox = li.querySelector('.file-select');
+    checkbox.checked = selectedFiles.has(file.name);
+    checkbox.addEventListener('change', () => {
+        if (checkbox.checked) {
+            selectedFiles.add(file.name);
+        } else {
+            selectedFiles.delete(file.name);
+        }
+        updateSelectionChrome();
+    });
+    return li;
+}
+
+// Shows the first lines of a text file under its entry, fetched on first use
+function toggleTextPreview(li, file, button) {
+    const shown = li.querySelector('.text-preview');
+    if (shown) {
+        shown.remove();
+        button.textContent = 'Preview';
+        return;
+    }
+    const pre = document.createElement('pre');
+    pre.className = 'text-preview';
+    pre.textContent = 'Loading…';
+    li.insertBefore(pre, li.querySelector('.file-meta').nextSibling);
+    button.textContent = 'Hide preview';
+    fetch(`/preview/${encodeURIComponent(file.name)}?v=${file.mtime}`)
+        .then(response => response.ok ? response.text() : Promise.reject(new Error(response.statusText)))
+        .then(text => { pre.textContent = text; })
+        .catch(() => { pre.textContent = 'No preview available.'; });
+}
+
+// The list shows pages of /files_json in the selected order and filter. Records
+// currently shown (in display order) and the cursor of the next page:
+let shownFiles = [];
+let nextCursor = null;
+let totalFiles = 0;
+let listRequest = 0; // Ignores responses to superseded requests
+const selectedFiles = new Set(); // Names ticked for a bulk download; survives re-sorting
+
+function updateSelectionChrome() {
+    downloadSelectedButton.disabled = selectedFiles.size === 0;
+    downloadSelectedButton.textContent = selectedFiles.size > 0
+        ? `Download selected (${selectedFiles.size})`
+        : 'Download selected';
+    deleteSelectedButton.disabled = selectedFiles.size === 0;
+    deleteSelectedButton.textContent = selectedFiles.size > 0
+        ? `Delete selected (${selectedFiles.size})`
+        : 'Delete selected';
+}
+
+// Deletes files in one request without reloading the page; the change feed then
+// removes them from the list. Disk space is freed by the server in the background.
+function deleteFiles(names) {
+    fetch('/delete_batch', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ names }),
+    })
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                showErrorMessage(data.error);
+                return;
+            }
+            data.removed.forEach(name => selectedFiles.delete(name));
+            updateSelectionChrome();
+            if (data.missing.length > 0) {
+                showErrorMessage(`${data.missing.length} file(s) were already gone.`);
+            }
+        })
+        .catch(error => {
+            console.error('Network error deleting files:', error);
+            showErrorMessage('Network error deleting files.');
+        });
+}
+
+function deleteSelected() {
+    if (confirm(`Are you sure you want to delete ${selectedFiles.size} files?`)) {
+        deleteFiles(Array.from(selectedFiles));
+    }
+}
+
+// Streams the selected files as one archive. A regular form POST lets the
+// browser save the response itself instead of buffering it in a Blob.
+function downloadSelected() {
+    const form = document.createElement('form');
+    form.method = 'post';
+    form.action = '/bulk_download';
+    const fields = [['format', bulkFormatSelect.value]];
+    selectedFiles.forEach(name => fields.push(['name', name]));
+    fields.forEach(([key, value]) => {
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = key;
+        input.value = value;
+        form.appendChild(input);
+    });
+    document.body.appendChild(form);
+    form.submit();
+    form.remove();
+}
+
+function currentView() {
+    const [sort, order] = fileSortSelect.value.split(':');
+    return { sort, order, q: fileFilterInput.value.trim() };
+}
+
+// Orders records the same way the server does: by (key, name), optionally descending
+function compareFiles(a, b) {
+    const view = currentView();
+    const key = file => view.sort === 'name' ? [file.name] : [file[view.sort], file.name];
+    const ka = key(a), kb = key(b);
+    let result = 0;
+    for (let i = 0; i < ka.length && result === 0; i++) {
+        result = ka[i] < kb[i] ? -1 : ka[i] > kb[i] ? 1 : 0;
+    }
+    return view.order === 'desc' ? -result : result;
+}
+
+function matchesFilter(file) {
+    return file.name.toLowerCase().includes(currentView().q.toLowerCase());
+}
 
-# --- HTML Template (Embedded directly in Python with embedded Tailwind CSS) ---
+function updateListChrome() {
+    if (shownFiles.length === 0) {
+        fileListUl.innerHTML = currentView().q
+            ? '<p class="text-gray-600 text-center py-4">No files match the filter.</p>'
+            : '<p class="text-gray-600 text-center py-4">No files uploaded yet. Be the first to share!</p>';
+    }
+    fileCountP.textContent = totalFiles > 0 ? `Showing ${shownFiles.length} of ${totalFiles} files` : '';
+    loadMoreButton.classList.toggle('hidden', nextCursor === null);
+}
+
+// Function to update the file list dynamically (full replacement or next page)
+function updateFileList(page, append) {
+    if (!append || shownFiles.length === 0) {
+        fileListUl.innerHTML = '';
+        shownFiles = [];
+    }
+    const fragment = document.createDocumentFragment();
+    page.files.forEach(file => {
+        shownFiles.push(file);
+        fragment.appendChild(createFileItem(file));
+    });
+    fileListUl.appendChild(fragment);
+    nextCursor = page.next_cursor;
+    totalFiles = page.total;
+    updateListChrome();
+}
+
+// Function to fetch files from the server via JSON endpoint
+function fetchFiles(append) {
+    const view = currentView();
+    const params = new URLSearchParams({ sort: view.sort, order: view.order, limit: 200 });
+    if (view.q) {
+        params.set('q', view.q);
+    }
+    if (append && nextCursor) {
+        params.set('cursor', nextCursor);
+    }
+    const request = ++listRequest;
+    fetch('/files_json?' + params)
+        .then(response => response.json())
+        .then(data => {
+            if (request !== listRequest) {
+                return;
+            }
+            if (data.error) {
+                console.error('Error fetching files:', data.error);
+                showErrorMessage('Could not load file list.');
+            } else {
+                updateFileList(data, append);
+            }
+        })
+        .catch(error => {
+            console.error('Network error fetching files:', error);
+            showErrorMessage('Network error loading file list.');
+        });
+}
+
+function removeShownFile(name) {
+    const index = shownFiles.findIndex(file => file.name === name);
+    if (index !== -1) {
+        shownFiles.splice(index, 1);
+        fileListUl.children[index].remove();
+        return true;
+    }
+    return false;
+}
+
+// Applies a change-feed delta to the loaded part of the list without refetching
+function applyDelta(delta) {
+    if (shownFiles.length === 0) {
+        fileListUl.innerHTML = ''; // Drop the "no files" message
+    }
+    delta.removed.forEach(name => {
+        selectedFiles.delete(name);
+        if (removeShownFile(name)) {
+            totalFiles--;
+        }
+    });
+    delta.added.forEach(file => {
+        const wasShown = removeShownFile(file.name);
+        if (!matchesFilter(file)) {
+            return;
+        }
+        let index = shownFiles.findIndex(other => compareFiles(file, other) < 0);
+        if (index === -1) {
+            if (nextCursor !== null) {
+                return; // Belongs to a page that hasn't been loaded yet
+            }
+            index = shownFiles.length;
+        }
+        if (!wasShown) {
+            totalFiles++;
+        }
+        shownFiles.splice(index, 0, file);
+        fileListUl.insertBefore(createFileItem(file), fileListUl.children[index] || null);
+    });
+    updateListChrome();
+    updateSelectionChrome();
+}
+
+let filterTimer = null;
+let suggestTimer = null;
+fileFilterInput.addEventListener('input', () => {
+    clearTimeout(filterTimer);
+    filterTimer = setTimeout(() => fetchFiles(false), 250);
+    clearTimeout(suggestTimer);
+    suggestTimer = setTimeout(fetchSuggestions, 60);
+});
+
+// Type-ahead: the best matches from /search appear under the filter while typing;
+// picking one narrows the list to that file.
+let suggestRequest = 0;
+let suggestions = [];
+let activeSuggestion = -1;
+
+function hideSuggestions() {
+    suggestions = [];
+    activeSuggestion = -1;
+    suggestionsUl.innerHTML = '';
+    suggestionsUl.classList.add('hidden');
+}
+
+function renderSuggestions() {
+    suggestionsUl.innerHTML = '';
+    suggestions.forEach((file, index) => {
+        const length = fileFilterInput.value.trim().length;
+        const li = document.createElement('li');
+        li.classList.toggle('active', index === activeSuggestion);
+        li.innerHTML = `<span>${escapeHtml(file.name.slice(0, file.match))}<mark>${
+            escapeHtml(file.name.slice(file.match, file.match + length))}</mark>${
+            escapeHtml(file.name.slice(file.match + length))}</span><span>${formatSize(file.size)}</span>`;
+        li.addEventListener('mousedown', event => {
+            event.preventDefault(); // Keep the focus in the input
+            pickSuggestion(index);
+        });
+        suggestionsUl.appendChild(li);
+    });
+    suggestionsUl.classList.toggle('hidden', suggestions.length === 0);
+}
+
+function fetchSuggestions() {
+    const q = fileFilterInput.value.trim();
+    const request = ++suggestRequest;
+    if (!q) {
+        hideSuggestions();
+        return;
+    }
+    fetch('/search?' + new URLSearchParams({ q, limit: 8 }))
+        .then(response => response.json())
+        .then(data => {
+            if (request !== suggestRequest || data.error) {
+                return;
+            }
+            suggestions = data.files;
+            activeSuggestion = -1;
+            renderSuggestions();
+        })
+        .catch(() => hideSuggestions());
+}
+
+function pickSuggestion(index) {
+    fileFilterInput.value = suggestions[index].name;
+    hideSuggestions();
+    suggestRequest++; // Drop answers still on their way
+    clearTimeout(filterTimer);
+    fetchFiles(false);
+}
+
+fileFilterInput.addEventListener('keydown', event => {
+    if (suggestions.length === 0) {
+        return;
+    }
+    if (event.key === 'ArrowDown' || event.key === 'ArrowUp') {
+        event.preventDefault();
+        const step = event.key === 'ArrowDown' ? 1 : -1;
+        // Cycles through the suggestions and back to none (-1)
+        const states = suggestions.length + 1;
+        activeSuggestion = (activeSuggestion + 1 + step + states) % states - 1;
+        renderSuggestions();
+    } else if (event.key === 'Enter' && activeSuggestion >= 0) {
+        event.preventDefault();
+        pickSuggestion(activeSuggestion);
+    } else if (event.key === 'Escape') {
+        hideSuggestions();
+    }
+});
+fileFilterInput.addEventListener('blur', hideSuggestions);
+fileSortSelect.addEventListener('change', () => fetchFiles(false));
+loadMoreButton.addEventListener('click', () => fetchFiles(true));
+downloadSelectedButton.addEventListener('click', downloadSelected);
+deleteSelectedButton.addEventListener('click', deleteSelected);
+
+// Subscribes to the server's change feed; the browser reconnects by itself
+// and resumes from the last event id it saw.
+function connectChangeFeed() {
+    if (!window.EventSource) {
+        fetchFiles(false);
+        setInterval(() => fetchFiles(false), 2000); // Old browsers: fall back to polling
+        return;
+    }
+    const source = new EventSource('/events');
+    source.addEventListener('reset', () => fetchFiles(false));
+    source.addEventListener('delta', event => applyDelta(JSON.parse(event.data)));
+}
+
+// Initial load and live updates of the file list
+document.addEventListener('DOMContentLoaded', () => {
+    connectChangeFeed();
+});
+
+// Check for server-side error message in URL query parameters
+const urlParams = new URLSearchParams(window.location.search);
+const serverErrorMessage = urlParams.get('error');
+if (serverErrorMessage) {
+    showErrorMessage(serverErrorMessage);
+    // Optionally clear the error from URL after displaying
+    // history.replaceState(null, '', window.location.pathname);
+}
+'''
+
+# --- HTML Template (Embedded directly in Python; CSS and JS are served from /assets) ---
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
 <html lang="en" class="dark"> <!-- Set to dark mode by default -->
@@ -45,1034 +1922,4790 @@ HTML_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>MK Cloud Server</title>
-    <!-- Embedded Tailwind CSS for offline functionality -->
-    <style>
-        /* Compiled and Minified Tailwind CSS for the dark theme and responsive design */
-        /*! tailwindcss v3.4.3 | MIT License | https://tailwindcss.com */
-        /*
-        This is a compiled version of the Tailwind CSS used in the previous design.
-        It's embedded directly here to ensure the styling works without an internet connection.
-        */
-        *, ::before, ::after {
-            box-sizing: border-box;
-            border-width: 0;
-            border-style: solid;
-            border-color: #e5e7eb
-        }
-        ::before, ::after {
-            --tw-content: ""
-        }
-        html {
-            line-height: 1.5;
-            -webkit-text-size-adjust: 100%;
-            font-family: ui-sans-serif, system-ui, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", "Segoe UI Symbol", "Noto Color Emoji";
-            font-feature-settings: normal;
-            font-variation-settings: normal
-        }
-        body {
-            margin: 0;
-            line-height: inherit
-        }
-        hr {
-            height: 0;
-            color: inherit;
-            border-top-width: 1px
-        }
-        abbr:where([title]) {
-            text-decoration: underline dotted
-        }
-        h1, h2, h3, h4, h5, h6 {
-            font-size: inherit;
-            font-weight: inherit
-        }
-        a {
-            color: inherit;
-            text-decoration: inherit
-        }
-        b, strong {
-            font-weight: bolder
-        }
-        code, kbd, samp, pre {
-            font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace;
-            font-size: 1em
-        }
-        small {
-            font-size: 80%
-        }
-        sub, sup {
-            font-size: 75%;
-            line-height: 0;
-            position: relative;
-            vertical-align: baseline
-        }
-        sub {
-            bottom: -0.25em
-        }
-        sup {
-            top: -0.5em
-        }
-        table {
-            text-indent: 0;
-            border-color: inherit;
-            border-collapse: collapse
-        }
-        button, input, optgroup, select, textarea {
-            font-family: inherit;
-            font-feature-settings: inherit;
-            font-variation-settings: inherit;
-            font-size: 100%;
-            font-weight: inherit;
-            line-height: inherit;
-            color: inherit;
-            margin: 0;
-            padding: 0
-        }
-        button, select {
-            text-transform: none
-        }
-        [type="button"], [type="reset"], [type="submit"] {
-            -webkit-appearance: button;
-            background-color: transparent;
-            background-image: none
-        }
-        :-moz-focusring {
-            outline: auto
-        }
-        :-moz-ui-invalid {
-            box-shadow: none
-        }
-        progress {
-            vertical-align: baseline
-        }
-        ::-webkit-inner-spin-button, ::-webkit-outer-spin-button {
-            height: auto
-        }
-        [type="search"] {
-            -webkit-appearance: textfield;
-            outline-offset: -2px
-        }
-        ::-webkit-search-decoration {
-            -webkit-appearance: none
-        }
-        ::-webkit-file-upload-button {
-            -webkit-appearance: button;
-            font: inherit
-        }
-        summary {
-            display: list-item
-        }
-        blockquote, dl, dd, h1, h2, h3, h4, h5, h6, hr, figure, p, pre {
-            margin: 0
-        }
-        fieldset {
-            margin: 0;
-            padding: 0
-        }
-        legend {
-            padding: 0
-        }
-        ol, ul, menu {
-            list-style: none;
-            margin: 0;
-            padding: 0
-        }
-        textarea {
-            resize: vertical
-        }
-        input::placeholder, textarea::placeholder {
-            opacity: 1;
-            color: #9ca3af
-        }
-        button, [role="button"] {
-            cursor: pointer
-        }
-        :disabled {
-            cursor: default
-        }
-        img, svg, video, canvas, audio, iframe, embed, object {
-            display: block;
-            vertical-align: middle
-        }
-        img, video {
-            max-width: 100%;
-            height: auto
-        }
-        [hidden] {
-            display: none
-        }
-        *, ::before, ::after {
-            --tw-border-spacing-x: 0;
-            --tw-border-spacing-y: 0;
-            --tw-translate-x: 0;
-            --tw-translate-y: 0;
-            --tw-rotate: 0;
-            --tw-skew-x: 0;
-            --tw-skew-y: 0;
-            --tw-scale-x: 1;
-            --tw-scale-y: 1;
-            --tw-pan-x: ;
-            --tw-pan-y: ;
-            --tw-pinch-zoom: ;
-            --tw-scroll-snap-strictness: proximity;
-            --tw-ordinal: ;
-            --tw-slashed-zero: ;
-            --tw-numeric-figure: ;
-            --tw-numeric-spacing: ;
-            --tw-numeric-fraction: ;
-            --tw-ring-inset: ;
-            --tw-ring-offset-width: 0px;
-            --tw-ring-offset-color: #fff;
-            --tw-ring-color: rgb(59 130 246 / .5);
-            --tw-ring-offset-shadow: 0 0 #0000;
-            --tw-ring-shadow: 0 0 #0000;
-            --tw-shadow: 0 0 #0000;
-            --tw-shadow-rgb: 0 0 0;
-            --tw-filters: blur(0) saturate(1) brightness(1) contrast(1) grayscale(0) hue-rotate(0deg) invert(0) sepia(0) drop-shadow(0 0 #0000);
-            --tw-backdrop-filters: blur(0) saturate(1) brightness(1) contrast(1) grayscale(0) hue-rotate(0deg) invert(0) sepia(0);
-            --tw-contain-size: ;
-            --tw-contain-layout: ;
-            --tw-contain-paint: ;
-            --tw-contain-style:
-        }
-        ::backdrop {
-            --tw-border-spacing-x: 0;
-            --tw-border-spacing-y: 0;
-            --tw-translate-x: 0;
-            --tw-translate-y: 0;
-            --tw-rotate: 0;
-            --tw-skew-x: 0;
-            --tw-skew-y: 0;
-            --tw-scale-x: 1;
-            --tw-scale-y: 1;
-            --tw-pan-x: ;
-            --tw-pan-y: ;
-            --tw-pinch-zoom: ;
-            --tw-scroll-snap-strictness: proximity;
-            --tw-ordinal: ;
-            --tw-slashed-zero: ;
-            --tw-numeric-figure: ;
-            --tw-numeric-spacing: ;
-            --tw-numeric-fraction: ;
-            --tw-ring-inset: ;
-            --tw-ring-offset-width: 0px;
-            --tw-ring-offset-color: #fff;
-            --tw-ring-color: rgb(59 130 246 / .5);
-            --tw-ring-offset-shadow: 0 0 #0000;
-            --tw-ring-shadow: 0 0 #0000;
-            --tw-shadow: 0 0 #0000;
-            --tw-shadow-rgb: 0 0 0;
-            --tw-filters: blur(0) saturate(1) brightness(1) contrast(1) grayscale(0) hue-rotate(0deg) invert(0) sepia(0) drop-shadow(0 0 #0000);
-            --tw-backdrop-filters: blur(0) saturate(1) brightness(1) contrast(1) grayscale(0) hue-rotate(0deg) invert(0) sepia(0);
-            --tw-contain-size: ;
-            --tw-contain-layout: ;
-            --tw-contain-paint: ;
-            --tw-contain-style:
-        }
-        .absolute {
-            position: absolute
-        }
-        .relative {
-            position: relative
-        }
-        .hidden {
-            display: none
-        }
-        .flex {
-            display: flex
-        }
-        .block {
-            display: block
-        }
-        .w-full {
-            width: 100%
-        }
-        .flex-grow {
-            flex-grow: 1
-        }
-        .flex-col {
-            flex-direction: column
-        }
-        .items-center {
-            align-items: center
-        }
-        .items-start {
-            align-items: flex-start
-        }
-        .justify-center {
-            justify-content: center
-        }
-        .justify-between {
-            justify-content: space-between
-        }
-        .justify-start {
-            justify-content: flex-start
-        }
-        .space-x-2>:not([hidden])~:not([hidden]) {
-            --tw-space-x: 0.5rem;
-            margin-left: var(--tw-space-x);
-            margin-right: 0
-        }
-        .space-y-3>:not([hidden])~:not([hidden]) {
-            --tw-space-y: 0.75rem;
-            margin-top: var(--tw-space-y);
-            margin-bottom: 0
-        }
-        .space-y-4>:not([hidden])~:not([hidden]) {
-            --tw-space-y: 1rem;
-            margin-top: var(--tw-space-y);
-            margin-bottom: 0
-        }
-        .space-y-8>:not([hidden])~:not([hidden]) {
-            --tw-space-y: 2rem;
-            margin-top: var(--tw-space-y);
-            margin-bottom: 0
-        }
-        .rounded-full {
-            border-radius: 9999px
-        }
-        .rounded-lg {
-            border-radius: 0.5rem
-        }
-        .rounded-xl {
-            border-radius: 0.75rem
-        }
-        .border {
-            border-width: 1px
-        }
-        .border-2 {
-            border-width: 2px
-        }
-        .border-dashed {
-            border-style: dashed
-        }
-        .border-transparent {
-            border-color: transparent
-        }
-        .border-gray-100 {
-            border-color: #f3f4f6
-        }
-        .border-gray-200 {
-            border-color: #e5e7eb
-        }
-        .border-gray-300 {
-            border-color: #d1d5db
-        }
-        .border-red-400 {
-            border-color: #f87171
-        }
-        .bg-white {
-            background-color: #fff
-        }
-        .bg-gray-50 {
-            background-color: #f9fafb
-        }
-        .bg-red-100 {
-            background-color: #fee2e2
-        }
-        .bg-indigo-50 {
-            background-color: #eef2ff
-        }
-        .bg-indigo-600 {
-            background-color: #4f46e5
-        }
-        .bg-green-500 {
-            background-color: #22c55e
-        }
-        .bg-red-500 {
-            background-color: #ef4444
-        }
-        .p-2 {
-            padding: 0.5rem
-        }
-        .p-4 {
-            padding: 1rem
-        }
-        .p-6 {
-            padding: 1.5rem
-        }
-        .p-8 {
-            padding: 2rem
-        }
-        .px-4 {
-            padding-left: 1rem;
-            padding-right: 1rem
-        }
-        .py-2 {
-            padding-top: 0.5rem;
-            padding-bottom: 0.5rem
-        }
-        .py-3 {
-            padding-top: 0.75rem;
-            padding-bottom: 0.75rem
-        }
-        .py-4 {
-            padding-top: 1rem;
-            padding-bottom: 1rem
-        }
-        .py-12 {
-            padding-top: 3rem;
-            padding-bottom: 3rem
-        }
-        .px-6 {
-            padding-left: 1.5rem;
-            padding-right: 1.5rem
-        }
-        .mb-2 {
-            margin-bottom: 0.5rem
-        }
-        .mb-4 {
-            margin-bottom: 1rem
-        }
-        .mt-1 {
-            margin-top: 0.25rem
-        }
-        .mt-4 {
-            margin-top: 1rem
-        }
-        .mt-8 {
-            margin-top: 2rem
-        }
-        .mr-4 {
-            margin-right: 1rem
-        }
-        .text-center {
-            text-align: center
-        }
-        .text-lg {
-            font-size: 1.125rem;
-            line-height: 1.75rem
-        }
-        .text-sm {
-            font-size: 0.875rem;
-            line-height: 1.25rem
-        }
-        .text-base {
-            font-size: 1rem;
-            line-height: 1.5rem
-        }
-        .text-2xl {
-            font-size: 1.5rem;
-            line-height: 2rem
-        }
-        .text-4xl {
-            font-size: 2.25rem;
-            line-height: 2.5rem
-        }
-        .font-semibold {
-            font-weight: 600
-        }
-        .font-bold {
-            font-weight: 700
-        }
-        .font-extrabold {
-            font-weight: 800
-        }
-        .font-medium {
-            font-weight: 500
-        }
-        .text-white {
-            color: #fff
-        }
-        .text-gray-900 {
-            color: #111827
-        }
-        .text-gray-600 {
-            color: #4b5563
-        }
-        .text-gray-700 {
-            color: #374151
-        }
-        .text-gray-500 {
-            color: #6b7280
-        }
-        .text-red-700 {
-            color: #b91c1c
-        }
-        .text-indigo-700 {
-            color: #4338ca
-        }
-        .truncate {
-            overflow: hidden;
-            text-overflow: ellipsis;
-            white-space: nowrap
-        }
-        .shadow-sm {
-            --tw-shadow: 0 1px 2px 0 rgb(0 0 0 / .05);
-            --tw-shadow-rgb: 0 0 0;
-            box-shadow: var(--tw-ring-offset-shadow, 0 0 #0000), var(--tw-ring-shadow, 0 0 #0000), var(--tw-shadow)
-        }
-        .shadow-lg {
-            --tw-shadow: 0 10px 15px -3px rgb(0 0 0 / .1), 0 4px 6px -4px rgb(0 0 0 / .1);
-            --tw-shadow-rgb: 0 0 0;
-            box-shadow: var(--tw-ring-offset-shadow, 0 0 #0000), var(--tw-ring-shadow, 0 0 #0000), var(--tw-shadow)
-        }
-        .shadow-2xl {
-            --tw-shadow: 0 25px 50px -12px rgb(0 0 0 / .25);
-            --tw-shadow-rgb: 0 0 0;
-            box-shadow: var(--tw-ring-offset-shadow, 0 0 #0000), var(--tw-ring-shadow, 0 0 #0000), var(--tw-shadow)
-        }
-        .shadow-inner {
-            --tw-shadow: inset 0 2px 4px 0 rgb(0 0 0 / .05);
-            --tw-shadow-rgb: 0 0 0;
-            box-shadow: var(--tw-ring-offset-shadow, 0 0 #0000), var(--tw-ring-shadow, 0 0 #0000), var(--tw-shadow)
-        }
-        .focus\:outline-none:focus {
-            outline: 2px solid transparent;
-            outline-offset: 2px
-        }
-        .focus\:ring-2:focus {
-            --tw-ring-offset-shadow: var(--tw-ring-inset) 0 0 0 var(--tw-ring-offset-width) var(--tw-ring-offset-color);
-            --tw-ring-shadow: var(--tw-ring-inset) 0 0 0 calc(2px + var(--tw-ring-offset-width)) var(--tw-ring-color);
-            box-shadow: var(--tw-ring-offset-shadow), var(--tw-ring-shadow), var(--tw-shadow, 0 0 #0000)
-        }
-        .focus\:ring-offset-2:focus {
-            --tw-ring-offset-width: 2px
-        }
-        .focus\:ring-indigo-500:focus {
-            --tw-ring-color: #6366f1
-        }
-        .hover\:border-indigo-500:hover {
-            border-color: #6366f1
-        }
-        .hover\:bg-indigo-100:hover {
-            background-color: #e0e7ff
-        }
-        .hover\:bg-indigo-700:hover {
-            background-color: #4338ca
-        }
-        .hover\:bg-green-600:hover {
-            background-color: #16a34a
-        }
-        .hover\:bg-red-600:hover {
-            background-color: #dc2626
-        }
-        .transition {
-            transition-property: color, background-color, border-color, text-decoration-color, fill, stroke, opacity, box-shadow, transform, filter, -webkit-backdrop-filter;
-            transition-property: color, background-color, border-color, text-decoration-color, fill, stroke, opacity, box-shadow, transform, filter, backdrop-filter;
-            transition-property: color, background-color, border-color, text-decoration-color, fill, stroke, opacity, box-shadow, transform, filter, backdrop-filter, -webkit-backdrop-filter;
-            transition-timing-function: cubic-bezier(0.4, 0, 0.2, 1);
-            transition-duration: 0.15s
-        }
-        .ease-in-out {
-            transition-timing-function: cubic-bezier(0.4, 0, 0.2, 1)
-        }
-        .duration-150 {
-            transition-duration: 0.15s
-        }
-        .duration-200 {
-            transition-duration: 0.2s
-        }
-        .duration-300 {
-            transition-duration: 0.3s
-        }
-        .min-h-screen {
-            min-height: 100vh
-        }
-        .relative {
-            position: relative
-        }
-        .absolute {
-            position: absolute
-        }
-        .top-4 {
-            top: 1rem
-        }
-        .right-4 {
-            right: 1rem
-        }
-        .cursor-pointer {
-            cursor: pointer
-        }
-        .bg-gradient-to-br {
-            background-image: linear-gradient(to bottom right, var(--tw-gradient-stops))
-        }
-        .from-indigo-50 {
-            --tw-gradient-from: #eef2ff;
-            --tw-gradient-to: rgb(238 242 255 / 0)
-        }
-        .to-purple-100 {
-            --tw-gradient-to: #ede9fe
-        }
-        .file\:mr-4::-webkit-file-upload-button {
-            margin-right: 1rem
-        }
-        .file\:mr-4::file-selector-button {
-            margin-right: 1rem
-        }
-        .file\:py-2::-webkit-file-upload-button {
-            padding-top: 0.5rem;
-            padding-bottom: 0.5rem
-        }
-        .file\:py-2::file-selector-button {
-            padding-top: 0.5rem;
-            padding-bottom: 0.5rem
-        }
-        .file\:px-4::-webkit-file-upload-button {
-            padding-left: 1rem;
-            padding-right: 1rem
-        }
-        .file\:px-4::file-selector-button {
-            padding-left: 1rem;
-            padding-right: 1rem
-        }
-        .file\:rounded-full::-webkit-file-upload-button {
-            border-radius: 9999px
-        }
-        .file\:rounded-full::file-selector-button {
-            border-radius: 9999px
-        }
-        .file\:border-0::-webkit-file-upload-button {
-            border-width: 0
-        }
-        .file\:border-0::file-selector-button {
-            border-width: 0
-        }
-        .file\:text-sm::-webkit-file-upload-button {
-            font-size: 0.875rem;
-            line-height: 1.25rem
-        }
-        .file\:text-sm::file-selector-button {
-            font-size: 0.875rem;
-            line-height: 1.25rem
-        }
-        .file\:font-semibold::-webkit-file-upload-button {
-            font-weight: 600
-        }
-        .file\:font-semibold::file-selector-button {
-            font-weight: 600
-        }
-        .file\:bg-indigo-50::-webkit-file-upload-button {
-            background-color: #eef2ff
-        }
-        .file\:bg-indigo-50::file-selector-button {
-            background-color: #eef2ff
-        }
-        .file\:text-indigo-700::-webkit-file-upload-button {
-            color: #4338ca
-        }
-        .file\:text-indigo-700::file-selector-button {
-            color: #4338ca
-        }
-        .hover\:file\:bg-indigo-100:hover::-webkit-file-upload-button {
-            background-color: #e0e7ff
-        }
-        .hover\:file\:bg-indigo-100:hover::file-selector-button {
-            background-color: #e0e7ff
-        }
-        @media (min-width: 640px) {
-            .sm\:px-6 {
-                padding-left: 1.5rem;
-                padding-right: 1.5rem
-            }
-            .sm\:items-center {
-                align-items: center
-            }
-            .sm\:mb-0 {
-                margin-bottom: 0
-            }
-            .sm\:w-auto {
-                width: auto
-            }
-        }
-        @media (min-width: 1024px) {
-            .lg\:px-8 {
-                padding-left: 2rem;
-                padding-right: 2rem
-            }
+    <!-- Tailwind CSS is served by this app for offline functionality -->
+    <link rel="stylesheet" href="{{ asset_url('app.css') }}">
+</head>
+<body class="min-h-screen flex flex-col items-center justify-center py-12 px-4 sm:px-6 lg:px-8">
+    <div class="max-w-4xl w-full bg-white p-8 rounded-xl shadow-2xl space-y-8 border border-gray-200">
+        <div class="text-center">
+            <h1 class="text-4xl font-extrabold text-gray-900 mb-4">
+                MK Cloud Server
+            </h1>
+            <p class="text-lg text-gray-600">
+                Upload and download files seamlessly across your network.
+            </p>
+        </div>
+
+        <!-- Error Message Display -->
+        <div id="error-message" class="hidden bg-red-100 border border-red-400 text-red-700 px-4 py-3 rounded relative" role="alert">
+            <strong class="font-bold">Error!</strong>
+            <span class="block" id="error-text"></span>
+        </div>
+
+        <!-- Upload Section -->
+        <div class="bg-gray-50 p-6 rounded-lg shadow-inner border border-gray-100">
+            <h2 class="text-2xl font-semibold text-gray-800 mb-4">Upload a File</h2>
+            
+            <!-- Drag and Drop Zone -->
+            <div id="drop-zone" class="border-2 border-dashed border-gray-300 rounded-lg p-6 text-center cursor-pointer hover:border-indigo-500">
+                <p class="text-gray-600 text-lg">Drag & Drop files here, or click to browse</p>
+                <p class="text-sm text-gray-500 mt-1">Max file size: 5GB. All file types are allowed.</p>
+                <input type="file" id="hidden-file-input" name="file" multiple class="hidden">
+            </div>
+
+            <!-- Traditional Upload Form (hidden, but can be shown if needed) -->
+            <form id="upload-form" action="/" method="post" enctype="multipart/form-data" class="mt-4 space-y-4 hidden">
+                <label for="file-upload" class="block text-sm font-medium text-gray-700">
+                    Select your file:
+                </label>
+                <div class="flex items-center space-x-3">
+                    <input id="file-upload" name="file" type="file" class="block w-full text-sm text-gray-900
+                        file:mr-4 file:py-2 file:px-4
+                        file:rounded-full file:border-0
+                        file:text-sm file:font-semibold
+                        file:bg-indigo-50 file:text-indigo-700
+                        hover:file:bg-indigo-100
+                        cursor-pointer focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:ring-offset-2" />
+                    <button type="submit" class="btn-primary inline-flex items-center px-6 py-2 border border-transparent text-base font-medium rounded-full shadow-sm text-white bg-indigo-600 hover:bg-indigo-700 focus:outline-none focus:ring-2 focus:ring-offset-2 focus:ring-indigo-500 transition ease-in-out duration-150">
+                        Upload
+                    </button>
+                </div>
+            </form>
+        </div>
+
+        <!-- Download Section -->
+        <div class="bg-white p-6 rounded-lg shadow-lg border border-gray-100">
+            <h2 class="text-2xl font-semibold text-gray-800 mb-4">Available Files</h2>
+            <div class="flex space-x-2 mb-4">
+                <div class="relative flex-grow">
+                    <input id="file-filter" type="search" placeholder="Search files..." autocomplete="off" class="file-control w-full">
+                    <ul id="search-suggestions" class="suggestions hidden"></ul>
+                </div>
+                <select id="file-sort" class="file-control">
+                    <option value="name:asc">Name (A-Z)</option>
+                    <option value="name:desc">Name (Z-A)</option>
+                    <option value="mtime:desc">Newest first</option>
+                    <option value="mtime:asc">Oldest first</option>
+                    <option value="size:desc">Largest first</option>
+                    <option value="size:asc">Smallest first</option>
+                </select>
+            </div>
+            <div class="flex items-center justify-between mb-2">
+                <p id="file-count" class="text-sm text-gray-500"></p>
+                <div class="flex items-center space-x-2">
+                    <select id="bulk-format" class="file-control text-sm">
+                        <option value="zip">ZIP</option>
+                        <option value="tar">TAR</option>
+                    </select>
+                    <button id="download-selected" type="button" disabled class="btn-primary px-4 py-2 rounded-full text-sm text-white bg-indigo-600 hover:bg-indigo-700 disabled:opacity-50">
+                        Download selected
+                    </button>
+                    <button id="delete-selected" type="button" disabled class="btn-delete px-4 py-2 rounded-full text-sm text-white bg-red-500 hover:bg-red-600 disabled:opacity-50">
+                        Delete selected
+                    </button>
+                </div>
+            </div>
+            <ul id="file-list" class="space-y-3">
+                <!-- Files will be loaded here by JavaScript -->
+                <p class="text-gray-600 text-center py-4">Loading files...</p>
+            </ul>
+            <div class="text-center mt-4">
+                <button id="load-more" type="button" class="hidden btn-primary px-4 py-2 rounded-full text-sm text-white bg-indigo-600 hover:bg-indigo-700">
+                    Load more
+                </button>
+            </div>
+        </div>
+
+        <p class="text-center text-sm text-gray-500 mt-8">
+            <span class="font-semibold">Note:</span> This server is accessible to all devices on the same Wi-Fi network. Find your server's IP address 192.168.1.4 and port `5000` to access it from other devices.
+        </p>
+    </div>
+
+    <script src="{{ asset_url('app.js') }}"></script>
+</body>
+</html>
+'''
+
+# --- Flask Routes ---
+@app.route('/', methods=['GET', 'POST'])
+def index():
+    """
+    Handles both displaying the main page and processing file uploads.
+    """
+    if request.method == 'POST':
+        # The page sends every selected/dropped file as its own 'file' part
+        uploaded_files = [f for f in request.files.getlist('file') if f.filename != '']
+        if not uploaded_files:
+            log.warning("Upload: no 'file' part (or only empty filenames) in the request")
+            return jsonify({"error": "No file selected for upload.", "files": []}), 400
+
+        # Since all file types are allowed, no 'allowed_file' check is needed.
+        # Max file size is still enforced by app.config['MAX_CONTENT_LENGTH']
+        started = time.perf_counter()
+        pending = []  # future or error result per file, in request order
+        seen = set()
+        rejected = 0  # files refused because of the request itself, not the server
+        for uploaded_file in uploaded_files:
+            filename = secure_filename(uploaded_file.filename)
+            if not filename:
+                pending.append({"filename": uploaded_file.filename, "error": "Invalid filename."})
+                rejected += 1
+            elif filename in seen:
+                # Two workers must never write the same path at once
+                pending.append({"filename": filename, "error": "Duplicate filename in this upload."})
+                rejected += 1
+            else:
+                seen.add(filename)
+                metrics.inc('mkcloud_upload_queue_depth')
+                # Runs in a copy of this thread's context, so the request (and its id in log records) stays visible
+                context = contextvars.copy_context()
+                pending.append(_upload_pool.submit(context.run, save_file_storage, uploaded_file, filename))
+
+        results = [item if isinstance(item, dict) else item.result() for item in pending]
+        summary = _upload_summary(results, started)
+        if any('error' not in r for r in results):
+            status = 200
+        else:
+            status = 400 if rejected == len(results) else 500
+        return jsonify(summary), status
+
+    # For GET requests, send the prerendered page
+    # The initial file list is empty, as JS will fetch it dynamically
+    return index_page.response('no-cache')
+
+@app.route('/files_json')
+def files_json():
+    """
+    Returns a JSON list of files in the UPLOAD_FOLDER.
+    Used by JavaScript for real-time updates.
+
+    Without query parameters this is the plain sorted list of names. With any of
+    limit, cursor, sort (name|size|mtime), order (asc|desc), prefix or q
+    (substring) it returns one page of {"name", "size", "mtime"} records:
+    {"files": [...], "next_cursor": ..., "total": ..., "version": ...}.
+    Pass next_cursor back as cursor to fetch the following page.
+    """
+    try:
+        if not any(arg in request.args for arg in ('limit', 'cursor', 'sort', 'order', 'prefix', 'q')):
+            # Served from the in-memory index (already compressed if the client
+            # accepts it); no filesystem calls per request
+            encoding = negotiate_encoding()
+            if encoding and len(file_index.listing_json()) < app.config['COMPRESS_MIN_SIZE']:
+                encoding = None
+            response = Response(file_index.listing_json(encoding), mimetype='application/json')
+            response.vary.add('Accept-Encoding')
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+            return response
+
+        sort = request.args.get('sort', 'name')
+        if sort not in ('name', 'size', 'mtime'):
+            return jsonify({"error": "sort must be one of name, size, mtime."}), 400
+        try:
+            limit = min(max(int(request.args.get('limit', FILES_PAGE_SIZE)), 1), FILES_PAGE_SIZE_MAX)
+            cursor = _decode_cursor(request.args.get('cursor'))
+            if cursor is not None and isinstance(cursor, str) != (sort == 'name'):
+                raise ValueError("Cursor belongs to a different sort order")
+        except (ValueError, TypeError):
+            return jsonify({"error": "Invalid limit or cursor."}), 400
+
+        version, records, next_key, total = file_index.query(
+            sort=sort,
+            descending=request.args.get('order') == 'desc',
+            prefix=request.args.get('prefix', ''),
+            contains=request.args.get('q', ''),
+            cursor=cursor,
+            limit=limit,
+        )
+        return jsonify({
+            "files": records,
+            "next_cursor": _encode_cursor(next_key) if next_key is not None else None,
+            "total": total,
+            "version": version,
+        })
+    except Exception as e:
+        log.exception('Error fetching files for JSON: %s', e)
+        return jsonify({"error": "Could not retrieve files"}), 500
+
+
+FILES_PAGE_SIZE = 200
+FILES_PAGE_SIZE_MAX = 5000
+
+
+def _encode_cursor(key):
+    """
+    Opaque pagination cursor: the sort key of the last item, base64url(JSON).
+    """
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return None
+    key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    if isinstance(key, str):
+        return key
+    if isinstance(key, list) and len(key) == 2 and isinstance(key[0], int) and isinstance(key[1], str):
+        return tuple(key)
+    raise ValueError("Malformed cursor")
+
+
+@app.route('/search')
+def search_files():
+    """
+    Type-ahead filename search: the best `limit` (default 10) matches for q,
+    ranked exact name, then name prefix, then word prefix, then any substring
+    (case-insensitive). Returns {"files": [{"name", "size", "mtime", "match"}, ...],
+    "more": ..., "version": ...}, where match is the offset of q in the name.
+    Served from the in-memory index; no filesystem calls.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_RESULTS)), 1), SEARCH_RESULTS_MAX)
+    except ValueError:
+        return jsonify({"error": "Invalid limit."}), 400
+    version, records, more = file_index.find(request.args.get('q', '').strip(), limit)
+    return jsonify({"files": records, "more": more, "version": version})
+
+
+@app.route('/download/<path:filename>')
+def download_file(filename):
+    """
+    Allows users to download files from the UPLOAD_FOLDER.
+    Supports Range/If-Range (resume, segmented downloads) and conditional GET.
+    The <path:filename> converter allows filenames with slashes (though secure_filename sanitizes them).
+    """
+    secured_filename = secure_filename(filename)
+
+    # Construct the full absolute path to the file
+    full_file_path = storage.locate(secured_filename)
+
+    try:
+        # Compressed variant if the client accepts one and the file compresses well.
+        # Range requests (resumes, segmented downloads) always get the plain file.
+        headers = {'Vary': 'Accept-Encoding'}
+        encoding = negotiate_encoding() if 'Range' not in request.headers else None
+        variant = compression_cache.variant(full_file_path, encoding) if encoding else None
+        if variant is not None:
+            variant_path, st = variant
+            try:
+                return _count_download(secured_filename, send_file_response(
+                    variant_path, download_name=secured_filename,
+                    etag=f'"{st.st_size:x}-{st.st_mtime_ns:x}-{encoding}"',
+                    headers=dict(headers, **{'Content-Encoding': encoding})))
+            except FileNotFoundError:
+                compression_cache.discard(os.path.basename(variant_path))  # Evicted meanwhile
+        # as_attachment-style download; opening the file doubles as the existence check
+        return _count_download(secured_filename,
+                               send_file_response(full_file_path, download_name=secured_filename, headers=headers))
+    except FileNotFoundError:
+        log.debug("Download: file '%s' not found at '%s'", secured_filename, full_file_path)
+        return "File not found.", 404
+    except Exception as e:
+        log.exception("Error downloading '%s': %s", secured_filename, e)
+        return "An error occurred during download.", 500
+
+
+def _count_download(name, response):
+    """
+    Counts a download in the catalog: a full GET, or a ranged one starting at
+    the first byte (resumes and the other segments aren't new downloads).
+    """
+    if request.method == 'GET' and (response.status_code == 200 or (
+            response.status_code == 206 and response.headers.get('Content-Range', '').startswith('bytes 0-'))):
+        catalog.count_download(name)
+    return response
+
+
+@app.route('/delete/<path:filename>', methods=['POST'])
+def delete_file(filename):
+    """
+    Allows users to delete files from the UPLOAD_FOLDER.
+    """
+    secured_filename = secure_filename(filename)
+    full_path = storage.locate(secured_filename)
+    log.debug('Attempting to delete file: %s', full_path)
+
+    # Same path as /delete_batch: the name goes away now, the space is freed in the background
+    try:
+        _, removed, _ = reclaimer.trash([secured_filename])
+        if removed:
+            log.info("File '%s' deleted from %s", secured_filename, full_path, extra={'file': secured_filename})
+        else:
+            log.warning("Delete: file '%s' not found at '%s'", secured_filename, full_path)
+    except Exception as e:
+        log.exception("Error deleting file '%s' from '%s': %s", secured_filename, full_path, e)
+    return redirect(url_for('index'))
+
+# --- File Responses: Range Requests and Conditional GET ---
+# Downloads are served with strong ETags, 304s for If-None-Match/If-Modified-Since,
+# and single- or multi-range 206 responses (honouring If-Range), so interrupted
+# downloads resume and download managers can fetch one file over several
+# connections. File bodies go through the server's wsgi.file_wrapper when it has
+# one (aioserver, gunicorn and similar servers send those with sendfile()); otherwise they are
+# read in large blocks.
+
+FILE_SEND_BLOCKSIZE = 1024 * 1024
+MAX_BYTE_RANGES = 32  # Requests asking for more ranges than this get the whole file
+
+
+def file_etag(st):
+    """
+    Strong validator for one version of a file: its size and nanosecond mtime.
+    """
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+class FileRangeIterator:
+    """
+    WSGI body yielding `length` bytes of an open file starting at `offset`.
+    """
+
+    def __init__(self, f, offset, length):
+        self.file = f
+        self.offset = offset
+        self.length = length
+
+    def __iter__(self):
+        self.file.seek(self.offset)
+        remaining = self.length
+        while remaining > 0:
+            block = self.file.read(min(FILE_SEND_BLOCKSIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+    def close(self):
+        self.file.close()
+
+
+class TransferFile(io.BufferedReader):
+    """
+    A file opened for a download; it counts as an active transfer until closed.
+    """
+
+    def __init__(self, path):
+        super().__init__(io.FileIO(path, 'rb'))
+        self._active = True
+        metrics.inc('mkcloud_active_transfers', direction='download')
+
+    def close(self):
+        if self._active:
+            self._active = False
+            metrics.inc('mkcloud_active_transfers', -1, direction='download')
+        super().close()
+
+
+def _file_body(f, offset, length):
+    """
+    Returns a WSGI body for one byte span of f. A server's wsgi.file_wrapper starts
+    sending at the file's current position and stops after Content-Length bytes.
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        f.seek(offset)
+        return file_wrapper(f, FILE_SEND_BLOCKSIZE)
+    return FileRangeIterator(f, offset, length)
+
+
+def _multipart_byteranges_body(f, parts, closing):
+    """
+    Yields a multipart/byteranges body; parts is a list of (header bytes, start, end).
+    """
+    try:
+        for header, start, end in parts:
+            yield header
+            yield from FileRangeIterator(f, start, end - start)
+        yield closing
+    finally:
+        f.close()
+
+
+def _requested_ranges(size):
+    """
+    Returns the satisfiable [start, end) ranges of the request's Range header,
+    sorted and with overlaps merged. None means "send the whole file" (no header,
+    a malformed one, or too many ranges); an empty list means unsatisfiable (416).
+    """
+    byte_range = parse_range_header(request.headers.get('Range'))
+    if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) > MAX_BYTE_RANGES:
+        return None
+
+    ranges = []
+    for start, end in byte_range.ranges:
+        if start < 0:  # Suffix range: the last -start bytes
+            start, end = max(0, size + start), size
+        elif end is None or end > size:
+            end = size
+        if start < end:
+            ranges.append([start, end])
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _if_range_matches(etag, st):
+    """
+    If-Range allows a partial response only while the client's copy is current.
+    """
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag  # Strong comparison; weak tags never match
+    if if_range.startswith('W/'):
+        return False
+    return parse_date(if_range) == _mtime_datetime(st)
+
+
+def _mtime_datetime(st):
+    """
+    The file's mtime at HTTP-date (whole second) precision.
+    """
+    return datetime.fromtimestamp(int(st.st_mtime), tz=timezone.utc)
+
+
+def _not_modified(etag, st):
+    """
+    Evaluates If-None-Match (weak comparison) or, without it, If-Modified-Since.
+    """
+    if request.headers.get('If-None-Match'):
+        return parse_etags(request.headers['If-None-Match']).contains_weak(unquote_etag(etag)[0])
+    since = parse_date(request.headers.get('If-Modified-Since'))
+    return since is not None and _mtime_datetime(st) <= since
+
+
+def send_file_response(path, download_name=None, mimetype=None, etag=None, headers=None, cache_control='no-cache'):
+    """
+    Builds a GET/HEAD response for the file at path with ETag, Last-Modified and
+    Range support. Raises FileNotFoundError if path is not a regular file.
+
+    download_name makes the response an attachment, etag overrides the default
+    validator (for variants of a file) and headers are added as-is. The default
+    Cache-Control makes clients revalidate, which the ETag turns into a cheap 304.
+    """
+    try:
+        f = TransferFile(path)
+    except (IsADirectoryError, NotADirectoryError):
+        raise FileNotFoundError(path)
+    try:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(path)
+        size = st.st_size
+        etag = etag or file_etag(st)
+        mimetype = mimetype or mimetypes.guess_type(download_name or path)[0] or 'application/octet-stream'
+
+        response_headers = Headers(headers or {})
+        response_headers['ETag'] = etag
+        response_headers['Last-Modified'] = http_date(_mtime_datetime(st))
+        response_headers['Accept-Ranges'] = 'bytes'
+        response_headers['Cache-Control'] = cache_control
+        if download_name:
+            response_headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+
+        if _not_modified(etag, st):
+            f.close()
+            return Response(status=304, headers=response_headers)
+
+        ranges = _requested_ranges(size) if _if_range_matches(etag, st) else None
+        if ranges == []:
+            f.close()
+            response_headers['Content-Range'] = f'bytes */{size}'
+            return Response('Requested range not satisfiable.', status=416, headers=response_headers)
+
+        if ranges and len(ranges) > 1:
+            boundary = secrets.token_hex(12)
+            parts = []
+            for start, end in ranges:
+                header = (f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                          f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n').encode('latin-1')
+                parts.append((header, start, end))
+            closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+            response_headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+            response_headers['Content-Length'] = str(
+                sum(len(h) + end - start for h, start, end in parts) + len(closing))
+            status = 206
+            body = _multipart_byteranges_body(f, parts, closing) if request.method != 'HEAD' else None
+        else:
+            start, end = ranges[0] if ranges else (0, size)
+            if ranges:
+                response_headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+            response_headers['Content-Type'] = mimetype
+            response_headers['Content-Length'] = str(end - start)
+            status = 206 if ranges else 200
+            body = _file_body(f, start, end - start) if request.method != 'HEAD' else None
+
+        if body is None:
+            f.close()
+            body = []
+        else:
+            # Counted when the body is handed to the server (it may be sent with sendfile())
+            metrics.inc('mkcloud_download_bytes_total', int(response_headers['Content-Length']))
+        return Response(body, status=status, headers=response_headers, direct_passthrough=True)
+    except BaseException:
+        f.close()
+        raise
+
+# --- Compression ---
+# Downloads and JSON responses are compressed when the client's Accept-Encoding
+# allows it: zstd and brotli when their optional packages are installed, gzip
+# always. Formats that are already compressed are skipped, both by extension and
+# by a quick trial compression of the file's first block. Compressed download
+# variants are kept in a size-bounded LRU cache on disk, keyed by content
+# identity, so a popular log file is compressed once, not on every request.
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+app.config['COMPRESSION_ENABLED'] = True
+app.config['COMPRESS_MIN_SIZE'] = 1024  # Smaller bodies aren't worth the CPU
+app.config['COMPRESS_INLINE_MAX'] = 16 * 1024 * 1024  # Larger files are compressed in the background
+app.config['COMPRESS_MAX_SIZE'] = 2 * 1024 * 1024 * 1024  # Larger files are always sent as-is
+app.config['COMPRESS_CACHE_MAX_BYTES'] = 1024 * 1024 * 1024  # Disk budget for compressed variants
+
+# Preferred first when the client rates several encodings equally
+COMPRESSION_ENCODINGS = [name for name, module in (('zstd', zstandard), ('br', brotli), ('gzip', gzip)) if module]
+
+# Already-compressed formats: compressing them again only burns CPU
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.7z', '.aac', '.apk', '.avi', '.avif', '.br', '.bz2', '.cab', '.deb', '.dmg', '.docx', '.epub',
+    '.flac', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg', '.lz', '.lz4', '.lzma', '.m4a', '.m4v',
+    '.mkv', '.mov', '.mp3', '.mp4', '.msi', '.odt', '.ogg', '.opus', '.png', '.pptx', '.rar', '.rpm',
+    '.tgz', '.txz', '.webm', '.webp', '.whl', '.xlsx', '.xz', '.zip', '.zst',
+}
+COMPRESS_SAMPLE_SIZE = 64 * 1024
+COMPRESS_SAMPLE_RATIO = 0.9  # Sample must shrink at least 10% to be worth it
+COMPRESS_INCOMPRESSIBLE_MAX = 10000  # identities remembered as not worth compressing
+
+
+def negotiate_encoding():
+    """
+    Returns the best content-coding both sides support, or None for identity.
+    """
+    if not app.config['COMPRESSION_ENABLED'] or 'Accept-Encoding' not in request.headers:
+        return None
+    return request.accept_encodings.best_match(COMPRESSION_ENCODINGS)
+
+
+def compress_bytes(data, encoding, best=False):
+    """
+    Compresses data in one go. best=True trades CPU for size, for bodies that
+    are compressed once and sent many times.
+    """
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=19 if best else 6).compress(data)
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else 5)
+    return gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+
+
+def compress_file(src_path, dst_path, encoding):
+    """
+    Streams src_path into dst_path compressed with encoding, in constant memory.
+    """
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        if encoding == 'zstd':
+            zstandard.ZstdCompressor(level=6).copy_stream(src, dst, read_size=FILE_SEND_BLOCKSIZE)
+            return
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=5)
+            while True:
+                block = src.read(FILE_SEND_BLOCKSIZE)
+                if not block:
+                    break
+                dst.write(compressor.process(block))
+            dst.write(compressor.finish())
+            return
+        with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=6, mtime=0) as gz:
+            shutil.copyfileobj(src, gz, FILE_SEND_BLOCKSIZE)
+
+
+class DiskCache:
+    """
+    Size-bounded LRU of generated files in STATE_FOLDER/cache/<name>, with the
+    disk budget in app.config[budget_key]. Worker processes share the folder but
+    each keeps its own LRU order.
+    """
+
+    def __init__(self, name, budget_key):
+        self.name = name
+        self.budget_key = budget_key
+        self.lock = threading.Lock()
+        self.entries = None  # OrderedDict: filename -> size, least recently used first
+        self.total_bytes = 0
+
+    def folder(self):
+        return os.path.join(app.config['STATE_FOLDER'], 'cache', self.name)
+
+    def _load(self):
+        """
+        Picks up entries left by a previous run, oldest first (caller holds the lock).
+        """
+        if self.entries is not None:
+            return
+        self.entries = OrderedDict()
+        os.makedirs(self.folder(), exist_ok=True)
+        found = []
+        for entry in os.scandir(self.folder()):
+            if entry.name.endswith('.tmp'):
+                # Interrupted build (recent ones may still be written by another worker)
+                if entry.stat().st_mtime < time.time() - 3600:
+                    os.remove(entry.path)
+            elif entry.is_file():
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.total_bytes += size
+
+    def _evict(self):
+        """
+        Drops least recently used entries until the cache fits its budget.
+        """
+        while self.entries and self.total_bytes > app.config[self.budget_key]:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.folder(), name))
+            except FileNotFoundError:
+                pass
+
+    def _add(self, name, size):
+        """
+        Records a new entry and evicts what no longer fits (caller holds the lock).
+        """
+        self._load()
+        old = self.entries.pop(name, None)
+        self.entries[name] = size
+        self.total_bytes += size - (old or 0)
+        self._evict()
+
+    def discard(self, name):
+        """
+        Forgets an entry whose file disappeared, e.g. evicted by another worker process.
+        """
+        with self.lock:
+            size = self.entries.pop(name, None) if self.entries is not None else None
+            if size is not None:
+                self.total_bytes -= size
+
+
+class CompressionCache(DiskCache):
+    """
+    Compressed file variants in STATE_FOLDER/cache/compressed. Entries are named
+    "<identity>.<encoding>"; the identity is the blob hash when the file is
+    deduplicated (shared by all names with that content) and
+    device/inode/size/mtime otherwise.
+    """
+
+    def __init__(self):
+        super().__init__('compressed', 'COMPRESS_CACHE_MAX_BYTES')
+        self.pending = set()  # Variants being compressed in the background
+        self.incompressible = OrderedDict()  # Identities whose sample didn't compress, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='compress')
+
+    @staticmethod
+    def identity(path, st):
+        digest = blob_store.digest_of(path)
+        return digest or f'{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}'
+
+    def _worth_compressing(self, path, st, identity):
+        if st.st_size < app.config['COMPRESS_MIN_SIZE'] or st.st_size > app.config['COMPRESS_MAX_SIZE']:
+            return False
+        if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return False
+        with self.lock:
+            if identity in self.incompressible:
+                self.incompressible.move_to_end(identity)
+                return False
+        with open(path, 'rb') as f:
+            sample = f.read(COMPRESS_SAMPLE_SIZE)
+        if len(gzip.compress(sample, compresslevel=1)) > len(sample) * COMPRESS_SAMPLE_RATIO:
+            with self.lock:
+                self.incompressible[identity] = True
+                if len(self.incompressible) > COMPRESS_INCOMPRESSIBLE_MAX:
+                    self.incompressible.popitem(last=False)
+            return False
+        return True
+
+    def _build(self, path, name):
+        """
+        Compresses path into the cache under name (temp file + rename).
+        """
+        dst_path = os.path.join(self.folder(), name)
+        tmp_path = f'{dst_path}.{os.getpid()}.tmp'
+        try:
+            compress_file(path, tmp_path, name.rsplit('.', 1)[1])
+            os.replace(tmp_path, dst_path)
+            size = os.path.getsize(dst_path)
+        except OSError as e:
+            log.error("Error compressing '%s' into the cache: %s", path, e)
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            return None
+        finally:
+            with self.lock:
+                self.pending.discard(name)
+        with self.lock:
+            self._add(name, size)
+        return dst_path
+
+    def variant(self, path, encoding):
+        """
+        Returns (variant path, stat of the original) for serving path with
+        encoding, or None if it should go out uncompressed. Large files that
+        aren't cached yet are queued for background compression and served
+        uncompressed this time.
+        """
+        st = os.stat(path)
+        identity = self.identity(path, st)
+        name = f'{identity}.{encoding}'
+        with self.lock:
+            self._load()
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                metrics.inc('mkcloud_cache_requests_total', cache='compression', result='hit')
+                return os.path.join(self.folder(), name), st
+            self.misses += 1
+            metrics.inc('mkcloud_cache_requests_total', cache='compression', result='miss')
+        if not self._worth_compressing(path, st, identity):
+            return None
+        if st.st_size <= app.config['COMPRESS_INLINE_MAX']:
+            variant_path = self._build(path, name)
+            return (variant_path, st) if variant_path else None
+        with self.lock:
+            if name not in self.pending:
+                self.pending.add(name)
+                self._executor.submit(self._build, path, name)
+        return None
+
+
+compression_cache = CompressionCache()
+
+
+@app.after_request
+def compress_json_response(response):
+    """
+    Compresses JSON bodies on the fly when the client accepts it.
+    """
+    if (response.mimetype != 'application/json' or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.status_code in (204, 304)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None or response.content_length is None or response.content_length < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(compress_bytes(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# --- Compiled Page and Static Assets ---
+# The page's stylesheet and script are served from /assets under content-hashed
+# names (app.<hash>.css), so browsers may cache them for a year and a changed
+# asset simply gets a new URL. The template is compiled and rendered once at
+# startup; GET / then only sends prebuilt bytes, or a 304 when the ETag
+# still matches. Every body is precompressed once with each supported encoding.
+
+ASSET_MAX_AGE = 365 * 24 * 60 * 60  # Versioned URLs never change content
+
+
+class StaticAsset:
+    """
+    An in-memory response body with a content-hash ETag and a precompressed
+    variant per content-coding, built once at startup.
+    """
+
+    def __init__(self, name, body, mimetype):
+        self.name = name
+        self.body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(self.body).hexdigest()[:16]
+        stem, ext = os.path.splitext(name)
+        self.versioned_name = f'{stem}.{self.digest}{ext}'
+        self.variants = {}
+        for encoding in COMPRESSION_ENCODINGS:
+            data = compress_bytes(self.body, encoding, best=True)
+            if len(data) < len(self.body):
+                self.variants[encoding] = data
+
+    def response(self, cache_control):
+        encoding = None
+        if app.config['COMPRESSION_ENABLED'] and 'Accept-Encoding' in request.headers:
+            encoding = request.accept_encodings.best_match(list(self.variants))
+        response = Response(self.variants[encoding] if encoding else self.body, mimetype=self.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = cache_control
+        response.vary.add('Accept-Encoding')
+        # Each encoding is a different representation and needs its own strong ETag
+        response.set_etag(f'{self.digest}-{encoding}' if encoding else self.digest)
+        return response.make_conditional(request)
+
+
+def asset_url(name):
+    return f'/assets/{STATIC_ASSETS[name].versioned_name}'
+
+
+STATIC_ASSETS = {
+    asset.name: asset for asset in (
+        StaticAsset('app.css', PAGE_CSS, 'text/css'),
+        StaticAsset('app.js', PAGE_JS, 'text/javascript'),
+    )
+}
+_versioned_assets = {asset.versioned_name: asset for asset in STATIC_ASSETS.values()}
+
+# The page has no per-request content (errors arrive in the query string and are
+# shown by the script), so it is rendered exactly once
+index_page = StaticAsset('index.html', app.jinja_env.from_string(HTML_TEMPLATE).render(asset_url=asset_url), 'text/html')
+
+
+@app.route('/assets/<path:filename>')
+def static_asset(filename):
+    """
+    Serves a page asset. Versioned names are immutable; plain names (app.css)
+    also work but must be revalidated.
+    """
+    asset = _versioned_assets.get(filename)
+    if asset is not None:
+        return asset.response(f'public, max-age={ASSET_MAX_AGE}, immutable')
+    asset = STATIC_ASSETS.get(filename)
+    if asset is not None:
+        return asset.response('no-cache')
+    return "Asset not found.", 404
+
+# --- Bulk Download (Streaming ZIP/TAR) ---
+# /bulk_download streams many files as one ZIP or TAR archive. The archive is built
+# while it is sent: each block written by zipfile/tar goes straight out to the
+# client, so memory use is constant and nothing is assembled on disk. Files are
+# picked by name (repeated "name" fields or a JSON "names" list) or by the same
+# prefix/q filters as /files_json.
+
+app.config['BULK_MAX_FILES'] = 10000
+
+
+class _ArchiveSink(io.RawIOBase):
+    """
+    Write-only, unseekable file object that collects archive bytes until the
+    response generator drains them. Being unseekable makes zipfile use data
+    descriptors instead of seeking back to patch headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _bulk_selection(max_files):
+    """
+    Returns the requested (deduplicated, secured) filenames in request order.
+    A filter selects at most max_files + 1 names, so callers can tell it matched too many.
+    Raises ValueError if a JSON body is not shaped like the parameters.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    elif not isinstance(data, dict):
+        raise ValueError("The JSON body must be an object")
+    names = data.get('names') or request.values.getlist('name')
+    prefix = data.get('prefix', request.values.get('prefix', ''))
+    contains = data.get('q', request.values.get('q', ''))
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise ValueError("names must be a list of strings")
+    if not isinstance(prefix, str) or not isinstance(contains, str):
+        raise ValueError("prefix and q must be strings")
+    if not names and (prefix or contains or data.get('all') or request.values.get('all')):
+        _, records, _, _ = file_index.query(prefix=prefix, contains=contains, limit=max_files + 1)
+        names = [record['name'] for record in records]
+    seen = set()
+    selection = []
+    for name in names:
+        name = secure_filename(name)
+        if name and name not in seen:
+            seen.add(name)
+            selection.append(name)
+    return selection
+
+
+def _open_entries(names):
+    """
+    Yields (name, open file, stat) for every selected file that still exists.
+    """
+    for name in names:
+        try:
+            f = open(storage.locate(name), 'rb')
+        except OSError as e:
+            log.warning("Bulk download: skipping '%s': %s", name, e)
+            continue
+        with f:
+            yield name, f, os.fstat(f.fileno())
+
+
+def _stream_zip(names, compress):
+    sink = _ArchiveSink()
+    with zipfile.ZipFile(sink, mode='w', strict_timestamps=False) as zf:
+        for name, f, st in _open_entries(names):
+            zinfo = zipfile.ZipInfo(name, time.localtime(st.st_mtime)[:6])
+            zinfo.file_size = st.st_size
+            # Per-entry choice: don't deflate formats that are already compressed
+            deflate = compress and os.path.splitext(name)[1].lower() not in INCOMPRESSIBLE_EXTENSIONS
+            zinfo.compress_type = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+            with zf.open(zinfo, 'w') as dest:
+                while True:
+                    block = f.read(FILE_SEND_BLOCKSIZE)
+                    if not block:
+                        break
+                    dest.write(block)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()  # Central directory
+
+
+def _stream_tar(names, compress):
+    sink = _ArchiveSink()
+    out = gzip.GzipFile(fileobj=sink, mode='wb', compresslevel=6, mtime=0) if compress else sink
+    written = 0
+    for name, f, st in _open_entries(names):
+        info = tarfile.TarInfo(name)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        out.write(header)
+        written += len(header)
+        remaining = st.st_size
+        while remaining > 0:
+            # Never send more than the header announced, even if the file grew
+            block = f.read(min(FILE_SEND_BLOCKSIZE, remaining))
+            if not block:
+                break
+            out.write(block)
+            remaining -= len(block)
+            yield sink.drain()
+        if remaining:
+            out.write(b'\0' * remaining)  # File shrank while streaming: pad to the announced size
+        padding = -st.st_size % tarfile.BLOCKSIZE
+        out.write(b'\0' * padding)
+        written += st.st_size + padding
+    # End-of-archive marker, padded to a whole record
+    trailer = 2 * tarfile.BLOCKSIZE
+    trailer += -(written + trailer) % tarfile.RECORDSIZE
+    out.write(b'\0' * trailer)
+    if compress:
+        out.close()
+    yield sink.drain()
+
+
+@app.route('/bulk_download', methods=['GET', 'POST'])
+def bulk_download():
+    """
+    Streams the selected files as one archive.
+    Parameters: name (repeatable) / names, or prefix / q / all=1 to select by
+    filter; format=zip|tar (default zip); compress=1 to deflate ZIP entries or
+    gzip the TAR stream.
+    """
+    archive_format = request.values.get('format', 'zip')
+    if archive_format not in ('zip', 'tar'):
+        return jsonify({"error": "format must be zip or tar."}), 400
+    compress = request.values.get('compress', '0').lower() in ('1', 'true', 'yes', 'on')
+    try:
+        names = _bulk_selection(app.config['BULK_MAX_FILES'])
+    except ValueError as e:
+        return jsonify({"error": f"{e}."}), 400
+    if not names:
+        return jsonify({"error": "No files selected."}), 400
+    if len(names) > app.config['BULK_MAX_FILES']:
+        return jsonify({"error": f"At most {app.config['BULK_MAX_FILES']} files per archive."}), 400
+
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    if archive_format == 'zip':
+        body, mimetype, download_name = _stream_zip(names, compress), 'application/zip', f'files-{stamp}.zip'
+    elif compress:
+        body, mimetype, download_name = _stream_tar(names, True), 'application/gzip', f'files-{stamp}.tar.gz'
+    else:
+        body, mimetype, download_name = _stream_tar(names, False), 'application/x-tar', f'files-{stamp}.tar'
+    log.info('Bulk download: streaming %d files as %s', len(names), download_name)
+    request.environ['mkcloud.transfer_lane'] = 'bulk'  # Length unknown, but never a small response
+    return Response(count_download(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{download_name}"',
+        'Cache-Control': 'no-store',
+    })
+
+# --- Thumbnails and Text Previews ---
+# The file list shows a small JPEG thumbnail of images (when the optional Pillow
+# package is installed) and a snippet of text files, so browsing costs kilobytes
+# instead of whole downloads. Previews are rendered in a process pool, so decoding
+# a 20 MB photo neither blocks a request thread nor holds the GIL: right after
+# each upload, and on demand when one is missing. They are kept in a size-bounded
+# LRU cache keyed by the file's content hash and mtime. GET /preview/<name>?v=<mtime>
+# (the mtime from the listing) may be cached by the browser for good, since a
+# changed file gets a new URL.
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+app.config['PREVIEW_ENABLED'] = True
+app.config['PREVIEW_WORKERS'] = 2  # renderer processes per server process
+app.config['PREVIEW_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+app.config['PREVIEW_WAIT'] = 10  # seconds a request waits for a preview rendered on demand
+app.config['THUMBNAIL_SIZE'] = 160  # pixels, longest side
+app.config['THUMBNAIL_MAX_SOURCE'] = 200 * 1024 * 1024  # larger images get no thumbnail
+app.config['TEXT_PREVIEW_BYTES'] = 2048
+
+THUMBNAIL_EXTENSIONS = {'.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'}
+TEXT_PREVIEW_EXTENSIONS = {
+    '.c', '.cfg', '.conf', '.cpp', '.cs', '.css', '.csv', '.go', '.h', '.html', '.ini', '.java', '.js',
+    '.json', '.log', '.md', '.php', '.py', '.rb', '.rs', '.sh', '.sql', '.toml', '.ts', '.txt', '.xml',
+    '.yaml', '.yml',
+}
+PREVIEW_MIMETYPES = {'image': 'image/jpeg', 'text': 'text/plain; charset=utf-8'}
+
+
+def preview_kind(name):
+    """
+    'image', 'text' or None: the kind of preview a file of this name can have.
+    """
+    ext = os.path.splitext(name)[1].lower()
+    if ext in THUMBNAIL_EXTENSIONS:
+        return 'image' if Image is not None else None
+    if ext in TEXT_PREVIEW_EXTENSIONS:
+        return 'text'
+    return None
+
+
+def render_preview(src_path, dst_path, kind, thumbnail_size, text_bytes):
+    """
+    Runs in a preview process: writes the thumbnail or text snippet of src_path
+    to dst_path. Returns False if the file can't be previewed.
+    """
+    tmp_path = f'{dst_path}.{os.getpid()}.tmp'
+    try:
+        if kind == 'image':
+            with Image.open(src_path) as im:
+                im.draft('RGB', (thumbnail_size, thumbnail_size))  # JPEGs decode straight at a reduced scale
+                im = ImageOps.exif_transpose(im)
+                im.thumbnail((thumbnail_size, thumbnail_size))
+                if im.mode in ('RGBA', 'LA', 'P'):
+                    im = im.convert('RGBA')
+                    background = Image.new('RGB', im.size, 'white')
+                    background.paste(im, mask=im.getchannel('A'))
+                    im = background
+                elif im.mode != 'RGB':
+                    im = im.convert('RGB')
+                im.save(tmp_path, 'JPEG', quality=80, optimize=True)
+        else:
+            with open(src_path, 'rb') as f:
+                data = f.read(text_bytes + 1)
+            if b'\0' in data:
+                return False  # Binary after all
+            text = data[:text_bytes].decode('utf-8', errors='replace')
+            if len(data) > text_bytes:
+                text = text.rsplit('\n', 1)[0] if '\n' in text else text
+                text += '\n…'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        os.replace(tmp_path, dst_path)
+        return True
+    except Exception:  # Corrupt or unsupported files just have no preview
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+def _init_preview_process(server_pid):
+    """
+    Renderer process setup: default signal handling instead of the server's, and
+    exit once the server process is gone (a forked server worker ends with
+    os._exit(), which never shuts this pool down). Renderers are children of the
+    fork server, not of the server process, so its pid is watched directly.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole process group; the server handles it
+
+    def watch_server():
+        while _process_alive(server_pid):
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch_server, name='preview-parent-watch', daemon=True).start()
+
+
+class PreviewCache(DiskCache):
+    """
+    Rendered previews in STATE_FOLDER/cache/previews, named "<key>.<kind>" where the
+    key is the blob hash (or device/inode/size) plus the mtime of the file.
+    """
+
+    def __init__(self):
+        super().__init__('previews', 'PREVIEW_CACHE_MAX_BYTES')
+        self.lock = threading.RLock()  # A render that is already done runs its callback at once
+        self.pending = {}  # entry name -> Future of render_preview
+        self.unpreviewable = set()  # entry names whose rendering failed
+        self._pool = None
+        self._pool_pid = None
+
+    @staticmethod
+    def key(path, st):
+        digest = blob_store.digest_of(path) or f'{st.st_dev:x}-{st.st_ino:x}-{st.st_size:x}'
+        return f'{digest}-{st.st_mtime_ns:x}'
+
+    def _executor(self):
+        # One pool per process. The server has threads running by now, and forking
+        # it could copy a lock some thread holds, so renderers come from a fork
+        # server that imports this module once (spawn where there is none).
+        # Caller holds the lock.
+        if self._pool is None or self._pool_pid != os.getpid():
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context('spawn')
+            self._pool = ProcessPoolExecutor(max_workers=app.config['PREVIEW_WORKERS'], mp_context=context,
+                                             initializer=_init_preview_process, initargs=(os.getpid(),))
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def shutdown(self):
+        """
+        Stops this process's renderers (a prefork worker exits without atexit).
+        """
+        with self.lock:
+            pool = self._pool if self._pool_pid == os.getpid() else None
+            self._pool = None
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)  # Not under the lock: finished renders take it in _rendered()
+
+    def _lookup(self, path):
+        """
+        Returns (entry name, kind, stat) for the file at path, or None if it can't
+        have a preview. Raises FileNotFoundError.
+        """
+        kind = preview_kind(path)
+        if kind is None or not app.config['PREVIEW_ENABLED']:
+            return None
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(path)
+        if kind == 'image' and st.st_size > app.config['THUMBNAIL_MAX_SOURCE']:
+            return None
+        return f'{self.key(path, st)}.{kind}', kind, st
+
+    def _render(self, path, name, kind):
+        """
+        Returns the Future rendering entry `name` (caller holds the lock).
+        """
+        future = self.pending.get(name)
+        if future is None:
+            try:
+                future = self._executor().submit(
+                    render_preview, path, os.path.join(self.folder(), name), kind,
+                    app.config['THUMBNAIL_SIZE'], app.config['TEXT_PREVIEW_BYTES'])
+            except BrokenProcessPool:
+                self._pool = None  # A renderer died (e.g. killed for memory); start over next time
+                raise
+            self.pending[name] = future
+            future.add_done_callback(lambda f: self._rendered(name, f))
+        return future
+
+    def _rendered(self, name, future):
+        with self.lock:
+            self.pending.pop(name, None)
+            try:
+                if future.result():
+                    self._add(name, os.path.getsize(os.path.join(self.folder(), name)))
+                else:
+                    self.unpreviewable.add(name)
+            except (OSError, BrokenProcessPool, CancelledError):
+                pass  # Tried again on the next request (cancelled: the pool was shut down)
+
+    def _cached(self, name):
+        """
+        Path of a rendered entry, also picking up ones another worker rendered
+        (caller holds the lock).
+        """
+        self._load()
+        path = os.path.join(self.folder(), name)
+        if name in self.entries:
+            self.entries.move_to_end(name)
+            return path
+        try:
+            self._add(name, os.path.getsize(path))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def schedule(self, filename):
+        """
+        Starts rendering the preview of a new file in the background.
+        """
+        try:
+            found = self._lookup(storage.locate(filename))
+            if found is None:
+                return
+            name, kind, _ = found
+            with self.lock:
+                if self._cached(name) is None and name not in self.unpreviewable:
+                    self._render(storage.locate(filename), name, kind)
+        except (OSError, BrokenProcessPool) as e:
+            log.warning("Could not schedule a preview of '%s': %s", filename, e)
+
+    def get(self, path):
+        """
+        Returns (preview path, kind, stat of the file) for the file at path,
+        rendering it now if needed, or None if it has no preview.
+        Raises FileNotFoundError.
+        """
+        found = self._lookup(path)
+        if found is None:
+            return None
+        name, kind, st = found
+        with self.lock:
+            cached = self._cached(name)
+            known_bad = cached is None and name in self.unpreviewable
+            metrics.inc('mkcloud_cache_requests_total', cache='preview',
+                        result='hit' if cached is not None or known_bad else 'miss')
+            if cached is not None:
+                return cached, kind, st
+            if known_bad:
+                return None
+            try:
+                future = self._render(path, name, kind)
+            except BrokenProcessPool:
+                return None
+        try:
+            ok = future.result(timeout=app.config['PREVIEW_WAIT'])
+        except (FuturesTimeoutError, BrokenProcessPool):
+            return None
+        return (os.path.join(self.folder(), name), kind, st) if ok else None
+
+
+preview_cache = PreviewCache()
+
+
+@app.route('/preview/<path:filename>')
+def file_preview(filename):
+    """
+    Thumbnail (image/jpeg) or text snippet of a file; 404 if it has none.
+    With ?v=<mtime> matching the file (as in the listing) the response is immutable.
+    """
+    secured_filename = secure_filename(filename)
+    path = storage.locate(secured_filename)
+    try:
+        preview = preview_cache.get(path)
+        if preview is None:
+            return jsonify({"error": "No preview for this file."}), 404
+        preview_path, kind, st = preview
+        try:
+            current = float(request.args.get('v', 'nan')) == st.st_mtime_ns / 1e9
+        except ValueError:
+            current = False
+        return send_file_response(
+            preview_path, mimetype=PREVIEW_MIMETYPES[kind],
+            etag=f'"{os.path.basename(preview_path)}"',
+            cache_control='public, max-age=31536000, immutable' if current else 'no-cache')
+    except FileNotFoundError:
+        return jsonify({"error": "File not found."}), 404
+
+# --- Batch Delete and Background Reclamation ---
+# POST /delete_batch removes any number of files from the listing in one request:
+# each file is renamed into a per-batch folder under STATE_FOLDER/trash (a rename
+# costs the same for 1 KB and 50 GB) and the index drops all names at once. The
+# Reclaimer thread then unlinks the trashed files in the background, shrinking
+# very large ones in steps so a single unlink never stalls the disk for seconds,
+# and records progress in "<job>.json" next to the batch folder, where any worker
+# process can read it for GET /delete_batch/<job>. Batches left over by a crash
+# are picked up again when the server starts.
+
+app.config['DELETE_BATCH_MAX'] = 100000  # names per batch (a filter matching more is rejected)
+app.config['RECLAIM_TRUNCATE_STEP'] = 1024 * 1024 * 1024  # big files are freed 1 GB at a time
+app.config['RECLAIM_STEP_PAUSE'] = 0.01  # seconds between truncate steps, to let other I/O through
+RECLAIM_STATUS_INTERVAL = 0.5  # seconds between progress updates while reclaiming
+
+
+class Reclaimer:
+    """
+    Queue of trashed batches plus the thread that frees their disk space.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.wakeup = threading.Condition(self.lock)
+        self._thread_pid = None
+
+    def folder(self):
+        return os.path.join(app.config['STATE_FOLDER'], 'trash')
+
+    def _paths(self, job_id):
+        base = os.path.join(self.folder(), job_id)
+        return base, base + '.json', base + '.manifest.json'
+
+    def _save_status(self, job_id, status):
+        _, status_path, _ = self._paths(job_id)
+        tmp_path = f'{status_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, status_path)
+
+    def status(self, job_id):
+        """
+        Returns the progress record of a batch, or None if there is no such batch.
+        """
+        if not _valid_upload_id(job_id):
+            return None
+        try:
+            with open(self._paths(job_id)[1]) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def trash(self, names):
+        """
+        Moves the named files out of UPLOAD_FOLDER into a new batch and queues it.
+        Returns (job status, names removed, names not found).
+        """
+        job_id = secrets.token_hex(16)
+        job_folder, _, manifest_path = self._paths(job_id)
+        os.makedirs(job_folder)
+        manifest = {}  # name -> blob digest or None
+        removed, missing = [], []
+        total_bytes = 0
+        for name in names:
+            path = storage.locate(name)
+            try:
+                st = os.stat(path)
+                if not stat.S_ISREG(st.st_mode):
+                    raise FileNotFoundError(name)
+                digest = blob_store.digest_of(path)
+                os.rename(path, os.path.join(job_folder, name))
+            except FileNotFoundError:
+                missing.append(name)
+                continue
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    log.error("Error deleting file '%s': %s", name, e)
+                    missing.append(name)
+                    continue
+                os.remove(path)  # STATE_FOLDER on another filesystem: no cheap rename
+                blob_store.release(digest)
+                removed.append(name)
+                continue
+            manifest[name] = digest
+            removed.append(name)
+            total_bytes += st.st_size
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        status = {"job_id": job_id, "state": "queued", "files": len(manifest), "bytes": total_bytes,
+                  "files_done": 0, "bytes_freed": 0, "created": time.time(), "finished": None}
+        self._save_status(job_id, status)
+        file_index.refresh(*removed)
+        catalog.remove(removed)
+        self.submit(job_id)
+        return status, removed, missing
+
+    def submit(self, job_id):
+        with self.lock:
+            if self._thread_pid != os.getpid():
+                self._thread_pid = os.getpid()
+                threading.Thread(target=self._run, name='reclaimer', daemon=True).start()
+            self.queue.append(job_id)
+            self.wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.wakeup.wait()
+                job_id = self.queue.popleft()
+            try:
+                self._reclaim(job_id)
+            except OSError as e:
+                log.exception('Error reclaiming deleted batch %s: %s', job_id, e)
+
+    def _free(self, path, digest):
+        """
+        Unlinks path; large files are truncated step by step first, unless their
+        inode is shared: a deduplicated file's other names and its blob are
+        links to the same data, which truncating would cut short for all of them.
+        """
+        st = os.stat(path)
+        size = st.st_size
+        step = app.config['RECLAIM_TRUNCATE_STEP']
+        if size > step and st.st_nlink == 1 and digest is None and blob_store.digest_of(path) is None:
+            with open(path, 'r+b') as f:
+                while size > step:
+                    size -= step
+                    f.truncate(size)
+                    time.sleep(app.config['RECLAIM_STEP_PAUSE'])
+        os.remove(path)
+
+    def _reclaim(self, job_id):
+        job_folder, _, manifest_path = self._paths(job_id)
+        lock_fd = os.open(job_folder, os.O_RDONLY)
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return  # Another worker process is already on it
+            try:
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                return  # Finished by another worker process meanwhile
+            status = self.status(job_id) or {"job_id": job_id, "files": len(manifest), "bytes": 0,
+                                             "created": time.time()}
+            status.update(state="running", files_done=0, bytes_freed=0)
+            self._save_status(job_id, status)
+            last_update = time.monotonic()
+            for name, digest in manifest.items():
+                path = os.path.join(job_folder, name)
+                try:
+                    size = os.stat(path).st_size
+                    self._free(path, digest)
+                    status['bytes_freed'] += size
+                except FileNotFoundError:
+                    pass  # Freed before a restart
+                blob_store.release(digest)
+                status['files_done'] += 1
+                if time.monotonic() - last_update >= RECLAIM_STATUS_INTERVAL:
+                    last_update = time.monotonic()
+                    self._save_status(job_id, status)
+            os.rmdir(job_folder)
+            os.remove(manifest_path)
+            status.update(state="done", finished=time.time())
+            self._save_status(job_id, status)
+            log.info('Reclaimed %d deleted files (%d bytes) from batch %s',
+                     status['files_done'], status['bytes_freed'], job_id, extra={'bytes': status['bytes_freed']})
+        finally:
+            os.close(lock_fd)
+
+    def recover(self):
+        """
+        Queues the batches an earlier run didn't finish, and forgets finished ones
+        after a day.
+        """
+        try:
+            entries = list(os.scandir(self.folder()))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_dir() and os.path.exists(self._paths(entry.name)[2]):
+                self.submit(entry.name)
+            elif entry.name.endswith('.json') and not entry.name.endswith('.manifest.json'):
+                status = self.status(entry.name[:-len('.json')])
+                if status and status['state'] == 'done' and status['finished'] < time.time() - 24 * 60 * 60:
+                    os.remove(entry.path)
+
+
+reclaimer = Reclaimer()
+
+
+@app.route('/delete_batch', methods=['POST'])
+def delete_batch():
+    """
+    Deletes many files at once. Takes {"names": [...]} (or repeated "name" fields),
+    or prefix / q / all=1 to delete what a filter matches. The names leave the
+    listing before the response is sent; disk space is freed in the background.
+    Responds 202 with the batch id to poll at GET /delete_batch/<job_id>.
+    """
+    try:
+        names = _bulk_selection(app.config['DELETE_BATCH_MAX'])
+    except ValueError as e:
+        return jsonify({"error": f"{e}."}), 400
+    if not names:
+        return jsonify({"error": "No files selected."}), 400
+    if len(names) > app.config['DELETE_BATCH_MAX']:
+        return jsonify({"error": f"At most {app.config['DELETE_BATCH_MAX']} files per batch."}), 400
+    try:
+        status, removed, missing = reclaimer.trash(names)
+    except OSError as e:
+        log.exception('Error starting batch delete: %s', e)
+        return jsonify({"error": "Server error deleting files."}), 500
+    log.info('Batch delete %s: %d files removed, %d not found', status['job_id'], len(removed), len(missing))
+    return jsonify(dict(status, removed=removed, missing=missing)), 202
+
+
+@app.route('/delete_batch/<job_id>', methods=['GET'])
+def delete_batch_status(job_id):
+    """
+    Progress of a batch: files/bytes queued, files_done/bytes_freed so far, state.
+    """
+    status = reclaimer.status(job_id)
+    if status is None:
+        return jsonify({"error": "Unknown batch."}), 404
+    return jsonify(status)
+
+# --- Atomic Uploads and Durability ---
+# Uploads are written under STATE_FOLDER/incoming (on the same filesystem as
+# UPLOAD_FOLDER) and renamed into place once complete, so listings never show a
+# half-written file, a crashed upload leaves nothing visible behind, and a file being
+# replaced stays downloadable until the new version is in place. When the size is
+# known up front the space is reserved with fallocate(2): the file is laid out in
+# one piece and a full disk fails the upload at once instead of after gigabytes.
+#
+# UPLOAD_FSYNC picks how much a finished upload is worth waiting for:
+#   'none'  - leave the data to the page cache; a power cut may lose recent uploads.
+#   'close' - fsync each file before the rename and its folder after it.
+#   'batch' - group commit: uploads finishing within UPLOAD_FSYNC_BATCH_INTERVAL
+#             share one syncfs(2) of the whole filesystem before their renames;
+#             the renames themselves ride along with the next batch.
+
+FSYNC_POLICIES = ('none', 'close', 'batch')
+
+app.config['UPLOAD_FSYNC'] = os.environ.get('UPLOAD_FSYNC', 'close')
+app.config['UPLOAD_FSYNC_BATCH_INTERVAL'] = 0.02  # seconds a batch waits for more uploads
+app.config['UPLOAD_PREALLOCATE'] = True
+if app.config['UPLOAD_FSYNC'] not in FSYNC_POLICIES:
+    log.warning("Unknown UPLOAD_FSYNC '%s'; using 'close'", app.config['UPLOAD_FSYNC'])
+    app.config['UPLOAD_FSYNC'] = 'close'
+
+
+def _incoming_folder():
+    """
+    Returns the folder holding uploads in progress, creating it if needed.
+    """
+    folder = os.path.join(app.config['STATE_FOLDER'], 'incoming')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def incoming_path(filename):
+    """
+    A fresh temporary path for an upload that will become filename.
+    """
+    return os.path.join(_incoming_folder(), f'{secrets.token_hex(8)}-{filename}')
+
+
+_libc = None
+
+
+def _libc_function(name):
+    """
+    Returns a libc function via ctypes, or None where it doesn't exist.
+    """
+    global _libc
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        return getattr(_libc, name)
+    except (OSError, AttributeError):
+        return None
+
+
+def preallocate(f, size):
+    """
+    Reserves size bytes for the open file f (which grows to that size). Raises
+    OSError(ENOSPC) if the disk can't hold it; filesystems without fallocate(2)
+    are skipped rather than emulated by writing zeros.
+    """
+    fallocate = _libc_function('fallocate')
+    if not app.config['UPLOAD_PREALLOCATE'] or fallocate is None or size <= 0:
+        return False
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    if fallocate(f.fileno(), 0, 0, size) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSPC, errno.EFBIG):
+        raise OSError(err, os.strerror(err))
+    return False  # EOPNOTSUPP and friends: write it the ordinary way
+
+
+def _fsync_folder(folder):
+    """
+    Makes renames in folder durable. Some filesystems can't fsync a directory.
+    """
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class GroupCommitter:
+    """
+    The 'batch' fsync policy: callers of wait() block until a filesystem-wide
+    sync that started after their call has finished. One thread per process runs
+    the syncs, each covering every upload that asked for it meanwhile.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._requested = 0  # highest batch anybody asked for
+        self._started = 0  # batches started
+        self._finished = 0  # batches finished
+        self._pid = None
+
+    def _ensure_thread(self):
+        if self._pid != os.getpid():
+            # A forked worker inherits the counters but not the thread
+            self._pid = os.getpid()
+            self._requested = self._started = self._finished
+            threading.Thread(target=self._run, name='group-commit', daemon=True).start()
+
+    def request(self):
+        """
+        Asks for a batch without waiting for it; returns its number.
+        """
+        with self._cond:
+            self._ensure_thread()
+            self._requested = max(self._requested, self._started + 1)
+            self._cond.notify_all()
+            return self._started + 1
+
+    def wait(self):
+        batch = self.request()
+        with self._cond:
+            while self._finished < batch:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._requested <= self._started:
+                    self._cond.wait()
+            time.sleep(app.config['UPLOAD_FSYNC_BATCH_INTERVAL'])  # let more uploads join
+            with self._cond:
+                self._started += 1
+                batch = self._started
+            try:
+                self._sync()
+            except OSError as e:
+                log.error('Group commit failed: %s', e)
+            with self._cond:
+                self._finished = batch
+                self._cond.notify_all()
+
+    @staticmethod
+    def _sync():
+        syncfs = _libc_function('syncfs')
+        if syncfs is None:
+            os.sync()
+            return
+        fd = os.open(app.config['UPLOAD_FOLDER'], os.O_RDONLY)
+        try:
+            if syncfs(fd) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+        finally:
+            os.close(fd)
+
+
+group_committer = GroupCommitter()
+
+
+def sync_upload(f):
+    """
+    Makes the data of a finished upload durable as UPLOAD_FSYNC asks; call it
+    before publish_upload(). f is the open file, already flushed.
+    """
+    policy = app.config['UPLOAD_FSYNC']
+    if policy == 'close':
+        os.fsync(f.fileno())
+    elif policy == 'batch':
+        group_committer.wait()
+
+
+def publish_upload(tmp_path, path):
+    """
+    Atomically renames a finished upload into place; returns the blob digest of
+    the file it replaced (for blob_store.release()), if any.
+    """
+    replaced_digest = blob_store.digest_of(path)
+    os.replace(tmp_path, path)
+    # rename() leaves both names alone when they already link to the same blob
+    discard_incoming(tmp_path)
+    policy = app.config['UPLOAD_FSYNC']
+    if policy == 'close':
+        _fsync_folder(os.path.dirname(path))
+    elif policy == 'batch':
+        group_committer.request()
+    return replaced_digest
+
+
+def discard_incoming(tmp_path):
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def _expire_incoming():
+    """
+    Removes temp files left behind by uploads that died with their process.
+    """
+    cutoff = time.time() - app.config['UPLOAD_SESSION_TTL']
+    for entry in os.scandir(_incoming_folder()):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def upload_error_status(e):
+    """
+    507 Insufficient Storage when the disk is full, 400 for other upload failures.
+    """
+    return 507 if isinstance(e, OSError) and e.errno in (errno.ENOSPC, errno.EFBIG) else 400
+
+# --- Resumable Chunked Uploads ---
+# A client creates an upload session, PUTs numbered chunks (in any order, several
+# at once if it likes), asks which byte ranges the server already has, and finally
+# completes the session to move the file into UPLOAD_FOLDER. If the connection
+# drops, only the chunks that never arrived have to be sent again.
+#
+# Each session is a sparse "<id>.part" data file plus an "<id>.json" sidecar in the
+# partial folder. The sidecar records which chunks were fully written, so sessions
+# survive a server restart, and it is the only copy of the session state, so every
+# worker process of a prefork server sees the same session.
+#
+# Completing a session marks it "completing" first, so no new chunk write starts,
+# and then waits for the chunk writes already under way (each holds a shared flock
+# on "<id>.writers"), so nothing writes into the data file once it is hashed.
+
+_upload_session_locks = {}  # upload_id -> threading.Lock for this process
+_upload_sessions_lock = threading.Lock()
+UPLOAD_COPY_BUFSIZE = 1024 * 1024  # 1 MB reads from the request stream
+
+
+def _partial_folder():
+    """
+    Returns the folder holding unfinished chunked uploads, creating it if needed.
+    """
+    folder = os.path.join(app.config['STATE_FOLDER'], 'partial')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def _valid_upload_id(upload_id):
+    """
+    Upload ids are 32 hex characters; anything else could escape the partial folder.
+    """
+    return len(upload_id) == 32 and all(c in '0123456789abcdef' for c in upload_id)
+
+
+def _session_paths(upload_id):
+    folder = _partial_folder()
+    return os.path.join(folder, upload_id + '.part'), os.path.join(folder, upload_id + '.json')
+
+
+def _save_session(session):
+    """
+    Persists the session sidecar. Written to a temp name and renamed so a crash
+    never leaves a half-written JSON file behind.
+    """
+    _, meta_path = _session_paths(session['upload_id'])
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({k: v for k, v in session.items() if k != 'lock'}, f)
+    os.replace(tmp_path, meta_path)
+
+
+class _SessionLock:
+    """
+    Serializes updates of one session across threads and worker processes: a
+    per-process lock plus flock() on "<id>.lock". Entering it reloads the session
+    from its sidecar, since another worker may have recorded chunks meanwhile.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        with _upload_sessions_lock:
+            self.thread_lock = _upload_session_locks.setdefault(session['upload_id'], threading.Lock())
+        self.fd = None
+        self.gone = False  # Set on entry: the session was completed or aborted meanwhile
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            _, meta_path = _session_paths(self.session['upload_id'])
+            if fcntl is not None:
+                self.fd = os.open(meta_path[:-len('.json')] + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                with open(meta_path) as f:
+                    self.session.update(json.load(f))
+                self.gone = False
+            except FileNotFoundError:
+                self.gone = True  # Completed or aborted meanwhile; nothing newer to read
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self.session
+
+    def __exit__(self, *exc_info):
+        if self.fd is not None:
+            os.close(self.fd)  # Also drops the flock
+            self.fd = None
+        self.thread_lock.release()
+
+
+class _ChunkWriters:
+    """
+    flock() on "<id>.writers": shared while a chunk is written, exclusive while
+    the session is completed. Without fcntl only the "completing" mark in the
+    session protects the data file.
+    """
+
+    def __init__(self, upload_id):
+        _, meta_path = _session_paths(upload_id)
+        self.fd = os.open(meta_path[:-len('.json')] + '.writers', os.O_RDWR | os.O_CREAT, 0o600) \
+            if fcntl is not None else None
+
+    def acquire(self, exclusive=False):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)  # Also drops the flock
+            self.fd = None
+
+
+def _completing(session):
+    """
+    Whether a live process is completing the session (caller holds its lock).
+    """
+    pid = session.get('completing')
+    return pid is not None and _process_alive(pid)
+
+
+def _load_session(upload_id):
+    """
+    Returns the session for upload_id read from its sidecar, or None.
+    """
+    if not _valid_upload_id(upload_id):
+        return None
+    _, meta_path = _session_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return None
+    session['lock'] = _SessionLock(session)
+    return session
+
+
+def _drop_session(upload_id, remove_data=True):
+    """
+    Forgets a session and removes its sidecar (and, unless finalized, its data).
+    """
+    with _upload_sessions_lock:
+        _upload_session_locks.pop(upload_id, None)
+    part_path, meta_path = _session_paths(upload_id)
+    lock_path = meta_path[:-len('.json')] + '.lock'
+    writers_path = meta_path[:-len('.json')] + '.writers'
+    paths = [meta_path, lock_path, writers_path] + ([part_path] if remove_data else [])
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _expire_upload_sessions():
+    """
+    Removes sessions that have not received a chunk within UPLOAD_SESSION_TTL.
+    """
+    cutoff = time.time() - app.config['UPLOAD_SESSION_TTL']
+    folder = _partial_folder()
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.json'):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    log.info('Expiring stale upload session: %s', entry.name[:-5])
+                    _drop_session(entry.name[:-5])
+            except OSError:
+                pass
+
+
+def _chunk_count(session):
+    return max(1, -(-session['size'] // session['chunk_size']))
+
+
+def _chunk_bounds(session, index):
+    """
+    Returns the (start, end) byte offsets covered by chunk number index.
+    """
+    start = index * session['chunk_size']
+    return start, min(start + session['chunk_size'], session['size'])
+
+
+def _received_ranges(session):
+    """
+    Collapses the received chunk numbers into sorted [start, end) byte ranges.
+    """
+    ranges = []
+    for index in sorted(session['received']):
+        start, end = _chunk_bounds(session, index)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def _session_status(session):
+    received = set(session['received'])
+    missing = [i for i in range(_chunk_count(session)) if i not in received]
+    return {
+        "upload_id": session['upload_id'],
+        "filename": session['filename'],
+        "size": session['size'],
+        "chunk_size": session['chunk_size'],
+        "chunk_count": _chunk_count(session),
+        "received": _received_ranges(session),
+        "missing_chunks": missing,
+        "bytes_received": sum(end - start for start, end in _received_ranges(session)),
+    }
+
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """
+    Starts a resumable upload. Expects JSON: {"filename": ..., "size": ...} and
+    optionally "chunk_size". Returns the session id and the chunk layout.
+    """
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename', '')))
+    size = data.get('size')
+    chunk_size = data.get('chunk_size') or app.config['UPLOAD_CHUNK_SIZE']
+
+    if not filename:
+        return jsonify({"error": "A filename is required."}), 400
+    if not isinstance(size, int) or size < 0:
+        return jsonify({"error": "A non-negative integer size is required."}), 400
+    if size > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({"error": "File is larger than the maximum upload size."}), 413
+    if not isinstance(chunk_size, int) or not (64 * 1024 <= chunk_size <= 64 * 1024 * 1024):
+        return jsonify({"error": "chunk_size must be between 64 KB and 64 MB."}), 400
+    sha256 = data.get('sha256')
+    if sha256 is not None and not (isinstance(sha256, str) and _valid_digest(sha256)):
+        return jsonify({"error": "sha256 must be a lowercase hex SHA-256 digest."}), 400
+
+    if sha256 is not None:
+        # The server may already have this content: then no chunk needs to be sent
+        st = blob_store.lookup(sha256)
+        if st is not None and st.st_size == size:
+            try:
+                blob_store.link(sha256, storage.target(filename))
+                storage.settle(filename)
+            except OSError as e:
+                log.error("Error linking blob %s as '%s': %s", sha256, filename, e)
+            else:
+                file_index.refresh(filename)
+                catalog.record_upload(filename, sha256)
+                log.info("File '%s' created from stored blob %s (%d bytes not uploaded)", filename, sha256, size,
+                         extra={'file': filename})
+                return jsonify({"filename": filename, "size": size, "sha256": sha256, "deduplicated": True})
+
+    _expire_upload_sessions()
+
+    upload_id = secrets.token_hex(16)
+    session = {
+        "upload_id": upload_id,
+        "filename": filename,
+        "size": size,
+        "chunk_size": chunk_size,
+        "created": time.time(),
+        "received": [],
+        "sha256": sha256,
+    }
+    part_path, _ = _session_paths(upload_id)
+    try:
+        # Reserve the full length up front, so chunks can be written at their offsets
+        # in any order and a full disk is noticed now (sparse where fallocate isn't
+        # supported).
+        with open(part_path, 'wb') as f:
+            if not preallocate(f, size):
+                f.truncate(size)
+        _save_session(session)
+    except OSError as e:
+        log.error("Error creating upload session for '%s': %s", filename, e)
+        _drop_session(upload_id)
+        if upload_error_status(e) == 507:
+            return jsonify({"error": f"Not enough disk space for '{filename}'."}), 507
+        return jsonify({"error": f"Server error creating upload for '{filename}'."}), 500
+
+    log.info("Upload session %s created for '%s' (%d bytes)", upload_id, filename, size, extra={'file': filename})
+    return jsonify(_session_status(session)), 201
+
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """
+    Reports which byte ranges of the upload have arrived and which chunks are missing.
+    """
+    session = _load_session(upload_id)
+    if session is None:
+        return jsonify({"error": "Unknown upload session."}), 404
+    with session['lock']:  # Reloads the sidecar, which other requests may be updating
+        status = _session_status(session)
+    return jsonify(status)
+
+
+@app.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    """
+    Stores one chunk. The request body is the raw chunk data; its offset is
+    index * chunk_size. Chunks may arrive in any order and in parallel, and
+    re-sending a chunk simply overwrites it.
+    """
+    session = _load_session(upload_id)
+    if session is None:
+        return jsonify({"error": "Unknown upload session."}), 404
+    if index >= _chunk_count(session):
+        return jsonify({"error": f"Chunk {index} is out of range."}), 416
+
+    with session['lock']:
+        if session['lock'].gone:
+            return jsonify({"error": "Unknown upload session."}), 404
+        if _completing(session):
+            return jsonify({"error": "Upload is being completed."}), 409
+        # Taken before the lock is released, so completing waits for this write
+        writers = _ChunkWriters(upload_id)
+        writers.acquire()
+    try:
+        return _write_chunk(session, upload_id, index)
+    finally:
+        writers.release()
+
+
+def _write_chunk(session, upload_id, index):
+    start, end = _chunk_bounds(session, index)
+    expected = end - start
+    part_path, _ = _session_paths(upload_id)
+    written = 0
+    metrics.inc('mkcloud_active_transfers', direction='upload')
+    try:
+        # Each request uses its own file handle, so parallel chunks of the same
+        # upload never share a file position.
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            while written < expected:
+                block = request.stream.read(min(UPLOAD_COPY_BUFSIZE, expected - written))
+                if not block:
+                    break
+                f.write(block)
+                written += len(block)
+    except OSError as e:
+        log.error('Error writing chunk %d of upload %s: %s', index, upload_id, e)
+        return jsonify({"error": "Server error writing chunk."}), 500
+    finally:
+        metrics.inc('mkcloud_active_transfers', -1, direction='upload')
+        metrics.inc('mkcloud_upload_bytes_total', written)
+
+    if written != expected or request.stream.read(1):
+        # The bytes on disk for this chunk may now be partly overwritten, so it
+        # has to be sent again even if an earlier attempt succeeded.
+        with session['lock']:
+            if index in session['received']:
+                session['received'].remove(index)
+                _save_session(session)
+        return jsonify({"error": f"Chunk {index} must be exactly {expected} bytes."}), 400
+
+    with session['lock']:
+        if index not in session['received']:
+            session['received'].append(index)
+            _save_session(session)
+        status = _session_status(session)
+    return jsonify(status)
+
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """
+    Moves a fully received upload into UPLOAD_FOLDER under its secured filename.
+    """
+    session = _load_session(upload_id)
+    if session is None:
+        return jsonify({"error": "Unknown upload session."}), 404
+
+    with session['lock']:
+        if session['lock'].gone:
+            return jsonify({"error": "Unknown upload session."}), 404
+        status = _session_status(session)
+        if status['missing_chunks']:
+            return jsonify(dict(status, error="Upload is incomplete.")), 409
+        if _completing(session):
+            return jsonify({"error": "Upload is already being completed."}), 409
+        session['completing'] = os.getpid()
+        _save_session(session)
+    writers = _ChunkWriters(upload_id)
+    try:
+        writers.acquire(exclusive=True)  # Waits for the chunk writes already under way
+        return _finish_upload(session, upload_id)
+    finally:
+        writers.release()
+
+
+def _reopen_session(session):
+    """
+    Lets chunks be written again after a failed completion (caller holds the lock).
+    """
+    session['completing'] = None
+    _save_session(session)
+
+
+def _finish_upload(session, upload_id):
+    with session['lock']:
+        if session['lock'].gone:
+            return jsonify({"error": "Unknown upload session."}), 404
+        status = _session_status(session)
+        if status['missing_chunks']:
+            # A chunk being re-sent failed while it waited
+            _reopen_session(session)
+            return jsonify(dict(status, error="Upload is incomplete.")), 409
+
+        part_path, _ = _session_paths(upload_id)
+        file_save_path = storage.path(session['filename'])
+        try:
+            # Chunks arrive out of order, so the content is hashed once it is complete
+            digest = hash_file(part_path)
+            if session.get('sha256') and digest != session['sha256']:
+                _reopen_session(session)
+                return jsonify({"error": "Uploaded data does not match the announced sha256.",
+                                "sha256": digest}), 422
+            with open(part_path, 'rb') as f:
+                sync_upload(f)
+            deduplicated = blob_store.adopt(part_path, digest)
+            file_save_path = storage.target(session['filename'])
+            blob_store.release(publish_upload(part_path, file_save_path))
+            storage.settle(session['filename'])
+        except OSError as e:
+            log.error("Error finalizing upload %s to '%s': %s", upload_id, file_save_path, e)
+            if os.path.exists(part_path):
+                _reopen_session(session)
+            return jsonify({"error": f"Server error saving '{session['filename']}'."}), 500
+        _drop_session(upload_id, remove_data=False)
+        file_index.refresh(session['filename'])
+        catalog.record_upload(session['filename'], digest)
+        preview_cache.schedule(session['filename'])
+
+    log.info("File '%s' uploaded in chunks to %s", session['filename'], file_save_path,
+             extra={'file': session['filename'], 'bytes': session['size']})
+    return jsonify({"filename": session['filename'], "size": session['size'], "sha256": digest,
+                    "deduplicated": deduplicated})
+
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """
+    Cancels an upload session and discards its partial data.
+    """
+    if _load_session(upload_id) is None:
+        return jsonify({"error": "Unknown upload session."}), 404
+    _drop_session(upload_id)
+    log.info('Upload session %s aborted', upload_id)
+    return '', 204
+
+# --- Streaming Uploads ---
+# request.files makes Werkzeug parse the whole multipart body into temporary files
+# first, and FileStorage.save() then copies those into UPLOAD_FOLDER: every byte is
+# written to disk twice. The streaming endpoints below never touch request.files.
+# They read the raw request stream in blocks, split multipart bodies incrementally
+# and write each file part straight into the temp file that becomes it (see Atomic
+# Uploads and Durability).
+
+UPLOAD_WRITE_BUFSIZE = 4 * 1024 * 1024  # Large buffered writes: fewer, bigger syscalls
+
+
+class UploadWriter:
+    """
+    Writes one uploaded file through a large write buffer to a temporary file,
+    which close() renames to its final path in UPLOAD_FOLDER, and measures the
+    throughput of the upload. size, when known, preallocates the space.
+    """
+
+    def __init__(self, filename, size=None):
+        self.filename = filename
+        self.path = storage.path(filename)
+        self.tmp_path = incoming_path(filename)
+        self.bytes_written = 0
+        self.started = time.perf_counter()
+        self.digest = None
+        self.deduplicated = False
+        self._hash = hashlib.sha256()
+        self._file = open(self.tmp_path, 'wb', buffering=UPLOAD_WRITE_BUFSIZE)
+        try:
+            self._preallocated = preallocate(self._file, size) if size else False
+        except OSError:
+            self._file.close()
+            discard_incoming(self.tmp_path)
+            raise
+        metrics.inc('mkcloud_active_transfers', direction='upload')
+
+    def write(self, data):
+        self._file.write(data)
+        self._hash.update(data)
+        self.bytes_written += len(data)
+
+    def content_hash(self):
+        """
+        SHA-256 (hex) of what has been written so far.
+        """
+        return self._hash.copy().hexdigest()
+
+    def close(self):
+        """
+        Makes the file durable (per UPLOAD_FSYNC), moves it into place, stores it
+        in the blob store and returns its summary.
+        """
+        try:
+            self._file.flush()
+            if self._preallocated and self._file.tell() != os.fstat(self._file.fileno()).st_size:
+                self._file.truncate()  # Fewer bytes arrived than were announced
+            sync_upload(self._file)
+            self._file.close()
+            self.digest = self._hash.hexdigest()
+            # Stored before the rename, so the name appears already linked to its blob.
+            # Replacing a name that links to a shared blob leaves the blob untouched.
+            self.deduplicated = blob_store.adopt(self.tmp_path, self.digest)
+            self.path = storage.target(self.filename)
+            blob_store.release(publish_upload(self.tmp_path, self.path))
+            storage.settle(self.filename)
+        except BaseException:
+            self.abort()
+            raise
+        self._file = None
+        self._count()
+        file_index.refresh(self.filename)
+        catalog.record_upload(self.filename, self.digest)
+        preview_cache.schedule(self.filename)
+        stats = self.stats()
+        log.info("File '%s' uploaded to %s: %d bytes in %ss (%s MB/s)%s", self.filename, self.path,
+                 stats['bytes'], stats['seconds'], stats['mb_per_s'],
+                 ' (duplicate content, stored once)' if self.deduplicated else '',
+                 extra={'file': self.filename, 'bytes': stats['bytes'], 'duration_ms': round(stats['seconds'] * 1000)})
+        return stats
+
+    def abort(self):
+        """
+        Closes and removes the partially written file, e.g. after a client
+        disconnect; whatever was at the final path stays as it was.
+        """
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except OSError:
+            pass  # e.g. flushing the buffer into a full disk
+        self._file = None
+        self._count()
+        discard_incoming(self.tmp_path)
+
+    def _count(self):
+        metrics.inc('mkcloud_active_transfers', -1, direction='upload')
+        metrics.inc('mkcloud_upload_bytes_total', self.bytes_written)
+
+    def stats(self):
+        seconds = time.perf_counter() - self.started
+        return {
+            "filename": self.filename,
+            "bytes": self.bytes_written,
+            "seconds": round(seconds, 3),
+            "mb_per_s": round(self.bytes_written / (1024 * 1024) / seconds, 2) if seconds > 0 else None,
+            "sha256": self.digest,
+            "deduplicated": self.deduplicated,
         }
 
-        /* Custom CSS from previous iterations, adjusted for dark mode defaults */
-        body {
-            font-family: 'Inter', sans-serif;
-            transition: background-color 0.3s ease, color 0.3s ease;
-            background-image: linear-gradient(to bottom right, #1a202c, #2d3748); /* Dark mode background */
-        }
-        .file-item, .drop-zone {
-            transition: transform 0.2s ease-in-out, box-shadow 0.2s ease-in-out, background-color 0.3s ease;
-        }
-        .file-item:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 8px 16px rgba(0, 0, 0, 0.1);
-        }
-        .btn-primary, .btn-delete {
-            transition: transform 0.15s ease-in-out, box-shadow 0.15s ease-in-out, background-color 0.3s ease;
-        }
-        .btn-primary:hover {
-            transform: translateY(-1px);
-            box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
-        }
-        .btn-delete:hover {
-            background-color: #dc2626; /* Red-600 */
-        }
-        /* Dark mode specific styles - now applied by default */
-        .bg-white { background-color: #2d3748; }
-        .text-gray-900 { color: #e2e8f0; }
-        .text-gray-600 { color: #a0aec0; }
-        .bg-gray-50 { background-color: #4a5568; }
-        .text-gray-800 { color: #e2e8f0; }
-        .text-gray-700 { color: #cbd5e0; }
-        .file-item { background-color: #4a5568; border-color: #2d3748; }
-        .border-gray-200, .border-gray-100 { border-color: #4a5568; }
-        .text-gray-500 { color: #a0aec0; }
-        .file\:bg-indigo-50 { background-color: #4338ca; } /* Indigo-700 for dark mode */
-        .file\:text-indigo-700 { color: #e0e7ff; } /* Indigo-100 for dark mode */
-        .hover\:file\:bg-indigo-100:hover { background-color: #3730a3; } /* Indigo-800 for dark mode */
-        .focus\:ring-indigo-500:focus { --tw-ring-color: #6366f1; } /* Indigo-500 for dark mode */
-        .bg-indigo-600 { background-color: #4f46e5; }
-        .hover\:bg-indigo-700:hover { background-color: #4338ca; }
-        .bg-green-500 { background-color: #22c55e; }
-        .hover\:bg-green-600:hover { background-color: #16a34a; }
-        .bg-red-500 { background-color: #ef4444; }
-        .hover\:bg-red-600:hover { background-color: #dc2626; }
-        .drop-zone.highlight { border-color: #818cf8; background-color: rgba(129, 140, 248, 0.1); }
-
-        /* Mobile-friendly adjustments (apply to all screen sizes for mobile-first) */
-        .max-w-4xl {
-            max-width: 100%;
-            padding: 1rem;
-        }
-        @media (min-width: 640px) {
-            .max-w-4xl {
-                max-width: 56rem;
-                padding: 2rem;
-            }
-        }
-        .file-item {
-            flex-direction: column;
-            align-items: flex-start;
-        }
-        .file-item .flex.space-x-2 {
-            width: 100%;
-            justify-content: flex-start;
-            margin-top: 0.5rem;
-        }
-    </style>
-</head>
-<body class="min-h-screen flex flex-col items-center justify-center py-12 px-4 sm:px-6 lg:px-8">
-    <div class="max-w-4xl w-full bg-white p-8 rounded-xl shadow-2xl space-y-8 border border-gray-200">
-        <div class="text-center">
-            <h1 class="text-4xl font-extrabold text-gray-900 mb-4">
-                MK Cloud Server
-            </h1>
-            <p class="text-lg text-gray-600">
-                Upload and download files seamlessly across your network.
-            </p>
-        </div>
 
-        <!-- Error Message Display -->
-        <div id="error-message" class="hidden bg-red-100 border border-red-400 text-red-700 px-4 py-3 rounded relative" role="alert">
-            <strong class="font-bold">Error!</strong>
-            <span class="block" id="error-text"></span>
-        </div>
+# Multi-file form uploads (index()) are written by a bounded pool, so several large
+# files hit the disk in parallel without one thread per file.
+_upload_pool = ThreadPoolExecutor(max_workers=app.config['UPLOAD_WORKERS'], thread_name_prefix='upload')
+
+
+def save_file_storage(uploaded_file, filename):
+    """
+    Copies one Werkzeug FileStorage into UPLOAD_FOLDER and returns its summary
+    (or an error entry). Runs on the upload pool.
+    """
+    metrics.inc('mkcloud_upload_queue_depth', -1)
+    writer = None
+    try:
+        writer = UploadWriter(filename, _stream_size(uploaded_file.stream))
+        while True:
+            block = uploaded_file.stream.read(UPLOAD_COPY_BUFSIZE)
+            if not block:
+                break
+            writer.write(block)
+        return writer.close()
+    except IOError as e:
+        log.error("IOError saving file '%s': %s", filename, e)
+        if upload_error_status(e) == 507:
+            error = f"Server error: not enough disk space for '{filename}'."
+        else:
+            error = f"Server error: Permissions issue saving '{filename}'."
+    except Exception as e:
+        log.exception("Error saving file '%s': %s", filename, e)
+        error = f"Server error saving '{filename}': {e}"
+    if writer is not None:
+        writer.abort()
+    return {"filename": filename, "error": error}
+
+
+def _stream_size(stream):
+    """
+    Bytes left in a spooled upload part, or None if the stream can't tell.
+    """
+    try:
+        position = stream.tell()
+        size = stream.seek(0, os.SEEK_END) - position
+        stream.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _iter_request_stream():
+    """
+    Yields the request body in UPLOAD_COPY_BUFSIZE blocks.
+    """
+    while True:
+        block = request.stream.read(UPLOAD_COPY_BUFSIZE)
+        if not block:
+            return
+        yield block
+
+
+def _upload_summary(results, started):
+    seconds = time.perf_counter() - started
+    total = sum(r['bytes'] for r in results if 'bytes' in r)
+    return {
+        "files": results,
+        "bytes": total,
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(total / (1024 * 1024) / seconds, 2) if seconds > 0 else None,
+    }
+
+
+@app.route('/stream_upload', methods=['POST'])
+def stream_upload():
+    """
+    Zero-spool multipart upload. Accepts the same form as index() (any number of
+    'file' parts) and returns per-file byte counts and throughput as JSON.
+    """
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({"error": "Expected a multipart/form-data body."}), 400
+
+    started = time.perf_counter()
+    # The limit bounds what one receive_data() call may add to what the decoder still holds
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=2 * UPLOAD_COPY_BUFSIZE)
+    results = []
+    writer = None
+    skipping = False  # True while discarding a part that won't be saved
+
+    def handle_events():
+        nonlocal writer, skipping
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, (NeedData, Epilogue)):
+                return
+            if isinstance(event, File):
+                filename = secure_filename(event.filename or '')
+                if event.name != 'file' or not filename:
+                    skipping = True
+                    if event.name == 'file':
+                        results.append({"filename": event.filename, "error": "Invalid or empty filename."})
+                else:
+                    skipping = False
+                    writer = UploadWriter(filename)
+            elif isinstance(event, Field):
+                skipping = True  # Plain form fields carry nothing we need
+            elif isinstance(event, Data):
+                if writer is not None and not skipping:
+                    writer.write(event.data)
+                    if not event.more_data:
+                        results.append(writer.close())
+                        writer = None
+
+    try:
+        for block in _iter_request_stream():
+            decoder.receive_data(block)
+            handle_events()
+        decoder.receive_data(None)
+        handle_events()
+    except Exception as e:
+        if writer is not None:
+            writer.abort()
+        log.warning('Streaming upload failed: %s', e)
+        return jsonify(dict(_upload_summary(results, started), error=f"Upload failed: {e}")), upload_error_status(e)
+
+    if writer is not None:
+        # The body ended in the middle of a file part
+        writer.abort()
+        results.append({"filename": writer.filename, "error": "Upload was truncated."})
+    if not results:
+        return jsonify({"error": "No file selected for upload."}), 400
+    return jsonify(_upload_summary(results, started))
+
+
+@app.route('/stream_upload/<path:filename>', methods=['PUT'])
+def stream_upload_raw(filename):
+    """
+    Zero-spool raw upload: the request body is the file content, e.g.
+    curl -T bigfile.iso http://server:5000/stream_upload/bigfile.iso
+    """
+    secured_filename = secure_filename(filename)
+    if not secured_filename:
+        return jsonify({"error": "Invalid filename."}), 400
+
+    started = time.perf_counter()
+    writer = None
+    try:
+        writer = UploadWriter(secured_filename, request.content_length)
+        for block in _iter_request_stream():
+            writer.write(block)
+        summary = writer.close()
+    except Exception as e:
+        if writer is not None:
+            writer.abort()
+        log.warning("Streaming upload of '%s' failed: %s", secured_filename, e)
+        return jsonify({"error": f"Upload failed: {e}"}), upload_error_status(e)
+    return jsonify(_upload_summary([summary], started))
+
+# --- Delta Uploads (rsync-style) ---
+# A file re-uploaded after a small edit (a VM image, a spreadsheet, a database
+# dump) needn't be sent again in full. The client fetches the block signatures of
+# the server's copy (GET /signatures/<name>), finds those blocks in its new
+# version and sends only block references plus the bytes in between
+# (POST /delta/<name>; formats in delta.py). The server rebuilds the new version
+# from the old one into a temp file that replaces the old version atomically,
+# like any other upload. Signatures are cached per file version and block size,
+# and those of a version rebuilt from a delta are recorded while it is written,
+# so a series of syncs never re-reads an unchanged file to hash it.
+
+app.config['SIGNATURE_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+
+
+class SignatureCache(DiskCache):
+    """
+    Block signatures in STATE_FOLDER/cache/signatures, named
+    "<identity>.<block size>.sig" (identities as in CompressionCache).
+    """
+
+    def __init__(self):
+        super().__init__('signatures', 'SIGNATURE_CACHE_MAX_BYTES')
+
+    def get(self, f, identity, block_size):
+        """
+        Signatures of the open file f, from the cache or computed (and cached).
+        """
+        name = f'{identity}.{block_size}.sig'
+        with self.lock:
+            self._load()
+            hit = name in self.entries
+            if hit:
+                self.entries.move_to_end(name)
+        metrics.inc('mkcloud_cache_requests_total', cache='signatures', result='hit' if hit else 'miss')
+        if hit:
+            try:
+                with open(os.path.join(self.folder(), name), 'rb') as cached:
+                    return cached.read()
+            except FileNotFoundError:
+                self.discard(name)  # Evicted by another worker process
+        data = b''.join(delta.signatures(f, block_size))
+        self.put(identity, block_size, data)
+        return data
+
+    def put(self, identity, block_size, data):
+        name = f'{identity}.{block_size}.sig'
+        path = os.path.join(self.folder(), name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with self.lock:
+                self._load()
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.error('Error caching block signatures %s: %s', name, e)
+            return
+        with self.lock:
+            self._add(name, len(data))
+
+
+signature_cache = SignatureCache()
+
+
+def _open_version(filename):
+    """
+    Opens the current version of filename. Returns (file, stat, cache identity);
+    raises FileNotFoundError.
+    """
+    path = storage.locate(filename)
+    f = open(path, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(filename)
+        identity = CompressionCache.identity(path, st)
+        if os.stat(path).st_ino != st.st_ino:
+            raise FileNotFoundError(filename)  # Replaced meanwhile: the identity may be the new version's
+    except BaseException:
+        f.close()
+        raise
+    return f, st, identity
+
+
+def _block_size_arg(value, size):
+    """
+    The requested block size, or the default for a file of `size` bytes.
+    Raises ValueError.
+    """
+    if value is None:
+        return delta.block_size_for(size)
+    block_size = int(value)
+    if not delta.MIN_BLOCK_SIZE <= block_size <= delta.MAX_BLOCK_SIZE:
+        raise ValueError(f'block size must be between {delta.MIN_BLOCK_SIZE} and {delta.MAX_BLOCK_SIZE}')
+    return block_size
+
+
+@app.route('/signatures/<path:filename>')
+def file_signatures(filename):
+    """
+    Block signatures of the current version of a file, for a delta upload.
+    Optional block_size (default about sqrt(file size)). The body is the packed
+    records; X-Block-Size and X-File-Size describe them and the ETag names the
+    version, to be sent back as If-Match with the delta.
+    """
+    secured_filename = secure_filename(filename)
+    try:
+        f, st, identity = _open_version(secured_filename)
+    except FileNotFoundError:
+        return jsonify({"error": "File not found."}), 404
+    with f:
+        try:
+            block_size = _block_size_arg(request.args.get('block_size'), st.st_size)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid block_size: {e}."}), 400
+        data = signature_cache.get(f, identity, block_size)
+    return Response(data, mimetype='application/octet-stream', headers={
+        'ETag': file_etag(st), 'X-Block-Size': str(block_size), 'X-File-Size': str(st.st_size),
+        'Cache-Control': 'no-cache'})
+
+
+@app.route('/delta/<path:filename>', methods=['POST'])
+def delta_upload(filename):
+    """
+    Replaces a file with a new version rebuilt from a delta against its current
+    version. Headers: If-Match (the ETag from /signatures), X-Block-Size, and
+    optionally X-File-Size (size of the new version, to preallocate it). 412 if
+    the file changed since the signatures were fetched, 422 if the result
+    doesn't have the SHA-256 the delta announces.
+    """
+    secured_filename = secure_filename(filename)
+    if not secured_filename:
+        return jsonify({"error": "Invalid filename."}), 400
+    if 'If-Match' not in request.headers:
+        return jsonify({"error": "If-Match with the ETag of the signatures is required."}), 428
+    try:
+        block_size = _block_size_arg(request.headers.get('X-Block-Size', ''), 0)
+        new_size = int(request.headers['X-File-Size']) if 'X-File-Size' in request.headers else None
+    except ValueError as e:
+        return jsonify({"error": f"Invalid X-Block-Size or X-File-Size: {e}."}), 400
+    try:
+        base, st, _ = _open_version(secured_filename)
+    except FileNotFoundError:
+        return jsonify({"error": "File not found."}), 404
+
+    started = time.perf_counter()
+    writer = None
+    with base:
+        if not request.if_match.contains(unquote_etag(file_etag(st))[0]):
+            return jsonify({"error": "The file changed since its signatures were fetched."}), 412
+        signatures = delta.SignatureWriter(block_size)
+
+        def write(data):
+            writer.write(data)
+            signatures.update(data)
+
+        try:
+            writer = UploadWriter(secured_filename, new_size)
+            copied, literal, digest = delta.apply(request.stream.read, base, block_size, st.st_size, write)
+            if digest != writer.content_hash():
+                writer.abort()
+                return jsonify({"error": "Rebuilt file does not match the announced sha256.",
+                                "sha256": writer.content_hash()}), 422
+            summary = writer.close()
+        except delta.DeltaError as e:
+            writer.abort()
+            log.warning("Delta upload of '%s' rejected: %s", secured_filename, e)
+            return jsonify({"error": f"Invalid delta: {e}."}), 400
+        except Exception as e:
+            if writer is not None:
+                writer.abort()
+            log.warning("Delta upload of '%s' failed: %s", secured_filename, e)
+            return jsonify({"error": f"Upload failed: {e}"}), upload_error_status(e)
+
+    try:
+        signature_cache.put(CompressionCache.identity(writer.path, os.stat(writer.path)), block_size,
+                            signatures.finish())
+    except OSError:
+        pass  # Replaced or deleted already
+    metrics.inc('mkcloud_delta_bytes_total', copied, source='copied')
+    metrics.inc('mkcloud_delta_bytes_total', literal, source='literal')
+    log.info("File '%s' rebuilt from a delta: %d bytes sent, %d copied from the previous version",
+             secured_filename, literal, copied, extra={'file': secured_filename, 'bytes': literal})
+    return jsonify(dict(_upload_summary([summary], started), copied_bytes=copied, literal_bytes=literal))
+
+# --- Content-Addressed Blob Store (Deduplication) ---
+# Every upload is hashed (SHA-256) while it is written. Each unique content is kept
+# once under STATE_FOLDER/blobs/<2 hex>/<sha256>, and the visible file in
+# UPLOAD_FOLDER is a hard link to that blob. Uploading content the server already
+# has therefore costs no extra space. Downloads and listings keep working on plain
+# files, and the link count of a blob says how many names still use it.
+#
+# Clients can ask "do you have sha256 X?" before uploading (HEAD/GET /blobs/<hash>)
+# and create a file from an existing blob without sending any bytes
+# (POST /blobs/<hash>/link, or "sha256" when creating a chunked upload).
+#
+# Files must not be edited in place inside UPLOAD_FOLDER: an edit would change the
+# blob shared by every other name with the same content. For the same reason a
+# name's modification time is its inode's: linking a duplicate upload sets it to
+# the time of the upload, for every name of that content.
+
+app.config['DEDUP_ENABLED'] = True
+app.config['BLOB_GC_INTERVAL'] = 60 * 60  # seconds between sweeps for orphaned blobs
+
+HASH_READ_BUFSIZE = 4 * 1024 * 1024
+BLOB_UNKNOWN_MAX = 4096  # linked inodes remembered as backed by no blob
+# os.link errors that can mean the filesystem has no hard links at all
+LINK_UNSUPPORTED_ERRNOS = {errno.EPERM, errno.EXDEV, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+
+def _valid_digest(digest):
+    return len(digest) == 64 and all(c in '0123456789abcdef' for c in digest)
+
+
+def hash_file(path):
+    """
+    SHA-256 hex digest of the file at path.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_READ_BUFSIZE)
+            if not block:
+                return digest.hexdigest()
+            digest.update(block)
+
+
+class BlobStore:
+    """
+    Hard-link based content-addressed store. Visible names are mapped to blob
+    hashes through their inode numbers, so the mapping needs no extra bookkeeping
+    and survives renames made outside the server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._inodes = None  # (st_dev, st_ino) -> sha256, loaded on first use
+        self._unknown = set()  # (st_dev, st_ino, st_nlink, st_ctime_ns) of linked files in no blob
+        self._links_unsupported = False
+        self._counters = None  # persisted upload savings, loaded on first use
+
+    def folder(self):
+        return os.path.join(app.config['STATE_FOLDER'], 'blobs')
+
+    def blob_path(self, digest):
+        return os.path.join(self.folder(), digest[:2], digest)
+
+    def _load(self):
+        """
+        Builds the inode -> hash map from the blob folder (caller holds the lock).
+        """
+        if self._inodes is not None:
+            return
+        self._inodes = {}
+        os.makedirs(self.folder(), exist_ok=True)
+        for shard in os.scandir(self.folder()):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if _valid_digest(entry.name):
+                        st = entry.stat()
+                        self._inodes[(st.st_dev, st.st_ino)] = entry.name
+
+    def enabled(self):
+        return app.config['DEDUP_ENABLED'] and not self._links_unsupported
+
+    def lookup(self, digest):
+        """
+        Returns the os.stat of the blob for digest, or None if it is not stored.
+        """
+        try:
+            return os.stat(self.blob_path(digest))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def digest_of(self, path):
+        """
+        Returns the hash of the blob backing the visible file at path, or None.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            self._load()
+            digest = self._inodes.get((st.st_dev, st.st_ino))
+            unknown = (st.st_dev, st.st_ino, st.st_nlink, st.st_ctime_ns)
+            if digest is None and st.st_nlink > 1 and unknown not in self._unknown:
+                # Linked, but unknown here: maybe another worker process stored it. Rescan,
+                # and if no blob has it, don't rescan for it again until its links change
+                self._inodes = None
+                self._load()
+                digest = self._inodes.get((st.st_dev, st.st_ino))
+                if digest is None:
+                    if len(self._unknown) >= BLOB_UNKNOWN_MAX:
+                        self._unknown.clear()
+                    self._unknown.add(unknown)
+            return digest
+
+    def _replace_with_link(self, blob, path):
+        """
+        Atomically points the name at path to the blob (link to a temp name, then
+        rename). The name shows the time it was written, like any other upload.
+        """
+        tmp_path = os.path.join(os.path.dirname(path), f'.{secrets.token_hex(8)}.link')
+        os.link(blob, tmp_path)
+        try:
+            os.utime(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+
+    def _links_work(self, path):
+        """
+        Whether a fresh file next to path can be linked into the blob folder, to
+        tell a filesystem without hard links from one file that can't be linked.
+        """
+        probe = os.path.join(os.path.dirname(path), f'.{secrets.token_hex(8)}.probe')
+        probe_link = os.path.join(self.folder(), os.path.basename(probe))
+        try:
+            with open(probe, 'wb'):
+                pass
+            os.link(probe, probe_link)
+            os.remove(probe_link)
+            return True
+        except OSError as e:
+            return e.errno not in LINK_UNSUPPORTED_ERRNOS
+        finally:
+            try:
+                os.remove(probe)
+            except OSError:
+                pass
+
+    def adopt(self, path, digest):
+        """
+        Stores the finished upload at path under digest. If the content is already
+        stored, path becomes another link to the existing blob and its own copy is
+        freed. Returns True when the content was a duplicate.
+        """
+        if not self.enabled():
+            return False
+        blob = self.blob_path(digest)
+        with self.lock:
+            self._load()
+            try:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                if os.path.exists(blob):
+                    self._replace_with_link(blob, path)
+                    return True
+                os.link(path, blob)
+            except OSError as e:
+                log.warning("Could not deduplicate '%s': %s", path, e)
+                if e.errno in LINK_UNSUPPORTED_ERRNOS and not self._links_work(path):
+                    # e.g. FAT/exFAT drives have no hard links: keep plain files from now on
+                    self._links_unsupported = True
+                    log.warning('Deduplication disabled: hard links are not supported in UPLOAD_FOLDER')
+                return False
+            st = os.stat(blob)
+            self._inodes[(st.st_dev, st.st_ino)] = digest
+            return False
+
+    def link(self, digest, path):
+        """
+        Creates (or replaces) the visible file at path from an existing blob.
+        Returns the blob size, or None if the blob is not stored.
+        """
+        st = self.lookup(digest)
+        if st is None:
+            return None
+        self._replace_with_link(self.blob_path(digest), path)
+        self.count_avoided(st.st_size)
+        return st.st_size
+
+    def release(self, digest):
+        """
+        Deletes the blob for digest once no visible name links to it any more.
+        """
+        if digest is None:
+            return
+        with self.lock:
+            st = self.lookup(digest)
+            if st is not None and st.st_nlink <= 1:
+                try:
+                    os.remove(self.blob_path(digest))
+                except FileNotFoundError:
+                    pass  # Another worker process released it first
+                self._load()
+                self._inodes.pop((st.st_dev, st.st_ino), None)
+
+    def collect_garbage(self):
+        """
+        Removes every orphaned blob, e.g. after files were deleted outside the server.
+        """
+        with self.lock:
+            self._load()
+            digests = list(self._inodes.values())
+        orphans = 0
+        for digest in digests:
+            st = self.lookup(digest)
+            if st is not None and st.st_nlink <= 1:
+                self.release(digest)
+                orphans += 1
+        if orphans:
+            log.info('Removed %d orphaned blobs', orphans)
+
+    def _counters_path(self):
+        return os.path.join(app.config['STATE_FOLDER'], 'dedup_counters.json')
+
+    def count_avoided(self, size):
+        """
+        Records an upload whose bytes never had to be sent.
+        """
+        with self.lock:
+            self._counters = None  # Re-read: other worker processes count too
+            counters = self._load_counters()
+            counters['uploads_skipped'] += 1
+            counters['upload_bytes_avoided'] += size
+            tmp_path = f'{self._counters_path()}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(counters, f)
+            os.replace(tmp_path, self._counters_path())
+
+    def _load_counters(self):
+        if self._counters is None:
+            try:
+                with open(self._counters_path()) as f:
+                    self._counters = json.load(f)
+            except (OSError, ValueError):
+                self._counters = {"uploads_skipped": 0, "upload_bytes_avoided": 0}
+        return self._counters
+
+    def report(self):
+        """
+        Space accounting: logical bytes (what the visible files add up to) versus
+        physical bytes actually stored for them.
+        """
+        with self.lock:
+            self._load()
+            digests = list(self._inodes.values())
+            counters = dict(self._load_counters())
+        blobs = physical = logical = 0
+        for digest in digests:
+            st = self.lookup(digest)
+            if st is None:
+                continue
+            blobs += 1
+            physical += st.st_size
+            logical += st.st_size * max(st.st_nlink - 1, 0)
+        return dict(counters, blobs=blobs, physical_bytes=physical, logical_bytes=logical,
+                    space_saved_bytes=max(logical - physical, 0))
+
+
+blob_store = BlobStore()
+
+
+def _collect_blobs_periodically(interval):
+    while True:
+        try:
+            blob_store.collect_garbage()
+        except OSError as e:
+            log.exception('Error collecting orphaned blobs: %s', e)
+        time.sleep(interval)
+
+
+@app.route('/blobs/<digest>', methods=['GET', 'HEAD'])
+def blob_info(digest):
+    """
+    Pre-upload check: 200 with the size if content with this SHA-256 is stored.
+    """
+    if not _valid_digest(digest):
+        return jsonify({"error": "Expected a lowercase hex SHA-256 digest."}), 400
+    st = blob_store.lookup(digest)
+    if st is None:
+        return jsonify({"sha256": digest, "stored": False}), 404
+    return jsonify({"sha256": digest, "stored": True, "size": st.st_size})
+
+
+@app.route('/blobs/<digest>/link', methods=['POST'])
+def link_blob(digest):
+    """
+    Creates a file from stored content without uploading it.
+    Expects JSON: {"filename": ...}.
+    """
+    if not _valid_digest(digest):
+        return jsonify({"error": "Expected a lowercase hex SHA-256 digest."}), 400
+    filename = secure_filename(str((request.get_json(silent=True) or {}).get('filename', '')))
+    if not filename:
+        return jsonify({"error": "A filename is required."}), 400
+    try:
+        size = blob_store.link(digest, storage.target(filename))
+        storage.settle(filename)
+    except OSError as e:
+        log.error("Error linking blob %s as '%s': %s", digest, filename, e)
+        return jsonify({"error": f"Server error saving '{filename}'."}), 500
+    if size is None:
+        return jsonify({"sha256": digest, "stored": False}), 404
+    file_index.refresh(filename)
+    catalog.record_upload(filename, digest)
+    log.info("File '%s' created from stored blob %s (%d bytes not uploaded)", filename, digest, size,
+             extra={'file': filename})
+    return jsonify({"filename": filename, "size": size, "sha256": digest, "deduplicated": True}), 201
+
+
+@app.route('/dedup_stats')
+def dedup_stats():
+    """
+    Reports space saved by deduplication and upload bytes avoided.
+    """
+    return jsonify(blob_store.report())
+
+# --- In-Memory Directory Index ---
+# /files_json used to run os.listdir plus one stat per entry for every poll from
+# every open tab. The index below keeps a sorted listing of UPLOAD_FOLDER in memory
+# and updates it from the upload/delete routes, from inotify events (Linux) for
+# changes made outside the server, and from a periodic os.scandir reconciliation
+# that also serves as the fallback where inotify is unavailable.
+#
+# Under the prefork server every worker process has its own index, fed from a
+# shared SQLite journal (see IndexJournal) instead of from its own observations,
+# so all workers list the same files under the same versions. One worker at a
+# time (whoever holds the flock on STATE_FOLDER/index.leader) runs the inotify
+# watcher and rescans; the others only record their own uploads and deletes.
+#
+# Each index also keeps a NameSearch over its names. It is changed along with the
+# listing, so the page's filter and the type-ahead suggestions of GET /search look
+# names up by prefix and trigram and don't walk all of them.
+
+app.config['INDEX_RECONCILE_INTERVAL'] = 10  # seconds between scandir passes without inotify
+app.config['INDEX_RECONCILE_INTERVAL_INOTIFY'] = 300  # safety-net pass when inotify is active
+app.config['INDEX_SHARED'] = False  # set by the prefork launcher
+app.config['INDEX_SYNC_INTERVAL'] = 0.05  # seconds between checks for other workers' changes
+app.config['SEARCH_SCAN_LIMIT'] = 2000  # candidate names ranked per type-ahead query; more are sampled
+SEARCH_RESULTS = 10
+SEARCH_RESULTS_MAX = 100
+
+
+class NameSearch:
+    """
+    Case-insensitive search over a set of filenames. A sorted list of keys (the
+    lowercased name, followed by "\\0name" if that differs) answers prefix
+    queries by bisection; a trigram index (trigram -> ascending array of name
+    ids) narrows substring queries down to the names to check. Ids only grow,
+    so adding a name appends to its postings; removing one leaves a hole until
+    the next compaction. Lowercase names are stored once, shared with the keys.
+    Not thread-safe: DirectoryIndex calls it with its lock held.
+    """
+
+    def __init__(self, names=()):
+        self.rebuild(names)
+
+    @staticmethod
+    def _trigrams(lowered):
+        return {lowered[i:i + 3] for i in range(len(lowered) - 2)}
+
+    @staticmethod
+    def _lower(name):
+        lowered = name.lower()
+        return name if lowered == name else lowered
+
+    @staticmethod
+    def _key(name, lowered):
+        return lowered if lowered == name else f'{lowered}\0{name}'
+
+    @staticmethod
+    def _name_of(key):
+        return key.split('\0', 1)[-1]
+
+    def rebuild(self, names):
+        self.names = list(names)  # id -> name, None once removed
+        self.lowered = [self._lower(name) for name in self.names]
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.holes = 0
+        self.postings = {}
+        for i, lowered in enumerate(self.lowered):
+            for gram in self._trigrams(lowered):
+                ids = self.postings.get(gram)
+                if ids is None:
+                    ids = self.postings[gram] = array('I')
+                ids.append(i)
+        self.keys = sorted(map(self._key, self.names, self.lowered))
+
+    def add(self, name):
+        if name in self.ids:
+            return
+        i = self.ids[name] = len(self.names)
+        lowered = self._lower(name)
+        self.names.append(name)
+        self.lowered.append(lowered)
+        for gram in self._trigrams(lowered):
+            self.postings.setdefault(gram, array('I')).append(i)
+        bisect.insort(self.keys, self._key(name, lowered))
+
+    def remove(self, name):
+        i = self.ids.pop(name, None)
+        if i is None:
+            return
+        lowered = self.lowered[i]
+        for gram in self._trigrams(lowered):
+            ids = self.postings[gram]
+            del ids[bisect.bisect_left(ids, i)]
+            if not ids:
+                del self.postings[gram]
+        del self.keys[bisect.bisect_left(self.keys, self._key(name, lowered))]
+        self.names[i] = self.lowered[i] = None
+        self.holes += 1
+        if self.holes > 1024 and self.holes > len(self.names) // 2:
+            self.rebuild(self.ids)
+
+    def _candidates(self, lowered):
+        """
+        Ids of the names that may contain lowered (3+ characters): the shortest
+        posting list among its trigrams.
+        """
+        shortest = None
+        for gram in self._trigrams(lowered):
+            ids = self.postings.get(gram)
+            if ids is None:
+                return array('I')
+            if shortest is None or len(ids) < len(shortest):
+                shortest = ids
+        return shortest
+
+    def matching(self, text):
+        """
+        All names containing text (case-insensitively), or None for text under
+        3 characters, which the trigrams can't narrow down.
+        """
+        lowered = text.lower()
+        if len(lowered) < 3:
+            return None
+        names = self.lowered
+        return [self.names[i] for i in self._candidates(lowered) if lowered in names[i]]
+
+    @staticmethod
+    def _word_offset(name, lowered, offset):
+        """
+        Offset of the first match at or after `offset` that starts a word
+        ("report" in "q3_report.pdf" but not in "unreported.txt"), or -1.
+        """
+        while offset > 0 and name[offset - 1].isalnum():
+            offset = name.find(lowered, offset + 1)
+        return offset
+
+    def search(self, text, limit, scan_limit):
+        """
+        Ranked matches for a type-ahead query: names equal to text first, then
+        names starting with it (in name order), then names with a word starting
+        with it, then any other names containing it (shorter names first
+        within both). Text under 3 characters only matches the start of names.
+        Inner matches are ranked among the first scan_limit candidates (or as
+        many as it takes to fill the page), so a query that many names contain
+        ranks a sample of them. Returns
+        ([(name, match offset), ...], whether more matches exist).
+        """
+        lowered = text.lower()
+        if not lowered:
+            return [], False
+        results = []
+        i = bisect.bisect_left(self.keys, lowered)
+        while i < len(self.keys) and self.keys[i].startswith(lowered):
+            if len(results) == limit:
+                return results, True
+            results.append((self._name_of(self.keys[i]), 0))
+            i += 1
+        if len(lowered) < 3:
+            return results, False
+
+        names = self.lowered
+        wanted = limit - len(results)
+        at_word, inside = [], []
+        more = False
+        for checked, i in enumerate(self._candidates(lowered)):
+            if checked >= scan_limit and len(at_word) + len(inside) >= wanted:
+                more = True
+                break
+            offset = names[i].find(lowered)
+            if offset > 0:  # Not a miss, nor a prefix match (listed above)
+                (at_word if self._word_offset(names[i], lowered, offset) > 0 else inside).append(i)
+
+        def length(i):
+            return len(names[i])
+
+        best = heapq.nsmallest(wanted, at_word, key=length)
+        best += heapq.nsmallest(wanted - len(best), inside, key=length)
+        for i in best:
+            offset = names[i].find(lowered)
+            word_offset = self._word_offset(names[i], lowered, offset)
+            results.append((self.names[i], word_offset if word_offset > 0 else offset))
+        return results, more or len(at_word) + len(inside) > wanted
+
+
+class DirectoryIndex:
+    """
+    Sorted in-memory listing of the regular files in one folder. Each entry maps
+    a filename to (size, mtime_ns). Every change bumps `version` and is kept in a
+    bounded change log, so clients holding a version cursor can ask for deltas.
+    The JSON listing is cached per version so idle polling costs no filesystem calls.
+    """
+
+    def __init__(self, max_changes=4096):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.folder = None
+        self.entries = {}  # name -> (size, mtime_ns)
+        self.names = []  # sorted list of the keys of self.entries
+        self.search = NameSearch()
+        self.version = 0
+        self.changes = deque(maxlen=max_changes)  # (version, op, name), op is 'add'/'update'/'remove'
+        self._listing_cache = (None, {})  # (version, {encoding or None: JSON bytes})
+        self._sorted_keys = {}  # 'size'/'mtime' -> (version, sorted (value, name) list)
+        self._listeners = set()  # callbacks run on every change, see subscribe()
+        self.journal = None  # IndexJournal when shared between worker processes
+        self._sync_lock = threading.Lock()
+
+    @staticmethod
+    def _visible(name):
+        # Dot-names are server state (.mkcloud) or OS litter; uploads never start with '.'
+        return not name.startswith('.')
+
+    def _set(self, name, entry, version=None):
+        """
+        Applies one change (entry None means removed) as the next version, or as
+        `version` when replaying the journal. Caller holds the lock.
+        Returns True if the listing changed.
+        """
+        old = self.entries.get(name)
+        if old == entry:
+            return False
+        if entry is None:
+            del self.entries[name]
+            del self.names[bisect.bisect_left(self.names, name)]
+            self.search.remove(name)
+            op = 'remove'
+        else:
+            if old is None:
+                bisect.insort(self.names, name)
+                self.search.add(name)
+            self.entries[name] = entry
+            op = 'add' if old is None else 'update'
+        self.version = self.version + 1 if version is None else version
+        self.changes.append((self.version, op, name))
+        return True
+
+    def _scan(self):
+        """
+        One os.scandir pass over the folder (and its shard folders): name -> (size, mtime_ns).
+        """
+        found = {}
+        for entry in storage.scan():
+            try:
+                st = entry.stat()
+            except OSError:
+                continue  # Removed between readdir and stat
+            # During a migration a file can be seen both before and after its move
+            found[entry.name] = (st.st_size, st.st_mtime_ns)
+        return found
+
+    def load(self, folder):
+        """
+        (Re)builds the index from scratch for folder.
+        """
+        self.folder = folder
+        self.reconcile()
+
+    def attach(self, journal, folder):
+        """
+        Shares the index through journal: loads its listing, and from now on
+        records changes there and replays them from there.
+        """
+        self.folder = folder
+        self.journal = journal
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        version, entries = self.journal.snapshot()
+        with self.lock:
+            self.entries = entries
+            self.names = sorted(entries)
+            self.search.rebuild(self.names)
+            self.version = version
+            self.changes.clear()  # Cursors from before the snapshot get a reset
+            self._notify()
+
+    def sync(self):
+        """
+        Replays the journal entries this process hasn't applied yet.
+        """
+        with self._sync_lock:
+            rows = self.journal.since(self.version)
+            if rows is None:
+                self._load_snapshot()  # Fell behind the pruned journal
+                return
+            if not rows:
+                return
+            with self.lock:
+                for version, op, name, size, mtime_ns in rows:
+                    self._set(name, None if op == 'remove' else (size, mtime_ns), version)
+                self.version = rows[-1][0]
+                self._notify()
+
+    def _observe(self, observed, complete=False, since=None):
+        """
+        Applies what was seen on disk: observed maps names to (size, mtime_ns) or
+        None. complete=True means observed is the whole folder as of a scan that
+        started at version `since`: names changed after that were reported while
+        the scan ran, so the scan's view of them may be stale and they are kept.
+        """
+        if self.journal is not None:
+            self.journal.record(observed, complete, since)
+            self.sync()
+            return
+        with self.lock:
+            if complete and not self.entries:
+                # First load: build the listing in one go instead of name by name
+                self.entries = {name: entry for name, entry in observed.items() if entry is not None}
+                self.names = sorted(self.entries)
+                self.search.rebuild(self.names)
+                self.version += 1
+                self.changes.clear()  # Older cursors get a reset
+                self._notify()
+                return
+            version = self.version
+            if complete and since is not None and since != version:
+                if not self.changes or self.changes[0][0] > since + 1:
+                    complete = False  # The change log no longer reaches back: only add and update
+                recent = {name for v, _, name in self.changes if v > since}
+                observed = {name: entry for name, entry in observed.items() if name not in recent}
+            else:
+                recent = ()
+            if complete:
+                for name in [n for n in self.entries if n not in observed and n not in recent]:
+                    self._set(name, None)
+            for name, entry in observed.items():
+                self._set(name, entry)
+            if self.version != version:
+                self._notify()
+
+    def reconcile(self):
+        """
+        Brings the index in line with the folder using a single scandir pass.
+        """
+        with self.lock:
+            since = self.version
+        self._observe(self._scan(), complete=True, since=since)
+
+    def refresh(self, *names):
+        """
+        Re-checks single files, e.g. after an upload, delete or inotify event.
+        Several names are applied as one batch.
+        """
+        if self.folder is None:
+            return
+        observed = {}
+        for name in names:
+            if not self._visible(name):
+                continue
+            try:
+                st = os.stat(storage.locate(name))
+                observed[name] = (st.st_size, st.st_mtime_ns) if stat.S_ISREG(st.st_mode) else None
+            except OSError:
+                observed[name] = None
+        if observed:
+            self._observe(observed)
+
+    def _notify(self):
+        # Called with the lock held
+        self.changed.notify_all()
+        for callback in list(self._listeners):
+            callback()
+
+    def subscribe(self, callback, version):
+        """
+        Calls callback() (from whichever thread changes the index) once the index
+        moves past `version`; immediately if it already has. Returns a function
+        that cancels the subscription. Callbacks must be quick and thread-safe.
+        """
+        with self.lock:
+            self._listeners.add(callback)
+            if self.version != version:
+                callback()
+
+        def unsubscribe():
+            with self.lock:
+                self._listeners.discard(callback)
+
+        return unsubscribe
+
+    def changes_since(self, version):
+        """
+        Returns (current version, [(version, op, name), ...]) for everything after
+        `version`, or None if the change log no longer reaches back that far.
+        """
+        with self.lock:
+            if version == self.version:
+                return self.version, []
+            if version > self.version or not self.changes or self.changes[0][0] > version + 1:
+                return None
+            return self.version, [c for c in self.changes if c[0] > version]
+
+    def wait_for_change(self, version, timeout):
+        """
+        Blocks until the index moves past `version` or timeout seconds pass.
+        """
+        with self.changed:
+            return self.changed.wait_for(lambda: self.version != version, timeout)
+
+    def listing_json(self, encoding=None):
+        """
+        The sorted filename list as JSON bytes, serialized (and compressed with
+        `encoding`, if given) once per version.
+        """
+        version, bodies = self._listing_cache
+        hit = version == self.version
+        if not hit:
+            with self.lock:
+                version = self.version
+                bodies = {None: json.dumps(self.names).encode('utf-8')}
+            self._listing_cache = (version, bodies)
+        if encoding not in bodies:
+            hit = False
+            bodies[encoding] = compress_bytes(bodies[None], encoding)
+        metrics.inc('mkcloud_cache_requests_total', cache='listing', result='hit' if hit else 'miss')
+        return bodies[encoding]
+
+    def _ordered_keys(self, sort):
+        """
+        Ascending sort keys for `sort` (caller holds the lock): the names list
+        itself for 'name', else (size or mtime_ns, name) tuples, rebuilt at most
+        once per version.
+        """
+        if sort == 'name':
+            return self.names
+        version, keys = self._sorted_keys.get(sort, (None, None))
+        hit = version == self.version
+        if not hit:
+            field = 0 if sort == 'size' else 1
+            keys = sorted((entry[field], name) for name, entry in self.entries.items())
+            self._sorted_keys[sort] = (self.version, keys)
+        metrics.inc('mkcloud_cache_requests_total', cache='sort_keys', result='hit' if hit else 'miss')
+        return keys
+
+    def describe(self, name):
+        """
+        Returns the {"name", "size", "mtime"} record for name, or None. Files
+        that can have a preview also get "preview": "image" or "text".
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        record = {"name": name, "size": entry[0], "mtime": entry[1] / 1e9}
+        kind = preview_kind(name)
+        if kind is not None:
+            record["preview"] = kind
+        return record
+
+    def query(self, sort='name', descending=False, prefix='', contains='', cursor=None, limit=500):
+        """
+        One page of the listing. Filters by name prefix and case-insensitive
+        substring, orders by name, size or mtime, and continues after `cursor`
+        (the sort key of the previous page's last item). Returns
+        (version, records, next cursor or None, total matches).
+        """
+        contains = contains.lower()
+
+        def matches(name):
+            return name.startswith(prefix) and contains in name.lower()
+
+        with self.lock:
+            found = self.search.matching(contains) if contains else None
+            if found is None:
+                keys = self._ordered_keys(sort)
+            else:
+                # Page through just the names containing the text
+                found = [name for name in found if name.startswith(prefix)]
+                field = 0 if sort == 'size' else 1
+                keys = sorted(found) if sort == 'name' else sorted((self.entries[name][field], name) for name in found)
+            name_of = (lambda key: key) if sort == 'name' else (lambda key: key[1])
+
+            # Find where the page starts; a name prefix narrows the range by bisection
+            if descending:
+                if cursor is not None:
+                    i = bisect.bisect_left(keys, cursor) - 1
+                elif sort == 'name' and prefix:
+                    i = bisect.bisect_right(keys, prefix + '\U0010ffff') - 1
+                else:
+                    i = len(keys) - 1
+                indexes = range(i, -1, -1)
+            else:
+                if cursor is not None:
+                    i = bisect.bisect_right(keys, cursor)
+                elif sort == 'name' and prefix:
+                    i = bisect.bisect_left(keys, prefix)
+                else:
+                    i = 0
+                indexes = range(i, len(keys))
+
+            page = []
+            more = False
+            for i in indexes:
+                name = name_of(keys[i])
+                if sort == 'name' and prefix and not name.startswith(prefix):
+                    break  # Left the block of names sharing the prefix
+                if matches(name):
+                    if len(page) == limit:
+                        more = True
+                        break
+                    page.append(keys[i])
+
+            if found is not None:
+                total = len(found)
+            elif not prefix and not contains:
+                total = len(self.names)
+            elif not contains:
+                total = (bisect.bisect_right(self.names, prefix + '\U0010ffff')
+                         - bisect.bisect_left(self.names, prefix))
+            else:
+                total = sum(1 for name in self.names if matches(name))
+
+            records = [self.describe(name_of(key)) for key in page]
+            return self.version, records, (page[-1] if more else None), total
+
+    def find(self, text, limit=SEARCH_RESULTS):
+        """
+        Ranked type-ahead matches for text (see NameSearch.search). Returns
+        (version, records with the "match" offset of text, whether there are more).
+        """
+        with self.lock:
+            found, more = self.search.search(text, limit, app.config['SEARCH_SCAN_LIMIT'])
+            records = [dict(self.describe(name), match=offset) for name, offset in found]
+            return self.version, records, more
+
+
+class IndexJournal:
+    """
+    SQLite (WAL mode) copy of the listing plus its change log, shared by the
+    worker processes of a prefork server. `changes` numbers every change with a
+    global, ever-increasing version, so the version cursors handed to clients
+    mean the same thing in every worker (and across restarts).
+    """
+
+    def __init__(self, path, keep_changes=100000):
+        self.lock = threading.Lock()
+        self.keep_changes = keep_changes
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # A crash may lose the last changes; rescans restore them
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS changes (
+                version INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, name TEXT NOT NULL,
+                size INTEGER, mtime_ns INTEGER);
+        """)
+
+    def record(self, observed, complete, since=None):
+        """
+        Writes the differences between observed (name -> (size, mtime_ns) or None)
+        and the shared listing as new changes, in one transaction. With
+        complete=True, names missing from observed are recorded as removed, except
+        names changed after version `since` (when the observation started).
+        """
+        with self.lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                if complete and since is not None:
+                    oldest = db.execute('SELECT MIN(version) FROM changes').fetchone()[0]
+                    if oldest is not None and oldest > since + 1:
+                        complete = False  # Pruned past the start: can't tell what changed since
+                    else:
+                        recent = {name for name, in db.execute(
+                            'SELECT DISTINCT name FROM changes WHERE version > ?', (since,))}
+                        observed = {name: entry for name, entry in observed.items() if name not in recent}
+                if complete:
+                    current = {name: (size, mtime_ns) for name, size, mtime_ns
+                               in db.execute('SELECT name, size, mtime_ns FROM files')}
+                    observed = dict(observed)
+                    for name in current:
+                        if since is None or name not in recent:
+                            observed.setdefault(name, None)
+                else:
+                    current = {}
+                    for name in observed:
+                        row = db.execute('SELECT size, mtime_ns FROM files WHERE name = ?', (name,)).fetchone()
+                        if row is not None:
+                            current[name] = tuple(row)
+                for name, entry in observed.items():
+                    old = current.get(name)
+                    if old == entry:
+                        continue
+                    if entry is None:
+                        db.execute('DELETE FROM files WHERE name = ?', (name,))
+                        db.execute("INSERT INTO changes (op, name) VALUES ('remove', ?)", (name,))
+                    else:
+                        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (name, *entry))
+                        db.execute('INSERT INTO changes (op, name, size, mtime_ns) VALUES (?, ?, ?, ?)',
+                                   ('add' if old is None else 'update', name, *entry))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def since(self, version):
+        """
+        Returns the [(version, op, name, size, mtime_ns), ...] after version, or
+        None if pruning already removed some of them.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT version, op, name, size, mtime_ns FROM changes '
+                                   'WHERE version > ? ORDER BY version', (version,)).fetchall()
+        if rows and rows[0][0] != version + 1:
+            return None
+        return rows
+
+    def snapshot(self):
+        """
+        Returns (version, {name: (size, mtime_ns)}) as of one consistent moment.
+        """
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                version = self.db.execute('SELECT COALESCE(MAX(version), 0) FROM changes').fetchone()[0]
+                entries = {name: (size, mtime_ns) for name, size, mtime_ns
+                           in self.db.execute('SELECT name, size, mtime_ns FROM files')}
+            finally:
+                self.db.execute('COMMIT')
+        return version, entries
+
+    def data_version(self):
+        """
+        Changes whenever another connection commits: a cheap "anything new?" check.
+        """
+        with self.lock:
+            return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def prune(self):
+        with self.lock:
+            self.db.execute('DELETE FROM changes WHERE version <= (SELECT MAX(version) FROM changes) - ?',
+                            (self.keep_changes,))
+
+
+file_index = DirectoryIndex()
+
+# inotify(7) via ctypes, so no third-party watcher package is needed
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+INOTIFY_MASK = (IN_CREATE | IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+                | IN_DELETE_SELF | IN_MOVE_SELF)
+
+
+def _inotify_open(folder):
+    """
+    Returns (inotify file descriptor, watch descriptor) watching folder, or None
+    if unsupported.
+    """
+    inotify_init1 = _libc_function('inotify_init1')
+    if inotify_init1 is None:
+        return None
+    fd = inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    wd = _inotify_add(fd, folder)
+    if wd is None:
+        os.close(fd)
+        return None
+    return fd, wd
+
+
+def _inotify_add(fd, folder):
+    wd = _libc_function('inotify_add_watch')(fd, os.fsencode(folder), INOTIFY_MASK)
+    return wd if wd >= 0 else None
+
+
+def _watch_shard(index, fd, folder, catch_up=True):
+    """
+    Adds a watch on a shard folder, then (for a new one) picks up what landed
+    there before the watch.
+    """
+    if _inotify_add(fd, folder) is None:
+        log.warning('Could not watch %s (fs.inotify.max_user_watches?); rescans will catch its changes', folder)
+        return
+    if not catch_up:
+        return
+    with os.scandir(folder) as it:
+        names = [entry.name for entry in it]
+    if names:
+        index.refresh(*names)
+
+
+def _watch_inotify(index, fd, top_wd, watch_lost):
+    """
+    Applies inotify events to the index until the watch on UPLOAD_FOLDER goes
+    away, then sets watch_lost. Shard folders are watched as they appear.
+    """
+    for folder in storage.shard_folders():
+        _watch_shard(index, fd, folder, catch_up=False)  # The index was just reconciled
+    while True:
+        try:
+            buf = os.read(fd, 64 * 1024)
+        except OSError as e:
+            log.error('inotify watcher stopped: %s', e)
+            watch_lost.set()
+            break
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += _INOTIFY_EVENT.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                index.reconcile()  # Events were dropped: rescan
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                if wd != top_wd:
+                    continue  # A shard folder went away
+                os.close(fd)
+                log.warning('inotify watch on UPLOAD_FOLDER was removed; falling back to periodic rescans')
+                watch_lost.set()
+                return
+            elif mask & IN_ISDIR:
+                _, width, _ = storage.current()
+                if wd == top_wd and mask & (IN_CREATE | IN_MOVED_TO) and storage.is_shard_name(name, width):
+                    _watch_shard(index, fd, os.path.join(app.config['UPLOAD_FOLDER'], name))
+            elif name:
+                index.refresh(name)
+    os.close(fd)
+
+
+def _reconcile_periodically(index, interval, watch_lost=None):
+    """
+    Rescans the folder every `interval` seconds to pick up changes nothing reported.
+    Once watch_lost is set, rescans right away and then every INDEX_RECONCILE_INTERVAL.
+    """
+    while True:
+        if watch_lost is None:
+            time.sleep(interval)
+        elif watch_lost.wait(interval):
+            watch_lost = None
+            interval = app.config['INDEX_RECONCILE_INTERVAL']
+        try:
+            index.reconcile()
+        except OSError as e:
+            log.exception('Error rescanning UPLOAD_FOLDER: %s', e)
+
+
+def _start_index_watchers():
+    watch = _inotify_open(app.config['UPLOAD_FOLDER'])
+    watch_lost = None
+    if watch is not None:
+        watch_lost = threading.Event()
+        threading.Thread(target=_watch_inotify, args=(file_index, *watch, watch_lost), name='index-inotify',
+                         daemon=True).start()
+        interval = app.config['INDEX_RECONCILE_INTERVAL_INOTIFY']
+        log.info('File index: %d files, watching UPLOAD_FOLDER with inotify', len(file_index.names))
+    else:
+        interval = app.config['INDEX_RECONCILE_INTERVAL']
+        log.info('File index: %d files, inotify unavailable; rescanning every %ss', len(file_index.names), interval)
+    threading.Thread(target=_reconcile_periodically, args=(file_index, interval, watch_lost), name='index-rescan',
+                     daemon=True).start()
+    _start_catalog_sync()
+
+
+_index_leader_fd = None
+
+
+def _acquire_index_leadership():
+    """
+    Tries to become the worker that watches UPLOAD_FOLDER for the shared index.
+    The flock is held until this process exits.
+    """
+    global _index_leader_fd
+    if _index_leader_fd is not None:
+        return True
+    fd = os.open(os.path.join(app.config['STATE_FOLDER'], 'index.leader'), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _index_leader_fd = fd
+    return True
+
+
+def _follow_journal(index, interval):
+    """
+    Applies the changes other workers record, and takes over watching the folder
+    when the worker doing it exits.
+    """
+    seen = None
+    next_leader_check = next_prune = time.monotonic()
+    while True:
+        time.sleep(interval)
+        try:
+            data_version = index.journal.data_version()
+            if data_version != seen:
+                seen = data_version
+                index.sync()
+            now = time.monotonic()
+            if _index_leader_fd is None and now >= next_leader_check:
+                next_leader_check = now + 5
+                if _acquire_index_leadership():
+                    log.info('File index: worker %d takes over watching UPLOAD_FOLDER', os.getpid())
+                    index.reconcile()
+                    _start_index_watchers()
+            if _index_leader_fd is not None and now >= next_prune:
+                next_prune = now + 60
+                index.journal.prune()
+        except (OSError, sqlite3.Error) as e:
+            log.exception('Error following the shared file index: %s', e)
+
+
+def start_file_index():
+    """
+    Loads the index and starts its watcher threads for the current process.
+    """
+    if not app.config['INDEX_SHARED']:
+        file_index.load(app.config['UPLOAD_FOLDER'])
+        _start_index_watchers()
+        return
+    os.makedirs(app.config['STATE_FOLDER'], exist_ok=True)
+    journal = IndexJournal(os.path.join(app.config['STATE_FOLDER'], 'index.db'))
+    file_index.attach(journal, app.config['UPLOAD_FOLDER'])
+    if _acquire_index_leadership():
+        file_index.reconcile()
+        _start_index_watchers()
+    else:
+        log.info('File index: %d files, following the shared index', len(file_index.names))
+    threading.Thread(target=_follow_journal, args=(file_index, app.config['INDEX_SYNC_INTERVAL']),
+                     name='index-follow', daemon=True).start()
+
+
+# --- Metadata Catalog ---
+# A persistent record of every file in STATE_FOLDER/catalog.db (SQLite, WAL mode):
+# name, size, mtime, type, SHA-256, the uploader's IP address and a download count,
+# indexed so GET /catalog can filter and sort by size, date, type or popularity
+# without touching UPLOAD_FOLDER. The upload and delete routes write their rows
+# in the same breath as they change the folder. Everything else (files changed
+# outside the server, names another worker process uploaded) arrives through the
+# file index: the process watching UPLOAD_FOLDER mirrors the index's changes into
+# the catalog, diffs the two on startup so only files that changed while the
+# server was down are touched, and hashes files whose content isn't known yet in
+# the background. Download counts are buffered and written every few seconds.
+
+app.config['CATALOG_FLUSH_INTERVAL'] = 2  # seconds between writes of buffered download counts
+app.config['CATALOG_HASH_PAUSE'] = 0.01  # seconds between files while hashing unknown content
+CATALOG_PAGE_SIZE = 200
+CATALOG_PAGE_SIZE_MAX = 5000
+CATALOG_SORT_COLUMNS = {'name': 'name', 'size': 'size', 'mtime': 'mtime_ns', 'downloads': 'downloads'}
+FILE_TYPES = {
+    'image': THUMBNAIL_EXTENSIONS | {'.heic', '.ico', '.svg'},
+    'video': {'.avi', '.m4v', '.mkv', '.mov', '.mp4', '.mpeg', '.mpg', '.webm', '.wmv'},
+    'audio': {'.aac', '.flac', '.m4a', '.mp3', '.ogg', '.opus', '.wav', '.wma'},
+    'document': {'.doc', '.docx', '.epub', '.odp', '.ods', '.odt', '.pdf', '.ppt', '.pptx', '.rtf', '.xls',
+                 '.xlsx'},
+    'archive': {'.7z', '.bz2', '.gz', '.iso', '.rar', '.tar', '.tgz', '.xz', '.zip', '.zst'},
+    'text': TEXT_PREVIEW_EXTENSIONS,
+}
+_FILE_TYPE_BY_EXTENSION = {ext: kind for kind, extensions in FILE_TYPES.items() for ext in extensions}
 
-        <!-- Upload Section -->
-        <div class="bg-gray-50 p-6 rounded-lg shadow-inner border border-gray-100">
-            <h2 class="text-2xl font-semibold text-gray-800 mb-4">Upload a File</h2>
-            
-            <!-- Drag and Drop Zone -->
-            <div id="drop-zone" class="border-2 border-dashed border-gray-300 rounded-lg p-6 text-center cursor-pointer hover:border-indigo-500">
-                <p class="text-gray-600 text-lg">Drag & Drop files here, or click to browse</p>
-                <p class="text-sm text-gray-500 mt-1">Max file size: 5GB. All file types are allowed.</p>
-                <input type="file" id="hidden-file-input" name="file" multiple class="hidden">
-            </div>
 
-            <!-- Traditional Upload Form (hidden, but can be shown if needed) -->
-            <form id="upload-form" action="/" method="post" enctype="multipart/form-data" class="mt-4 space-y-4 hidden">
-                <label for="file-upload" class="block text-sm font-medium text-gray-700">
-                    Select your file:
-                </label>
-                <div class="flex items-center space-x-3">
-                    <input id="file-upload" name="file" type="file" class="block w-full text-sm text-gray-900
-                        file:mr-4 file:py-2 file:px-4
-                        file:rounded-full file:border-0
-                        file:text-sm file:font-semibold
-                        file:bg-indigo-50 file:text-indigo-700
-                        hover:file:bg-indigo-100
-                        cursor-pointer focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:ring-offset-2" />
-                    <button type="submit" class="btn-primary inline-flex items-center px-6 py-2 border border-transparent text-base font-medium rounded-full shadow-sm text-white bg-indigo-600 hover:bg-indigo-700 focus:outline-none focus:ring-2 focus:ring-offset-2 focus:ring-indigo-500 transition ease-in-out duration-150">
-                        Upload
-                    </button>
-                </div>
-            </form>
-        </div>
+def file_type(name):
+    """
+    Coarse type of a file for catalog queries: one of FILE_TYPES or 'other'.
+    """
+    kind = _FILE_TYPE_BY_EXTENSION.get(os.path.splitext(name)[1].lower())
+    if kind is not None:
+        return kind
+    mimetype = mimetypes.guess_type(name)[0] or ''
+    major = mimetype.split('/')[0]
+    if major in ('image', 'video', 'audio', 'text'):
+        return major
+    return 'other'
 
-        <!-- Download Section -->
-        <div class="bg-white p-6 rounded-lg shadow-lg border border-gray-100">
-            <h2 class="text-2xl font-semibold text-gray-800 mb-4">Available Files</h2>
-            <ul id="file-list" class="space-y-3">
-                <!-- Files will be loaded here by JavaScript -->
-                <p class="text-gray-600 text-center py-4">Loading files...</p>
-            </ul>
-        </div>
 
-        <p class="text-center text-sm text-gray-500 mt-8">
-            <span class="font-semibold">Note:</span> This server is accessible to all devices on the same Wi-Fi network. Find your server's IP address 192.168.1.4 and port `5000` to access it from other devices.
-        </p>
-    </div>
+class Catalog:
+    """
+    The catalog database. Each process opens its own connection (a SQLite
+    connection must not cross a fork) on first use.
+    """
 
-    <script>
-        const dropZone = document.getElementById('drop-zone');
-        const hiddenFileInput = document.getElementById('hidden-file-input');
-        const errorMessageDiv = document.getElementById('error-message');
-        const errorTextSpan = document.getElementById('error-text');
-        const fileListUl = document.getElementById('file-list');
-
-        function showErrorMessage(message) {
-            errorTextSpan.textContent = message;
-            errorMessageDiv.classList.remove('hidden');
-            setTimeout(() => {
-                errorMessageDiv.classList.add('hidden');
-            }, 5000); // Hide after 5 seconds
-        }
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._downloads = {}  # name -> downloads not yet written
+        self._flush_pid = None
 
-        dropZone.addEventListener('click', () => {
-            hiddenFileInput.click(); // Trigger hidden file input click
-        });
+    def path(self):
+        return os.path.join(app.config['STATE_FOLDER'], 'catalog.db')
 
-        hiddenFileInput.addEventListener('change', (event) => {
-            const files = event.target.files;
-            handleFiles(files);
-        });
+    def db(self):
+        """
+        This process's connection (caller holds the lock).
+        """
+        if self._pid != os.getpid():
+            os.makedirs(app.config['STATE_FOLDER'], exist_ok=True)
+            db = sqlite3.connect(self.path(), timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')  # A crash may lose the last changes; the startup diff restores them
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, type TEXT NOT NULL,
+                    sha256 TEXT, uploader_ip TEXT, uploaded_at REAL, downloads INTEGER NOT NULL DEFAULT 0);
+                CREATE INDEX IF NOT EXISTS files_size ON files (size, name);
+                CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime_ns, name);
+                CREATE INDEX IF NOT EXISTS files_type ON files (type, name);
+                CREATE INDEX IF NOT EXISTS files_downloads ON files (downloads, name);
+                CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+                CREATE INDEX IF NOT EXISTS files_unhashed ON files (name) WHERE sha256 IS NULL;
+            """)
+            self._db, self._pid = db, os.getpid()
+        return self._db
 
-        dropZone.addEventListener('dragover', (event) => {
-            event.preventDefault();
-            dropZone.classList.add('highlight');
-        });
+    def _transaction(self, work):
+        with self.lock:
+            db = self.db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(db)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            return result
 
-        dropZone.addEventListener('dragleave', (event) => {
-            dropZone.classList.remove('highlight');
-        });
+    def record_upload(self, name, digest):
+        """
+        Records a file the current request just put in place: its size and
+        mtime as stored, its content hash and the client's address. A name
+        uploaded again keeps its download count.
+        """
+        uploader_ip = request.remote_addr if has_request_context() else None
+        try:
+            st = os.stat(storage.locate(name))
+            self._transaction(lambda db: db.execute(
+                'INSERT INTO files (name, size, mtime_ns, type, sha256, uploader_ip, uploaded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, '
+                'sha256 = excluded.sha256, uploader_ip = excluded.uploader_ip, uploaded_at = excluded.uploaded_at',
+                (name, st.st_size, st.st_mtime_ns, file_type(name), digest, uploader_ip, time.time())))
+        except (OSError, sqlite3.Error) as e:
+            # The file is in place either way; the index mirror adds the row without these details
+            log.error("Error recording '%s' in the catalog: %s", name, e)
 
-        dropZone.addEventListener('drop', (event) => {
-            event.preventDefault();
-            dropZone.classList.remove('highlight');
-            const files = event.dataTransfer.files;
-            handleFiles(files);
-        });
+    def remove(self, names):
+        if not names:
+            return
+        try:
+            self._transaction(lambda db: db.executemany('DELETE FROM files WHERE name = ?',
+                                                        [(name,) for name in names]))
+        except sqlite3.Error as e:
+            # The index mirror removes the rows when it sees the names go
+            log.error('Error removing %d files from the catalog: %s', len(names), e)
 
-        function handleFiles(files) {
-            if (files.length === 0) {
-                return;
-            }
+    def apply(self, observed, complete=False):
+        """
+        Brings the rows in line with observed (name -> (size, mtime_ns) or None,
+        as the file index has them). A row whose size or mtime changed loses its
+        hash until the hasher gets to it. With complete=True, rows for names
+        missing from observed are removed. Returns the number of rows changed.
+        """
+        def work(db):
+            if complete:
+                current = {name: (size, mtime_ns) for name, size, mtime_ns
+                           in db.execute('SELECT name, size, mtime_ns FROM files')}
+                gone = [(name,) for name in current if name not in observed]
+            else:
+                current = {}
+                for name in observed:
+                    row = db.execute('SELECT size, mtime_ns FROM files WHERE name = ?', (name,)).fetchone()
+                    if row is not None:
+                        current[name] = tuple(row)
+                gone = [(name,) for name, entry in observed.items() if entry is None and name in current]
+            changed = [(name, *entry, file_type(name)) for name, entry in observed.items()
+                       if entry is not None and current.get(name) != tuple(entry)]
+            db.executemany('DELETE FROM files WHERE name = ?', gone)
+            db.executemany(
+                'INSERT INTO files (name, size, mtime_ns, type) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET sha256 = NULL, size = excluded.size, mtime_ns = excluded.mtime_ns',
+                changed)
+            return len(gone) + len(changed)
+        return self._transaction(work)
 
-            const formData = new FormData();
-            for (let i = 0; i < files.length; i++) {
-                const file = files[i];
-                formData.append('file', file); // Append all files directly
-            }
-            
-            // Submit the form data
-            fetch('/', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => {
-                // Flask redirects on success or error, so let the browser handle it.
-                // The page reload will trigger fetchFiles() on DOMContentLoaded.
-                if (response.redirected) {
-                    window.location.href = response.url;
-                } else {
-                    response.text().then(text => {
-                        console.error('Server response:', text);
-                        showErrorMessage('Upload failed: ' + (text || 'Unknown error.'));
-                    });
-                }
-            })
-            .catch(error => {
-                console.error('Upload failed:', error);
-                showErrorMessage('Network error during upload.');
-            });
-        }
+    def count_download(self, name):
+        with self.lock:
+            self._downloads[name] = self._downloads.get(name, 0) + 1
+            if self._flush_pid != os.getpid():
+                self._flush_pid = os.getpid()
+                self._downloads = {name: 1}  # Counts inherited through a fork belong to the parent
+                threading.Thread(target=self._flush_periodically, name='catalog-flush', daemon=True).start()
 
-        // Function to update the file list dynamically
-        function updateFileList(files) {
-            let filesHtml = '';
-            if (files.length > 0) {
-                files.forEach(file => {
-                    filesHtml += `
-                    <li class="file-item flex flex-col items-start justify-between p-4 bg-gray-50 rounded-lg shadow-sm transition ease-in-out duration-200 border border-gray-100">
-                        <span class="text-lg text-gray-800 font-medium truncate flex-grow mr-4 mb-2">${file}</span>
-                        <div class="flex space-x-2 w-full justify-start">
-                            <a href="/download/${file}" class="inline-flex items-center px-4 py-2 border border-transparent text-sm font-medium rounded-full shadow-sm text-white bg-green-500 hover:bg-green-600 focus:outline-none focus:ring-2 focus:ring-offset-2 focus:ring-green-500 transition ease-in-out duration-150">
-                                Download
-                            </a>
-                            <form action="/delete/${file}" method="post" onsubmit="return confirm('Are you sure you want to delete ${file}?');">
-                                <button type="submit" class="btn-delete inline-flex items-center px-4 py-2 border border-transparent text-sm font-medium rounded-full shadow-sm text-white bg-red-500 hover:bg-red-600 focus:outline-none focus:ring-2 focus:ring-offset-2 focus:ring-red-500 transition ease-in-out duration-150">
-                                    Delete
-                                </button>
-                            </form>
-                        </div>
-                    </li>
-                    `;
-                });
-            } else {
-                filesHtml = '<p class="text-gray-600 text-center py-4">No files uploaded yet. Be the first to share!</p>';
-            }
-            fileListUl.innerHTML = filesHtml;
-
-            // Re-attach confirm handlers for newly added forms
-            fileListUl.querySelectorAll('form').forEach(form => {
-                form.onsubmit = function() {
-                    // Extract filename from the preceding span for the confirmation message
-                    const fileNameSpan = form.closest('li').querySelector('span');
-                    const fileName = fileNameSpan ? fileNameSpan.textContent.trim() : 'this file';
-                    return confirm(`Are you sure you want to delete ${fileName}?`);
-                };
-            });
-        }
+    def flush(self):
+        """
+        Adds the buffered download counts to their rows.
+        """
+        with self.lock:
+            counts, self._downloads = self._downloads, {}
+        if counts:
+            self._transaction(lambda db: db.executemany(
+                'UPDATE files SET downloads = downloads + ? WHERE name = ?',
+                [(count, name) for name, count in counts.items()]))
 
-        // Function to fetch files from the server via JSON endpoint
-        function fetchFiles() {
-            fetch('/files_json')
-                .then(response => response.json())
-                .then(data => {
-                    if (data.error) {
-                        console.error('Error fetching files:', data.error);
-                        showErrorMessage('Could not load file list.');
-                    } else {
-                        updateFileList(data);
-                    }
-                })
-                .catch(error => {
-                    console.error('Network error fetching files:', error);
-                    showErrorMessage('Network error loading file list.');
-                });
-        }
+    def _flush_periodically(self):
+        while True:
+            time.sleep(app.config['CATALOG_FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                log.exception('Error writing download counts to the catalog: %s', e)
 
-        // Initial load and periodic refresh of file list
-        document.addEventListener('DOMContentLoaded', () => {
-            fetchFiles(); // Load files on page load
-            setInterval(fetchFiles, 2000); // Refresh every 2 seconds
-        });
+    def unhashed(self, limit=100):
+        with self.lock:
+            return self.db().execute('SELECT name, size, mtime_ns FROM files WHERE sha256 IS NULL LIMIT ?',
+                                     (limit,)).fetchall()
 
-        // Check for server-side error message in URL query parameters
-        const urlParams = new URLSearchParams(window.location.search);
-        const serverErrorMessage = urlParams.get('error');
-        if (serverErrorMessage) {
-            showErrorMessage(serverErrorMessage);
-            // Optionally clear the error from URL after displaying
-            // history.replaceState(null, '', window.location.pathname);
-        }
-    </script>
-</body>
-</html>
-'''
+    def set_hash(self, name, size, mtime_ns, digest):
+        """
+        Stores the hash of name's content, unless the file changed since it was read.
+        """
+        self._transaction(lambda db: db.execute(
+            'UPDATE files SET sha256 = ? WHERE name = ? AND size = ? AND mtime_ns = ?',
+            (digest, name, size, mtime_ns)))
 
-# --- Flask Routes ---
-@app.route('/', methods=['GET', 'POST'])
-def index():
+    def get(self, name):
+        with self.lock:
+            row = self.db().execute(f'SELECT {self._COLUMNS} FROM files WHERE name = ?', (name,)).fetchone()
+        return self._record(row) if row is not None else None
+
+    def hashes(self, names=None):
+        """
+        name -> (size, mtime_ns, sha256) of the hashed rows among names (all if None).
+        """
+        query = 'SELECT name, size, mtime_ns, sha256 FROM files WHERE sha256 IS NOT NULL'
+        with self.lock:
+            db = self.db()
+            if names is None:
+                rows = db.execute(query).fetchall()
+            else:
+                rows = []
+                for i in range(0, len(names), 500):
+                    chunk = names[i:i + 500]
+                    rows += db.execute(f"{query} AND name IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+        return {name: (size, mtime_ns, sha256) for name, size, mtime_ns, sha256 in rows}
+
+    _COLUMNS = 'name, size, mtime_ns, type, sha256, uploader_ip, uploaded_at, downloads'
+
+    @staticmethod
+    def _record(row):
+        name, size, mtime_ns, kind, sha256, uploader_ip, uploaded_at, downloads = row
+        return {"name": name, "size": size, "mtime": mtime_ns / 1e9, "type": kind, "sha256": sha256,
+                "uploader_ip": uploader_ip, "uploaded_at": uploaded_at, "downloads": downloads}
+
+    def query(self, types=(), min_size=None, max_size=None, since=None, until=None, prefix='', sha256=None,
+              sort='name', descending=False, cursor=None, limit=CATALOG_PAGE_SIZE):
+        """
+        One page of catalog records matching all given filters (since/until
+        bound the mtime, in seconds), ordered by CATALOG_SORT_COLUMNS[sort] then
+        name and continuing after `cursor` (the sort key of the previous page's
+        last item). Returns (records, next cursor or None, total matches).
+        """
+        where, params = [], []
+        if types:
+            where.append(f"type IN ({', '.join('?' * len(types))})")
+            params.extend(types)
+        for clause, value in (('size >= ?', min_size), ('size <= ?', max_size), ('sha256 = ?', sha256),
+                              ('mtime_ns >= ?', None if since is None else int(since * 1e9)),
+                              ('mtime_ns < ?', None if until is None else int(until * 1e9))):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        if prefix:
+            where.append('name >= ? AND name < ?')
+            params.extend((prefix, prefix + '\U0010ffff'))
+        column = CATALOG_SORT_COLUMNS[sort]
+        direction, compare = ('DESC', '<') if descending else ('ASC', '>')
+        filters = ' AND '.join(where) or '1'
+
+        page_where, page_params = filters, list(params)
+        if cursor is not None:
+            if sort == 'name':
+                page_where += f' AND name {compare} ?'
+                page_params.append(cursor)
+            else:
+                page_where += f' AND ({column}, name) {compare} (?, ?)'
+                page_params.extend(cursor)
+        order = f'name {direction}' if sort == 'name' else f'{column} {direction}, name {direction}'
+        with self.lock:
+            db = self.db()
+            db.execute('BEGIN')
+            try:
+                rows = db.execute(f'SELECT {self._COLUMNS} FROM files WHERE {page_where} ORDER BY {order} LIMIT ?',
+                                  page_params + [limit + 1]).fetchall()
+                total = db.execute(f'SELECT COUNT(*) FROM files WHERE {filters}', params).fetchone()[0]
+            finally:
+                db.execute('COMMIT')
+        records = [self._record(row) for row in rows[:limit]]
+        next_key = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_key = last[0] if sort == 'name' else (last[self._SORT_FIELDS[sort]], last[0])
+        return records, next_key, total
+
+    _SORT_FIELDS = {'size': 1, 'mtime': 2, 'downloads': 7}  # Positions in _COLUMNS
+
+
+catalog = Catalog()
+
+
+def _mirror_index_into_catalog(index):
     """
-    Handles both displaying the main page and processing file uploads.
+    Follows the file index's changes into the catalog. Starts (and restarts,
+    whenever the change log doesn't reach back far enough) with a full diff.
     """
-    error_message = request.args.get('error') # Get error message from query parameter
+    version = None
+    while True:
+        try:
+            if version is None:
+                with index.lock:
+                    version, entries = index.version, dict(index.entries)
+                changed = catalog.apply(entries, complete=True)
+                log.info('Catalog: %d files, %d rows brought up to date', len(entries), changed)
+                continue
+            index.wait_for_change(version, 30)
+            delta = index.changes_since(version)
+            if delta is None:
+                version = None
+                continue
+            version, changes = delta
+            if changes:
+                with index.lock:
+                    observed = {name: index.entries.get(name) for _, _, name in changes}
+                catalog.apply(observed)
+        except sqlite3.Error as e:
+            log.exception('Error updating the catalog from the file index: %s', e)
+            version = None
+            time.sleep(5)
 
-    if request.method == 'POST':
-        # Check if a file was submitted in the form
-        if 'file' not in request.files:
-            print("Upload Warning: No 'file' part in the request.")
-            return redirect(url_for('index', error="No file selected for upload."))
 
-        uploaded_file = request.files['file']
+def _hash_catalog_files():
+    """
+    Fills in the hash of files the catalog learned about from the index: from
+    the blob store if the file is linked to a blob, else by reading it.
+    """
+    while True:
+        try:
+            rows = catalog.unhashed()
+            for name, size, mtime_ns in rows:
+                path = storage.locate(name)
+                try:
+                    digest = blob_store.digest_of(path) or hash_file(path)
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue  # The index will report the delete
+                if (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+                    catalog.set_hash(name, size, mtime_ns, digest)
+                time.sleep(app.config['CATALOG_HASH_PAUSE'])
+        except (OSError, sqlite3.Error) as e:
+            log.exception('Error hashing files for the catalog: %s', e)
+            rows = []
+        if len(rows) < 100:
+            time.sleep(10)
 
-        # If the user submits an empty file input
-        if uploaded_file.filename == '':
-            print("Upload Warning: No selected file (empty filename).")
-            return redirect(url_for('index', error="No file selected for upload."))
 
-        # Since all file types are allowed, no 'allowed_file' check is needed.
-        # Max file size is still enforced by app.config['MAX_CONTENT_LENGTH']
-        filename = secure_filename(uploaded_file.filename)
-        file_save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        try:
-            uploaded_file.save(file_save_path)
-            print(f"File '{filename}' uploaded successfully to: {file_save_path}")
-        except IOError as e:
-            print(f"IOError saving file '{filename}' to '{file_save_path}': {e}")
-            return redirect(url_for('index', error=f"Server error: Permissions issue saving '{filename}'."))
-        except Exception as e:
-            print(f"General Error saving file '{filename}' to '{file_save_path}': {e}")
-            return redirect(url_for('index', error=f"Server error saving '{filename}': {e}"))
-        return redirect(url_for('index'))
+def _start_catalog_sync():
+    threading.Thread(target=_mirror_index_into_catalog, args=(file_index,), name='catalog-mirror', daemon=True).start()
+    threading.Thread(target=_hash_catalog_files, name='catalog-hash', daemon=True).start()
 
-    # For GET requests, list files and render the page
-    # The initial file list is empty, as JS will fetch it dynamically
-    return render_template_string(HTML_TEMPLATE, files=[], error_message=error_message)
 
-@app.route('/files_json')
-def files_json():
+def _catalog_filters():
     """
-    Returns a JSON list of files in the UPLOAD_FOLDER.
-    Used by JavaScript for real-time updates.
+    The query arguments of GET /catalog as keyword arguments for Catalog.query().
+    Raises ValueError for malformed ones.
+    """
+    args = request.args
+    types = [kind for value in args.getlist('type') for kind in value.split(',') if kind]
+    unknown = set(types) - set(FILE_TYPES) - {'other'}
+    if unknown:
+        raise ValueError(f"Unknown type: {', '.join(sorted(unknown))}")
+    sort = args.get('sort', 'name')
+    if sort not in CATALOG_SORT_COLUMNS:
+        raise ValueError(f"sort must be one of {', '.join(CATALOG_SORT_COLUMNS)}")
+    sha256 = args.get('sha256')
+    if sha256 is not None and not _valid_digest(sha256):
+        raise ValueError("sha256 must be a lowercase hex SHA-256 digest")
+    cursor = _decode_cursor(args.get('cursor'))
+    if cursor is not None and isinstance(cursor, str) != (sort == 'name'):
+        raise ValueError("Cursor belongs to a different sort order")
+
+    def number(key, kind):
+        return kind(args[key]) if args.get(key) else None
+
+    return dict(types=types, min_size=number('min_size', int), max_size=number('max_size', int),
+                since=number('since', float), until=number('until', float), prefix=args.get('prefix', ''),
+                sha256=sha256, sort=sort, descending=args.get('order') == 'desc', cursor=cursor,
+                limit=min(max(int(args.get('limit', CATALOG_PAGE_SIZE)), 1), CATALOG_PAGE_SIZE_MAX))
+
+
+@app.route('/catalog')
+def catalog_query():
+    """
+    Queries the metadata catalog. Filters: type (image, video, audio, document,
+    archive, text, other; repeat or comma-separate for several), min_size and
+    max_size (bytes), since and until (mtime, Unix seconds), prefix, sha256.
+    Sorts by sort=name|size|mtime|downloads and order=asc|desc. Returns
+    {"files": [...], "next_cursor": ..., "total": ...}; pass next_cursor back
+    as cursor for the following page.
     """
-    files = []
     try:
-        if os.path.exists(app.config['UPLOAD_FOLDER']):
-            files = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) if os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], f))]
-            files.sort()
-        return jsonify(files)
-    except Exception as e:
-        print(f"Error fetching files for JSON: {e}")
-        return jsonify({"error": "Could not retrieve files"}), 500
+        filters = _catalog_filters()
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"Invalid query: {e}."}), 400
+    try:
+        records, next_key, total = catalog.query(**filters)
+    except sqlite3.Error as e:
+        log.exception('Error querying the catalog: %s', e)
+        return jsonify({"error": "Could not query the catalog."}), 500
+    return jsonify({
+        "files": records,
+        "next_cursor": _encode_cursor(next_key) if next_key is not None else None,
+        "total": total,
+    })
 
 
-@app.route('/download/<path:filename>')
-def download_file(filename):
+@app.route('/catalog/<path:filename>')
+def catalog_entry(filename):
     """
-    Allows users to download files from the UPLOAD_FOLDER.
-    Uses send_from_directory for secure and robust file serving.
-    The <path:filename> converter allows filenames with slashes (though secure_filename sanitizes them).
+    The catalog record of one file.
     """
-    print(f"--- Download Request Debug ---")
-    print(f"Request URL: {request.url}")
-    print(f"Raw filename from URL parameter: {filename}")
+    try:
+        record = catalog.get(secure_filename(filename))
+    except sqlite3.Error as e:
+        log.exception('Error querying the catalog: %s', e)
+        return jsonify({"error": "Could not query the catalog."}), 500
+    if record is None:
+        return jsonify({"error": "File not found."}), 404
+    return jsonify(record)
 
-    secured_filename = secure_filename(filename)
-    print(f"Secured filename for download: {secured_filename}")
 
-    # Construct the full absolute path to the file
-    full_file_path = os.path.join(app.config['UPLOAD_FOLDER'], secured_filename)
-    print(f"Constructed full file path for download: {full_file_path}")
+# --- Sync Manifest ---
+# GET /manifest is what sync clients (sync.py) diff against: every file's name,
+# size, mtime and SHA-256, in one response instead of a /catalog page walk. Names
+# and sizes come from the file index, so a file is listed as soon as it is in
+# place; its hash comes from the catalog and is null while the catalog hasn't
+# hashed that version yet (files uploaded through the server are hashed as they
+# arrive). A client that keeps the "version" of its last manifest and passes it as
+# ?since= gets only the files changed since then plus the names removed, which
+# is what keeps a watching client's polls cheap; when the change log doesn't reach
+# back that far the response is a full manifest again ("complete": true).
 
-    # Check if the file actually exists at the constructed path
-    if not os.path.exists(full_file_path):
-        print(f"Download Error: File '{secured_filename}' not found at '{full_file_path}'. Sending 404.")
-        return "File not found.", 404
-    
+MANIFEST_HASH_LOOKUP_MAX = 10000  # more names than this read the hashes of the whole catalog at once
+
+
+def _manifest_records(entries):
+    """
+    Manifest records for entries (name -> (size, mtime_ns)), sorted by name.
+    """
     try:
-        # Serve the file from the configured UPLOAD_FOLDER
-        # as_attachment=True prompts the browser to download instead of display
-        print(f"Attempting send_from_directory for directory: {app.config['UPLOAD_FOLDER']}, filename: {secured_filename}")
-        return send_from_directory(app.config['UPLOAD_FOLDER'], secured_filename, as_attachment=True)
-    except FileNotFoundError:
-        # This catch is mostly for robustness, as os.path.exists should ideally catch it
-        print(f"Download Error: File '{secured_filename}' not found during send_from_directory (caught by FileNotFoundError).")
-        return "File not found (internal error).", 404
-    except Exception as e:
-        print(f"General Download Error for '{secured_filename}': {e}")
-        return "An error occurred during download.", 500
-    print(f"--- End Download Request Debug ---")
+        hashes = catalog.hashes(None if len(entries) > MANIFEST_HASH_LOOKUP_MAX else list(entries))
+    except sqlite3.Error as e:
+        log.exception('Error reading hashes from the catalog: %s', e)
+        hashes = {}
+    records = []
+    for name in sorted(entries):
+        size, mtime_ns = entries[name]
+        known = hashes.get(name)
+        records.append({"name": name, "size": size, "mtime": mtime_ns / 1e9,
+                        "sha256": known[2] if known is not None and known[:2] == (size, mtime_ns) else None})
+    return records
 
 
-@app.route('/delete/<path:filename>', methods=['POST'])
-def delete_file(filename):
+@app.route('/manifest')
+def manifest():
     """
-    Allows users to delete files from the UPLOAD_FOLDER.
+    Every file as {"name", "size", "mtime", "sha256"}, with the index "version"
+    it reflects. With since=<version> only what changed after that version:
+    "complete" is then false and "removed" lists the names that went away.
     """
-    secured_filename = secure_filename(filename)
-    full_path = os.path.join(app.config['UPLOAD_FOLDER'], secured_filename)
-    print(f"Attempting to delete file: {full_path}")
+    try:
+        since = int(request.args['since']) if 'since' in request.args else None
+    except ValueError:
+        return jsonify({"error": "since must be a version number."}), 400
+    delta = file_index.changes_since(since) if since is not None else None
+    if delta is None:
+        with file_index.lock:
+            version, entries = file_index.version, dict(file_index.entries)
+        return jsonify({"version": version, "complete": True, "files": _manifest_records(entries), "removed": []})
+    version, changes = delta
+    names = {name for _, _, name in changes}
+    with file_index.lock:
+        entries = {name: file_index.entries[name] for name in names if name in file_index.entries}
+    return jsonify({"version": version, "complete": False, "files": _manifest_records(entries),
+                    "removed": sorted(names - entries.keys())})
+
+
+# --- Change Feed (Server-Sent Events) ---
+# Instead of every tab downloading the whole listing every 2 seconds, the page keeps
+# one EventSource open on /events. The stream starts with a "reset" event carrying
+# the current version (the client then loads the pages it wants from /files_json),
+# followed by "delta" events with the files added or changed (with size and mtime)
+# and the names removed. Every event id is the index version, so a reconnecting
+# browser sends it back as Last-Event-ID and only receives what it missed. An idle
+# connection costs one keep-alive comment every EVENTS_KEEPALIVE seconds.
+
+app.config['EVENTS_KEEPALIVE'] = 15  # seconds
 
-    if os.path.isfile(full_path):
+
+def _sse_event(event, version, data):
+    return f"id: {version}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _delta_payload(version, changes):
+    """
+    Collapses a run of changes into the net files added/updated and names removed.
+    """
+    names = sorted({name for _, _, name in changes})
+    records = [(name, file_index.describe(name)) for name in names]
+    return {
+        "version": version,
+        "added": [record for _, record in records if record is not None],
+        "removed": [name for name, record in records if record is None],
+    }
+
+
+@app.route('/events')
+def file_events():
+    """
+    Server-Sent Events stream of changes to the file listing.
+    Resumes from the Last-Event-ID header (or ?since=<version>) when given.
+    """
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        cursor = int(cursor) if cursor is not None else None
+    except ValueError:
+        cursor = None
+    keepalive = app.config['EVENTS_KEEPALIVE']
+    # Under the asyncio server, waits park on the event loop instead of a worker thread
+    suspend = request.environ.get('mkcloud.suspend')
+
+    def stream():
+        version = cursor
+        yield "retry: 3000\n\n"
+        while True:
+            delta = file_index.changes_since(version) if version is not None else None
+            if delta is None:
+                # New client, or one too far behind for the change log: start over
+                version = file_index.version
+                yield _sse_event('reset', version, {"version": version})
+            elif delta[1]:
+                version = delta[0]
+                yield _sse_event('delta', version, _delta_payload(version, delta[1]))
+            if suspend is not None:
+                waited_for = version
+                yield suspend(lambda callback: file_index.subscribe(callback, waited_for), keepalive)
+                if file_index.version == version:
+                    yield ": keep-alive\n\n"
+            elif not file_index.wait_for_change(version, keepalive):
+                yield ": keep-alive\n\n"
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- Metrics ---
+# GET /metrics reports per-route request counts and latencies, transfer volumes,
+# active transfers, cache hit rates and free disk space in the Prometheus text
+# format. Recording stays on in production: each thread adds to dicts of its own,
+# so the hot path takes no lock, and the per-thread dicts are only summed when
+# scraped. Under the prefork server every worker also publishes its totals to
+# STATE_FOLDER/metrics every METRICS_PUBLISH_INTERVAL seconds, and a scrape (which
+# lands on any one worker) adds up the published totals of the other workers.
+
+app.config['METRICS_PUBLISH_INTERVAL'] = 5  # seconds; only used with several workers
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name -> (type, help) of everything /metrics reports, in output order
+METRICS = {
+    'mkcloud_http_requests_total': (
+        'counter', 'HTTP requests by route, method and status code.'),
+    'mkcloud_http_request_duration_seconds': (
+        'histogram', 'Time until the response was ready to send (streamed bodies not included), by route.'),
+    'mkcloud_upload_bytes_total': ('counter', 'File data received by uploads.'),
+    'mkcloud_download_bytes_total': ('counter', 'File data sent by downloads and archives.'),
+    'mkcloud_active_transfers': ('gauge', 'Uploads and downloads in progress, by direction.'),
+    'mkcloud_upload_queue_depth': ('gauge', 'Files of multi-file uploads waiting for an upload worker.'),
+    'mkcloud_cache_requests_total': ('counter', 'Cache lookups by cache and result (hit or miss).'),
+    'mkcloud_delta_bytes_total': (
+        'counter', 'Content of delta uploads by source: copied from the previous version or sent as literal data.'),
+    'mkcloud_files': ('gauge', 'Files in UPLOAD_FOLDER.'),
+    'mkcloud_disk_free_bytes': ('gauge', 'Free space on the disk holding UPLOAD_FOLDER.'),
+    'mkcloud_disk_total_bytes': ('gauge', 'Size of the disk holding UPLOAD_FOLDER.'),
+    'mkcloud_transfer_limit_bytes_per_second': (
+        'gauge', 'Configured response bandwidth limits by scope (server or client); 0 is unlimited.'),
+    'mkcloud_transfer_streams': ('gauge', 'Response bodies being paced by the bandwidth scheduler, by lane.'),
+    'mkcloud_transfer_allocated_bytes_per_second': (
+        'gauge', 'Bandwidth currently allocated to the streams of each lane (0 when unlimited).'),
+    'mkcloud_transfer_clients': ('gauge', 'Clients with response bodies in progress.'),
+    'mkcloud_transfer_bytes_total': ('counter', 'Response body bytes sent, by scheduler lane.'),
+    'mkcloud_transfer_wait_seconds_total': (
+        'counter', 'Time response bodies spent waiting for bandwidth, by lane.'),
+    'mkcloud_log_records_dropped_total': ('counter', 'Log records dropped because stdout fell behind.'),
+}
+
+
+class Metrics:
+    """
+    Counters and latency histograms. A series is keyed by (metric name, labels),
+    labels being a tuple of (label, value) pairs; callers must pass the labels of
+    one metric in the same order every time.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()  # registering threads and scraping only
+        self._shards = []  # (thread, (counters, histograms)) per recording thread
+        self._retired = ({}, {})  # totals of threads that have exited
+        self._collectors = []
+
+    def register(self, collector):
+        """
+        Adds a function returning {(name, labels): value} for values kept elsewhere;
+        it is called for every snapshot.
+        """
+        self._collectors.append(collector)
+
+    def _shard(self):
         try:
-            os.remove(full_path)
-            print(f"File '{secured_filename}' deleted successfully from: {full_path}")
-        except Exception as e:
-            print(f"Error deleting file '{secured_filename}' from '{full_path}': {e}")
-    else:
-        print(f"Delete Error: File '{secured_filename}' not found at '{full_path}' for deletion.")
-    return redirect(url_for('index'))
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds value to a counter, or to a gauge when value may be negative.
+        """
+        counters = self._shard()[0]
+        key = (name, tuple(labels.items()))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records one latency: per-bucket counts (the last one is +Inf), then the sum.
+        """
+        histograms = self._shard()[1]
+        key = (name, tuple(labels.items()))
+        buckets = histograms.get(key)
+        if buckets is None:
+            buckets = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        buckets[-1] += seconds
+
+    @staticmethod
+    def _merge(into, counters, histograms):
+        for key, value in counters.items():
+            into[0][key] = into[0].get(key, 0) + value
+        for key, buckets in histograms.items():
+            total = into[1].get(key)
+            into[1][key] = list(buckets) if total is None else [a + b for a, b in zip(total, buckets)]
+
+    def snapshot(self):
+        """
+        Returns (counters, histograms) summed over all threads of this process.
+        """
+        totals = ({}, {})
+        with self._lock:
+            live = []
+            for thread, (counters, histograms) in self._shards:
+                if thread.is_alive():
+                    live.append((thread, (counters, histograms)))
+                else:
+                    self._merge(self._retired, counters, histograms)  # The thread won't write again
+            self._shards = live
+            self._merge(totals, *self._retired)
+            for _, (counters, histograms) in live:
+                # Copying a dict or list is atomic under the GIL, so no recording
+                # thread has to wait for the scrape
+                self._merge(totals, counters.copy(), {k: list(v) for k, v in histograms.copy().items()})
+        for collector in self._collectors:
+            self._merge(totals, collector(), {})
+        return totals
+
+    @staticmethod
+    def folder():
+        return os.path.join(app.config['STATE_FOLDER'], 'metrics')
+
+    def publish(self):
+        """
+        Writes this process's totals to folder()/<pid>.json for the other workers.
+        """
+        counters, histograms = self.snapshot()
+        os.makedirs(self.folder(), exist_ok=True)
+        path = os.path.join(self.folder(), f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({
+                "counters": [[name, labels, value] for (name, labels), value in counters.items()],
+                "histograms": [[name, labels, buckets] for (name, labels), buckets in histograms.items()],
+            }, f)
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        """
+        This process's live totals plus the last published totals of the other
+        workers. Gauges of workers that have exited are left out.
+        """
+        totals = self.snapshot()
+        if not app.config['INDEX_SHARED']:
+            return totals
+        try:
+            published = [n for n in os.listdir(self.folder()) if n.endswith('.json')]
+        except FileNotFoundError:
+            published = []
+        for filename in published:
+            pid = int(filename[:-5])
+            if pid == os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.folder(), filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _process_alive(pid)
+            counters = {(name, tuple(map(tuple, labels))): value for name, labels, value in data['counters']
+                        if alive or METRICS.get(name, ('counter',))[0] != 'gauge'}
+            histograms = {(name, tuple(map(tuple, labels))): buckets for name, labels, buckets in data['histograms']}
+            self._merge(totals, counters, histograms)
+        return totals
+
+    @staticmethod
+    def reset_published():
+        """
+        Forgets the totals published by an earlier run (called before forking workers).
+        """
+        shutil.rmtree(Metrics.folder(), ignore_errors=True)
+
+
+metrics = Metrics()
+metrics.register(lambda: {('mkcloud_log_records_dropped_total', ()): log_records_dropped()})
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _publish_metrics_periodically(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            metrics.publish()
+        except OSError as e:
+            log.error('Error publishing metrics: %s', e)
+
+
+def count_download(body):
+    """
+    Wraps a streamed download body (e.g. an archive) so its bytes are counted
+    and it shows up as an active transfer while it is being sent.
+    """
+    metrics.inc('mkcloud_active_transfers', direction='download')
+    try:
+        for block in body:
+            metrics.inc('mkcloud_download_bytes_total', len(block))
+            yield block
+    finally:
+        metrics.inc('mkcloud_active_transfers', -1, direction='download')
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = request.environ.get('mkcloud.started')  # Set by start_request()
+    if started is not None:
+        # The URL rule, not the path, so file names don't each become a series
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.inc('mkcloud_http_requests_total', route=route, method=request.method,
+                    code=str(response.status_code))
+        metrics.observe('mkcloud_http_request_duration_seconds', time.perf_counter() - started, route=route)
+    return response
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+def render_metrics(counters, histograms):
+    """
+    Prometheus text exposition format (version 0.0.4).
+    """
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            for (_, labels), buckets in sorted(item for item in histograms.items() if item[0][0] == name):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {buckets[-1]:.6f}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        else:
+            for (_, labels), value in sorted(item for item in counters.items() if item[0][0] == name):
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Prometheus scrape target.
+    """
+    counters, histograms = metrics.collect()
+    # Point-in-time values are read at scrape time instead of being recorded
+    counters[('mkcloud_files', ())] = len(file_index.entries)
+    try:
+        usage = shutil.disk_usage(app.config['UPLOAD_FOLDER'])
+        counters[('mkcloud_disk_free_bytes', ())] = usage.free
+        counters[('mkcloud_disk_total_bytes', ())] = usage.total
+    except OSError as e:
+        log.error('Error reading disk usage for metrics: %s', e)
+    counters[('mkcloud_transfer_limit_bytes_per_second', (('scope', 'server'),))] = app.config['TRANSFER_RATE_LIMIT']
+    counters[('mkcloud_transfer_limit_bytes_per_second', (('scope', 'client'),))] = \
+        app.config['TRANSFER_CLIENT_RATE_LIMIT']
+    return Response(render_metrics(counters, histograms), mimetype='text/plain; version=0.0.4')
+
+
+# --- Bandwidth Scheduling ---
+# With aioserver, response bodies are paced so one client pulling a huge file can't
+# starve everybody else: a token bucket per client (TRANSFER_CLIENT_RATE_LIMIT) and
+# one for the whole server (TRANSFER_RATE_LIMIT), both in bytes/s and 0 meaning
+# unlimited. The server-wide bandwidth is shared between the downloads in progress
+# in proportion to their lane's weight. Responses up to TRANSFER_INTERACTIVE_MAX
+# bytes (listings, pages, thumbnails, small files) and streams of unknown length
+# such as the change feed only wait for their client's limit, never for the
+# server-wide one; downloads of TRANSFER_BULK_MIN bytes or more and archives go to
+# the 'bulk' lane, the rest to 'normal'.
+#
+# With several workers each gets an equal slice of TRANSFER_RATE_LIMIT. A client's
+# connections land on any worker (SO_REUSEPORT spreads them), so every
+# TRANSFER_SHARE_INTERVAL seconds each worker writes its open streams per client
+# to STATE_FOLDER/transfers.db and gives each client's bucket its share of
+# TRANSFER_CLIENT_RATE_LIMIT, in proportion to the streams it serves. A new
+# stream may exceed the limit for up to one interval before the shares catch up.
+
+app.config['TRANSFER_RATE_LIMIT'] = int(os.environ.get('TRANSFER_RATE_LIMIT', 0))
+app.config['TRANSFER_CLIENT_RATE_LIMIT'] = int(os.environ.get('TRANSFER_CLIENT_RATE_LIMIT', 0))
+app.config['TRANSFER_LANE_WEIGHTS'] = {'normal': 4, 'bulk': 1}
+app.config['TRANSFER_INTERACTIVE_MAX'] = 256 * 1024
+app.config['TRANSFER_BULK_MIN'] = 16 * 1024 * 1024
+app.config['TRANSFER_SLICE'] = 256 * 1024  # bytes sent per scheduling decision
+app.config['TRANSFER_SHARE_INTERVAL'] = 0.5  # seconds between exchanges of per-client stream counts
+
+transfer_scheduler = None  # aioserver.BandwidthScheduler, when serving with aioserver
+
+
+class TransferShares:
+    """
+    SQLite table of the streams each worker process has open per client, from
+    which every worker works out its share of a client's bandwidth. Rows not
+    refreshed for `stale` seconds (a worker that died) are ignored.
+    """
+
+    def __init__(self, path, pid=None, stale=2.0):
+        self.pid = os.getpid() if pid is None else pid
+        self.stale = stale
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=OFF')  # Rewritten every interval; nothing to keep across a crash
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS streams (
+                pid INTEGER NOT NULL, client TEXT NOT NULL, streams INTEGER NOT NULL, updated REAL NOT NULL,
+                PRIMARY KEY (pid, client))
+        """)
+
+    def exchange(self, streams):
+        """
+        Replaces this process's rows with streams ({client: open streams}) and
+        returns {client: fraction of its limit this process may use} for every
+        client with streams anywhere. A process without streams for a client
+        counts as having one, in case the client's next request lands on it.
+        """
+        now = time.time()
+        with self.lock:
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('DELETE FROM streams WHERE pid = ? OR updated < ?', (self.pid, now - 10 * self.stale))
+                db.executemany('INSERT INTO streams VALUES (?, ?, ?, ?)',
+                               [(self.pid, client, count, now) for client, count in streams.items()])
+                others = dict(db.execute('SELECT client, SUM(streams) FROM streams WHERE pid != ? AND updated >= ? '
+                                         'GROUP BY client', (self.pid, now - self.stale)))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        shares = {}
+        for client in set(streams) | set(others):
+            mine = max(streams.get(client, 0), 1)
+            shares[client] = mine / (mine + others.get(client, 0))
+        return shares
+
+
+def _share_client_bandwidth_periodically(interval):
+    shares = TransferShares(os.path.join(app.config['STATE_FOLDER'], 'transfers.db'))
+    while True:
+        time.sleep(interval)
+        try:
+            transfer_scheduler.set_client_shares(shares.exchange(transfer_scheduler.client_streams()))
+        except sqlite3.Error as e:
+            log.error('Error sharing client bandwidth between workers: %s', e)
+
+
+def transfer_series():
+    """
+    The scheduler's live allocation as metric series (published with the rest).
+    """
+    if transfer_scheduler is None:
+        return {}
+    stats = transfer_scheduler.stats()
+    series = {('mkcloud_transfer_clients', ()): stats['clients']}
+    for lane, values in stats['lanes'].items():
+        labels = (('lane', lane),)
+        series[('mkcloud_transfer_streams', labels)] = values['streams']
+        series[('mkcloud_transfer_allocated_bytes_per_second', labels)] = round(values['allocated'])
+        series[('mkcloud_transfer_bytes_total', labels)] = values['bytes']
+        series[('mkcloud_transfer_wait_seconds_total', labels)] = round(values['wait'], 3)
+    return series
+
+
+metrics.register(transfer_series)
+
+# --- Background Services ---
+# Started lazily on the first request of each process instead of at import time,
+# so threads are never created before a fork and tests can adjust app.config first.
+_services_pid = None
+_services_lock = threading.Lock()
+
+
+@app.before_request
+def start_background_services():
+    global _services_pid
+    if _services_pid == os.getpid():
+        return
+    with _services_lock:
+        if _services_pid == os.getpid():
+            return
+        start_file_index()
+        reclaimer.recover()
+        _expire_incoming()
+        threading.Thread(target=_collect_blobs_periodically, args=(app.config['BLOB_GC_INTERVAL'],),
+                         name='blob-gc', daemon=True).start()
+        if app.config['INDEX_SHARED']:
+            threading.Thread(target=_publish_metrics_periodically, args=(app.config['METRICS_PUBLISH_INTERVAL'],),
+                             name='metrics-publish', daemon=True).start()
+            if transfer_scheduler is not None and app.config['TRANSFER_CLIENT_RATE_LIMIT']:
+                threading.Thread(target=_share_client_bandwidth_periodically,
+                                 args=(app.config['TRANSFER_SHARE_INTERVAL'],),
+                                 name='transfer-shares', daemon=True).start()
+        _services_pid = os.getpid()
 
 # --- Server Run ---
+# `python main.py` serves with aioserver, an asyncio HTTP/1.1 server: connections
+# and slow transfers live on the event loop, small request bodies are read before
+# the app sees them while uploads are streamed to it straight off the socket, and
+# app code and disk I/O run on bounded executors. Set SERVER_MODE=dev for Flask's
+# development server instead.
+#
+# WORKERS=N (N > 1) forks N such server processes sharing the port through
+# SO_REUSEPORT; their file indexes are kept identical through the shared SQLite
+# journal. Only the supervising parent advertises the server over mDNS.
+app.config['SERVER_WORKERS'] = int(os.environ.get('WORKERS', 1))
+app.config['MDNS_NAME'] = os.environ.get('MDNS_NAME', 'mycloud')  # empty: don't advertise
+app.config['SERVER_APP_WORKERS'] = 64  # threads running request handlers
+app.config['SERVER_DISK_WORKERS'] = 8  # threads reading file bodies that can't be sent with sendfile()
+app.config['SERVER_BODY_MEMORY'] = 1024 * 1024  # larger (and chunked) request bodies are streamed to the app
+
+
 def register_mdns(name="mycloud", port=5000):
     zeroconf = Zeroconf()
     
@@ -1091,8 +6724,68 @@ def register_mdns(name="mycloud", port=5000):
     )
     
     zeroconf.register_service(service_info)
-    print(f"mDNS service registered at: http://{name}.local:{port}")
+    log.info('mDNS service registered at: http://%s.local:%d', name, port)
     return zeroconf
 
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
+
+_zeroconf = None
+
+
+def start_mdns(port):
+    """
+    Advertises the server once per machine; a failure (e.g. no multicast) isn't fatal.
+    """
+    global _zeroconf
+    if not app.config['MDNS_NAME']:
+        return
+    try:
+        _zeroconf = register_mdns(app.config['MDNS_NAME'], port)
+    except Exception as e:
+        log.warning('mDNS registration failed: %s', e)
+
+
+def stop_mdns():
+    if _zeroconf is not None:
+        _zeroconf.unregister_all_services()
+        _zeroconf.close()
+
+if __name__ == '__main__' and sys.argv[1:2] == ['migrate-layout']:
+    # python main.py migrate-layout [--width N] [--pause S]: see Storage Layout
+    import argparse
+    parser = argparse.ArgumentParser(prog='main.py migrate-layout', description=migrate_layout.__doc__)
+    parser.add_argument('--width', type=int, help='hex digits per shard folder (default STORAGE_SHARD_WIDTH)')
+    parser.add_argument('--batch', type=int, default=1000, help='files moved between pauses')
+    parser.add_argument('--pause', type=float, default=0.05, help='seconds to pause after each batch')
+    args = parser.parse_args(sys.argv[2:])
+    migrate_layout(width=args.width, pause=args.pause, batch=args.batch)
+    logging.shutdown()
+elif __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+    if os.environ.get('SERVER_MODE', 'production') == 'dev':
+        app.run(host='0.0.0.0', port=port)  # Flask's development server (reloader/debugger friendly)
+    else:
+        import aioserver
+        options = dict(app_workers=app.config['SERVER_APP_WORKERS'],
+                       disk_workers=app.config['SERVER_DISK_WORKERS'],
+                       body_memory_max=app.config['SERVER_BODY_MEMORY'],
+                       max_body_size=app.config['MAX_CONTENT_LENGTH'])
+        transfer_scheduler = aioserver.BandwidthScheduler(
+            rate=app.config['TRANSFER_RATE_LIMIT'] // app.config['SERVER_WORKERS'],
+            client_rate=app.config['TRANSFER_CLIENT_RATE_LIMIT'],
+            weights=app.config['TRANSFER_LANE_WEIGHTS'],
+            interactive_max=app.config['TRANSFER_INTERACTIVE_MAX'],
+            bulk_min=app.config['TRANSFER_BULK_MIN'],
+            slice_size=app.config['TRANSFER_SLICE'])
+        options['scheduler'] = transfer_scheduler
+        if app.config['SERVER_WORKERS'] > 1:
+            app.config['INDEX_SHARED'] = True
+            Metrics.reset_published()
+            aioserver.serve_prefork(app, host='0.0.0.0', port=port, workers=app.config['SERVER_WORKERS'],
+                                    on_start=lambda: start_mdns(port), on_stop=stop_mdns,
+                                    on_worker_exit=preview_cache.shutdown, **options)
+        else:
+            start_mdns(port)
+            try:
+                aioserver.serve(app, host='0.0.0.0', port=port, **options)
+            finally:
+                stop_mdns()
\ No newline at end of file
@@ -0,0 +1,588 @@
+"""
+Command-line sync client: mirrors a local folder to the server (push) or the
+server's files to a local folder (pull), transferring only what differs.
+
+    python sync.py push ~/backups http://server:5000
+    python sync.py pull ~/mirror http://server:5000 --delete
+    python sync.py push ~/notes http://server:5000 --watch
+
+Each run fetches the server's manifest (GET /manifest: name, size, mtime and
+SHA-256 of every file), compares it with the local folder and sends or fetches
+the files that differ over a pool of keep-alive connections (--connections), so
+thousands of small files aren't sent one round trip at a time. A changed file
+that is large on both sides goes up as an rsync-style delta (delta.py) instead
+of in full. Local hashes are cached in .mkcloud-sync.json in the folder, keyed by
+size and mtime, so unchanged files aren't read again on the next run. --watch
+keeps syncing every --interval seconds; the manifest is then fetched as changes
+since the previous one.
+
+The server keeps a flat list of names, made safe with werkzeug's
+secure_filename(): a push sends sub/dir/file.txt as sub_dir_file.txt, and a pull
+writes the server's names into the top level of the folder. Local paths that
+map to the same server name are skipped with a warning. Only the standard
+library (and delta.py next to this file) is needed.
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+import delta
+
+STATE_NAME = '.mkcloud-sync.json'
+TEMP_SUFFIX = '.mkcloud-part'
+READ_SIZE = 1024 * 1024
+SMALL_FILE_SIZE = 1024 * 1024  # files up to this size are sent from memory in one write
+DELTA_MIN_SIZE = 8 * 1024 * 1024  # changed files at least this large (both versions) go up as deltas
+DELETE_BATCH = 10000  # names per POST /delete_batch
+RETRIES = 2  # extra attempts of a request whose keep-alive connection turned out to be closed
+
+_unsafe_chars = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+class SyncError(Exception):
+    pass
+
+
+def server_name(relpath):
+    """
+    The name the server stores relpath under: werkzeug's secure_filename(),
+    which also folds the folder separators into underscores. '' if nothing
+    usable is left.
+    """
+    name = unicodedata.normalize('NFKD', relpath).encode('ascii', 'ignore').decode('ascii')
+    for sep in (os.sep, os.path.altsep, '/'):
+        if sep:
+            name = name.replace(sep, ' ')
+    return _unsafe_chars.sub('', '_'.join(name.split())).strip('._')
+
+
+def is_server_name(name):
+    """
+    Whether name is one the server could have stored, so it is safe to use as a
+    file name under the folder (no separators, no '..').
+    """
+    return bool(name) and server_name(name) == name and not any(
+        sep in name for sep in (os.sep, os.path.altsep, '/') if sep)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                return digest.hexdigest()
+            digest.update(block)
+
+
+class Connections:
+    """
+    One keep-alive connection to the server per thread, reopened when the
+    server closes it.
+    """
+
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise SyncError(f'Not an http(s) URL: {url}')
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host, self.port = parts.hostname, parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self.connection_class(self.host, self.port, timeout=self.timeout, blocksize=READ_SIZE)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def request(self, method, path, body=None, headers=None, encode_chunked=False):
+        """
+        Sends a request and returns the response, whose body the caller must
+        read in full before the connection's next request. A request that finds
+        its idle connection closed is retried on a new one, unless its body is a
+        one-shot iterator.
+        """
+        start = body.tell() if hasattr(body, 'seek') else None
+        retry = body is None or isinstance(body, bytes) or start is not None
+        for attempt in range(RETRIES + 1):
+            if attempt and start is not None:
+                body.seek(start)
+            conn = self._connection()
+            try:
+                conn.request(method, self.prefix + path, body=body, headers=headers or {},
+                             encode_chunked=encode_chunked)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                if not retry or attempt == RETRIES:
+                    raise
+                continue
+            if response.will_close:
+                self._local.conn = None  # Still readable; the next request opens a new connection
+            return response
+
+    def json(self, method, path, body=None, expect=(200,)):
+        headers = {'Content-Type': 'application/json'} if body is not None else None
+        response = self.request(method, path, None if body is None else json.dumps(body).encode(), headers)
+        data = response.read()
+        if response.status not in expect:
+            raise SyncError(f'{method} {path}: HTTP {response.status} {_error_text(data)}')
+        return json.loads(data)
+
+
+def _error_text(data):
+    try:
+        return json.loads(data).get('error', '')
+    except (ValueError, AttributeError):
+        return data[:200].decode('utf-8', 'replace')
+
+
+class _Limited:
+    """
+    Reads at most `size` bytes of f, so a file that grows during its upload
+    doesn't send more than its Content-Length announced.
+    """
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, n=-1):
+        n = self.remaining if n < 0 else min(n, self.remaining)
+        data = self.f.read(n)
+        self.remaining -= len(data)
+        return data
+
+
+class HashCache:
+    """
+    SHA-256 of local files by relative path, valid while their size and mtime
+    are unchanged; kept in STATE_NAME in the synced folder.
+    """
+
+    def __init__(self, root):
+        self.path = os.path.join(root, STATE_NAME)
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f).get('hashes', {})
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, path, relpath, size, mtime_ns):
+        with self.lock:
+            entry = self.entries.get(relpath)
+        if entry is not None and entry[:2] == [size, mtime_ns]:
+            return entry[2]
+        digest = hash_file(path)
+        self.put(relpath, size, mtime_ns, digest)
+        return digest
+
+    def put(self, relpath, size, mtime_ns, digest):
+        with self.lock:
+            self.entries[relpath] = [size, mtime_ns, digest]
+            self.dirty = True
+
+    def save(self, keep):
+        """
+        Writes the cache, forgetting paths that are not in `keep` any more.
+        """
+        with self.lock:
+            for relpath in [p for p in self.entries if p not in keep]:
+                del self.entries[relpath]
+                self.dirty = True
+            if not self.dirty:
+                return
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'hashes': self.entries}, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+
+def scan_tree(root, recursive=True):
+    """
+    name on the server -> (relative path, size, mtime_ns) of the regular files
+    under root. Returns (files, collisions) with collisions listing the paths
+    skipped because another path maps to the same name.
+    """
+    files, collisions = {}, []
+    pending = ['']
+    while pending:
+        rel_dir = pending.pop()
+        try:
+            entries = list(os.scandir(os.path.join(root, rel_dir)))
+        except OSError as e:
+            print(f'warning: cannot read {os.path.join(root, rel_dir)}: {e}', file=sys.stderr)
+            continue
+        for entry in entries:
+            relpath = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    pending.append(relpath)
+                continue
+            if not entry.is_file(follow_symlinks=False) or entry.name == STATE_NAME or \
+                    entry.name.endswith(TEMP_SUFFIX) or entry.name.startswith(f'{STATE_NAME}.'):
+                continue
+            name = server_name(relpath)
+            if not name:
+                collisions.append(relpath)
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue  # Removed since the directory was read
+            if name in files:
+                collisions.append(relpath)
+                continue
+            files[name] = (relpath, st.st_size, st.st_mtime_ns)
+    return files, collisions
+
+
+class SyncClient:
+    """
+    Syncs one local folder with one server. The remote view (the manifest) is
+    kept between runs, so repeated runs only fetch its changes.
+    """
+
+    def __init__(self, url, root, connections=8, delete=False, dry_run=False, verbose=False,
+                 delta_min_size=DELTA_MIN_SIZE):
+        self.root = os.path.abspath(root)
+        self.http = Connections(url)
+        self.pool = ThreadPoolExecutor(max_workers=connections, thread_name_prefix='sync')
+        self.delete = delete
+        self.dry_run = dry_run
+        self.verbose = verbose
+        self.delta_min_size = delta_min_size
+        self.hashes = HashCache(self.root)
+        self.remote = {}  # name -> manifest record
+        self.version = None
+        self._warned = set()
+
+    def close(self):
+        self.pool.shutdown()
+        self.http.close()
+
+    # --- Manifest and diff ---
+
+    def refresh_manifest(self):
+        """
+        Brings the remote view up to date. Returns True if anything changed.
+        """
+        path = '/manifest' if self.version is None else f'/manifest?since={self.version}'
+        manifest = self.http.json('GET', path)
+        if manifest['complete']:
+            self.remote = {}
+        for record in manifest['files']:
+            if not is_server_name(record['name']):
+                if record['name'] not in self._warned:
+                    self._warned.add(record['name'])
+                    print(f"warning: ignoring {record['name']!r} in the manifest: not a valid file name",
+                          file=sys.stderr)
+                continue
+            self.remote[record['name']] = record
+        for name in manifest['removed']:
+            self.remote.pop(name, None)
+        changed = manifest['complete'] or manifest['files'] or manifest['removed']
+        self.version = manifest['version']
+        return bool(changed)
+
+    def _local_files(self, recursive):
+        files, collisions = scan_tree(self.root, recursive)
+        for relpath in collisions:
+            if relpath not in self._warned:
+                self._warned.add(relpath)
+                print(f'warning: skipping {relpath}: no usable server name or it clashes with another file',
+                      file=sys.stderr)
+        return files
+
+    def _differs(self, name, local, local_is_newer):
+        """
+        Whether the local file (relpath, size, mtime_ns) and the remote one of
+        the same name have different content. Without a remote hash (the server
+        hasn't hashed that version yet) equal sizes count as the same content
+        unless local_is_newer(remote record) says otherwise.
+        """
+        remote = self.remote.get(name)
+        relpath, size, mtime_ns = local
+        if remote is None or remote['size'] != size:
+            return True
+        if remote['sha256'] is None:
+            return local_is_newer(remote)
+        return self.hashes.get(os.path.join(self.root, relpath), relpath, size, mtime_ns) != remote['sha256']
+
+    def plan_push(self, local):
+        uploads = [name for name, entry in local.items()
+                   if self._differs(name, entry, lambda remote: entry[2] / 1e9 > remote['mtime'])]
+        deletes = sorted(self.remote.keys() - local.keys()) if self.delete else []
+        return uploads, deletes
+
+    def plan_pull(self, local):
+        downloads = [name for name in self.remote
+                     if name not in local or self._differs(name, local[name],
+                                                           lambda remote: remote['mtime'] > local[name][2] / 1e9)]
+        deletes = sorted(local.keys() - self.remote.keys()) if self.delete else []
+        return downloads, deletes
+
+    # --- Transfers (run on the pool, one keep-alive connection per thread) ---
+
+    def upload(self, name, relpath):
+        path = os.path.join(self.root, relpath)
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            remote = self.remote.get(name)
+            if remote is not None and min(remote['size'], st.st_size) >= self.delta_min_size:
+                result = self._upload_delta(name, f, st)
+                if result is not None:
+                    return result
+                f.seek(0)
+            body = f.read(st.st_size) if st.st_size <= SMALL_FILE_SIZE else _Limited(f, st.st_size)
+            response = self.http.request('PUT', f'/stream_upload/{quote(name)}', body=body,
+                                         headers={'Content-Length': str(st.st_size)})
+            data = response.read()
+            if response.status != 200:
+                raise SyncError(f'upload of {relpath} failed: HTTP {response.status} {_error_text(data)}')
+        summary = json.loads(data)['files'][0]
+        self.hashes.put(relpath, st.st_size, st.st_mtime_ns, summary['sha256'])
+        return {'bytes': st.st_size, 'sent': st.st_size, 'sha256': summary['sha256'], 'size': st.st_size}
+
+    def _upload_delta(self, name, f, st):
+        """
+        Sends f as a delta against the server's version. Returns None if the
+        server's version changed meanwhile (then the file goes up in full).
+        """
+        response = self.http.request('GET', f'/signatures/{quote(name)}')
+        signatures = response.read()
+        if response.status != 200:
+            return None
+        block_size = int(response.getheader('X-Block-Size'))
+        base_size = int(response.getheader('X-File-Size'))
+        sent = 0
+
+        def body():
+            nonlocal sent
+            for chunk in delta.encode(_Limited(f, st.st_size), signatures, block_size, base_size):
+                sent += len(chunk)
+                yield chunk
+
+        response = self.http.request('POST', f'/delta/{quote(name)}', body=body(), encode_chunked=True, headers={
+            'If-Match': response.getheader('ETag'), 'X-Block-Size': str(block_size),
+            'X-File-Size': str(st.st_size), 'Transfer-Encoding': 'chunked'})
+        data = response.read()
+        if response.status == 412:
+            return None
+        if response.status != 200:
+            raise SyncError(f'delta upload of {name} failed: HTTP {response.status} {_error_text(data)}')
+        summary = json.loads(data)
+        sha256 = summary['files'][0]['sha256']
+        return {'bytes': st.st_size, 'sent': sent, 'sha256': sha256, 'size': st.st_size}
+
+    def download(self, name):
+        if not is_server_name(name):
+            raise SyncError(f'refusing to download {name!r}: not a valid file name')
+        path = os.path.join(self.root, name)
+        tmp_path = path + TEMP_SUFFIX
+        response = self.http.request('GET', f'/download/{quote(name)}')
+        if response.status != 200:
+            data = response.read()
+            raise SyncError(f'download of {name} failed: HTTP {response.status} {_error_text(data)}')
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    block = response.read(READ_SIZE)
+                    if not block:
+                        break
+                    f.write(block)
+                    digest.update(block)
+                    size += len(block)
+            expected = self.remote.get(name, {}).get('sha256')
+            if expected is not None and digest.hexdigest() != expected:
+                raise SyncError(f'download of {name} does not match the manifest (changed meanwhile?)')
+            mtime_ns = int(self.remote[name]['mtime'] * 1e9) if name in self.remote else time.time_ns()
+            os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        st = os.stat(path)
+        self.hashes.put(name, st.st_size, st.st_mtime_ns, digest.hexdigest())
+        return {'bytes': size, 'sent': size}
+
+    def _run(self, jobs, work):
+        """
+        Runs work(*job) for every job on the pool. Returns (results, errors),
+        both keyed by the jobs' first item.
+        """
+        futures = [(job, self.pool.submit(work, *job)) for job in jobs]
+        results, errors = [], []
+        for job, future in futures:
+            try:
+                result = future.result()
+            except (OSError, http.client.HTTPException, SyncError, ValueError, KeyError) as e:
+                errors.append(job[0])
+                print(f'error: {job[0]}: {e}', file=sys.stderr)
+                continue
+            results.append((job[0], result))
+            if self.verbose:
+                print(f"{job[0]}  {result['bytes']} bytes" + (
+                    f" ({result['sent']} sent)" if result['sent'] != result['bytes'] else ''))
+        return results, errors
+
+    # --- Runs ---
+
+    def push(self):
+        """
+        One push: uploads new and changed files (and deletes the server's files
+        missing locally, with delete=True). Returns the run's statistics.
+        """
+        started = time.perf_counter()
+        self.refresh_manifest()
+        local = self._local_files(recursive=True)
+        uploads, deletes = self.plan_push(local)
+        uploads.sort(key=lambda name: -local[name][1])
+        results, errors = [], []
+        if not self.dry_run:
+            results, errors = self._run([(name, local[name][0]) for name in uploads], self.upload)
+            for name, result in results:
+                # Until the next manifest says otherwise, the server has what was sent
+                self.remote[name] = {'name': name, 'size': result['size'], 'mtime': time.time(),
+                                     'sha256': result['sha256']}
+            if deletes:
+                self._delete_remote(deletes)
+        self.hashes.save({entry[0] for entry in local.values()})
+        return self._stats('push', uploads, deletes, results, errors, started)
+
+    def pull(self):
+        """
+        One pull: downloads new and changed files into the top level of the
+        folder (and deletes local files missing on the server, with delete=True).
+        """
+        started = time.perf_counter()
+        self.refresh_manifest()
+        local = self._local_files(recursive=False)
+        downloads, deletes = self.plan_pull(local)
+        downloads.sort(key=lambda name: -self.remote[name]['size'])
+        results, errors = [], []
+        if not self.dry_run:
+            results, errors = self._run([(name,) for name in downloads], self.download)
+            for name in deletes:
+                os.remove(os.path.join(self.root, local[name][0]))
+        self.hashes.save(set(self.remote) | {entry[0] for name, entry in local.items() if name not in deletes})
+        return self._stats('pull', downloads, deletes, results, errors, started)
+
+    def _delete_remote(self, names):
+        for i in range(0, len(names), DELETE_BATCH):
+            self.http.json('POST', '/delete_batch', {'names': names[i:i + DELETE_BATCH]}, expect=(202,))
+            for name in names[i:i + DELETE_BATCH]:
+                self.remote.pop(name, None)
+
+    def _stats(self, direction, planned, deletes, results, errors, started):
+        seconds = time.perf_counter() - started
+        total = sum(result['bytes'] for _, result in results)
+        sent = sum(result['sent'] for _, result in results)
+        return {
+            'direction': direction,
+            'planned': len(planned),
+            'files': len(results),
+            'bytes': total,
+            'bytes_sent': sent,
+            'deleted': len(deletes),
+            'errors': len(errors),
+            'seconds': round(seconds, 3),
+            'mb_per_s': round(sent / (1024 * 1024) / seconds, 2) if seconds > 0 else None,
+            'files_per_s': round(len(results) / seconds, 1) if seconds > 0 else None,
+        }
+
+    def watch(self, direction, interval):
+        """
+        Syncs every `interval` seconds until interrupted, reporting runs that did something.
+        """
+        run = self.push if direction == 'push' else self.pull
+        while True:
+            try:
+                stats = run()
+            except (OSError, http.client.HTTPException, SyncError, ValueError) as e:
+                print(f'error: {e}', file=sys.stderr)
+                self.http.close()
+            else:
+                if stats['planned'] or stats['deleted'] or stats['errors']:
+                    print(format_stats(stats, self.dry_run), flush=True)
+            time.sleep(interval)
+
+
+def format_stats(stats, dry_run=False):
+    if dry_run:
+        return f"{stats['direction']}: would transfer {stats['planned']} files and delete {stats['deleted']}"
+    line = (f"{stats['direction']}: {stats['files']} files ({stats['bytes'] / (1024 * 1024):.1f} MB, "
+            f"{stats['bytes_sent'] / (1024 * 1024):.1f} MB transferred) in {stats['seconds']}s, "
+            f"{stats['mb_per_s']} MB/s, {stats['files_per_s']} files/s")
+    if stats['deleted']:
+        line += f", {stats['deleted']} deleted"
+    if stats['errors']:
+        line += f", {stats['errors']} errors"
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('direction', choices=('push', 'pull'), help='push: folder to server, pull: server to folder')
+    parser.add_argument('folder')
+    parser.add_argument('url', help='server URL, e.g. http://192.168.1.10:5000')
+    parser.add_argument('--connections', type=int, default=8, help='parallel keep-alive connections (default 8)')
+    parser.add_argument('--delete', action='store_true',
+                        help='also delete files missing on the other side')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be transferred')
+    parser.add_argument('--watch', action='store_true', help='keep syncing until interrupted')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between syncs with --watch')
+    parser.add_argument('--delta-min-size', type=int, default=DELTA_MIN_SIZE,
+                        help='send changed files at least this large as deltas (bytes)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='list every file transferred')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        if args.direction == 'push':
+            parser.error(f'{args.folder} is not a folder')
+        os.makedirs(args.folder)
+    client = SyncClient(args.url, args.folder, connections=args.connections, delete=args.delete,
+                        dry_run=args.dry_run, verbose=args.verbose, delta_min_size=args.delta_min_size)
+    try:
+        if args.watch:
+            client.watch(args.direction, args.interval)
+        stats = client.push() if args.direction == 'push' else client.pull()
+    except KeyboardInterrupt:
+        return 130
+    except (OSError, http.client.HTTPException, SyncError) as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    finally:
+        client.close()
+    print(format_stats(stats, args.dry_run))
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+# main.py reads its folders from the environment when it is imported
+os.environ['UPLOAD_FOLDER'] = tempfile.mkdtemp(prefix='mkcloud-test-')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aioserver  # noqa: E402
+import main  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    return main
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+@pytest.fixture
+def serve():
+    """
+    Starts an aioserver.Server for main.app on a free port in a background
+    event loop: serve(**options) returns (port, server).
+    """
+    started = []
+
+    def start(**options):
+        server = aioserver.Server(main.app, **options)
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        listener = asyncio.run_coroutine_threadsafe(asyncio.start_server(
+            server.handle_connection, '127.0.0.1', 0, limit=aioserver.MAX_HEADER_BYTES), loop).result(5)
+        started.append((loop, thread, listener, server))
+        return listener.sockets[0].getsockname()[1], server
+
+    async def stop(listener, server):
+        listener.close()
+        await server.close_connections(grace=1)
+        await listener.wait_closed()
+
+    yield start
+    for loop, thread, listener, server in started:
+        asyncio.run_coroutine_threadsafe(stop(listener, server), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        loop.close()
+        server.shutdown()
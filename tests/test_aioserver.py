@@ -0,0 +1,111 @@
+import asyncio
+import http.client
+import os
+import time
+
+import aioserver
+
+
+def test_empty_file_download_keeps_the_connection(app, client, serve):
+    assert client.put('/stream_upload/empty.txt', data=b'').status_code == 200
+    port, _ = serve()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    for _ in range(2):  # The second request reuses the keep-alive connection
+        conn.request('GET', '/download/empty.txt')
+        response = conn.getresponse()
+        assert response.status == 200
+        assert response.getheader('Content-Length') == '0'
+        assert response.read() == b''
+        assert not response.will_close
+    conn.close()
+
+
+def _upload(conn, method, path, body, headers=None):
+    conn.request(method, path, body=body, headers=headers or {}, encode_chunked='Transfer-Encoding' in (headers or {}))
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def test_large_bodies_stream_to_the_app(app, serve):
+    port, server = serve(body_memory_max=64 * 1024)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    data = os.urandom(3 * 1024 * 1024 + 17)
+
+    status, _ = _upload(conn, 'PUT', '/stream_upload/streamed.bin', data)
+    assert status == 200
+
+    def chunks():
+        for offset in range(0, len(data), 100000):
+            yield data[offset:offset + 100000]
+
+    status, _ = _upload(conn, 'PUT', '/stream_upload/chunked.bin', chunks(), {'Transfer-Encoding': 'chunked'})
+    assert status == 200
+
+    boundary = 'testboundary'
+    form = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="form.bin"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    status, _ = _upload(conn, 'POST', '/stream_upload', form,
+                        {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    assert status == 200
+
+    for name in ('streamed.bin', 'chunked.bin', 'form.bin'):
+        with open(app.storage.locate(name), 'rb') as f:
+            assert f.read() == data, name
+    assert not os.path.exists(os.path.join(app.app.config['STATE_FOLDER'], 'spool'))
+
+
+def test_unread_body_is_skipped_on_a_kept_connection(serve):
+    port, _ = serve(body_memory_max=1024)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    status, _ = _upload(conn, 'POST', '/no-such-route', os.urandom(200 * 1024))
+    assert status in (404, 405)
+    status, body = _upload(conn, 'GET', '/manifest', None)
+    assert status == 200 and b'"version"' in body
+
+
+async def _stop_during_download(app, grace):
+    """
+    Starts a paced 1 MB download and an idle connection, then stops the server.
+    Returns (download bytes received, seconds the stop took, whether new connections were refused).
+    """
+    server = aioserver.Server(app.app, scheduler=aioserver.BandwidthScheduler(client_rate=2 * 1024 * 1024))
+    listener = await asyncio.start_server(server.handle_connection, '127.0.0.1', 0,
+                                          limit=aioserver.MAX_HEADER_BYTES)
+    port = listener.sockets[0].getsockname()[1]
+    idle_reader, idle_writer = await asyncio.open_connection('127.0.0.1', port)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /download/graceful.bin HTTP/1.1\r\nHost: test\r\n\r\n')
+    head = await reader.readuntil(b'\r\n\r\n')
+    assert head.startswith(b'HTTP/1.1 200')
+    body = asyncio.ensure_future(reader.read())
+    started = time.monotonic()
+    try:
+        listener.close()
+        await server.close_connections(grace=grace)
+        stopped = time.monotonic() - started
+        assert await asyncio.wait_for(idle_reader.read(), 1) == b''  # Idle connections end at once
+        try:
+            await asyncio.open_connection('127.0.0.1', port)
+            refused = False
+        except ConnectionRefusedError:
+            refused = True
+        return len(await asyncio.wait_for(body, 5)), stopped, refused
+    finally:
+        idle_writer.close()
+        writer.close()
+        await listener.wait_closed()
+        server.shutdown()
+
+
+def test_stopping_lets_the_response_in_progress_finish(app, client):
+    assert client.put('/stream_upload/graceful.bin', data=os.urandom(1024 * 1024)).status_code == 200
+    received, stopped, refused = asyncio.run(_stop_during_download(app, grace=5))
+    assert received == 1024 * 1024
+    assert refused and stopped < 5
+
+
+def test_stopping_cuts_responses_off_after_the_grace_period(app, client):
+    assert client.put('/stream_upload/graceful.bin', data=os.urandom(1024 * 1024)).status_code == 200
+    received, stopped, refused = asyncio.run(_stop_during_download(app, grace=0.1))
+    assert received < 1024 * 1024
+    assert refused and stopped < 1
@@ -0,0 +1,36 @@
+import gzip
+import re
+
+
+def test_page_links_versioned_assets(app, client):
+    page = client.get('/')
+    assert page.status_code == 200 and page.mimetype == 'text/html'
+    for name in ('app.css', 'app.js'):
+        url = app.asset_url(name)
+        assert url.encode() in page.data
+        asset = client.get(url)
+        assert asset.status_code == 200
+        assert asset.data == app.STATIC_ASSETS[name].body
+        assert 'immutable' in asset.headers['Cache-Control']
+        plain = client.get(f'/assets/{name}')
+        assert plain.data == asset.data and plain.headers['Cache-Control'] == 'no-cache'
+    assert re.fullmatch(r'/assets/app\.[0-9a-f]{16}\.css', app.asset_url('app.css'))
+    assert client.get('/assets/app.0000000000000000.css').status_code == 404
+
+
+def test_page_revalidates_with_a_304(client):
+    page = client.get('/')
+    assert page.headers['Cache-Control'] == 'no-cache'
+    again = client.get('/', headers={'If-None-Match': page.headers['ETag']})
+    assert again.status_code == 304 and again.data == b''
+
+
+def test_precompressed_variants_have_their_own_etag(client):
+    plain = client.get('/')
+    compressed = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert gzip.decompress(compressed.data) == plain.data
+    assert compressed.headers['ETag'] != plain.headers['ETag']
+    # The plain ETag doesn't validate the gzip variant
+    assert client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': plain.headers['ETag']}).status_code == 200
@@ -0,0 +1,62 @@
+import http.client
+import os
+import threading
+import time
+
+import aioserver
+
+RATE = 4 * 1024 * 1024
+BURST = max(256 * 1024, RATE * aioserver.TRANSFER_BURST)
+
+
+def _download(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    assert response.status == 200
+    return len(body)
+
+
+def test_concurrent_streams_of_one_client_stay_under_its_limit(client, serve):
+    assert client.put('/stream_upload/limited.bin', data=os.urandom(2 * 1024 * 1024)).status_code == 200
+    port, _ = serve(scheduler=aioserver.BandwidthScheduler(client_rate=RATE))
+    sizes = []
+    threads = [threading.Thread(target=lambda: sizes.append(_download(port, '/download/limited.bin')))
+               for _ in range(2)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    assert sizes == [2 * 1024 * 1024] * 2
+    assert elapsed >= 0.9 * (sum(sizes) - BURST) / RATE
+
+
+def test_small_responses_on_new_connections_count_against_the_limit(client, serve):
+    assert client.put('/stream_upload/small.bin', data=os.urandom(200 * 1024)).status_code == 200
+    port, _ = serve(scheduler=aioserver.BandwidthScheduler(client_rate=RATE))
+    started = time.monotonic()
+    total = sum(_download(port, '/download/small.bin') for _ in range(16))
+    elapsed = time.monotonic() - started
+    assert elapsed >= 0.9 * (total - BURST) / RATE
+
+
+def test_workers_split_a_clients_limit_by_their_streams(app, tmp_path):
+    path = str(tmp_path / 'transfers.db')
+    first = app.TransferShares(path, pid=1)
+    second = app.TransferShares(path, pid=2)
+    assert first.exchange({'10.0.0.1': 1}) == {'10.0.0.1': 1.0}
+    assert second.exchange({'10.0.0.1': 3}) == {'10.0.0.1': 0.75}
+    assert first.exchange({'10.0.0.1': 1}) == {'10.0.0.1': 0.25}
+    assert first.exchange({}) == {'10.0.0.1': 0.25}  # No stream here yet: keep room for one
+
+    scheduler = aioserver.BandwidthScheduler(client_rate=RATE)
+    stream = scheduler.open({'REMOTE_ADDR': '10.0.0.1'}, 10 * 1024 * 1024)
+    scheduler.set_client_shares({'10.0.0.1': 0.25})
+    assert stream.bucket.rate == RATE / 4
+    assert scheduler.client_streams() == {'10.0.0.1': 1}
+    scheduler.close(stream)
+    assert scheduler.client_streams() == {}
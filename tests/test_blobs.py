@@ -0,0 +1,89 @@
+import errno
+import os
+import time
+
+import pytest
+
+
+def test_linked_file_without_blob_is_looked_up_once(app, client, monkeypatch, tmp_path):
+    client.get('/manifest')
+    path = app.storage.target('hardlinked.txt')
+    with open(path, 'wb') as f:
+        f.write(b'linked outside the server')
+    os.link(path, tmp_path / 'other-name')
+    store = app.blob_store
+    scans = []
+    load = store._load
+
+    def counting_load():
+        if store._inodes is None:
+            scans.append(path)
+        load()
+
+    monkeypatch.setattr(store, '_load', counting_load)
+    for _ in range(3):
+        assert store.digest_of(path) is None
+    assert len(scans) == 1
+
+    os.link(path, tmp_path / 'third-name')  # New links: maybe a blob now
+    assert store.digest_of(path) is None
+    assert len(scans) == 2
+
+
+def test_duplicate_upload_shows_its_own_upload_time(app, client):
+    data = os.urandom(1000)
+    assert client.put('/stream_upload/original.bin', data=data).status_code == 200
+    original = app.storage.locate('original.bin')
+    os.utime(original, (1_000_000_000, 1_000_000_000))
+    before = time.time()
+    assert client.put('/stream_upload/duplicate.bin', data=data).status_code == 200
+    duplicate = app.storage.locate('duplicate.bin')
+    assert os.path.samefile(original, duplicate)
+    assert os.stat(duplicate).st_mtime >= before - 1
+
+
+def _failing_link(monkeypatch, error, times=None):
+    link = os.link
+    calls = []
+
+    def failing(src, dst, *args, **kwargs):
+        calls.append(dst)
+        if times is None or len(calls) <= times:
+            raise OSError(error, os.strerror(error))
+        return link(src, dst, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'link', failing)
+
+
+def _upload_path(app, name):
+    path = app.storage.target(name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(100))
+    return path
+
+
+@pytest.mark.parametrize('error', [errno.EMLINK, errno.ENOENT, errno.EIO])
+def test_other_link_errors_skip_only_that_file(app, client, monkeypatch, error):
+    client.get('/manifest')
+    _failing_link(monkeypatch, error)
+    path = _upload_path(app, 'unlinkable.bin')
+    assert app.blob_store.adopt(path, app.hash_file(path)) is False
+    assert app.blob_store.enabled()
+
+
+def test_one_file_that_cannot_be_linked_keeps_dedup(app, client, monkeypatch):
+    client.get('/manifest')
+    _failing_link(monkeypatch, errno.EPERM, times=1)  # The probe's link works
+    path = _upload_path(app, 'protected.bin')
+    assert app.blob_store.adopt(path, app.hash_file(path)) is False
+    assert app.blob_store.enabled()
+
+
+def test_filesystem_without_links_disables_dedup(app, client, monkeypatch):
+    client.get('/manifest')
+    monkeypatch.setattr(app.blob_store, '_links_unsupported', False)
+    _failing_link(monkeypatch, errno.EPERM)
+    path = _upload_path(app, 'fat.bin')
+    assert app.blob_store.adopt(path, app.hash_file(path)) is False
+    assert not app.blob_store.enabled()
+    assert [name for name in os.listdir(os.path.dirname(path)) if name.endswith('.probe')] == []
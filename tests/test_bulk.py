@@ -0,0 +1,71 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+
+@pytest.mark.parametrize('route', ['/bulk_download', '/delete_batch'])
+@pytest.mark.parametrize('body', [
+    ['a.txt'],
+    {'names': 'abc'},
+    {'names': ['a.txt', 7]},
+    {'prefix': 3},
+    {'q': ['a']},
+])
+def test_malformed_selection_is_rejected(client, route, body):
+    for name in ('a', 'b', 'c', 'a.txt'):
+        assert client.put(f'/stream_upload/{name}', data=b'keep me').status_code == 200
+    response = client.post(route, json=body)
+    assert response.status_code == 400
+    assert client.get('/download/a').data == b'keep me'
+
+
+def _upload_archive_files(client):
+    files = {'archive-a.txt': b'hello ' * 1000, 'archive-b.jpg': os.urandom(70000), 'archive-c.bin': b''}
+    for name, data in files.items():
+        assert client.put(f'/stream_upload/{name}', data=data).status_code == 200
+    return files
+
+
+@pytest.mark.parametrize('compress', ['0', '1'])
+def test_zip_archive_holds_the_selected_files(client, compress):
+    files = _upload_archive_files(client)
+    response = client.post(f'/bulk_download?compress={compress}',
+                           json={'names': ['archive-b.jpg', 'archive-a.txt', 'archive-c.bin', 'archive-a.txt',
+                                           'missing.txt']})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    assert 'Content-Length' not in response.headers
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+        assert zf.namelist() == ['archive-b.jpg', 'archive-a.txt', 'archive-c.bin']
+        for name in zf.namelist():
+            assert zf.read(name) == files[name]
+        types = {info.filename: info.compress_type for info in zf.infolist()}
+    assert types['archive-b.jpg'] == zipfile.ZIP_STORED  # Already compressed formats are stored
+    assert types['archive-a.txt'] == (zipfile.ZIP_DEFLATED if compress == '1' else zipfile.ZIP_STORED)
+
+
+@pytest.mark.parametrize('compress, mode', [('0', 'r:'), ('1', 'r:gz')])
+def test_tar_archive_holds_the_selected_files(client, compress, mode):
+    files = _upload_archive_files(client)
+    response = client.get('/bulk_download', query_string={'format': 'tar', 'compress': compress, 'prefix': 'archive-'})
+    assert response.status_code == 200
+    assert response.mimetype == ('application/gzip' if compress == '1' else 'application/x-tar')
+    if compress == '0':
+        assert len(response.data) % tarfile.RECORDSIZE == 0
+    with tarfile.open(fileobj=io.BytesIO(response.data), mode=mode) as tf:
+        members = tf.getmembers()
+        assert sorted(member.name for member in members) == sorted(files)
+        for member in members:
+            assert tf.extractfile(member).read() == files[member.name]
+
+
+def test_archive_limits(client, app, monkeypatch):
+    _upload_archive_files(client)
+    assert client.get('/bulk_download?format=rar&name=archive-a.txt').status_code == 400
+    assert client.get('/bulk_download').status_code == 400
+    monkeypatch.setitem(app.app.config, 'BULK_MAX_FILES', 2)
+    assert client.get('/bulk_download?prefix=archive-').status_code == 400
+    assert client.get('/bulk_download?name=archive-a.txt&name=archive-c.bin').status_code == 200
@@ -0,0 +1,94 @@
+import hashlib
+
+import pytest
+
+GB = 1024 ** 3
+ROWS = {  # name -> (size, mtime in seconds)
+    'a-photo.jpg': (3000, 1000),
+    'b-movie.mp4': (5 * GB, 2000),
+    'c-notes.txt': (10, 3000),
+    'd-report.pdf': (700, 4000),
+    'e-backup.tar': (700, 5000),
+    'f-unknown.xyz': (1, 6000),
+}
+
+
+@pytest.fixture
+def catalog(app, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.app.config, 'STATE_FOLDER', str(tmp_path))
+    catalog = app.Catalog()
+    catalog.apply({name: (size, int(mtime * 1e9)) for name, (size, mtime) in ROWS.items()}, complete=True)
+    return catalog
+
+
+def _names(records):
+    return [record['name'] for record in records]
+
+
+def _pages(catalog, limit=2, **filters):
+    names, cursor = [], None
+    while True:
+        records, cursor, total = catalog.query(limit=limit, cursor=cursor, **filters)
+        names += _names(records)
+        if cursor is None:
+            return names, total
+
+
+def test_filters(catalog):
+    assert _names(catalog.query(types=['image', 'video'])[0]) == ['a-photo.jpg', 'b-movie.mp4']
+    assert _names(catalog.query(types=['other'])[0]) == ['f-unknown.xyz']
+    assert _names(catalog.query(min_size=700, max_size=3000)[0]) == ['a-photo.jpg', 'd-report.pdf', 'e-backup.tar']
+    assert _names(catalog.query(since=2000, until=4000)[0]) == ['b-movie.mp4', 'c-notes.txt']
+    assert _names(catalog.query(prefix='d-')[0]) == ['d-report.pdf']
+    assert catalog.query(types=['document', 'archive'], min_size=700)[2] == 2
+
+
+def test_every_sort_order_pages_through_everything_once(catalog):
+    by_size = sorted(ROWS, key=lambda name: (ROWS[name][0], name))
+    assert _pages(catalog, sort='size') == (by_size, len(ROWS))
+    assert _pages(catalog, sort='size', descending=True)[0] == by_size[::-1]
+    assert _pages(catalog, sort='mtime', descending=True)[0] == sorted(ROWS, key=lambda n: -ROWS[n][1])
+    assert _pages(catalog, sort='name', limit=4)[0] == sorted(ROWS)
+    assert _pages(catalog, types=['document', 'archive'], sort='size', limit=1) == (['d-report.pdf',
+                                                                                      'e-backup.tar'], 2)
+
+
+def test_download_counts_and_hashes(catalog):
+    for _ in range(3):
+        catalog.count_download('c-notes.txt')
+    catalog.count_download('a-photo.jpg')
+    catalog.flush()
+    assert _names(catalog.query(sort='downloads', descending=True, limit=2)[0]) == ['c-notes.txt', 'a-photo.jpg']
+    assert catalog.get('c-notes.txt')['downloads'] == 3
+
+    digest = 'ab' * 32
+    size, mtime = ROWS['c-notes.txt']
+    assert catalog.unhashed(limit=100) and ('c-notes.txt', size, int(mtime * 1e9)) in catalog.unhashed()
+    catalog.set_hash('c-notes.txt', size, int(mtime * 1e9) + 1, digest)  # Changed since it was read
+    assert catalog.get('c-notes.txt')['sha256'] is None
+    catalog.set_hash('c-notes.txt', size, int(mtime * 1e9), digest)
+    assert _names(catalog.query(sha256=digest)[0]) == ['c-notes.txt']
+    # A new version loses the hash but keeps its download count
+    catalog.apply({'c-notes.txt': (11, int(mtime * 1e9))})
+    assert catalog.get('c-notes.txt')['sha256'] is None
+    assert catalog.get('c-notes.txt')['downloads'] == 3
+    catalog.apply({'c-notes.txt': None})
+    assert catalog.get('c-notes.txt') is None
+
+
+def test_uploads_are_recorded_with_their_hash_and_uploader(client):
+    data = b'catalogued'
+    assert client.put('/stream_upload/catalogued.txt', data=data).status_code == 200
+    record = client.get('/catalog/catalogued.txt').get_json()
+    assert record['sha256'] == hashlib.sha256(data).hexdigest()
+    assert record['size'] == len(data) and record['type'] == 'text'
+    assert record['uploader_ip'] == '127.0.0.1'
+    page = client.get('/catalog', query_string={'type': 'text', 'prefix': 'catalogued'}).get_json()
+    assert _names(page['files']) == ['catalogued.txt'] and page['total'] == 1
+    assert client.get('/catalog/not-there.txt').status_code == 404
+
+
+@pytest.mark.parametrize('query', ['type=spreadsheet', 'sort=owner', 'sha256=ABC', 'min_size=big', 'limit=x',
+                                   'cursor=%%%'])
+def test_bad_queries(client, query):
+    assert client.get(f'/catalog?{query}').status_code == 400
@@ -0,0 +1,92 @@
+import hashlib
+import io
+import os
+import threading
+
+CHUNK = 64 * 1024
+
+
+def _create(client, size, chunk_size):
+    response = client.post('/uploads', json={'filename': 'chunked.bin', 'size': size, 'chunk_size': chunk_size})
+    assert response.status_code == 201
+    return response.get_json()['upload_id']
+
+
+def test_parallel_chunks_all_arrive(app, client):
+    data = os.urandom(8 * CHUNK)
+    upload_id = _create(client, len(data), CHUNK)
+    responses = {}
+
+    def put(index):
+        responses[index] = app.app.test_client().put(f'/uploads/{upload_id}/chunks/{index}',
+                                                    data=data[index * CHUNK:(index + 1) * CHUNK])
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for index, response in responses.items():
+        assert response.status_code == 200
+        assert index not in response.get_json()['missing_chunks']
+    assert client.get(f'/uploads/{upload_id}').get_json()['missing_chunks'] == []
+    assert client.post(f'/uploads/{upload_id}/complete').status_code == 200
+    with open(app.storage.locate('chunked.bin'), 'rb') as f:
+        assert f.read() == data
+
+
+def test_status_waits_for_the_session_lock(app, client):
+    upload_id = _create(client, 2 * CHUNK, CHUNK)
+    session = app._load_session(upload_id)
+    responses = []
+    with session['lock']:
+        reader = threading.Thread(target=lambda: responses.append(app.app.test_client().get(f'/uploads/{upload_id}')))
+        reader.start()
+        reader.join(0.2)
+        assert reader.is_alive()  # Blocked while a writer holds the session
+        session['received'].append(0)
+        app._save_session(session)
+    reader.join(5)
+    assert responses[0].get_json()['missing_chunks'] == [1]
+
+
+def test_complete_waits_for_a_chunk_being_written(app, client):
+    data = os.urandom(2 * CHUNK)
+    upload_id = _create(client, len(data), CHUNK)
+    for index in range(2):
+        assert client.put(f'/uploads/{upload_id}/chunks/{index}',
+                          data=data[index * CHUNK:(index + 1) * CHUNK]).status_code == 200
+    resent = os.urandom(CHUNK)
+    halfway, release = threading.Event(), threading.Event()
+
+    class SlowBody(io.BytesIO):
+        def readinto(self, buffer):
+            if self.tell() >= CHUNK // 2:
+                halfway.set()
+                release.wait(5)
+            return super().readinto(memoryview(buffer)[:CHUNK // 2])
+
+        def read(self, size=-1):
+            buffer = bytearray(CHUNK if size < 0 else size)
+            return bytes(buffer[:self.readinto(buffer)])
+
+    responses = {}
+    writer = threading.Thread(target=lambda: responses.setdefault('put', app.app.test_client().put(
+        f'/uploads/{upload_id}/chunks/0', input_stream=SlowBody(resent), content_length=CHUNK)))
+    writer.start()
+    assert halfway.wait(5)
+    completer = threading.Thread(target=lambda: responses.setdefault('complete', app.app.test_client().post(
+        f'/uploads/{upload_id}/complete')))
+    completer.start()
+    completer.join(0.3)
+    assert completer.is_alive()  # Waits for the chunk being written
+    release.set()
+    writer.join(5)
+    completer.join(5)
+    assert responses['put'].status_code == 200
+    assert responses['complete'].status_code == 200
+    final = resent + data[CHUNK:]
+    assert responses['complete'].get_json()['sha256'] == hashlib.sha256(final).hexdigest()
+    with open(app.storage.locate('chunked.bin'), 'rb') as f:
+        assert f.read() == final
+    assert client.put(f'/uploads/{upload_id}/chunks/0', data=resent).status_code == 404
@@ -0,0 +1,14 @@
+import os
+
+
+def test_incompressible_decisions_are_bounded(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'COMPRESS_INCOMPRESSIBLE_MAX', 2)
+    cache = app.CompressionCache()
+    identities = []
+    for i in range(3):
+        path = tmp_path / f'random-{i}.dat'
+        path.write_bytes(os.urandom(8 * 1024))
+        st = os.stat(path)
+        identities.append(cache.identity(str(path), st))
+        assert not cache._worth_compressing(str(path), st, identities[-1])
+    assert list(cache.incompressible) == identities[1:]
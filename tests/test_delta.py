@@ -0,0 +1,102 @@
+import hashlib
+import io
+import os
+import random
+
+import pytest
+
+import delta
+
+BLOCK = delta.MIN_BLOCK_SIZE
+
+
+def _encode(base, new, block_size=BLOCK):
+    signatures = b''.join(delta.signatures(io.BytesIO(base), block_size))
+    return b''.join(delta.encode(io.BytesIO(new), signatures, block_size, len(base)))
+
+
+def _round_trip(base, new, block_size=BLOCK):
+    """
+    Encodes new against base and applies it; returns (copied, literal bytes).
+    """
+    data = _encode(base, new, block_size)
+    out = bytearray()
+    copied, literal, digest = delta.apply(io.BytesIO(data).read, io.BytesIO(base), block_size, len(base), out.extend)
+    assert bytes(out) == new
+    assert digest == hashlib.sha256(new).hexdigest()
+    assert copied + literal == len(new)
+    return copied, literal
+
+
+def test_unchanged_file_is_all_copies():
+    base = os.urandom(40 * BLOCK + 123)  # A short last block
+    assert _round_trip(base, base) == (len(base), 0)
+    assert len(_encode(base, base)) < 64
+
+
+def test_moved_and_changed_blocks():
+    rng = random.Random(1)
+    blocks = [rng.randbytes(BLOCK) for _ in range(30)]
+    tail = rng.randbytes(BLOCK // 3)
+    base = b''.join(blocks) + tail
+    # Blocks reordered, shifted by an insertion at an odd offset, one rewritten
+    changed = rng.randbytes(BLOCK)
+    new = b'xyz' + b''.join(blocks[10:20] + blocks[:10]) + changed + b''.join(blocks[21:]) + tail
+    copied, literal = _round_trip(base, new)
+    assert literal == 3 + len(changed)
+
+
+def test_short_tail_block_still_matches():
+    rng = random.Random(2)
+    base = rng.randbytes(10 * BLOCK + 100)
+    new = base[:BLOCK] + b'edited' + base[BLOCK + 6:]
+    copied, literal = _round_trip(base, new)
+    assert literal <= BLOCK  # Only the edited block; the 100-byte tail was copied
+    # The short block only matches at the end of the new version
+    assert _round_trip(base, base + b'appended')[1] == 100 + len(b'appended')
+
+
+@pytest.mark.parametrize('base, new', [(b'', b''), (b'', b'new file'), (b'old file', b''), (b'short', b'shorter')])
+def test_small_and_empty_files(base, new):
+    _round_trip(base, new)
+
+
+def test_large_literals_are_split():
+    new = os.urandom(delta.MAX_LITERAL + 10)
+    assert _round_trip(b'', new) == (0, len(new))
+
+
+@pytest.mark.parametrize('data, message', [
+    (b'C' + delta.COPY.pack(5, 1) + b'E' + bytes(32), 'outside the base'),
+    (b'C' + delta.COPY.pack(0, 0) + b'E' + bytes(32), 'outside the base'),
+    (b'L' + delta.LITERAL.pack(10) + b'abc', 'ends unexpectedly'),
+    (b'L' + delta.LITERAL.pack(delta.MAX_LITERAL + 1), 'exceeds'),
+    (b'E' + bytes(32) + b'more', 'after the end'),
+    (b'X', 'Unknown'),
+])
+def test_malformed_deltas(data, message):
+    base = os.urandom(2 * BLOCK)
+    with pytest.raises(delta.DeltaError, match=message):
+        delta.apply(io.BytesIO(data).read, io.BytesIO(base), BLOCK, len(base), lambda chunk: None)
+
+
+def test_delta_upload_to_the_server(client):
+    rng = random.Random(3)
+    base = rng.randbytes(50 * BLOCK + 7)
+    assert client.put('/stream_upload/delta.bin', data=base).status_code == 200
+    response = client.get('/signatures/delta.bin', query_string={'block_size': BLOCK})
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    new = base[:20 * BLOCK] + b'inserted' + base[20 * BLOCK:]
+    body = b''.join(delta.encode(io.BytesIO(new), response.data, BLOCK, len(base)))
+    headers = {'If-Match': etag, 'X-Block-Size': str(BLOCK), 'X-File-Size': str(len(new))}
+    assert client.post('/delta/delta.bin', data=body, headers=dict(headers, **{'If-Match': '"stale"'})).status_code == 412
+    assert client.post('/delta/delta.bin', data=body, headers={'X-Block-Size': str(BLOCK)}).status_code == 428
+    response = client.post('/delta/delta.bin', data=body, headers=headers)
+    assert response.status_code == 200
+    summary = response.get_json()
+    assert summary['literal_bytes'] == len(b'inserted')
+    assert summary['files'][0]['sha256'] == hashlib.sha256(new).hexdigest()
+    assert client.get('/download/delta.bin').data == new
+    # The old signatures no longer fit the new version
+    assert client.post('/delta/delta.bin', data=body, headers=headers).status_code == 412
@@ -0,0 +1,100 @@
+import http.client
+
+from werkzeug.http import http_date
+
+DATA = bytes(range(256)) * 40  # 10240 bytes
+
+
+def _upload(client, name='ranged.bin'):
+    assert client.put(f'/stream_upload/{name}', data=DATA).status_code == 200
+    return f'/download/{name}'
+
+
+def test_single_ranges(client):
+    url = _upload(client)
+    for header, start, end in [('bytes=0-99', 0, 100), ('bytes=10000-', 10000, len(DATA)),
+                               ('bytes=-40', len(DATA) - 40, len(DATA)), ('bytes=10200-99999', 10200, len(DATA))]:
+        response = client.get(url, headers={'Range': header})
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == f'bytes {start}-{end - 1}/{len(DATA)}'
+        assert response.data == DATA[start:end]
+
+
+def test_multiple_ranges_are_sent_as_multipart(client):
+    url = _upload(client)
+    response = client.get(url, headers={'Range': 'bytes=0-9,500-599,600-649'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    assert int(response.headers['Content-Length']) == len(response.data)
+    body = response.data
+    assert b'Content-Range: bytes 0-9/10240\r\n\r\n' + DATA[0:10] in body
+    # Adjacent ranges are merged into one part
+    assert b'Content-Range: bytes 500-649/10240\r\n\r\n' + DATA[500:650] in body
+    assert body.count(b'Content-Range') == 2
+    assert body.endswith(b'--' + response.mimetype_params['boundary'].encode() + b'--\r\n')
+
+
+def test_adjacent_ranges_make_a_single_part(client):
+    url = _upload(client)
+    response = client.get(url, headers={'Range': 'bytes=0-9,10-19'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 0-19/{len(DATA)}'
+    assert response.data == DATA[:20]
+
+
+def test_unsatisfiable_and_malformed_ranges(client):
+    url = _upload(client)
+    response = client.get(url, headers={'Range': 'bytes=20000-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(DATA)}'
+    response = client.get(url, headers={'Range': 'lines=1-2'})
+    assert response.status_code == 200 and response.data == DATA
+
+
+def test_if_range_only_allows_a_partial_response_for_the_current_version(client):
+    url = _upload(client)
+    current = client.head(url)
+    etag, modified = current.headers['ETag'], current.headers['Last-Modified']
+    for if_range, status in [(etag, 206), (modified, 206), ('"stale"', 200), (f'W/{etag}', 200),
+                             (http_date(0), 200)]:
+        response = client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': if_range})
+        assert response.status_code == status, if_range
+        assert response.data == (DATA[:10] if status == 206 else DATA)
+
+
+def test_conditional_get(client):
+    url = _upload(client)
+    current = client.get(url)
+    etag = current.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(url, headers={'If-None-Match': f'W/{etag}, "other"'}).status_code == 304
+    assert client.get(url, headers={'If-None-Match': '"other"'}).status_code == 200
+    assert client.get(url, headers={'If-Modified-Since': current.headers['Last-Modified']}).status_code == 304
+    assert client.get(url, headers={'If-Modified-Since': http_date(0)}).status_code == 200
+    # A new version gets a new validator
+    assert client.put('/stream_upload/ranged.bin', data=DATA[:-1]).status_code == 200
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_head_has_the_headers_without_the_body(client):
+    url = _upload(client)
+    response = client.head(url, headers={'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.headers['Content-Length'] == '10'
+    assert response.data == b''
+
+
+def test_ranges_through_the_server(client, serve):
+    url = _upload(client, 'served.bin')
+    port, _ = serve()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        for header, expected in [('bytes=100-199', DATA[100:200]), ('bytes=-1', DATA[-1:])]:
+            conn.request('GET', url, headers={'Range': header})
+            response = conn.getresponse()
+            assert response.status == 206
+            assert response.read() == expected  # Sent with sendfile() from the range start
+        conn.request('GET', url)
+        assert conn.getresponse().read() == DATA
+    finally:
+        conn.close()
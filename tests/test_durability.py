@@ -0,0 +1,105 @@
+import errno
+import io
+import os
+import threading
+
+import pytest
+
+
+def _incoming(app):
+    return os.listdir(app._incoming_folder())
+
+
+def test_listing_keeps_the_old_version_until_the_upload_is_complete(app, client):
+    assert client.put('/stream_upload/atomic.txt', data=b'old version').status_code == 200
+    halfway, release = threading.Event(), threading.Event()
+    new = os.urandom(256 * 1024)
+
+    class SlowBody(io.BytesIO):
+        def readinto(self, buffer):
+            if self.tell() >= len(new) // 2:
+                halfway.set()
+                release.wait(5)
+            return super().readinto(memoryview(buffer)[:len(new) // 2])
+
+        def read(self, size=-1):
+            buffer = bytearray(len(new) if size < 0 else size)
+            return bytes(buffer[:self.readinto(buffer)])
+
+    responses = []
+    uploader = threading.Thread(target=lambda: responses.append(app.app.test_client().put(
+        '/stream_upload/atomic.txt', input_stream=SlowBody(new), content_length=len(new))))
+    uploader.start()
+    try:
+        assert halfway.wait(5)
+        assert client.get('/download/atomic.txt').data == b'old version'
+        assert any(name.endswith('-atomic.txt') for name in _incoming(app))
+    finally:
+        release.set()
+        uploader.join(5)
+    assert responses[0].status_code == 200
+    assert client.get('/download/atomic.txt').data == new
+    assert not any(name.endswith('-atomic.txt') for name in _incoming(app))
+
+
+def test_failed_upload_leaves_the_old_version_and_no_temp_file(app, client):
+    assert client.put('/stream_upload/kept.txt', data=b'old version').status_code == 200
+
+    class BrokenBody(io.BytesIO):
+        def readinto(self, buffer):
+            if self.tell():
+                raise OSError(errno.ECONNRESET, 'client went away')
+            return super().readinto(memoryview(buffer)[:1000])
+
+        def read(self, size=-1):
+            buffer = bytearray(1000)
+            return bytes(buffer[:self.readinto(buffer)])
+
+    response = client.put('/stream_upload/kept.txt', input_stream=BrokenBody(b'x' * 200000), content_length=200000)
+    assert response.status_code == 400
+    assert client.get('/download/kept.txt').data == b'old version'
+    assert not any(name.endswith('-kept.txt') for name in _incoming(app))
+
+
+def test_preallocated_file_is_cut_to_what_arrived(app, client):
+    with app.app.test_request_context():
+        writer = app.UploadWriter('prealloc.bin', 1024 * 1024)
+        if not writer._preallocated:
+            writer.abort()
+            pytest.skip('no fallocate(2) here')
+        assert os.path.getsize(writer.tmp_path) == 1024 * 1024
+        writer.write(b'only this')
+        writer.close()
+    assert client.get('/download/prealloc.bin').data == b'only this'
+
+
+def test_full_disk_fails_the_upload_at_once(app, client, monkeypatch):
+    def no_space(fd, mode, offset, length):
+        return -1
+
+    monkeypatch.setattr(app, '_libc_function', lambda name: no_space if name == 'fallocate' else None)
+    monkeypatch.setattr(app.ctypes, 'get_errno', lambda: errno.ENOSPC)
+    response = client.put('/stream_upload/too-big.bin', data=b'x' * 1000)
+    assert response.status_code == 507
+    assert client.get('/download/too-big.bin').status_code == 404
+    assert not any(name.endswith('-too-big.bin') for name in _incoming(app))
+
+
+def test_batch_policy_shares_syncs_between_uploads(app, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'UPLOAD_FSYNC', 'batch')
+    monkeypatch.setitem(app.app.config, 'UPLOAD_FSYNC_BATCH_INTERVAL', 0.1)
+    syncs = []
+    monkeypatch.setattr(app.GroupCommitter, '_sync', staticmethod(lambda: syncs.append(1)))
+    monkeypatch.setattr(app, 'group_committer', app.GroupCommitter())
+    statuses = []
+
+    def upload(i):
+        statuses.append(app.app.test_client().put(f'/stream_upload/batched-{i}.txt', data=b'batched').status_code)
+
+    threads = [threading.Thread(target=upload, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert statuses == [200] * 8
+    assert 1 <= len(syncs) < 8
@@ -0,0 +1,82 @@
+import http.client
+import json
+
+
+def _events(chunks):
+    """
+    Yields (event, id, data) for every event of an SSE stream, skipping comments.
+    """
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk.decode() if isinstance(chunk, bytes) else chunk
+        while '\n\n' in buffer:
+            block, buffer = buffer.split('\n\n', 1)
+            fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':'))
+            if 'event' in fields:
+                yield fields['event'], int(fields['id']), json.loads(fields['data'])
+
+
+def test_stream_starts_with_a_reset_then_sends_deltas(app, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'EVENTS_KEEPALIVE', 0.1)
+    response = client.get('/events', buffered=False)
+    try:
+        events = _events(response.iter_encoded())
+        event, version, data = next(events)
+        assert event == 'reset' and data == {'version': version}
+
+        assert client.put('/stream_upload/event-added.txt', data=b'new').status_code == 200
+        event, version, data = next(events)
+        assert event == 'delta' and data['version'] == version
+        assert [record['name'] for record in data['added']] == ['event-added.txt']
+        assert data['added'][0]['size'] == 3
+
+        assert client.post('/delete/event-added.txt').status_code == 302  # Back to the page
+        event, _, data = next(events)
+        assert event == 'delta' and data['removed'] == ['event-added.txt'] and data['added'] == []
+    finally:
+        response.close()
+
+
+def test_reconnecting_client_only_gets_what_it_missed(app, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'EVENTS_KEEPALIVE', 0.1)
+    version = app.file_index.version
+    assert client.put('/stream_upload/missed-one.txt', data=b'1').status_code == 200
+    assert client.put('/stream_upload/missed-two.txt', data=b'2').status_code == 200
+    for headers, query in [({'Last-Event-ID': str(version)}, ''), ({}, f'?since={version}')]:
+        response = client.get(f'/events{query}', headers=headers, buffered=False)
+        try:
+            event, new_version, data = next(_events(response.iter_encoded()))
+        finally:
+            response.close()
+        assert event == 'delta' and new_version == app.file_index.version
+        assert [record['name'] for record in data['added']] == ['missed-one.txt', 'missed-two.txt']
+
+    response = client.get('/events', headers={'Last-Event-ID': 'garbage'}, buffered=False)
+    try:
+        assert next(_events(response.iter_encoded()))[0] == 'reset'
+    finally:
+        response.close()
+
+
+def test_stream_waits_on_the_event_loop_under_the_server(app, client, serve):
+    port, server = serve(app_workers=2)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request('GET', '/events')
+        response = conn.getresponse()
+        assert response.getheader('Content-Type').startswith('text/event-stream')
+        events = _events(iter(lambda: response.readline(), b''))
+        assert next(events)[0] == 'reset'
+        # Parked streams hold no app worker: two more requests still get served
+        for i in range(2):
+            other = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            other.request('PUT', f'/stream_upload/served-event-{i}.txt', body=b'x')
+            assert other.getresponse().status == 200
+            other.close()
+        names = []
+        while len(names) < 2:
+            event, _, data = next(events)
+            names += [record['name'] for record in data['added']]
+        assert names == ['served-event-0.txt', 'served-event-1.txt']
+    finally:
+        conn.close()
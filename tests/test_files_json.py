@@ -0,0 +1,64 @@
+import base64
+import json
+import time
+
+NAMES = ['page-c.txt', 'page-a.txt', 'page-e.txt', 'page-b.txt', 'page-d.txt']  # Upload order
+SIZES = {'page-a.txt': 30, 'page-b.txt': 10, 'page-c.txt': 50, 'page-d.txt': 20, 'page-e.txt': 40}
+
+
+def _upload_pages(client):
+    for name in NAMES:
+        assert client.put(f'/stream_upload/{name}', data=b'x' * SIZES[name]).status_code == 200
+
+
+def _all_pages(client, **params):
+    names, cursor, pages = [], None, 0
+    while True:
+        query = dict(params, prefix='page-', limit=2, **({'cursor': cursor} if cursor else {}))
+        response = client.get('/files_json', query_string=query)
+        assert response.status_code == 200
+        page = response.get_json()
+        assert page['total'] == len(NAMES) and len(page['files']) <= 2
+        names += [record['name'] for record in page['files']]
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            return names, pages
+
+
+def test_pages_cover_every_file_once_in_each_order(client):
+    _upload_pages(client)
+    assert _all_pages(client) == (sorted(NAMES), 3)
+    assert _all_pages(client, order='desc')[0] == sorted(NAMES, reverse=True)
+    assert _all_pages(client, sort='size')[0] == sorted(NAMES, key=SIZES.get)
+    assert _all_pages(client, sort='size', order='desc')[0] == sorted(NAMES, key=SIZES.get, reverse=True)
+    assert _all_pages(client, sort='mtime')[0] == NAMES
+
+
+def test_a_file_added_between_pages_does_not_shift_the_next_page(client):
+    _upload_pages(client)
+    first = client.get('/files_json', query_string={'prefix': 'page-', 'limit': 2}).get_json()
+    assert [r['name'] for r in first['files']] == ['page-a.txt', 'page-b.txt']
+    assert client.put('/stream_upload/page-0.txt', data=b'before the cursor').status_code == 200
+    second = client.get('/files_json', query_string={'prefix': 'page-', 'limit': 2,
+                                                     'cursor': first['next_cursor']}).get_json()
+    assert [r['name'] for r in second['files']] == ['page-c.txt', 'page-d.txt']
+    assert second['version'] > first['version']
+    assert client.post('/delete/page-0.txt').status_code == 302
+
+
+def test_records_and_filters(client):
+    _upload_pages(client)
+    page = client.get('/files_json', query_string={'q': 'age-b', 'limit': 10}).get_json()
+    assert [(r['name'], r['size']) for r in page['files']] == [('page-b.txt', 10)]
+    assert abs(page['files'][0]['mtime'] - time.time()) < 60
+    assert set(NAMES) <= set(client.get('/files_json').get_json())  # Plain list of names
+
+
+def test_bad_parameters(client):
+    assert client.get('/files_json?sort=owner').status_code == 400
+    assert client.get('/files_json?limit=many').status_code == 400
+    assert client.get('/files_json?cursor=%%%').status_code == 400
+    name_cursor = base64.urlsafe_b64encode(json.dumps('page-b.txt').encode()).decode().rstrip('=')
+    assert client.get(f'/files_json?sort=size&cursor={name_cursor}').status_code == 400
+    assert client.get('/files_json?limit=0').status_code == 200  # Clamped to one record
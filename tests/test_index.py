@@ -0,0 +1,52 @@
+import threading
+import time
+
+
+def _upload_during_scan(client, monkeypatch, index, name):
+    scan = index._scan
+
+    def slow_scan():
+        found = scan()
+        # Lands after the scan has passed its folder, before the scan is applied
+        assert client.put(f'/stream_upload/{name}', data=b'new').status_code == 200
+        index.refresh(name)  # Reported to this index, as the upload route or inotify would
+        return found
+
+    monkeypatch.setattr(index, '_scan', slow_scan)
+
+
+def test_rescan_keeps_files_uploaded_while_it_ran(app, client, monkeypatch):
+    client.get('/manifest')  # Starts the index
+    _upload_during_scan(client, monkeypatch, app.file_index, 'during-scan.txt')
+    app.file_index.reconcile()
+    assert 'during-scan.txt' in app.file_index.entries
+
+
+def test_shared_rescan_keeps_files_uploaded_while_it_ran(app, client, monkeypatch, tmp_path):
+    client.get('/manifest')
+    index = app.DirectoryIndex()
+    index.attach(app.IndexJournal(str(tmp_path / 'index.db')), app.app.config['UPLOAD_FOLDER'])
+    index.reconcile()
+    _upload_during_scan(client, monkeypatch, index, 'shared-during-scan.txt')
+    index.reconcile()
+    assert 'shared-during-scan.txt' in index.entries
+    assert 'shared-during-scan.txt' in index.journal.snapshot()[1]
+
+
+def test_lost_watch_switches_to_the_short_rescan_interval(app, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'INDEX_RECONCILE_INTERVAL', 0.01)
+
+    class Index:
+        rescans = 0
+
+        def reconcile(self):
+            self.rescans += 1
+
+    index = Index()
+    watch_lost = threading.Event()
+    threading.Thread(target=app._reconcile_periodically, args=(index, 300, watch_lost), daemon=True).start()
+    time.sleep(0.1)
+    assert index.rescans == 0
+    watch_lost.set()
+    time.sleep(0.2)
+    assert index.rescans > 2
@@ -0,0 +1,45 @@
+import http.client
+import logging
+import os
+import threading
+
+import aioserver
+
+
+def test_full_log_queue_drops_and_counts_records(app):
+    release = threading.Event()
+    written = []
+
+    class SlowTarget(logging.Handler):
+        def emit(self, record):
+            release.wait(5)
+            written.append(record.getMessage())
+
+    handler = app.AsyncLogHandler(SlowTarget(), maxsize=2)
+    for i in range(10):
+        handler.handle(logging.LogRecord('test', logging.INFO, __file__, 0, 'record %d', (i,), None))
+    assert handler.dropped >= 7  # The writer holds at most one, the queue two
+    release.set()
+    handler.close()
+    assert any('log records dropped' in message for message in written)
+    assert len(written) == 10 - handler.dropped + 1
+
+
+def test_access_log_duration_includes_sending_the_body(client, serve, caplog):
+    assert client.put('/stream_upload/timed.bin', data=os.urandom(1024 * 1024)).status_code == 200
+    rate = 2 * 1024 * 1024
+    port, _ = serve(scheduler=aioserver.BandwidthScheduler(client_rate=rate))
+    caplog.set_level(logging.INFO, logger='mkcloud')
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', '/download/timed.bin')
+    response = conn.getresponse()
+    assert len(response.read()) == 1024 * 1024
+    conn.close()
+    for _ in range(50):
+        records = [r for r in caplog.records if getattr(r, 'route', None) == '/download/<path:filename>']
+        if records:
+            break
+        threading.Event().wait(0.05)
+    sending = (1024 * 1024 - rate * aioserver.TRANSFER_BURST) / rate
+    assert records and records[0].duration_ms >= 0.9 * sending * 1000
+    assert records[0].request_id and records[0].client_ip == '127.0.0.1'
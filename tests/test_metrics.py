@@ -0,0 +1,77 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+
+
+def _value(text, series):
+    match = re.search(rf'^{re.escape(series)} (\S+)$', text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+def test_counts_from_every_thread_survive_the_thread(app):
+    metrics = app.Metrics()
+
+    def record():
+        for _ in range(1000):
+            metrics.inc('mkcloud_upload_bytes_total', 2)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counters, _ = metrics.snapshot()
+    assert counters[('mkcloud_upload_bytes_total', ())] == 8000
+    assert metrics.snapshot()[0][('mkcloud_upload_bytes_total', ())] == 8000  # Retired, not lost
+
+
+def test_histograms_render_cumulative_buckets(app):
+    metrics = app.Metrics()
+    for seconds in (0.002, 0.002, 0.3, 100):
+        metrics.observe('mkcloud_http_request_duration_seconds', seconds, route='/x')
+    text = app.render_metrics(*metrics.snapshot())
+    series = 'mkcloud_http_request_duration_seconds'
+    assert _value(text, f'{series}_bucket{{route="/x",le="0.001"}}') == 0
+    assert _value(text, f'{series}_bucket{{route="/x",le="0.005"}}') == 2
+    assert _value(text, f'{series}_bucket{{route="/x",le="0.5"}}') == 3
+    assert _value(text, f'{series}_bucket{{route="/x",le="+Inf"}}') == 4
+    assert _value(text, f'{series}_count{{route="/x"}}') == 4
+    assert abs(_value(text, f'{series}_sum{{route="/x"}}') - 100.304) < 1e-6
+    assert f'# TYPE {series} histogram' in text
+
+
+def test_endpoint_counts_requests_by_route_and_bytes(client):
+    before = client.get('/metrics').get_data(as_text=True)
+    assert client.put('/stream_upload/metered.bin', data=b'x' * 1000).status_code == 200
+    assert client.get('/download/metered.bin').status_code == 200
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    series = 'mkcloud_http_requests_total{route="/download/<path:filename>",method="GET",code="200"}'
+    assert _value(text, series) == _value(before, series) + 1
+    assert 'metered.bin' not in text  # Routes, not paths
+    for name in ('mkcloud_upload_bytes_total', 'mkcloud_download_bytes_total'):
+        assert _value(text, name) >= _value(before, name) + 1000
+    assert _value(text, 'mkcloud_disk_total_bytes') > 0
+
+
+def test_totals_of_exited_workers_keep_counters_but_not_gauges(app, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.app.config, 'STATE_FOLDER', str(tmp_path))
+    monkeypatch.setitem(app.app.config, 'INDEX_SHARED', True)
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    os.makedirs(app.Metrics.folder())
+    with open(os.path.join(app.Metrics.folder(), f'{exited.pid}.json'), 'w') as f:
+        json.dump({'counters': [['mkcloud_upload_bytes_total', [], 500],
+                                ['mkcloud_active_transfers', [['direction', 'upload']], 3]],
+                   'histograms': []}, f)
+    metrics = app.Metrics()
+    metrics.inc('mkcloud_upload_bytes_total', 20)
+    counters, _ = metrics.collect()
+    assert counters[('mkcloud_upload_bytes_total', ())] == 520
+    assert ('mkcloud_active_transfers', (('direction', 'upload'),)) not in counters
+    metrics.publish()
+    assert os.path.exists(os.path.join(app.Metrics.folder(), f'{os.getpid()}.json'))
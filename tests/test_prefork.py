@@ -0,0 +1,95 @@
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _worker_index(app, journal_path):
+    index = app.DirectoryIndex()
+    index.attach(app.IndexJournal(journal_path, keep_changes=3), app.app.config['UPLOAD_FOLDER'])
+    return index
+
+
+def test_workers_share_listing_and_versions(app, client, tmp_path):
+    client.get('/manifest')
+    leader = _worker_index(app, str(tmp_path / 'index.db'))
+    leader.reconcile()
+    follower = _worker_index(app, str(tmp_path / 'index.db'))
+    assert follower.version == leader.version and follower.entries == leader.entries
+    before = follower.version
+
+    assert client.put('/stream_upload/worker-shared.txt', data=b'shared').status_code == 200
+    leader.refresh('worker-shared.txt')
+    follower.sync()
+    assert follower.version == leader.version > before
+    assert follower.entries['worker-shared.txt'] == leader.entries['worker-shared.txt']
+    # A cursor handed out by one worker means the same in the other
+    assert follower.changes_since(before) == leader.changes_since(before)
+
+
+def test_follower_behind_the_pruned_journal_reloads(app, client, tmp_path):
+    client.get('/manifest')
+    leader = _worker_index(app, str(tmp_path / 'index.db'))
+    leader.reconcile()
+    follower = _worker_index(app, str(tmp_path / 'index.db'))
+    before = follower.version
+    for i in range(5):
+        assert client.put(f'/stream_upload/pruned-{i}.txt', data=b'x').status_code == 200
+        leader.refresh(f'pruned-{i}.txt')
+    leader.journal.prune()
+    follower.sync()
+    assert follower.version == leader.version
+    assert {f'pruned-{i}.txt' for i in range(5)} <= follower.entries.keys()
+    assert follower.changes_since(before) is None  # Clients that far behind get a reset
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request(method, path, body=body)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def test_prefork_workers_serve_the_same_listing(tmp_path):
+    port = _free_port()
+    env = dict(os.environ, UPLOAD_FOLDER=str(tmp_path / 'uploads'), PORT=str(port), WORKERS='2', MDNS_NAME='',
+               LOG_LEVEL='WARNING')
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], cwd=str(tmp_path), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 20
+        while True:
+            try:
+                _request(port, 'GET', '/files_json')
+                break
+            except OSError:
+                assert time.time() < deadline and server.poll() is None, 'server did not start'
+                time.sleep(0.1)
+        assert _request(port, 'PUT', '/stream_upload/prefork.txt', b'on one worker')[0] == 200
+        time.sleep(0.5)  # Several INDEX_SYNC_INTERVALs
+        # New connections land on either worker; every one lists the file under one version
+        versions = set()
+        for _ in range(20):
+            status, body = _request(port, 'GET', '/files_json?prefix=prefork')
+            page = json.loads(body)
+            assert status == 200 and [r['name'] for r in page['files']] == ['prefork.txt']
+            versions.add(page['version'])
+        assert len(versions) == 1
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(20) == 0
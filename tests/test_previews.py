@@ -0,0 +1,7 @@
+def test_text_preview_renders_outside_the_server_process(app, client):
+    assert client.put('/stream_upload/note.txt', data=b'hello\nworld\n').status_code == 200
+    response = client.get('/preview/note.txt')
+    assert response.status_code == 200
+    assert response.get_data() == b'hello\nworld\n'
+    # Never fork the (threaded) server process itself
+    assert app.preview_cache._pool._mp_context.get_start_method() in ('forkserver', 'spawn')
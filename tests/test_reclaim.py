@@ -0,0 +1,37 @@
+import os
+import time
+
+
+def wait_for_batch(client, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(f'/delete_batch/{job_id}').get_json()
+        if status['state'] == 'done':
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f'batch {job_id} did not finish: {status}')
+
+
+def test_deleting_a_deduplicated_file_leaves_the_other_intact(app, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'RECLAIM_TRUNCATE_STEP', 1000)
+    data = os.urandom(5000)
+    assert client.put('/stream_upload/reclaim-one.bin', data=data).status_code == 200
+    response = client.put('/stream_upload/reclaim-two.bin', data=data)
+    assert response.get_json()['files'][0]['deduplicated']
+
+    response = client.post('/delete_batch', json={'names': ['reclaim-one.bin']})
+    assert response.status_code == 202
+    wait_for_batch(client, response.get_json()['job_id'])
+
+    with open(app.storage.locate('reclaim-two.bin'), 'rb') as f:
+        assert f.read() == data
+    assert client.get('/download/reclaim-two.bin').data == data
+
+
+def test_large_unshared_file_is_freed_in_steps(app, client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'RECLAIM_TRUNCATE_STEP', 1000)
+    assert client.put('/stream_upload/reclaim-big.bin', data=os.urandom(5000)).status_code == 200
+    response = client.post('/delete_batch', json={'names': ['reclaim-big.bin']})
+    status = wait_for_batch(client, response.get_json()['job_id'])
+    assert status['bytes_freed'] == 5000
+    assert not os.path.exists(app.storage.locate('reclaim-big.bin'))
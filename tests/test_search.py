@@ -0,0 +1,62 @@
+import random
+import string
+
+
+def test_ranking(app):
+    search = app.NameSearch(['unreported.txt', 'Report.pdf', 'report', 'q3_report.pdf', 'xreportx.doc',
+                             'report-2024.xlsx', 'my report final.docx', 'other.txt'])
+    found, more = search.search('report', 10, 100)
+    assert not more
+    assert found == [
+        ('report', 0), ('report-2024.xlsx', 0), ('Report.pdf', 0),  # Exact and prefix, in key order
+        ('q3_report.pdf', 3), ('my report final.docx', 3),  # Word starts, shorter first
+        ('xreportx.doc', 1), ('unreported.txt', 2),  # Anywhere inside, shorter first
+    ]
+
+
+def test_short_queries_only_match_name_starts(app):
+    search = app.NameSearch(['ab.txt', 'cab.txt', 'AB-upper.txt'])
+    assert search.search('ab', 10, 100) == ([('AB-upper.txt', 0), ('ab.txt', 0)], False)
+    assert search.matching('ab') is None
+    assert search.search('', 10, 100) == ([], False)
+
+
+def test_limit_and_more(app):
+    search = app.NameSearch([f'photo-{i:03}.jpg' for i in range(50)] + [f'holiday photo {i}.jpg' for i in range(50)])
+    found, more = search.search('photo', 10, 100)
+    assert len(found) == 10 and more
+    assert [name for name, _ in found] == [f'photo-{i:03}.jpg' for i in range(10)]
+    found, more = search.search('holiday', 5, 2)
+    assert len(found) == 5 and more
+
+
+def test_index_stays_exact_through_adds_and_removes(app):
+    rng = random.Random(7)
+    alphabet = string.ascii_letters[:8] + '._-'
+    search = app.NameSearch()
+    names = set()
+    for step in range(6000):
+        if names and rng.random() < 0.45:
+            name = rng.choice(sorted(names))
+            names.discard(name)
+            search.remove(name)
+        else:
+            name = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 10)))
+            names.add(name)
+            search.add(name)
+        if step % 500 == 0 or step == 5999:
+            for text in ('abc', 'AbC', 'a.b', 'ddd', 'e-f'):
+                expected = sorted(name for name in names if text.lower() in name.lower())
+                assert sorted(search.matching(text)) == expected
+                found, _ = search.search(text, len(names) + 1, len(names) + 1)
+                assert sorted(name for name, _ in found) == expected
+    assert sorted(search.ids) == sorted(names)
+
+
+def test_search_endpoint(client):
+    assert client.put('/stream_upload/Searchable_Quarterly-Report.pdf', data=b'x').status_code == 200
+    page = client.get('/search', query_string={'q': 'quarterly'}).get_json()
+    record = next(r for r in page['files'] if r['name'] == 'Searchable_Quarterly-Report.pdf')
+    assert record['match'] == len('Searchable_') and record['size'] == 1
+    assert client.get('/search?q=quarterly&limit=lots').status_code == 400
+    assert client.get('/search').get_json()['files'] == []
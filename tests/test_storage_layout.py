@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def layout(app, monkeypatch, tmp_path):
+    """
+    A fresh StorageLayout over an empty UPLOAD_FOLDER and STATE_FOLDER of its own.
+    """
+    uploads, state = tmp_path / 'uploads', tmp_path / 'state'
+    uploads.mkdir()
+    monkeypatch.setitem(app.app.config, 'UPLOAD_FOLDER', str(uploads))
+    monkeypatch.setitem(app.app.config, 'STATE_FOLDER', str(state))
+    monkeypatch.setitem(app.app.config, 'STORAGE_SHARD_WIDTH', 2)
+    monkeypatch.setattr(app, 'LAYOUT_CHECK_INTERVAL', 0)
+    monkeypatch.setattr(app, 'blob_store', app.BlobStore())
+    storage = app.StorageLayout()
+    monkeypatch.setattr(app, 'storage', storage)
+    return storage
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_migration_moves_every_file_into_its_shard(app, layout):
+    names = [f'file-{i}.txt' for i in range(20)]
+    for name in names:
+        _write(layout.target(name), name.encode())
+    assert layout.current() == ('flat', 2, False)
+    assert app.migrate_layout(batch=7) == len(names)
+    assert layout.current() == ('sharded', 2, False)
+    for name in names:
+        path = layout.locate(name)
+        assert os.path.dirname(path) == os.path.join(app.app.config['UPLOAD_FOLDER'], layout.shard(name, 2))
+        assert _read(path) == name.encode()
+    assert list(layout.top_level_files()) == []
+    assert sorted(entry.name for entry in layout.scan()) == sorted(names)
+    assert app.migrate_layout() == 0  # Safe to re-run
+    with pytest.raises(ValueError):
+        app.migrate_layout(width=3)
+
+
+def test_files_stay_reachable_while_the_migration_is_pending(app, layout):
+    for name in ('moved.txt', 'waiting.txt', 'replaced.txt'):
+        _write(layout.target(name), b'old ' + name.encode())
+    layout.record('sharded', 2, pending=True)
+    assert layout.migrate('moved.txt')
+    # Not migrated yet: found at the top level
+    assert _read(layout.locate('waiting.txt')) == b'old waiting.txt'
+    assert _read(layout.locate('moved.txt')) == b'old moved.txt'
+    assert sorted(entry.name for entry in layout.scan()) == ['moved.txt', 'replaced.txt', 'waiting.txt']
+    # A new version goes to the shard and drops the top-level copy
+    _write(layout.target('replaced.txt'), b'new version')
+    layout.settle('replaced.txt')
+    assert _read(layout.locate('replaced.txt')) == b'new version'
+    assert not os.path.exists(os.path.join(app.app.config['UPLOAD_FOLDER'], 'replaced.txt'))
+    app.migrate_layout()
+    assert _read(layout.locate('waiting.txt')) == b'old waiting.txt'
+    assert _read(layout.locate('replaced.txt')) == b'new version'
+
+
+def test_a_file_named_like_a_shard_is_moved_out_of_the_way(app, layout):
+    occupant = layout.shard('sharded.txt', 2)  # A top-level file called like the shard folder
+    _write(layout.target(occupant), b'occupant')
+    layout.record('sharded', 2, pending=True)
+    _write(layout.target('sharded.txt'), b'first in the shard')
+    assert _read(layout.locate(occupant)) == b'occupant'
+    assert _read(layout.locate('sharded.txt')) == b'first in the shard'
+
+
+def test_recorded_layout_wins_over_the_setting(app, layout, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'STORAGE_LAYOUT', 'sharded')
+    assert layout.current() == ('sharded', 2, False)  # Empty folder: sharded right away
+    monkeypatch.setitem(app.app.config, 'STORAGE_LAYOUT', 'flat')
+    assert app.StorageLayout().current() == ('sharded', 2, False)
+
+
+def test_switching_a_populated_folder_to_sharded_leaves_it_pending(app, layout, monkeypatch):
+    _write(layout.target('existing.txt'), b'existing')
+    monkeypatch.setitem(app.app.config, 'STORAGE_LAYOUT', 'sharded')
+    fresh = app.StorageLayout()
+    assert fresh.current() == ('sharded', 2, True)
+    assert _read(fresh.locate('existing.txt')) == b'existing'
@@ -0,0 +1,144 @@
+import hashlib
+import os
+
+import pytest
+
+import sync
+
+
+class FakeManifest:
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    def json(self, method, path, body=None, expect=(200,)):
+        return self.manifest
+
+    def close(self):
+        pass
+
+
+def _client(root, files, **options):
+    client = sync.SyncClient('http://127.0.0.1:1', str(root), **options)
+    client.http = FakeManifest({'complete': True, 'version': 1, 'removed': [], 'files': [
+        {'name': name, 'size': 1, 'mtime': 0, 'sha256': '0' * 64} for name in files]})
+    return client
+
+
+@pytest.mark.parametrize('name', ['../outside.txt', 'sub/inside.txt', '..', '.hidden', 'a b.txt'])
+def test_unsafe_manifest_names_are_never_written(tmp_path, name, capsys):
+    root = tmp_path / 'folder'
+    root.mkdir()
+    (root / 'local.txt').write_bytes(b'keep')
+    client = _client(root, [name, 'local.txt'], delete=True)
+    try:
+        client.refresh_manifest()
+        assert list(client.remote) == ['local.txt']
+        assert 'ignoring' in capsys.readouterr().err
+        with pytest.raises(sync.SyncError):
+            client.download(name)
+    finally:
+        client.close()
+    assert sorted(os.listdir(tmp_path)) == ['folder']
+    assert (root / 'local.txt').read_bytes() == b'keep'
+
+
+def test_scan_tree_folds_folders_into_names(tmp_path):
+    (tmp_path / 'photos' / '2024').mkdir(parents=True)
+    (tmp_path / 'photos' / '2024' / 'beach.jpg').write_bytes(b'jpg')
+    (tmp_path / 'photos_2024_beach.jpg').write_bytes(b'clash')
+    (tmp_path / 'notes.txt').write_bytes(b'notes')
+    (tmp_path / sync.STATE_NAME).write_text('{}')
+    (tmp_path / f'half.bin{sync.TEMP_SUFFIX}').write_bytes(b'x')
+    files, collisions = sync.scan_tree(str(tmp_path))
+    assert sorted(files) == ['notes.txt', 'photos_2024_beach.jpg']
+    assert len(collisions) == 1  # Whichever of the two clashing paths came second
+    assert sorted(sync.scan_tree(str(tmp_path), recursive=False)[0]) == ['notes.txt', 'photos_2024_beach.jpg']
+    assert sync.scan_tree(str(tmp_path), recursive=False)[0]['notes.txt'][:2] == ('notes.txt', 5)
+
+
+def _local(root, name, data, mtime):
+    path = root / name
+    path.write_bytes(data)
+    os.utime(path, (mtime, mtime))
+    st = path.stat()
+    return name, (name, st.st_size, st.st_mtime_ns)
+
+
+def test_plans_compare_hashes_then_sizes_then_times(tmp_path):
+    client = _client(tmp_path, [], delete=True)
+    try:
+        local = dict([
+            _local(tmp_path, 'same.txt', b'same', 1000),
+            _local(tmp_path, 'edited.txt', b'edit', 1000),
+            _local(tmp_path, 'resized.txt', b'longer now', 1000),
+            _local(tmp_path, 'newer.txt', b'abcd', 2000),
+            _local(tmp_path, 'older.txt', b'abcd', 500),
+            _local(tmp_path, 'local-only.txt', b'new', 1000),
+        ])
+        sha = {name: hashlib.sha256(data).hexdigest() for name, data in [('same.txt', b'same'),
+                                                                          ('edited.txt', b'EDIT')]}
+        client.remote = {name: {'name': name, 'size': size, 'mtime': 1000.0, 'sha256': sha.get(name)}
+                         for name, size in [('same.txt', 4), ('edited.txt', 4), ('resized.txt', 4),
+                                            ('newer.txt', 4), ('older.txt', 4), ('remote-only.txt', 9)]}
+        uploads, deletes = client.plan_push(local)
+        assert sorted(uploads) == ['edited.txt', 'local-only.txt', 'newer.txt', 'resized.txt']
+        assert deletes == ['remote-only.txt']
+        downloads, deletes = client.plan_pull(local)
+        assert sorted(downloads) == ['edited.txt', 'older.txt', 'remote-only.txt', 'resized.txt']
+        assert deletes == ['local-only.txt']
+        client.delete = False
+        assert client.plan_push(local)[1] == [] and client.plan_pull(local)[1] == []
+    finally:
+        client.close()
+
+
+def test_manifest_since_returns_only_the_changes(client):
+    assert client.put('/stream_upload/manifest-kept.txt', data=b'kept').status_code == 200
+    assert client.put('/stream_upload/manifest-gone.txt', data=b'gone').status_code == 200
+    full = client.get('/manifest').get_json()
+    assert full['complete'] and full['removed'] == []
+    record = next(r for r in full['files'] if r['name'] == 'manifest-kept.txt')
+    assert record['size'] == 4 and record['sha256'] == hashlib.sha256(b'kept').hexdigest()
+
+    assert client.put('/stream_upload/manifest-new.txt', data=b'new').status_code == 200
+    assert client.post('/delete/manifest-gone.txt').status_code == 302
+    changes = client.get(f"/manifest?since={full['version']}").get_json()
+    assert not changes['complete'] and changes['version'] > full['version']
+    assert [r['name'] for r in changes['files']] == ['manifest-new.txt']
+    assert changes['removed'] == ['manifest-gone.txt']
+    assert client.get(f"/manifest?since={changes['version']}").get_json()['files'] == []
+    assert client.get('/manifest?since=latest').status_code == 400
+    assert client.get(f"/manifest?since={changes['version'] + 1000}").get_json()['complete']
+
+
+def test_push_and_pull_against_the_server(client, serve, tmp_path):
+    port, _ = serve()
+    url = f'http://127.0.0.1:{port}'
+    source = tmp_path / 'source'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'synced-a.txt').write_bytes(b'a' * 100)
+    (source / 'sub' / 'synced-b.bin').write_bytes(os.urandom(300 * 1024))
+    pusher = sync.SyncClient(url, str(source))
+    try:
+        stats = pusher.push()
+        assert (stats['files'], stats['errors']) == (2, 0)
+        assert client.get('/download/sub_synced-b.bin').data == (source / 'sub' / 'synced-b.bin').read_bytes()
+        assert pusher.push()['planned'] == 0  # Nothing changed
+        (source / 'synced-a.txt').write_bytes(b'b' * 100)
+        assert pusher.push()['planned'] == 1
+    finally:
+        pusher.close()
+
+    target = tmp_path / 'target'
+    target.mkdir()
+    (target / 'stale.txt').write_bytes(b'not on the server')
+    puller = sync.SyncClient(url, str(target), delete=True)
+    try:
+        stats = puller.pull()
+        assert stats['errors'] == 0 and stats['deleted'] == 1
+        assert (target / 'synced-a.txt').read_bytes() == b'b' * 100
+        assert (target / 'sub_synced-b.bin').read_bytes() == (source / 'sub' / 'synced-b.bin').read_bytes()
+        assert not (target / 'stale.txt').exists()
+        assert puller.pull()['planned'] == 0
+    finally:
+        puller.close()
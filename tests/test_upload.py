@@ -0,0 +1,72 @@
+import hashlib
+import io
+import os
+
+
+def _files(*names):
+    return {'file': [(io.BytesIO(b'content'), name) for name in names]}
+
+
+def test_upload_of_only_rejected_files_is_a_client_error(client):
+    response = client.post('/', data=_files('...', 'twice.txt', 'twice.txt'))
+    assert response.status_code == 200  # twice.txt was saved once
+    response = client.post('/', data=_files('...', '///'), content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert [r['error'] for r in response.get_json()['files']] == ['Invalid filename.'] * 2
+
+
+def test_upload_that_fails_to_write_is_a_server_error(app, client, monkeypatch):
+    monkeypatch.setattr(app, 'save_file_storage', lambda f, name: {'filename': name, 'error': 'Server error.'})
+    response = client.post('/', data=_files('...', 'written.txt'), content_type='multipart/form-data')
+    assert response.status_code == 500
+
+
+def _multipart(parts, boundary='mkcloud-test-boundary', end=True):
+    body = b''
+    for name, filename, content in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename is not None else '')
+        body += f'--{boundary}\r\nContent-Disposition: {disposition}\r\n\r\n'.encode() + content + b'\r\n'
+    if end:
+        body += f'--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def test_streaming_multipart_upload_writes_every_file_part(app, client):
+    first, second = os.urandom(300 * 1024), b'second file'
+    body, content_type = _multipart([('file', 'first.bin', first), ('note', None, b'ignored field'),
+                                     ('file', '../second.txt', second), ('file', '', b'no name')])
+    response = client.post('/stream_upload', data=body, content_type=content_type)
+    assert response.status_code == 200
+    summary = response.get_json()
+    assert [(r['filename'], r.get('bytes')) for r in summary['files']] == [
+        ('first.bin', len(first)), ('second.txt', len(second)), ('', None)]
+    assert summary['files'][0]['sha256'] == hashlib.sha256(first).hexdigest()
+    assert summary['bytes'] == len(first) + len(second)
+    assert client.get('/download/first.bin').data == first
+    assert client.get('/download/second.txt').data == second
+
+
+def test_truncated_multipart_upload_keeps_no_partial_file(app, client):
+    body, content_type = _multipart([('file', 'complete.txt', b'all here'), ('file', 'cut.bin', b'x' * 1000)],
+                                    end=False)
+    response = client.post('/stream_upload', data=body[:-200], content_type=content_type)
+    assert response.status_code == 400
+    summary = response.get_json()
+    assert summary['error'] and [r['filename'] for r in summary['files']] == ['complete.txt']
+    assert client.get('/download/complete.txt').data == b'all here'
+    assert client.get('/download/cut.bin').status_code == 404
+
+
+def test_streaming_upload_needs_a_multipart_body(client):
+    assert client.post('/stream_upload', data=b'raw', content_type='application/octet-stream').status_code == 400
+
+
+def test_raw_streaming_upload_replaces_the_file(app, client):
+    assert client.put('/stream_upload/raw.bin', data=b'old version').status_code == 200
+    data = os.urandom(2 * 1024 * 1024 + 5)
+    response = client.put('/stream_upload/raw.bin', data=data)
+    assert response.status_code == 200
+    assert response.get_json()['files'][0]['bytes'] == len(data)
+    with open(app.storage.locate('raw.bin'), 'rb') as f:
+        assert f.read() == data
+    assert client.put('/stream_upload/...', data=b'x').status_code == 400